@@ -0,0 +1,87 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2020, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+# 		   http://ilastik.org/license/
+###############################################################################
+"""
+Compares the block codecs of the compressed caches (see lazyflow.utility.compressedBlockStore)
+for user labels: memory per stored label block, and the latency of painting a brush stroke
+and of reading a viewer tile.
+"""
+
+import numpy as np
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators.opCompressedUserLabelArray import OpCompressedUserLabelArray
+from lazyflow.utility import Timer, compressedBlockStore
+
+SHAPE = (1, 512, 512, 64, 1)
+BLOCKSHAPE = (1, 64, 64, 64, 1)
+NUM_STROKES = 200
+BRUSH = 5
+
+
+def create_label_array(codec):
+    op = OpCompressedUserLabelArray(graph=Graph(), codec=codec)
+    op.shape.setValue(SHAPE)
+    op.blockShape.setValue(BLOCKSHAPE)
+    op.eraser.setValue(255)
+    op.Input.setValue(vigra.VigraArray(SHAPE, axistags=vigra.defaultAxistags("txyzc"), dtype=np.uint8))
+    return op
+
+
+def paint(op, rng):
+    """Paint short brush strokes in random z-slices, like a user does."""
+    with Timer() as timer:
+        for _ in range(NUM_STROKES):
+            x, y = rng.randint(0, SHAPE[1] - 40), rng.randint(0, SHAPE[2] - BRUSH)
+            z = rng.randint(0, SHAPE[3])
+            stroke = np.zeros((1, 40, BRUSH, 1, 1), dtype=np.uint8)
+            stroke[:] = rng.randint(1, 4)
+            op.Input[0:1, x : x + 40, y : y + BRUSH, z : z + 1, 0:1] = stroke
+    return timer.seconds() / NUM_STROKES
+
+
+def read_tiles(op, rng):
+    """Read 256x256 tiles in random z-slices, like the viewer does."""
+    with Timer() as timer:
+        for _ in range(NUM_STROKES):
+            x, y = rng.randint(0, SHAPE[1] - 256), rng.randint(0, SHAPE[2] - 256)
+            z = rng.randint(0, SHAPE[3])
+            op.Output[0:1, x : x + 256, y : y + 256, z : z + 1, 0:1].wait()
+    return timer.seconds() / NUM_STROKES
+
+
+def run():
+    for codec in compressedBlockStore.available_codecs():
+        op = create_label_array(codec)
+        paint_latency = paint(op, np.random.RandomState(0))
+        read_latency = read_tiles(op, np.random.RandomState(1))
+        num_blocks = len(op._blocks)
+        print(
+            "{:>14}: {:8.0f} bytes per label block, {:6.2f} ms per stroke, {:6.2f} ms per tile".format(
+                codec, op.usedMemory() / max(1, num_blocks), paint_latency * 1e3, read_latency * 1e3
+            )
+        )
+        op.cleanUp()
+
+
+if __name__ == "__main__":
+    run()
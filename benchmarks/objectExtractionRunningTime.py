@@ -33,7 +33,8 @@ from lazyflow.request import Request, RequestPool
 
 from functools import partial
 
-from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction
+from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction, OpRegionFeatures
+from ilastik.plugins import pluginManager
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 
 import warnings
@@ -286,8 +287,66 @@ class ObjectExtractionTimeComparison(object):
             result[i] = cleanup(res, nobj, features)
 
 
+# Local (neighborhood) features: per-object loop vs. batched computation
+class LocalFeaturesTimeComparison(object):
+    LOCAL_FEATURES = {
+        NAME: {
+            "Count": {},
+            "Mean in neighborhood": {"margin": (5, 5, 1)},
+            "Sum in neighborhood": {"margin": (5, 5, 1)},
+        }
+    }
+
+    def _images(self, numObjects):
+        # a grid of small objects, numObjects in total
+        side = int(np.ceil(np.sqrt(numObjects)))
+        binary = np.zeros((1, side * 8, side * 8, 1, 1), dtype=np.uint8)
+        for i in range(numObjects):
+            x, y = 8 * (i // side), 8 * (i % side)
+            binary[0, x : x + 3, y : y + 3, 0, 0] = 1
+        raw = np.random.random(binary.shape).astype(np.float32)
+        axistags = vigra.defaultAxistags("txyzc")
+        return vigra.taggedView(raw, axistags), vigra.taggedView(binary, axistags)
+
+    def _time(self, raw, binary):
+        g = Graph()
+        opLabel = OpLabelVolume(graph=g)
+        opLabel.Input.setValue(binary)
+        opRegionFeatures = OpRegionFeatures(graph=g)
+        opRegionFeatures.RawVolume.setValue(raw)
+        opRegionFeatures.LabelVolume.connect(opLabel.Output)
+        opRegionFeatures.Features.setValue(self.LOCAL_FEATURES)
+        opLabel.Output[:].wait()
+
+        with Timer() as timer:
+            opRegionFeatures.Output[0:1].wait()
+        return timer.seconds()
+
+    def run(self, objectCounts=(100, 1000, 10000, 50000)):
+        print("\nStarting local feature computation (per object vs. batched)")
+        plugin = pluginManager.getPluginByName(NAME, "ObjectFeatures").plugin_object
+        for numObjects in objectCounts:
+            raw, binary = self._images(numObjects)
+
+            batched = self._time(raw, binary)
+            plugin.compute_local_batch = lambda *args: None
+            try:
+                per_object = self._time(raw, binary)
+            finally:
+                del plugin.compute_local_batch
+
+            print(
+                "{:>6} objects: per object {:.2f} secs, batched {:.2f} secs ({:.1f}x)".format(
+                    numObjects, per_object, batched, per_object / batched
+                )
+            )
+
+
 if __name__ == "__main__":
 
     # Run object extraction comparison
     objectExtractionTimeComparison = ObjectExtractionTimeComparison()
     objectExtractionTimeComparison.run()
+
+    # Run local feature comparison
+    LocalFeaturesTimeComparison().run()
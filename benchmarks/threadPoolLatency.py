@@ -0,0 +1,86 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2020, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+# 		   http://ilastik.org/license/
+###############################################################################
+"""
+Measures the latency of interactive tasks (e.g. viewer tiles) while the thread pool is saturated
+with batch tasks (e.g. an export).
+
+Without priority classes, an interactive task waits behind the batch tasks that were queued before it.
+With priority classes, it only waits for a worker to finish its current task.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+from lazyflow.request.threadPool import PriorityClass, ThreadPool
+
+NUM_WORKERS = 8
+BATCH_QUEUE_DEPTH = 200
+NUM_INTERACTIVE_TASKS = 100
+TASK_SECONDS = 0.005
+
+
+class Task:
+    def __init__(self, priority_class, latencies=None):
+        self.priority_class = priority_class
+        self.assigned_worker = None
+        self.latencies = latencies
+        self.submitted = time.perf_counter()
+        self.finished = threading.Event()
+
+    def __call__(self):
+        if self.latencies is not None:
+            self.latencies.append(time.perf_counter() - self.submitted)
+        # Simulates work that releases the GIL (e.g. a vigra filter)
+        time.sleep(TASK_SECONDS)
+        self.finished.set()
+
+
+def run(use_priority_classes):
+    pool = ThreadPool(NUM_WORKERS)
+    batch_class = PriorityClass.BATCH if use_priority_classes else PriorityClass.INTERACTIVE
+
+    latencies = []
+    for _ in range(NUM_INTERACTIVE_TASKS):
+        # Keep the pool saturated with batch work
+        queued = sum(pool.get_queue_depths().values())
+        for _ in range(BATCH_QUEUE_DEPTH - queued):
+            pool.wake_up(Task(batch_class))
+
+        task = Task(PriorityClass.INTERACTIVE, latencies)
+        pool.wake_up(task)
+        task.finished.wait()
+        time.sleep(TASK_SECONDS)
+
+    pool.stop()
+    return np.array(latencies)
+
+
+if __name__ == "__main__":
+    for use_priority_classes in (False, True):
+        latencies = 1000 * run(use_priority_classes)
+        print(
+            "priority classes {:>3}: interactive latency p50 {:7.1f} ms, p95 {:7.1f} ms, p99 {:7.1f} ms".format(
+                "on" if use_priority_classes else "off", *np.percentile(latencies, [50, 95, 99])
+            )
+        )
@@ -0,0 +1,83 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+# 		   http://ilastik.org/license/
+###############################################################################
+"""
+Measures the cache-hit latency of OpUnblockedArrayCache as the number of stored blocks grows.
+With the spatial block index, the hit latency should stay flat from 100 to 100k blocks.
+"""
+
+import numpy as np
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators.opUnblockedArrayCache import OpUnblockedArrayCache
+from lazyflow.operators.opArrayPiper import OpArrayPiper
+from lazyflow.utility import Timer
+
+TILE = 16
+NUM_HITS = 2000
+
+
+def fill_cache(op_cache, num_blocks, shape):
+    """Store num_blocks tiles directly via setInSlot so no upstream computation is timed."""
+    tile = np.zeros((1, TILE, TILE), dtype=np.uint8)
+    tiles_per_row = shape[2] // TILE
+    tiles_per_slice = tiles_per_row * (shape[1] // TILE)
+    for i in range(num_blocks):
+        z, rest = divmod(i, tiles_per_slice)
+        y, x = divmod(rest, tiles_per_row)
+        op_cache.Input[z : z + 1, y * TILE : (y + 1) * TILE, x * TILE : (x + 1) * TILE] = tile
+
+
+def time_hits(op_cache, num_blocks, shape):
+    rng = np.random.RandomState(0)
+    tiles_per_row = shape[2] // TILE
+    tiles_per_slice = tiles_per_row * (shape[1] // TILE)
+    block_ids = rng.randint(0, num_blocks, size=NUM_HITS)
+    with Timer() as timer:
+        for i in block_ids:
+            z, rest = divmod(int(i), tiles_per_slice)
+            y, x = divmod(rest, tiles_per_row)
+            # Request an inner sub-roi so the containment lookup (not just the exact-key lookup) is exercised.
+            op_cache.Output((z, y * TILE + 1, x * TILE + 1), (z + 1, (y + 1) * TILE - 1, (x + 1) * TILE - 1)).wait()
+    return timer.seconds() / NUM_HITS
+
+
+def run():
+    for num_blocks in (100, 1000, 10000, 100000):
+        num_slices = num_blocks // (64 * 64) + 1
+        shape = (num_slices, 64 * TILE, 64 * TILE)
+
+        graph = Graph()
+        op_provider = OpArrayPiper(graph=graph)
+        op_provider.Input.meta.axistags = vigra.defaultAxistags("zyx")
+        op_provider.Input.setValue(np.zeros(shape, dtype=np.uint8))
+        op_cache = OpUnblockedArrayCache(graph=graph)
+        op_cache.Input.connect(op_provider.Output)
+
+        fill_cache(op_cache, num_blocks, shape)
+        latency = time_hits(op_cache, num_blocks, shape)
+        print("{:>7d} blocks: {:8.1f} us per cache hit".format(num_blocks, latency * 1e6))
+        op_cache.cleanUp()
+
+
+if __name__ == "__main__":
+    run()
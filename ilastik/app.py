@@ -63,6 +63,11 @@ def _argparser() -> argparse.ArgumentParser:
         "--exit_on_failure", help="Immediately call exit(1) if an unhandled exception occurs.", action="store_true"
     )
     ap.add_argument("--hbp", help="Enable HBP-specific functionality.", action="store_true")
+    ap.add_argument(
+        "--profile_requests",
+        help="Record all lazyflow requests and write them as a Chrome trace "
+        "(plus a table of the time spent per operator) to the given file at exit.",
+    )
     return ap
 
 
@@ -298,11 +303,25 @@ def _prepare_lazyflow_config(parsed_args):
     n_threads = os.getenv("LAZYFLOW_THREADS", None)
     total_ram_mb = os.getenv("LAZYFLOW_TOTAL_RAM_MB", None)
     status_interval_secs = int(os.getenv("LAZYFLOW_STATUS_MONITOR_SECONDS", "0"))
+    spill_dir = os.getenv("LAZYFLOW_SPILL_DIR", None)
+    spill_mb = os.getenv("LAZYFLOW_SPILL_MB", None)
+    cache_codec = os.getenv("LAZYFLOW_CACHE_CODEC", None)
+    # (LAZYFLOW_MULTIPROCESS_HDF5 is read by lazyflow itself)
+    multiprocess_hdf5_readers = None
+    if "LAZYFLOW_MULTIPROCESS_HDF5" not in os.environ:
+        multiprocess_hdf5_readers = ilastik_config.getint("lazyflow", "multiprocess_hdf5_readers")
+    adaptive_export_batching = ilastik_config.getboolean("lazyflow", "adaptive_export_batching")
+    parallel_page_reads = ilastik_config.getboolean("lazyflow", "parallel_page_reads")
+    incremental_training = ilastik_config.getboolean("lazyflow", "incremental_training")
+    incremental_smoothing = ilastik_config.getboolean("lazyflow", "incremental_smoothing")
+    # (LAZYFLOW_PROFILE is read by lazyflow itself, too)
+    profile_path = parsed_args.profile_requests
 
     # Convert str -> int
     if n_threads is not None:
         n_threads = int(n_threads)
     total_ram_mb = total_ram_mb and int(total_ram_mb)
+    spill_mb = spill_mb and int(spill_mb)
 
     # If not in env, check config file.
     if n_threads is None:
@@ -310,15 +329,35 @@ def _prepare_lazyflow_config(parsed_args):
         if n_threads == -1:
             n_threads = None
     total_ram_mb = total_ram_mb or ilastik_config.getint("lazyflow", "total_ram_mb")
+    spill_mb = spill_mb or ilastik_config.getint("lazyflow", "spill_mb")
+    spill_dir = spill_dir or ilastik_config.get("lazyflow", "spill_dir") or None
+    cache_codec = cache_codec or ilastik_config.get("lazyflow", "cache_codec") or None
+    blosc_release_gil = ilastik_config.getboolean("lazyflow", "blosc_release_gil")
 
     # Note that n_threads == 0 is valid and useful for debugging.
-    if (n_threads is not None) or total_ram_mb or status_interval_secs:
+    if (
+        (n_threads is not None)
+        or total_ram_mb
+        or status_interval_secs
+        or spill_mb
+        or cache_codec
+        or blosc_release_gil
+        or multiprocess_hdf5_readers
+        or profile_path
+        or not adaptive_export_batching
+        or parallel_page_reads
+        or incremental_training
+        or incremental_smoothing
+    ):
 
         def _configure_lazyflow_settings():
             import lazyflow
             import lazyflow.request
-            from lazyflow.utility import Memory
-            from lazyflow.operators import cacheMemoryManager
+            from lazyflow.utility import Memory, spillStore, compressedBlockStore
+            from lazyflow.utility import adaptiveRequestController, pageCache, requestProfiler
+            from lazyflow.utility.io_util import multiprocessHdf5File
+            from lazyflow.classifiers import lazyflowClassifier
+            from lazyflow.operators import cacheMemoryManager, opPixelFeaturesPresmoothed
 
             if status_interval_secs:
                 memory_logger = logging.getLogger("lazyflow.operators.cacheMemoryManager")
@@ -339,6 +378,26 @@ def _prepare_lazyflow_config(parsed_args):
                 fmt = Memory.format(ram)
                 logger.info("Configuring lazyflow RAM limit to {}".format(fmt))
                 Memory.setAvailableRam(ram)
+            if spill_mb > 0:
+                spillStore.configure(spill_dir, spill_mb * 1024 ** 2)
+            if cache_codec or blosc_release_gil:
+                compressedBlockStore.configure(cache_codec, release_gil=blosc_release_gil)
+            if multiprocess_hdf5_readers:
+                if multiprocess_hdf5_readers == -1:
+                    multiprocessHdf5File.configure()
+                else:
+                    multiprocessHdf5File.configure(multiprocess_hdf5_readers)
+            if not adaptive_export_batching:
+                adaptiveRequestController.configure(adaptive_exports=False)
+            if parallel_page_reads:
+                pageCache.configure(parallel_reads=True)
+            if incremental_training:
+                lazyflowClassifier.configure(incremental_training=True)
+            if incremental_smoothing:
+                opPixelFeaturesPresmoothed.configure(incremental_smoothing=True)
+            if profile_path and not requestProfiler.is_running():
+                logger.info(f"Profiling lazyflow requests to {profile_path}")
+                requestProfiler.start(profile_path)
 
         return _configure_lazyflow_settings
     return None
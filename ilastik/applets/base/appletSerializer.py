@@ -35,10 +35,13 @@ from lazyflow.utility.orderedSignal import OrderedSignal
 from ilastik.utility.maybe import maybe
 from ilastik.utility.commandLineProcessing import convertStringToList
 from ilastik import Project
+import collections
 import os
 import sys
 import re
 import tempfile
+import threading
+import uuid
 import h5py
 import numpy
 import warnings
@@ -399,7 +402,19 @@ class SerialListSlot(SerialSlot):
 
 
 class SerialBlockSlot(SerialSlot):
-    """A slot which only saves nonzero blocks."""
+    """A slot which only saves nonzero blocks.
+
+    Each block is stored under a name derived from its roi. When the slot's group was written (or loaded)
+    by this serializer, saving only (re)writes the blocks that were made dirty since then, and deletes
+    the blocks that became empty. Otherwise (e.g. if the slot was dirtied without a roi), the whole group
+    is rewritten.
+    """
+
+    # Group attribute that identifies the saved state (see _savedSequence())
+    SAVE_TOKEN_ATTR = "saveToken"
+
+    # Number of saved states to remember (e.g. the project file and a snapshot)
+    MAX_SAVED_STATES = 4
 
     def __init__(
         self,
@@ -421,93 +436,208 @@ class SerialBlockSlot(SerialSlot):
 
         """
         assert isinstance(slot, OutputSlot), "slot is of wrong type: '{}' is not an OutputSlot".format(slot.name)
+        # Dirty rois of each subslot: {subslot: {(start, stop): sequence number}}
+        # (The key None means that the whole subslot is dirty.)
+        self._dirty_lock = threading.Lock()
+        self._dirty_rois = collections.defaultdict(dict)
+        self._sequence = 0
+        # The states that were saved: {save token: sequence number}
+        self._saved_states = collections.OrderedDict()
+
         super().__init__(slot, inslot, name, subname, default, depends, selfdepends)
         self.blockslot = blockslot
-        self._bind(slot)
         self._shrink_to_bb = shrink_to_bb
         self.compression_level = compression_level
 
-    def shouldSerialize(self, group):
-        # Should this be a docstring?
-        #
-        # Must be overloaded as SerialBlockSlot does not serialize itself in the simple way that other SerialSlot do
-        # as a consequence of the nesting of groups required. Follows the same logic as _serialize and checks to see
-        # if each relevant subgroup has been created and if any are missing or their data is missing it should be
-        # serialized. Otherwise, if everything is intact, it doesn't suggest serialization unless the state has changed.
+    @property
+    def dirty(self):
+        return self._dirty
+
+    @dirty.setter
+    def dirty(self, isDirty):
+        if isDirty and not self.ignoreDirty:
+            # We don't know what changed: Nothing that was saved can be kept.
+            with self._dirty_lock:
+                self._saved_states.clear()
+        SerialSlot.dirty.fset(self, isDirty)
+
+    def _bind(self, slot=None):
+        slot = maybe(slot, self.slot)
+
+        def doMulti(slot, index, size):
+            slot[index].notifyDirty(self._recordDirtyRoi)
+            slot[index].notifyValueChanged(self.setDirty)
 
-        logger.debug("Checking whether to serialize BlockSlot: {}".format(self.name))
+        if slot.level == 0:
+            slot.notifyDirty(self._recordDirtyRoi)
+            slot.notifyValueChanged(self.setDirty)
+        else:
+            slot.notifyInserted(doMulti)
+            slot.notifyRemoved(self.setDirty)
+
+    def _recordDirtyRoi(self, slot, roi, **kwargs):
+        if self.ignoreDirty:
+            return
+        try:
+            key = (tuple(map(int, roi.start)), tuple(map(int, roi.stop)))
+        except (AttributeError, TypeError):
+            key = None
+        with self._dirty_lock:
+            self._sequence += 1
+            self._dirty_rois[slot][key] = self._sequence
+        self._dirty = True
+
+    def _savedSequence(self, mygroup):
+        """
+        Return the sequence number of the state that was saved to (or loaded from) the given group,
+        or None if we don't know what it contains.
+        """
+        token = mygroup.attrs.get(self.SAVE_TOKEN_ATTR)
+        if isinstance(token, bytes):
+            token = token.decode("utf-8")
+        with self._dirty_lock:
+            return self._saved_states.get(token)
+
+    def _rememberSavedState(self, mygroup, sequence, token=None):
+        if token is None:
+            token = uuid.uuid4().hex
+            mygroup.attrs[self.SAVE_TOKEN_ATTR] = token
+        with self._dirty_lock:
+            self._saved_states[token] = sequence
+            self._saved_states.move_to_end(token)
+            while len(self._saved_states) > self.MAX_SAVED_STATES:
+                self._saved_states.popitem(last=False)
+
+            # Forget the dirty rois that are older than all saved states.
+            oldest = min(self._saved_states.values())
+            for subslot, rois in list(self._dirty_rois.items()):
+                for key, roi_sequence in list(rois.items()):
+                    if roi_sequence <= oldest:
+                        del rois[key]
+                if not rois:
+                    del self._dirty_rois[subslot]
+
+    def _dirtyRoisSince(self, subslot, sequence):
+        """
+        Return the (starts, stops) of the rois of subslot that were made dirty after the given sequence number,
+        or None if the whole subslot is dirty.
+        """
+        with self._dirty_lock:
+            keys = [key for key, roi_sequence in self._dirty_rois.get(subslot, {}).items() if roi_sequence > sequence]
+        if None in keys:
+            return None
+        ndim = len(subslot.meta.shape)
+        starts = numpy.array([start for start, _ in keys], dtype=numpy.int64).reshape(-1, ndim)
+        stops = numpy.array([stop for _, stop in keys], dtype=numpy.int64).reshape(-1, ndim)
+        return starts, stops
+
+    def _nonzeroBlocks(self, index):
+        """
+        Return the nonzero blocks of the given subslot as {block name: (start, stop)}
+        """
+        shape = self.slot[index].meta.shape
+        blocks = {}
+        for slicing in self.blockslot[index].value:
+            if isinstance(slicing[0], slice):
+                start, stop = sliceToRoi(slicing, shape)
+            else:
+                start, stop = slicing
+            start, stop = tuple(map(int, start)), tuple(map(int, stop))
+            blocks["block_" + "_".join("{}-{}".format(*bounds) for bounds in zip(start, stop))] = (start, stop)
+        return blocks
 
+    def shouldSerialize(self, group):
+        # Must be overloaded as SerialBlockSlot does not serialize itself in the simple way that other SerialSlot do
+        # as a consequence of the nesting of groups required. Checks whether each subgroup exists and contains the
+        # right number of blocks. Otherwise, if everything is intact, it doesn't suggest serialization unless the
+        # state has changed.
         if self.dirty:
-            logger.debug('BlockSlot "' + self.name + '" appears to be dirty. Should serialize.')
+            logger.debug("BlockSlot %s is dirty. Should serialize.", self.name)
             return True
 
-        # SerialSlot interchanges self.name and name when they frequently are the same thing. It is not clear if using
-        # self.name would be acceptable here or whether name should be an input to shouldSerialize or if there should be
-        # a _shouldSerialize method, which takes the name.
         if self.name not in group:
-            logger.debug(
-                'Missing "'
-                + self.name
-                + '" in group "'
-                + repr(group)
-                + '" belonging to BlockSlot "'
-                + self.name
-                + '". Should serialize.'
-            )
+            logger.debug("Missing %s in group %r. Should serialize.", self.name, group)
             return True
-        else:
-            logger.debug(
-                'Found "' + self.name + '" in group "' + repr(group) + '" belonging to BlockSlot "' + self.name + '".'
-            )
 
-        # Just because the group was serialized doesn't mean that the relevant data was.
         mygroup = group[self.name]
-        num = len(self.blockslot)
-        for index in range(num):
-            subname = self.subname.format(index)
+        saved_sequence = self._savedSequence(mygroup)
+        if saved_sequence is not None and saved_sequence < self._sequence:
+            # Changed since the group was saved (e.g. if this serializer saved a snapshot to another file since).
+            logger.debug("Group %r of BlockSlot %s is outdated. Should serialize.", mygroup, self.name)
+            return True
 
-            # Check to se if each subname has been created as a group
-            if subname not in mygroup:
-                logger.debug(
-                    'Missing "'
-                    + subname
-                    + '" from "'
-                    + repr(mygroup)
-                    + '" belonging to BlockSlot "'
-                    + self.name
-                    + '". Should serialize.'
-                )
+        # Just because the group was serialized doesn't mean that the relevant data was.
+        for index in range(len(self.blockslot)):
+            subname = self.subname.format(index)
+            if subname not in mygroup or len(mygroup[subname]) != len(self.blockslot[index].value):
+                logger.debug("Missing blocks in %s of BlockSlot %s. Should serialize.", subname, self.name)
                 return True
-            else:
-                logger.debug(
-                    'Found "' + subname + '" from "' + repr(mygroup) + '" belonging to BlockSlot "' + self.name + '".'
-                )
 
-            subgroup = mygroup[subname]
+        logger.debug("Everything belonging to BlockSlot %s appears to be in order. Should not serialize.", self.name)
+        return False
 
-            nonZeroBlocks = self.blockslot[index].value
-            for blockIndex in range(len(nonZeroBlocks)):
-                blockName = "block{:04d}".format(blockIndex)
+    def serialize(self, group):
+        if not self.shouldSerialize(group):
+            return
+        with self._dirty_lock:
+            sequence = self._sequence
 
-                if blockName not in subgroup:
-                    logger.debug('Missing "' + blockName + '" from "' + repr(subgroup) + '". Should serialize.')
-                    return True
-                else:
-                    logger.debug(
-                        'Found "'
-                        + blockName
-                        + '" from "'
-                        + repr(subgroup)
-                        + '" belonging to BlockSlot "'
-                        + self.name
-                        + '".'
-                    )
+        if self.slot.ready() and self._canUpdateInPlace(group):
+            self._updateInPlace(group[self.name])
+        else:
+            deleteIfPresent(group, self.name)
+            if self.slot.ready():
+                self._serialize(group, self.name, self.slot)
 
-        logger.debug(
-            'Everything belonging to BlockSlot "' + self.name + '" appears to be in order. Should not serialize.'
+        if self.name in group:
+            self._rememberSavedState(group[self.name], sequence)
+        self.dirty = False
+
+    def deserialize(self, group):
+        super().deserialize(group)
+        if self.name in group:
+            token = group[self.name].attrs.get(self.SAVE_TOKEN_ATTR)
+            if token is not None:
+                if isinstance(token, bytes):
+                    token = token.decode("utf-8")
+                # The group contains exactly what was just loaded.
+                with self._dirty_lock:
+                    sequence = self._sequence
+                self._rememberSavedState(group[self.name], sequence, token)
+
+    def _canUpdateInPlace(self, group):
+        if type(self)._serialize is not SerialBlockSlot._serialize or self.name not in group:
+            # (Subclasses that save differently always rewrite everything.)
+            return False
+        mygroup = group[self.name]
+        return (
+            self._savedSequence(mygroup) is not None
+            and len(mygroup) == len(self.blockslot)
+            and all(self.subname.format(index) in mygroup for index in range(len(self.blockslot)))
         )
 
-        return False
+    @timeLogged(logger, logging.DEBUG)
+    def _updateInPlace(self, mygroup):
+        """
+        Rewrite only the blocks that were made dirty since mygroup was saved, and delete the blocks that are gone.
+        """
+        logger.debug("Updating BlockSlot: {}".format(self.name))
+        saved_sequence = self._savedSequence(mygroup)
+        for index in range(len(self.blockslot)):
+            subgroup = mygroup[self.subname.format(index)]
+            blocks = self._nonzeroBlocks(index)
+            for blockName in set(subgroup.keys()) - set(blocks.keys()):
+                del subgroup[blockName]
+
+            dirty_rois = self._dirtyRoisSince(self.slot[index], saved_sequence)
+            for blockName, (start, stop) in blocks.items():
+                if blockName in subgroup:
+                    if dirty_rois is not None:
+                        dirty_starts, dirty_stops = dirty_rois
+                        if not ((dirty_starts < stop) & (dirty_stops > start)).all(axis=1).any():
+                            continue
+                    del subgroup[blockName]
+                self._writeBlock(mygroup, subgroup, blockName, roiToSlice(start, stop), index)
 
     @timeLogged(logger, logging.DEBUG)
     def _serialize(self, group, name, slot):
@@ -517,49 +647,48 @@ class SerialBlockSlot(SerialSlot):
         for index in range(num):
             subname = self.subname.format(index)
             subgroup = mygroup.create_group(subname)
-            nonZeroBlocks = self.blockslot[index].value
-            for blockIndex, slicing in enumerate(nonZeroBlocks):
-                if not isinstance(slicing[0], slice):
-                    slicing = roiToSlice(*slicing)
-
-                block = self.slot[index][slicing].wait()
-                blockName = "block{:04d}".format(blockIndex)
-
-                if self._shrink_to_bb:
-                    nonzero_coords = numpy.nonzero(block)
-                    if len(nonzero_coords[0]) > 0:
-                        block_start = sliceToRoi(slicing, [sl.stop for sl in slicing])[0]
-                        block_bounding_box_start = numpy.array(list(map(numpy.min, nonzero_coords)))
-                        block_bounding_box_stop = 1 + numpy.array(list(map(numpy.max, nonzero_coords)))
-                        block_slicing = roiToSlice(block_bounding_box_start, block_bounding_box_stop)
-                        bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
-                        bounding_box_roi += block_start
-
-                        # Overwrite the vars that are written to the file
-                        slicing = roiToSlice(*bounding_box_roi)
-                        block = block[block_slicing]
-
-                block, slicing = self.reshape_datablock_and_slicing_for_output(block, slicing, slot[index])
-                # If we have a masked array, convert it to a structured array so that h5py can handle it.
-                if slot[index].meta.has_mask:
-                    mygroup.attrs["meta.has_mask"] = True
-
-                    block_group = subgroup.create_group(blockName)
-
-                    if self.compression_level:
-                        block_group.create_dataset(
-                            "data", data=block.data, compression="gzip", compression_opts=compression_level
-                        )
-                    else:
-                        block_group.create_dataset("data", data=block.data)
+            for blockName, (start, stop) in self._nonzeroBlocks(index).items():
+                self._writeBlock(mygroup, subgroup, blockName, roiToSlice(start, stop), index)
+
+    def _writeBlock(self, mygroup, subgroup, blockName, slicing, index):
+        slot = self.slot
+        block = self.slot[index][slicing].wait()
+
+        if self._shrink_to_bb:
+            nonzero_coords = numpy.nonzero(block)
+            if len(nonzero_coords[0]) > 0:
+                block_start = sliceToRoi(slicing, [sl.stop for sl in slicing])[0]
+                block_bounding_box_start = numpy.array(list(map(numpy.min, nonzero_coords)))
+                block_bounding_box_stop = 1 + numpy.array(list(map(numpy.max, nonzero_coords)))
+                block_slicing = roiToSlice(block_bounding_box_start, block_bounding_box_stop)
+                bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
+                bounding_box_roi += block_start
+
+                # Overwrite the vars that are written to the file
+                slicing = roiToSlice(*bounding_box_roi)
+                block = block[block_slicing]
+
+        block, slicing = self.reshape_datablock_and_slicing_for_output(block, slicing, slot[index])
+        # If we have a masked array, convert it to a structured array so that h5py can handle it.
+        if slot[index].meta.has_mask:
+            mygroup.attrs["meta.has_mask"] = True
+
+            block_group = subgroup.create_group(blockName)
+
+            if self.compression_level:
+                block_group.create_dataset(
+                    "data", data=block.data, compression="gzip", compression_opts=self.compression_level
+                )
+            else:
+                block_group.create_dataset("data", data=block.data)
 
-                    block_group.create_dataset("mask", data=block.mask, compression="gzip", compression_opts=2)
-                    block_group.create_dataset("fill_value", data=block.fill_value)
+            block_group.create_dataset("mask", data=block.mask, compression="gzip", compression_opts=2)
+            block_group.create_dataset("fill_value", data=block.fill_value)
 
-                    block_group.attrs["blockSlice"] = slicingToString(slicing)
-                else:
-                    subgroup.create_dataset(blockName, data=block)
-                    subgroup[blockName].attrs["blockSlice"] = slicingToString(slicing)
+            block_group.attrs["blockSlice"] = slicingToString(slicing)
+        else:
+            subgroup.create_dataset(blockName, data=block)
+            subgroup[blockName].attrs["blockSlice"] = slicingToString(slicing)
 
     def reshape_datablock_and_slicing_for_output(
         self, block: numpy.ndarray, slicing: List[slice], slot: Slot
@@ -1,6 +1,9 @@
+import argparse
 import logging
+import threading
 import weakref
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable, Dict, Hashable, List, Optional, Union, Mapping, Iterable
 import numpy
 import vigra
@@ -19,6 +22,22 @@ from ilastik.applets.dataSelection.opDataSelection import (
 logger = logging.getLogger(__name__)  # noqa
 
 
+class BatchExportError(RuntimeError):
+    """
+    Raised by a parallel batch export after all datasets were processed, if some of them failed.
+
+    Attributes:
+        results: The results of all datasets (None for the failed ones), in input order.
+        failures: Maps the index of each failed dataset to its exception.
+    """
+
+    def __init__(self, results, failures, batches):
+        self.results = results
+        self.failures = failures
+        failed_inputs = "\n".join(f"  {batches[i]}: {failures[i]!r}" for i in sorted(failures))
+        super().__init__(f"Export failed for {len(failures)} of {len(batches)} datasets:\n{failed_inputs}")
+
+
 class BatchProcessingApplet(Applet):
     """
     This applet can be appended to a workflow to provide batch-processing support.
@@ -52,8 +71,19 @@ class BatchProcessingApplet(Applet):
         return []
 
     def parse_known_cmdline_args(self, cmdline_args):
-        # We use the same parser as the DataSelectionApplet
+        # Parse our own args first, so the DataSelectionApplet parser doesn't mistake their values for input files.
+        arg_parser = argparse.ArgumentParser(add_help=False)
+        arg_parser.add_argument(
+            "--parallel_lanes",
+            help="Number of datasets to process at the same time (useful for many small files).",
+            type=int,
+            default=1,
+        )
+        batch_args, cmdline_args = arg_parser.parse_known_args(cmdline_args)
+
+        # For everything else, we use the same parser as the DataSelectionApplet
         parsed_args, unused_args = DataSelectionApplet.parse_known_cmdline_args(cmdline_args, self.role_names)
+        parsed_args.parallel_lanes = batch_args.parallel_lanes
         return parsed_args, unused_args
 
     def run_export_from_parsed_args(self, parsed_args):
@@ -61,7 +91,12 @@ class BatchProcessingApplet(Applet):
         Run the export for each dataset listed in parsed_args (we use the same parser as DataSelectionApplet).
         """
         role_path_dict = self.dataSelectionApplet.role_paths_from_parsed_args(parsed_args)
-        return self.run_export(role_path_dict, parsed_args.input_axes, sequence_axis=parsed_args.stack_along)
+        return self.run_export(
+            role_path_dict,
+            parsed_args.input_axes,
+            sequence_axis=parsed_args.stack_along,
+            parallel_lanes=getattr(parsed_args, "parallel_lanes", 1),
+        )
 
     def run_export(
         self,
@@ -69,6 +104,7 @@ class BatchProcessingApplet(Applet):
         input_axes: Optional[str] = None,
         export_to_array: bool = False,
         sequence_axis: Optional[str] = None,
+        parallel_lanes: int = 1,
     ) -> Union[List[str], List[numpy.array]]:
         """Run the export for each dataset listed in role_data_dict
 
@@ -86,6 +122,9 @@ class BatchProcessingApplet(Applet):
             After each lane is processed, the given post-processing callback will be executed.
             signature: lane_postprocessing_callback(batch_lane_index)
 
+            If parallel_lanes > 1, up to that many lanes are added at once and exported concurrently
+            (see _run_parallel_export()).
+
         Args:
             role_data_dict: dict with role_name: list(paths) of data that should be processed.
             input_axes: axis description to override from the default role
@@ -93,6 +132,7 @@ class BatchProcessingApplet(Applet):
               Instead, export the results to a list of arrays, which is returned.
               If False, return a list of the filenames we produced to.
             sequence_axis: stack along this axis, overrides setting from default role
+            parallel_lanes: number of datasets to export at the same time
 
         Returns:
             list containing either strings of paths to exported files,
@@ -100,6 +140,12 @@ class BatchProcessingApplet(Applet):
         """
         self.progressSignal(0)
         batches = list(zip(*role_data_dict.values()))
+        if parallel_lanes > 1:
+            try:
+                return self._run_parallel_export(batches, parallel_lanes, input_axes, export_to_array, sequence_axis)
+            finally:
+                self.progressSignal(100)
+
         try:
             results = []
             for batch_index, role_inputs in enumerate(batches):
@@ -149,43 +195,142 @@ class BatchProcessingApplet(Applet):
         previous_axes_tags = self.get_previous_axes_tags()
         # Call customization hook
         self.dataExportApplet.prepare_for_entire_export()
-        # Add a lane to the end of the workflow for batch processing
-        # (Expanding OpDataSelection by one has the effect of expanding the whole workflow.)
-        self.dataSelectionApplet.topLevelOperator.addLane(self.num_lanes)
-        batch_lane = self.dataSelectionApplet.topLevelOperator.getLane(self.num_lanes - 1)
         try:
-            for role_index, (role_input, role_axis_tags) in enumerate(zip(role_inputs, previous_axes_tags)):
-                if not role_input:
-                    continue
-                if isinstance(role_input, DatasetInfo):
-                    role_info = role_input
-                else:
-                    role_info = FilesystemDatasetInfo(
-                        filePath=role_input,
-                        project_file=None,
-                        axistags=vigra.defaultAxistags(input_axes) if input_axes else role_axis_tags,
-                        sequence_axis=sequence_axis,
-                        guess_tags_for_singleton_axes=True,  # FIXME: add cmd line param to negate this
-                    )
-                batch_lane.DatasetGroup[role_index].setValue(role_info)
-            self.workflow().handleNewLanesAdded()
-            # Call customization hook
-            self.dataExportApplet.prepare_lane_for_export(self.num_lanes - 1)
-            opDataExport = self.dataExportApplet.topLevelOperator.getLane(self.num_lanes - 1)
-            opDataExport.progressSignal.subscribe(progress_callback)
-            if export_to_array:
-                logger.info("Exporting to in-memory array.")
-                result = opDataExport.run_export_to_array()
-            else:
-                logger.info(f"Exporting to {opDataExport.ExportPath.value}")
-                opDataExport.run_export()
-                result = opDataExport.ExportPath.value
+            lane_index = self._add_batch_lane(role_inputs, previous_axes_tags, input_axes, sequence_axis)
+            result = self._export_lane(lane_index, export_to_array, progress_callback)
 
             # Call customization hook
-            self.dataExportApplet.post_process_lane_export(self.num_lanes - 1)
+            self.dataExportApplet.post_process_lane_export(lane_index)
             return result
         finally:
-            self.dataSelectionApplet.topLevelOperator.removeLane(original_num_lanes, original_num_lanes)
+            self._remove_batch_lanes(original_num_lanes)
+
+    def _run_parallel_export(
+        self,
+        batches: List[tuple],
+        parallel_lanes: int,
+        input_axes: Optional[str],
+        export_to_array: bool,
+        sequence_axis: Optional[str],
+    ) -> Union[List[str], List[numpy.array]]:
+        """
+        Export the given datasets in groups of (up to) parallel_lanes datasets.
+
+        Adding and removing lanes changes the whole workflow graph, so it happens in this thread:
+        all lanes of a group are added (each with a copy of the trained classifier, see handleNewLanesAdded()),
+        then exported concurrently, post-processed in input order and finally removed together.
+
+        A failing dataset does not stop the export of the others.
+        If any dataset failed, a BatchExportError is raised after all datasets have been processed.
+        """
+        results = [None] * len(batches)
+        failures = {}
+
+        progress = [0.0] * len(batches)
+        progress_lock = threading.Lock()
+
+        def update_progress(batch_index, p):
+            with progress_lock:
+                progress[batch_index] = p
+                total_progress = sum(progress) / len(batches)
+            self.progressSignal(total_progress)
+
+        # Call customization hook
+        self.dataExportApplet.prepare_for_entire_export()
+        for group_start in range(0, len(batches), parallel_lanes):
+            group = range(group_start, min(group_start + parallel_lanes, len(batches)))
+            original_num_lanes = self.num_lanes
+            previous_axes_tags = self.get_previous_axes_tags()
+            try:
+                lane_indexes = OrderedDict()
+                for batch_index in group:
+                    try:
+                        lane_indexes[batch_index] = self._add_batch_lane(
+                            batches[batch_index], previous_axes_tags, input_axes, sequence_axis
+                        )
+                    except Exception as ex:
+                        logger.exception(f"Could not set up the export of {batches[batch_index]}")
+                        failures[batch_index] = ex
+
+                with ThreadPoolExecutor(max_workers=parallel_lanes) as executor:
+                    futures = OrderedDict(
+                        (
+                            batch_index,
+                            executor.submit(
+                                self._export_lane, lane_index, export_to_array, partial(update_progress, batch_index)
+                            ),
+                        )
+                        for batch_index, lane_index in lane_indexes.items()
+                    )
+
+                    # Collect the results in input order
+                    for batch_index, future in futures.items():
+                        try:
+                            results[batch_index] = future.result()
+                            # Call customization hook
+                            self.dataExportApplet.post_process_lane_export(lane_indexes[batch_index])
+                        except Exception as ex:
+                            logger.exception(f"Export of {batches[batch_index]} failed")
+                            failures[batch_index] = ex
+                        update_progress(batch_index, 100)
+            finally:
+                self._remove_batch_lanes(original_num_lanes)
+
+        self.dataExportApplet.post_process_entire_export()
+        if failures:
+            raise BatchExportError(results, failures, batches) from next(iter(failures.values()))
+        return results
+
+    def _add_batch_lane(
+        self,
+        role_inputs: List[Union[str, DatasetInfo]],
+        previous_axes_tags: List[Optional[AxisTags]],
+        input_axes: Optional[str] = None,
+        sequence_axis: Optional[str] = None,
+    ) -> int:
+        """
+        Appends a lane for the given inputs to the workflow and returns its index.
+        """
+        # Add a lane to the end of the workflow for batch processing
+        # (Expanding OpDataSelection by one has the effect of expanding the whole workflow.)
+        self.dataSelectionApplet.topLevelOperator.addLane(self.num_lanes)
+        lane_index = self.num_lanes - 1
+        batch_lane = self.dataSelectionApplet.topLevelOperator.getLane(lane_index)
+        for role_index, (role_input, role_axis_tags) in enumerate(zip(role_inputs, previous_axes_tags)):
+            if not role_input:
+                continue
+            if isinstance(role_input, DatasetInfo):
+                role_info = role_input
+            else:
+                role_info = FilesystemDatasetInfo(
+                    filePath=role_input,
+                    project_file=None,
+                    axistags=vigra.defaultAxistags(input_axes) if input_axes else role_axis_tags,
+                    sequence_axis=sequence_axis,
+                    guess_tags_for_singleton_axes=True,  # FIXME: add cmd line param to negate this
+                )
+            batch_lane.DatasetGroup[role_index].setValue(role_info)
+        self.workflow().handleNewLanesAdded()
+        # Call customization hook
+        self.dataExportApplet.prepare_lane_for_export(lane_index)
+        return lane_index
+
+    def _export_lane(
+        self, lane_index: int, export_to_array: bool, progress_callback: Callable[[int], None]
+    ) -> Union[str, numpy.array]:
+        opDataExport = self.dataExportApplet.topLevelOperator.getLane(lane_index)
+        opDataExport.progressSignal.subscribe(progress_callback)
+        if export_to_array:
+            logger.info("Exporting to in-memory array.")
+            return opDataExport.run_export_to_array()
+        else:
+            logger.info(f"Exporting to {opDataExport.ExportPath.value}")
+            opDataExport.run_export()
+            return opDataExport.ExportPath.value
+
+    def _remove_batch_lanes(self, original_num_lanes: int):
+        while self.num_lanes > original_num_lanes:
+            self.dataSelectionApplet.topLevelOperator.removeLane(self.num_lanes - 1, self.num_lanes - 1)
 
     @property
     def num_lanes(self) -> int:
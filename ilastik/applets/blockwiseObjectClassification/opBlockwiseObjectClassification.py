@@ -20,21 +20,24 @@
 ###############################################################################
 # Built-in
 from __future__ import division
+import collections
 import logging
+import time
 
 # Third-party
 import numpy
 
 # lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.request import RequestLock, RequestPool
+from lazyflow.request import Request, RequestLock, RequestPool
 from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice, TinyVector
 from lazyflow.operators import OpSubRegion, OpMultiArrayStacker, OpBlockedArrayCache
+from lazyflow.operators.opCache import ObservableCache, ManagedBlockedCache
+from lazyflow.operators.cacheEvictionPolicies import BlockStatistics
 from lazyflow.stype import Opaque
 from lazyflow.rtype import List
 
 # ilastik
-from ilastik.utility import bind
 from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction
 from ilastik.applets.objectClassification.opObjectClassification import (
     OpObjectPredict,
@@ -48,7 +51,7 @@ logger = logging.getLogger(__name__)
 traceLogger = logging.getLogger("TRACE." + __name__)
 
 
-class OpSingleBlockObjectPrediction(Operator):
+class OpSingleBlockObjectPrediction(Operator, ObservableCache):
     RawImage = InputSlot()
     BinaryImage = InputSlot()
 
@@ -152,6 +155,14 @@ class OpSingleBlockObjectPrediction(Operator):
         self._opProbabilityCache = OpBlockedArrayCache(parent=self)
         self._opProbabilityCache.Input.connect(self._opProbabilityChannelStacker.Output)
 
+    def setBlockRoi(self, block_roi):
+        """
+        Re-target this pipeline to another block of the same image.
+        (All results cached for the previous block are discarded.)
+        """
+        self.block_roi = block_roi
+        self._setupOutputs()
+
     def setupOutputs(self):
         tagged_input_shape = self.RawImage.meta.getTaggedShape()
         self._halo_roi = self.computeHaloRoi(
@@ -209,6 +220,16 @@ class OpSingleBlockObjectPrediction(Operator):
         """
         pass
 
+    def usedMemory(self):
+        return self._opPredictionCache.usedMemory() + self._opProbabilityCache.usedMemory()
+
+    def fractionOfUsedMemoryDirty(self):
+        # dirty memory is discarded immediately
+        return 0.0
+
+    def freeMemory(self):
+        return self._opPredictionCache.freeMemory() + self._opProbabilityCache.freeMemory()
+
     def _handleDirtyPrediction(self, slot, roi):
         """
         Foward dirty notifications from our internal output slot to the external one,
@@ -247,9 +268,15 @@ class OpSingleBlockObjectPrediction(Operator):
         return halo_roi
 
 
-class OpBlockwiseObjectClassification(Operator):
+class OpBlockwiseObjectClassification(Operator, ManagedBlockedCache):
     """
     Handles prediction ONLY.  Training must be provided externally and loaded via the serializer.
+
+    Each block is predicted by its own OpSingleBlockObjectPrediction pipeline.  The pipelines are kept
+    in a bounded pool: when a block without a pipeline is requested, the least recently used pipeline
+    is re-targeted to it.  The pipelines are also the "blocks" of this cache, so that the cache memory
+    manager can evict them (least recently used first), as well as the blocks of the input caches
+    (with ShareHaloData), whose keys are prefixed with the name of their input slot.
     """
 
     RawImage = InputSlot()
@@ -259,15 +286,28 @@ class OpBlockwiseObjectClassification(Operator):
     SelectedFeatures = InputSlot(rtype=List, stype=Opaque)
     BlockShape3dDict = InputSlot(value={"x": 512, "y": 512, "z": 512})  # A dict of SPATIAL block dims
     HaloPadding3dDict = InputSlot(value={"x": 64, "y": 64, "z": 64})  # A dict of spatial block dims
+    # If True, the raw and binary input blocks are cached, so that the halos shared by neighboring blocks are only
+    # computed once (useful if the inputs are expensive and not cached upstream).
+    ShareHaloData = InputSlot(value=False)
 
     PredictionImage = OutputSlot()
     ProbabilityChannelImage = OutputSlot()
     BlockwiseRegionFeatures = OutputSlot()
 
+    # Number of block pipelines kept for reuse (None: twice the number of worker threads).
+    # (More pipelines are created if all of them are busy.)
+    MAX_BLOCK_PIPELINES = None
+
     def __init__(self, *args, **kwargs):
         super(self.__class__, self).__init__(*args, **kwargs)
-        self._blockPipelines = {}  # indexed by blockstart
+        self._blockPipelines = collections.OrderedDict()  # indexed by blockstart, least recently used first
+        self._idlePipelines = []  # evicted pipelines, to be re-targeted to other blocks
+        self._pipelineUsers = collections.Counter()  # blockstart -> number of requests using the pipeline
+        self._last_access_times = {}  # blockstart -> time
         self._lock = RequestLock()
+        self._inputCaches = {}  # input slot name -> OpBlockedArrayCache (only with ShareHaloData)
+
+        self.registerWithMemoryManager()
 
     def setupOutputs(self):
         # Check for preconditions.
@@ -318,6 +358,32 @@ class OpBlockwiseObjectClassification(Operator):
         self.BlockwiseRegionFeatures.meta.dtype = object
         self.BlockwiseRegionFeatures.meta.axistags = self.PredictionImage.meta.axistags
 
+        self._setupInputCaches(block_shape)
+
+    def _setupInputCaches(self, block_shape):
+        """
+        With ShareHaloData, the raw and binary inputs are cached in entire blocks (with all channels).
+        """
+        share_halo_data = self.ShareHaloData.value
+        if share_halo_data != bool(self._inputCaches):
+            # The pipelines must be connected to the other inputs
+            self._deleteAllPipelines()
+            for opCache in self._inputCaches.values():
+                opCache.cleanUp()
+            self._inputCaches = {}
+            if share_halo_data:
+                for input_slot in (self.RawImage, self.BinaryImage):
+                    opCache = OpBlockedArrayCache(parent=self)
+                    opCache.Input.connect(input_slot)
+                    self._inputCaches[input_slot.name] = opCache
+
+        for name, opCache in self._inputCaches.items():
+            input_meta = self.inputs[name].meta
+            c_index = input_meta.axistags.channelIndex
+            cache_block_shape = list(block_shape)
+            cache_block_shape[c_index] = input_meta.shape[c_index]
+            opCache.BlockShape.setValue(tuple(cache_block_shape))
+
     def execute(self, slot, subindex, roi, destination):
         if slot == self.PredictionImage or slot == self.ProbabilityChannelImage:
             return self._executePredictionImage(slot, roi, destination)
@@ -334,14 +400,20 @@ class OpBlockwiseObjectClassification(Operator):
         block_starts = getIntersectingBlocks(block_shape, roi_one_channel)
         block_starts = list(map(tuple, block_starts))
 
-        # Ensure that block pipelines exist (create first if necessary)
-        for block_start in block_starts:
-            self._ensurePipelineExists(block_start)
+        # Ensure that block pipelines exist (create or re-target first if necessary)
+        # The pipelines stay assigned to their blocks until they are released again.
+        with self._lock:
+            block_pipelines = [self._acquirePipeline(block_start) for block_start in block_starts]
+        try:
+            self._executeBlockPipelines(slot, roi, roi_one_channel, block_pipelines, destination)
+        finally:
+            self._releasePipelines(block_starts)
+        return destination
 
+    def _executeBlockPipelines(self, slot, roi, roi_one_channel, block_pipelines, destination):
         # Retrieve result from each block, and write into the appropriate region of the destination
         pool = RequestPool()
-        for block_start in block_starts:
-            opBlockPipeline = self._blockPipelines[block_start]
+        for opBlockPipeline in block_pipelines:
             block_roi = opBlockPipeline.block_roi
             block_intersection = getIntersection(block_roi, roi_one_channel)
             block_relative_intersection = numpy.subtract(block_intersection, block_roi[0])
@@ -361,8 +433,6 @@ class OpBlockwiseObjectClassification(Operator):
             pool.add(req)
         pool.wait()
 
-        return destination
-
     def _executeBlockwiseRegionFeatures(self, roi, destination):
         """
         Provide data for the BlockwiseRegionFeatures slot.
@@ -409,34 +479,91 @@ class OpBlockwiseObjectClassification(Operator):
 
         return destination
 
-    def _ensurePipelineExists(self, block_start):
-        if block_start in self._blockPipelines:
-            return
+    def _maxBlockPipelines(self):
+        if self.MAX_BLOCK_PIPELINES is not None:
+            return self.MAX_BLOCK_PIPELINES
+        return max(4, 2 * Request.global_thread_pool.num_workers)
+
+    def _acquirePipeline(self, block_start):
+        """
+        Return the pipeline for the given block, and mark it as in use (see _releasePipelines()).
+        If there is none, re-target an idle or the least recently used pipeline, or create a new one.
+        (Requires self._lock.)
+        """
+        opBlockPipeline = self._blockPipelines.get(block_start)
+        if opBlockPipeline is None:
+            block_roi = self.get_block_roi(block_start)
+            if not self._idlePipelines and len(self._blockPipelines) >= self._maxBlockPipelines():
+                self._evictLeastRecentlyUsedPipeline()
+
+            if self._idlePipelines:
+                logger.debug("Re-targeting pipeline to block: {}".format(block_start))
+                opBlockPipeline = self._idlePipelines.pop()
+                opBlockPipeline.setBlockRoi(block_roi)
+            else:
+                opBlockPipeline = self._createPipeline(block_roi)
+            self._blockPipelines[block_start] = opBlockPipeline
+
+        self._blockPipelines.move_to_end(block_start)
+        self._pipelineUsers[block_start] += 1
+        self._last_access_times[block_start] = time.time()
+        return opBlockPipeline
+
+    def _releasePipelines(self, block_starts):
         with self._lock:
-            if block_start in self._blockPipelines:
-                return
+            for block_start in block_starts:
+                self._pipelineUsers[block_start] -= 1
+                if self._pipelineUsers[block_start] == 0:
+                    del self._pipelineUsers[block_start]
+
+            # Shrink the pool again, if we had to create extra pipelines while all of them were busy
+            excess = len(self._blockPipelines) + len(self._idlePipelines) - self._maxBlockPipelines()
+            while excess > 0 and self._idlePipelines:
+                self._idlePipelines.pop().cleanUp()
+                excess -= 1
+            while excess > 0 and self._evictLeastRecentlyUsedPipeline():
+                self._idlePipelines.pop().cleanUp()
+                excess -= 1
+
+    def _evictLeastRecentlyUsedPipeline(self):
+        """
+        Move the least recently used pipeline that is not in use to the idle pipelines.
+        Returns False if all pipelines are in use.
+        (Requires self._lock.)
+        """
+        for block_start in self._blockPipelines:
+            if block_start not in self._pipelineUsers:
+                self._evictPipeline(block_start)
+                return True
+        return False
 
-            logger.debug("Creating pipeline for block: {}".format(block_start))
+    def _evictPipeline(self, block_start):
+        """
+        Detach the pipeline from its block, and free its memory.
+        (Requires self._lock.)
+        """
+        opBlockPipeline = self._blockPipelines.pop(block_start)
+        del self._last_access_times[block_start]
+        self._idlePipelines.append(opBlockPipeline)
+        return opBlockPipeline.freeMemory()
 
-            block_shape = self._getFullShape(self._block_shape_dict)
-            halo_padding = self._getFullShape(self._halo_padding_dict)
+    def _createPipeline(self, block_roi):
+        logger.debug("Creating pipeline for block: {}".format(block_roi[0]))
 
-            input_shape = self.RawImage.meta.shape
-            block_stop = getBlockBounds(input_shape, block_shape, block_start)[1]
-            block_roi = (block_start, block_stop)
+        halo_padding = self._getFullShape(self._halo_padding_dict)
 
-            # Instantiate pipeline
-            opBlockPipeline = OpSingleBlockObjectPrediction(block_roi, halo_padding, parent=self)
+        # Instantiate pipeline
+        opBlockPipeline = OpSingleBlockObjectPrediction(block_roi, halo_padding, parent=self)
+        if self._inputCaches:
+            opBlockPipeline.RawImage.connect(self._inputCaches["RawImage"].Output)
+            opBlockPipeline.BinaryImage.connect(self._inputCaches["BinaryImage"].Output)
+        else:
             opBlockPipeline.RawImage.connect(self.RawImage)
             opBlockPipeline.BinaryImage.connect(self.BinaryImage)
-            opBlockPipeline.Classifier.connect(self.Classifier)
-            opBlockPipeline.LabelsCount.connect(self.LabelsCount)
-            opBlockPipeline.SelectedFeatures.connect(self.SelectedFeatures)
-
-            # Forward dirtyness
-            opBlockPipeline.PredictionImage.notifyDirty(bind(self._handleDirtyBlock, block_start))
-
-            self._blockPipelines[block_start] = opBlockPipeline
+        opBlockPipeline.Classifier.connect(self.Classifier)
+        opBlockPipeline.LabelsCount.connect(self.LabelsCount)
+        opBlockPipeline.SelectedFeatures.connect(self.SelectedFeatures)
+        return opBlockPipeline
 
     def get_blockshape(self):
         return self._getFullShape(self.BlockShape3dDict.value)
@@ -474,20 +601,86 @@ class OpBlockwiseObjectClassification(Operator):
 
     def _deleteAllPipelines(self):
         logger.debug("Deleting all pipelines.")
-        oldBlockPipelines = self._blockPipelines
-        self._blockPipelines = {}
         with self._lock:
-            for opBlockPipeline in list(oldBlockPipelines.values()):
+            oldBlockPipelines = list(self._blockPipelines.values()) + self._idlePipelines
+            self._blockPipelines = collections.OrderedDict()
+            self._idlePipelines = []
+            self._last_access_times = {}
+            for opBlockPipeline in oldBlockPipelines:
                 opBlockPipeline.cleanUp()
 
     def propagateDirty(self, slot, subindex, roi):
         if slot == self.BlockShape3dDict or slot == self.HaloPadding3dDict:
             self._deleteAllPipelines()
             self.PredictionImage.setDirty(slice(None))
+            self.ProbabilityChannelImage.setDirty(slice(None))
+        elif slot == self.ShareHaloData:
+            # Same results (the pipelines are re-connected in setupOutputs)
+            pass
+        elif slot == self.RawImage or slot == self.BinaryImage:
+            # Evicted blocks have no pipeline that could notify us, so we determine the dirty blocks ourselves:
+            # Objects can change in all blocks whose halo intersects the dirty region.
+            block_shape = numpy.array(self._getFullShape(self._block_shape_dict))
+            halo_padding = self._getFullShape(self._halo_padding_dict)
+            shape = self.PredictionImage.meta.shape
+            start = numpy.maximum(numpy.subtract(roi.start, halo_padding), 0) // block_shape * block_shape
+            stop = numpy.minimum(-(-numpy.add(roi.stop, halo_padding) // block_shape) * block_shape, shape)
+            start[-1], stop[-1] = 0, 1
+            self.PredictionImage.setDirty(start, stop)
+            stop[-1] = self.ProbabilityChannelImage.meta.shape[-1]
+            self.ProbabilityChannelImage.setDirty(start, stop)
+        else:
+            # Classifier, LabelsCount or SelectedFeatures
+            self.PredictionImage.setDirty(slice(None))
+            self.ProbabilityChannelImage.setDirty(slice(None))
+
+    # ======= cache interface: the "blocks" of this cache are the block pipelines and the input cache blocks =======
+
+    def usedMemory(self):
+        with self._lock:
+            pipelines = list(self._blockPipelines.values()) + self._idlePipelines
+        total = sum(opCache.usedMemory() for opCache in list(self._inputCaches.values()))
+        for opBlockPipeline in pipelines:
+            total += opBlockPipeline.usedMemory()
+        return total
+
+    def fractionOfUsedMemoryDirty(self):
+        # dirty memory is discarded immediately
+        return 0.0
 
-    def _handleDirtyBlock(self, block_start, slot, roi):
-        # Convert roi from block coords to global coords
-        block_relative_roi = (roi.start, roi.stop)
-        global_roi = block_relative_roi + numpy.array(block_start)
-        logger.debug("Setting roi dirty: {}".format(global_roi))
-        self.PredictionImage.setDirty(*global_roi)
+    def getBlockAccessTimes(self):
+        return [(stats.key, stats.last_access) for stats in self.getBlockStatistics()]
+
+    def getBlockStatistics(self):
+        with self._lock:
+            stats = [
+                BlockStatistics(k, t, None, None)
+                for k, t in self._last_access_times.items()
+                if k not in self._pipelineUsers
+            ]
+        for name, opCache in list(self._inputCaches.items()):
+            stats += [block_stats._replace(key=(name, block_stats.key)) for block_stats in opCache.getBlockStatistics()]
+        return stats
+
+    def freeBlock(self, key):
+        if isinstance(key[0], str):
+            name, key = key
+            opCache = self._inputCaches.get(name)
+            return 0 if opCache is None else opCache.freeBlock(key)
+
+        with self._lock:
+            if key not in self._blockPipelines or key in self._pipelineUsers:
+                return 0
+            logger.debug("Evicting pipeline for block: {}".format(key))
+            return self._evictPipeline(key)
+
+    def freeMemory(self):
+        with self._lock:
+            freed = 0
+            for block_start in list(self._blockPipelines.keys()):
+                if block_start not in self._pipelineUsers:
+                    freed += self._evictPipeline(block_start)
+        return freed + sum(opCache.freeMemory() for opCache in list(self._inputCaches.values()))
+
+    def freeDirtyMemory(self):
+        return 0.0
@@ -47,7 +47,7 @@ from volumina.api import createDataSource
 from volumina.layer import SegmentationEdgesLayer, LabelableSegmentationEdgesLayer
 from volumina.utility import ShortcutManager
 
-from lazyflow.request import Request
+from lazyflow.request import Request, PriorityClass
 
 import logging
 
@@ -375,7 +375,9 @@ class EdgeTrainingGui(LayerViewerGui):
             layer_index = self.layerstack.findMatchingIndex(lambda l: l.name == layer_name)
             num_slices = self.editor.dataShape["txyzc".index(axis)]
             view2d = self.editor.imageViews["xyz".index(axis)]
-            view2d.scene().triggerPrefetch([layer_index], spatial_axis_range=(0, num_slices))
+            # The visible tiles go first.
+            with Request.root_priority_class(PriorityClass.PREFETCH):
+                view2d.scene().triggerPrefetch([layer_index], spatial_axis_range=(0, num_slices))
 
         prefetch_menu = QMenu("Prefetch")
         prefetch_menu.addAction(QAction("All Z-slices", prefetch_menu, triggered=partial(prefetch_layer, "z")))
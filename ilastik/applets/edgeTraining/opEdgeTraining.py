@@ -1,5 +1,6 @@
 from builtins import range
 
+import threading
 from functools import partial
 
 import numpy as np
@@ -9,6 +10,8 @@ import vigra
 import ilastikrag
 
 from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.request import Request, RequestPool
+from lazyflow.utility import Memory
 from lazyflow.roi import roiToSlice
 from lazyflow.operators import OpValueCache, OpBlockedArrayCache
 from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory
@@ -249,6 +252,18 @@ class OpComputeEdgeFeatures(Operator):
     Rag = InputSlot()
     EdgeFeaturesDataFrame = OutputSlot()  # Includes columns 'sp1' and 'sp2'
 
+    def __init__(self, *args, **kwargs):
+        super(OpComputeEdgeFeatures, self).__init__(*args, **kwargs)
+        # Computed features of each channel: {(channel_name, feature_names) : (column_names, feature_matrix)}
+        # (Only the channels that are dirty or whose features were changed have to be recomputed.)
+        self._channel_features = {}
+        self._channel_features_rag = None
+        self._channel_features_lock = threading.Lock()
+        # Incremented whenever the features of a channel (resp. all channels) are invalidated,
+        # so that features which were computed meanwhile aren't stored.
+        self._channel_generations = {}
+        self._channel_features_generation = 0
+
     def setupOutputs(self):
         assert self.VoxelData.meta.getAxisKeys()[-1] == "c"
         self.EdgeFeaturesDataFrame.meta.shape = (1,)
@@ -259,38 +274,63 @@ class OpComputeEdgeFeatures(Operator):
             rag = self.Rag.value
             channel_feature_names = self.FeatureNames.value
 
-            edge_feature_dfs = []
-
+            # The selected features of each channel
+            selected_features = []
             for c in range(self.VoxelData.meta.shape[-1]):
                 channel_name = self.VoxelData.meta.channel_names[c]
                 if channel_name not in channel_feature_names:
                     continue
 
-                feature_names = [decodeToStringIfBytes(f) for f in channel_feature_names[channel_name]]
+                feature_names = tuple(decodeToStringIfBytes(f) for f in channel_feature_names[channel_name])
                 if not feature_names:
                     # No features selected for this channel
                     continue
-
-                voxel_data = self.VoxelData[..., c : c + 1].wait()
-                voxel_data = vigra.taggedView(voxel_data, self.VoxelData.meta.axistags)
-                voxel_data = voxel_data[..., 0]  # drop channel
-                edge_features_df = rag.compute_features(voxel_data, feature_names)
-
-                # if np.isnan(edge_features_df.values).any():
-                #    raise RuntimeError("Whoa, why are there NaN values in the feature matrix?")
-
-                edge_features_df = edge_features_df.iloc[:, 2:]  # Discard columns [sp1, sp2]
-
-                # Prefix all column names with the channel name, to guarantee uniqueness
-                # (Generally a nice feature, but also required for serialization.)
-                edge_features_df.columns = [
-                    channel_name + " " + feature_name for feature_name in edge_features_df.columns.values
+                selected_features.append((c, channel_name, feature_names))
+
+            with self._channel_features_lock:
+                if self._channel_features_rag is not rag:
+                    self._channel_features.clear()
+                    self._channel_features_rag = rag
+                # Forget the features that aren't selected anymore.
+                selected_keys = {(channel_name, feature_names) for _, channel_name, feature_names in selected_features}
+                for key in set(self._channel_features) - selected_keys:
+                    del self._channel_features[key]
+                # The cached features are only a shortcut, they may be discarded while the rest is computed.
+                computed_features = {
+                    key: self._channel_features[key] for key in selected_keys & set(self._channel_features)
+                }
+                missing_features = [
+                    (c, channel_name, feature_names)
+                    for c, channel_name, feature_names in selected_features
+                    if (channel_name, feature_names) not in computed_features
                 ]
-                edge_feature_dfs.append(edge_features_df)
 
-            # Could use join() or merge() here, but we know the rows are already in the right order, and concat() should be faster.
-            all_edge_features_df = pd.DataFrame(rag.edge_ids, columns=["sp1", "sp2"])
-            all_edge_features_df = pd.concat([all_edge_features_df] + edge_feature_dfs, axis=1, copy=False)
+            def compute_channel_features(c, channel_name, feature_names):
+                features = self._compute_channel_features(rag, c, channel_name, feature_names)
+                computed_features[(channel_name, feature_names)] = features
+
+            # Compute the missing channels in parallel, but only as many at once as fit in RAM.
+            pool = RequestPool(max_active=self._max_parallel_channels())
+            for c, channel_name, feature_names in missing_features:
+                pool.add(Request(partial(compute_channel_features, c, channel_name, feature_names)))
+            pool.wait()
+
+            channel_features = [
+                computed_features[(channel_name, feature_names)] for _, channel_name, feature_names in selected_features
+            ]
+
+            # Assemble all feature columns in a single (column-major) float32 matrix.
+            column_names = [name for names, _ in channel_features for name in names]
+            num_edges = len(rag.edge_ids)
+            feature_matrix = np.empty((len(column_names), num_edges), dtype=np.float32).transpose()
+            column = 0
+            for names, features in channel_features:
+                feature_matrix[:, column : column + len(names)] = features
+                column += len(names)
+
+            all_edge_features_df = pd.DataFrame(feature_matrix, columns=column_names, copy=False)
+            all_edge_features_df.insert(0, "sp2", rag.edge_ids[:, 1])
+            all_edge_features_df.insert(0, "sp1", rag.edge_ids[:, 0])
             result[0] = all_edge_features_df
 
         else:
@@ -316,7 +356,52 @@ class OpComputeEdgeFeatures(Operator):
 
             result[0] = edge_features_df
 
+    def _max_parallel_channels(self):
+        # Each channel needs its voxel data, plus (roughly) the same again for the feature computation.
+        voxel_count = np.prod(self.VoxelData.meta.shape[:-1])
+        ram_per_channel = 2 * voxel_count * max(np.dtype(self.VoxelData.meta.dtype).itemsize, 4)
+        return int(
+            max(1, min(Request.global_thread_pool.num_workers, Memory.getAvailableRamComputation() // ram_per_channel))
+        )
+
+    def _channel_generation(self, channel_name):
+        return self._channel_features_generation, self._channel_generations.get(channel_name, 0)
+
+    def _compute_channel_features(self, rag, c, channel_name, feature_names):
+        with self._channel_features_lock:
+            generation = self._channel_generation(channel_name)
+        voxel_data = self.VoxelData[..., c : c + 1].wait()
+        voxel_data = vigra.taggedView(voxel_data, self.VoxelData.meta.axistags)
+        voxel_data = voxel_data[..., 0]  # drop channel
+        edge_features_df = rag.compute_features(voxel_data, list(feature_names))
+
+        # if np.isnan(edge_features_df.values).any():
+        #    raise RuntimeError("Whoa, why are there NaN values in the feature matrix?")
+
+        edge_features_df = edge_features_df.iloc[:, 2:]  # Discard columns [sp1, sp2]
+
+        # Prefix all column names with the channel name, to guarantee uniqueness
+        # (Generally a nice feature, but also required for serialization.)
+        column_names = [channel_name + " " + feature_name for feature_name in edge_features_df.columns.values]
+        features = edge_features_df.values.astype(np.float32, copy=False)
+        with self._channel_features_lock:
+            if self._channel_features_rag is rag and generation == self._channel_generation(channel_name):
+                self._channel_features[(channel_name, feature_names)] = (column_names, features)
+        return column_names, features
+
     def propagateDirty(self, slot, subindex, roi):
+        with self._channel_features_lock:
+            if slot is self.VoxelData:
+                # Only the features of the dirty channels must be recomputed.
+                dirty_channels = self.VoxelData.meta.channel_names[roi.start[-1] : roi.stop[-1]]
+                for channel_name in dirty_channels:
+                    self._channel_generations[channel_name] = self._channel_generations.get(channel_name, 0) + 1
+                for key in list(self._channel_features):
+                    if key[0] in dirty_channels:
+                        del self._channel_features[key]
+            elif slot is self.Rag:
+                self._channel_features_generation += 1
+                self._channel_features.clear()
         self.EdgeFeaturesDataFrame.setDirty()
 
 
@@ -25,7 +25,6 @@ import numpy.lib.recfunctions as rfn
 import vigra
 import time
 import warnings
-import itertools
 from collections import defaultdict, OrderedDict
 from functools import partial
 
@@ -673,98 +672,45 @@ class OpObjectClassification(Operator, MultiLaneOperatorABC):
         maxs_old = old_bboxes["Coord<Maximum>"]
         mins_new = new_bboxes["Coord<Minimum>"]
         maxs_new = new_bboxes["Coord<Maximum>"]
-        nobj_old = mins_old.shape[0]
         nobj_new = mins_new.shape[0]
         if axistags is None:
             axistags = "xyz"
 
-        data2D = False
-        if mins_old.shape[1] == 2:
-            data2D = True
-
-        class bbox(object):
-            def __init__(self, minmaxs, axistags):
-                self.xmin = minmaxs[0][axistags.index("x")]
-                self.ymin = minmaxs[0][axistags.index("y")]
-                if not data2D:
-                    self.zmin = minmaxs[0][axistags.index("z")]
-                else:
-                    self.zmin = 0
-                self.xmax = minmaxs[1][axistags.index("x")]
-                self.ymax = minmaxs[1][axistags.index("y")]
-                if not data2D:
-                    self.zmax = minmaxs[1][axistags.index("z")]
-                else:
-                    self.zmax = 0
-                self.rad_x = 0.5 * (self.xmax - self.xmin)
-                self.cent_x = self.xmin + self.rad_x
-                self.rad_y = 0.5 * (self.ymax - self.ymin)
-                self.cent_y = self.ymin + self.rad_y
-                self.rad_z = 0.5 * (self.zmax - self.zmin)
-                self.cent_z = self.zmin + self.rad_z
-
-            @staticmethod
-            def overlap(bbox_tuple):
-                this = bbox_tuple[0]
-                that = bbox_tuple[1]
-                over_x = this.rad_x + that.rad_x - (abs(this.cent_x - that.cent_x))
-                over_y = this.rad_y + that.rad_y - (abs(this.cent_y - that.cent_y))
-                over_z = this.rad_z + that.rad_z - (abs(this.cent_z - that.cent_z))
-                if not data2D:
-                    if over_x > 0 and over_y > 0 and over_z > 0:
-                        return over_x * over_y * over_z
-                else:
-                    if over_x > 0 and over_y > 0:
-                        return over_x * over_y
-                return 0
+        ndim = 2 if mins_old.shape[1] == 2 else 3
 
         nonzeros = numpy.nonzero(old_labels)[0]
-        bboxes_old = [bbox(x, axistags) for x in zip(mins_old[nonzeros], maxs_old[nonzeros])]
-        bboxes_new = [bbox(x, axistags) for x in zip(mins_new, maxs_new)]
-
+        centers_old, radii_old = _bbox_geometry(mins_old[nonzeros], maxs_old[nonzeros], axistags, ndim)
         # remove background
         # FIXME: assuming background is 0 again
-        bboxes_new = bboxes_new[1:]
+        centers_new, radii_new = _bbox_geometry(mins_new[1:], maxs_new[1:], axistags, ndim)
 
-        double_for_loop = itertools.product(bboxes_old, bboxes_new)
-        overlaps = list(map(bbox.overlap, double_for_loop))
+        # Sparse overlap matrix: only the pairs of old and new objects that actually overlap
+        old_index, new_index, overlaps = _overlapping_bboxes(centers_old, radii_old, centers_new, radii_new, ndim)
 
-        overlaps = numpy.asarray(overlaps)
-        overlaps = overlaps.reshape((len(bboxes_old), len(bboxes_new)))
         new_labels = numpy.zeros((nobj_new,), dtype=numpy.uint32)
         old_labels_lost = dict()
-        old_labels_lost["full"] = []
-        old_labels_lost["partial"] = []
         new_labels_lost = dict()
-        new_labels_lost["conflict"] = []
-        for iobj in range(overlaps.shape[0]):
-            # take the object with maximum overlap
-            overlapsum = numpy.sum(overlaps[iobj, :])
-            if overlapsum == 0:
-                old_labels_lost["full"].append(
-                    (bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z)
-                )
-                continue
-            newindex = numpy.argmax(overlaps[iobj, :])
-            if overlapsum - overlaps[iobj, newindex] > 0:
-                # this object overlaps with more than one new object
-                old_labels_lost["partial"].append(
-                    (bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z)
-                )
 
-            overlaps[iobj, :] = 0
-            overlaps[iobj, newindex] = 1  # doesn't matter what number>0
+        # take the new object with maximum overlap (the first one, on ties)
+        order = numpy.lexsort((new_index, -overlaps, old_index))
+        old_index, new_index, overlaps = old_index[order], new_index[order], overlaps[order]
+        first = numpy.ones(len(old_index), dtype=bool)
+        first[1:] = old_index[1:] != old_index[:-1]
+        best_old, best_new, best_overlap = old_index[first], new_index[first], overlaps[first]
+
+        overlapsum = numpy.bincount(old_index, weights=overlaps, minlength=len(nonzeros))
+        lost = overlapsum == 0
+        # objects that overlap with more than one new object
+        partial = numpy.zeros(len(nonzeros), dtype=bool)
+        partial[best_old] = overlapsum[best_old] - best_overlap > 0
+        old_labels_lost["full"] = [tuple(c) for c in centers_old[lost]]
+        old_labels_lost["partial"] = [tuple(c) for c in centers_old[partial]]
+
+        num_assigned = numpy.bincount(best_new, minlength=len(centers_new))
+        unique = num_assigned[best_new] == 1
+        new_labels[best_new[unique] + 1] = old_labels[nonzeros[best_old[unique]]]  # +1 because of the background
+        new_labels_lost["conflict"] = [tuple(c) for c in centers_new[num_assigned > 1]]
 
-        for iobj in range(overlaps.shape[1]):
-            labels = numpy.where(overlaps[:, iobj] > 0)[0]
-            if labels.shape[0] == 1:
-                new_labels[iobj + 1] = old_labels[nonzeros[labels[0]]]  # iobj+1 because of the background
-            elif labels.shape[0] > 1:
-                new_labels_lost["conflict"].append(
-                    (bboxes_new[iobj].cent_x, bboxes_new[iobj].cent_y, bboxes_new[iobj].cent_z)
-                )
-
-        new_labels = new_labels
         new_labels[0] = 0  # FIXME: hardcoded background value again
         return new_labels, old_labels_lost, new_labels_lost
 
@@ -995,6 +941,84 @@ def replace_missing(a):
     return rows, cols
 
 
+def _bbox_geometry(mins, maxs, axistags, ndim):
+    """Centers and radii (x, y, z order) of the given bounding boxes. For 2D boxes, z is 0."""
+    lower = numpy.zeros((len(mins), 3))
+    upper = numpy.zeros((len(mins), 3))
+    for i, axis in enumerate("xyz"[:ndim]):
+        lower[:, i] = mins[:, axistags.index(axis)]
+        upper[:, i] = maxs[:, axistags.index(axis)]
+    radii = 0.5 * (upper - lower)
+    return lower + radii, radii
+
+
+def _expand_ranges(starts, stops):
+    """
+    Concatenation of the ranges [starts[i], stops[i]), and the index i of the range each value belongs to.
+
+    >>> _expand_ranges(numpy.array([0, 5, 2]), numpy.array([2, 5, 5]))
+    (array([0, 1, 2, 3, 4]), array([0, 0, 2, 2, 2]))
+    """
+    counts = numpy.maximum(stops - starts, 0)
+    range_index = numpy.repeat(numpy.arange(len(starts)), counts)
+    offsets = numpy.cumsum(counts) - counts
+    values = numpy.arange(counts.sum()) - offsets[range_index] + starts[range_index]
+    return values, range_index
+
+
+def _grid_cells(lower, upper, cell_size, grid_shape):
+    """
+    All cells of a regular grid touched by each of the given boxes.
+    Returns the (linear) cell ids and the index of the box for each of them.
+    """
+    first = numpy.floor(lower / cell_size).astype(numpy.int64)
+    last = numpy.floor(upper / cell_size).astype(numpy.int64)
+    cells = numpy.zeros(len(lower), dtype=numpy.int64)
+    box_index = numpy.arange(len(lower))
+    for axis in range(lower.shape[1]):
+        coord, entry = _expand_ranges(first[box_index, axis], last[box_index, axis] + 1)
+        cells = cells[entry] * grid_shape[axis] + coord
+        box_index = box_index[entry]
+    return cells, box_index
+
+
+def _overlapping_bboxes(centers_a, radii_a, centers_b, radii_b, ndim):
+    """
+    All pairs of overlapping boxes from the two sets (given as centers and radii), and their overlap
+    (the product of radius_a + radius_b - abs(center_a - center_b) over all axes).
+
+    Candidate pairs are the boxes that share a cell of a regular grid (with roughly the size of the boxes),
+    so that the effort is proportional to the number of overlapping pairs instead of len(a) * len(b).
+    """
+    no_overlaps = (numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0))
+    if len(centers_a) == 0 or len(centers_b) == 0:
+        return no_overlaps
+
+    centers_a, radii_a, centers_b, radii_b = (x[:, :ndim] for x in (centers_a, radii_a, centers_b, radii_b))
+    lower_a, upper_a = centers_a - radii_a, centers_a + radii_a
+    lower_b, upper_b = centers_b - radii_b, centers_b + radii_b
+    origin = numpy.minimum(lower_a.min(axis=0), lower_b.min(axis=0))
+    extent = numpy.maximum(upper_a.max(axis=0), upper_b.max(axis=0)) - origin
+    cell_size = numpy.maximum(numpy.concatenate([radii_a, radii_b]).mean(axis=0) * 2, 1)
+    grid_shape = (extent // cell_size).astype(numpy.int64) + 1
+
+    cells_a, index_a = _grid_cells(lower_a - origin, upper_a - origin, cell_size, grid_shape)
+    cells_b, index_b = _grid_cells(lower_b - origin, upper_b - origin, cell_size, grid_shape)
+    order = numpy.argsort(cells_b, kind="stable")
+    cells_b, index_b = cells_b[order], index_b[order]
+
+    # join on the cell id
+    entry_b, entry_a = _expand_ranges(
+        numpy.searchsorted(cells_b, cells_a, side="left"), numpy.searchsorted(cells_b, cells_a, side="right")
+    )
+    pairs = numpy.unique(index_a[entry_a] * len(centers_b) + index_b[entry_b])
+    pair_a, pair_b = pairs // len(centers_b), pairs % len(centers_b)
+
+    over = radii_a[pair_a] + radii_b[pair_b] - numpy.abs(centers_a[pair_a] - centers_b[pair_b])
+    overlapping = (over > 0).all(axis=1)
+    return pair_a[overlapping], pair_b[overlapping], over[overlapping].prod(axis=1)
+
+
 class OpObjectTrain(Operator):
     """Trains a random forest on all labeled objects."""
 
@@ -1367,9 +1391,54 @@ class OpRelabelSegmentation(Operator):
     loggingName = __name__ + ".OpRelabelSegmentation"
     logger = logging.getLogger(loggingName)
 
+    def __init__(self, *args, **kwargs):
+        super(OpRelabelSegmentation, self).__init__(*args, **kwargs)
+        self._lookupTables = {}  # t -> lookup table (label -> mapped value)
+        self._lookupTablesGeneration = 0  # incremented whenever the lookup tables are invalidated
+        self._lookupTablesLock = RequestLock()
+
     def setupOutputs(self):
         self.Output.meta.assignFrom(self.Image.meta)
         self.Output.meta.dtype = self.ObjectMap.meta.mapping_dtype
+        self._resetLookupTables()
+
+    def _resetLookupTables(self, timesteps=None):
+        with self._lookupTablesLock:
+            self._lookupTablesGeneration += 1
+            if timesteps is None:
+                self._lookupTables.clear()
+            else:
+                for t in timesteps:
+                    self._lookupTables.pop(t, None)
+
+    def _getLookupTable(self, t, dtype):
+        """
+        The object map of time step t as a dense lookup table of the given dtype.
+        Its last entry is 0, for all labels that are not in the map (see execute()).
+        Lookup tables are cached until the ObjectMap becomes dirty.
+        """
+        with self._lookupTablesLock:
+            lut = self._lookupTables.get(t)
+            generation = self._lookupTablesGeneration
+        if lut is not None:
+            return lut.astype(dtype, copy=False)
+
+        tmap = self.ObjectMap([t]).wait()[t]
+        # FIXME: necessary because predictions are returned
+        # enclosed in a list.
+        if isinstance(tmap, list):
+            tmap = tmap[0]
+        tmap = tmap.squeeze()
+        if tmap.ndim == 0:
+            # no objects, nothing to paint
+            tmap = numpy.zeros((0,))
+
+        lut = numpy.zeros((len(tmap) + 1,), dtype=dtype)
+        lut[:-1] = tmap
+        with self._lookupTablesLock:
+            if generation == self._lookupTablesGeneration:
+                self._lookupTables[t] = lut
+        return lut
 
     def execute(self, slot, subindex, roi, result):
         tStart = time.perf_counter()
@@ -1378,42 +1447,22 @@ class OpRelabelSegmentation(Operator):
         img = self.Image(roi.start, roi.stop).wait()
         tIMG = 1000.0 * (time.perf_counter() - tIMG)
 
+        tMAP = 0.0
+        tWORK = 0.0
         for t in range(roi.start[0], roi.stop[0]):
-
-            tMAP = time.perf_counter()
-            map_ = self.ObjectMap([t]).wait()
-            tmap = map_[t]
-            # FIXME: necessary because predictions are returned
-            # enclosed in a list.
-            if isinstance(tmap, list):
-                tmap = tmap[0]
-            tmap = tmap.squeeze()
-            if tmap.ndim == 0:
-                # no objects, nothing to paint
-                result[t - roi.start[0]][:] = 0
-                return result
-
-            tMAP = 1000.0 * (time.perf_counter() - tMAP)
-            # FIXME: This should be cached (and reset when the input becomes dirty)")
-            tMAX = time.perf_counter()
-            idx = img.max()
-
-            if len(tmap) <= idx:
-                newTmap = numpy.zeros((idx + 1,))  # And maybe this should be cached, too?
-                newTmap[: len(tmap)] = tmap[:]
-                tmap = newTmap
-            tMAX = 1000.0 * (time.perf_counter() - tMAX)
+            tLUT = time.perf_counter()
+            lut = self._getLookupTable(t, result.dtype)
+            tMAP += 1000.0 * (time.perf_counter() - tLUT)
 
             # do the work thing
-            tWORK = time.perf_counter()
-            result[t - roi.start[0]] = tmap[img[t - roi.start[0]]]
-            tWORK = 1000.0 * (time.perf_counter() - tWORK)
+            # (labels beyond the end of the map are clipped to the last entry of the lookup table, i.e. 0)
+            tTAKE = time.perf_counter()
+            numpy.take(lut, img[t - roi.start[0]], mode="clip", out=result[t - roi.start[0]])
+            tWORK += 1000.0 * (time.perf_counter() - tTAKE)
 
         if self.logger.getEffectiveLevel() >= logging.DEBUG:
             tStart = 1000.0 * (time.perf_counter() - tStart)
-            self.logger.debug(
-                "took %f msec. (img: %f, wait ObjectMap: %f, do work: %f, max: %f)" % (tStart, tIMG, tMAP, tWORK, tMAX)
-            )
+            self.logger.debug("took %f msec. (img: %f, lookup tables: %f, do work: %f)" % (tStart, tIMG, tMAP, tWORK))
 
         return result
 
@@ -1426,14 +1475,20 @@ class OpRelabelSegmentation(Operator):
             # setDirty with a (time, object) pair, while elsewhere we
             # call setDirty with ().
             if len(roi._l) == 0:
+                if slot is self.ObjectMap:
+                    self._resetLookupTables()
                 self.Output.setDirty(slice(None))
             elif isinstance(roi._l[0], int):
+                if slot is self.ObjectMap:
+                    self._resetLookupTables(roi._l)
                 for t in roi._l:
                     self.Output.setDirty(slice(t))
             else:
                 assert len(roi._l[0]) == 2
                 # for each dirty object, only set its bounding box dirty
                 ts = list(set(t for t, _ in roi._l))
+                if slot is self.ObjectMap:
+                    self._resetLookupTables(ts)
                 feats = self.Features(ts).wait()
                 for t, obj in roi._l:
                     min_coords = feats[t][default_features_key]["Coord<Minimum>"][obj].astype(numpy.uint32)
@@ -31,7 +31,7 @@ import vigra.analysis
 
 # lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OperatorWrapper
-from lazyflow.request import Request, RequestPool
+from lazyflow.request import Request, RequestPool, RequestLock
 from lazyflow.stype import Opaque
 from lazyflow.rtype import List, SubRegion
 from lazyflow.roi import roiToSlice, sliceToRoi
@@ -124,6 +124,7 @@ class OpCachedRegionFeatures(Operator):
     LabelImage = InputSlot()
     CacheInput = InputSlot(optional=True)
     Features = InputSlot(rtype=List, stype=Opaque)
+    BlockShape = InputSlot(optional=True)
 
     Output = OutputSlot()
     CleanBlocks = OutputSlot()
@@ -145,6 +146,7 @@ class OpCachedRegionFeatures(Operator):
         self._opRegionFeatures.Atlas.connect(self.Atlas)
         self._opRegionFeatures.LabelVolume.connect(self.LabelImage)
         self._opRegionFeatures.Features.connect(self.Features)
+        self._opRegionFeatures.BlockShape.connect(self.BlockShape)
 
         # Hook up the cache.
         self._opCache = OpBlockedArrayCache(parent=self)
@@ -329,6 +331,9 @@ class OpObjectExtraction(Operator):
     # for example {"Standard Object Features": {"Mean in neighborhood":{"margin": (5, 5, 2)}}}
     Features = InputSlot(rtype=List, stype=Opaque, value={})
 
+    # spatial block shape for computing the features of large volumes blockwise (see OpRegionFeatures)
+    RegionFeaturesBlockShape = InputSlot(optional=True)
+
     LabelImage = OutputSlot()
     ObjectCenterImage = OutputSlot()
 
@@ -378,6 +383,7 @@ class OpObjectExtraction(Operator):
         self._opRegFeats.LabelImage.connect(self._opLabelVolume.CachedOutput)
         self._opRegFeats.Features.connect(self.Features)
         self._opRegFeats.Atlas.connect(self.Atlas)  # move into constructor?
+        self._opRegFeats.BlockShape.connect(self.RegionFeaturesBlockShape)
         self.RegionFeaturesCleanBlocks.connect(self._opRegFeats.CleanBlocks)
 
         self._opRegFeats.CacheInput.connect(self.RegionFeaturesCacheInput)
@@ -447,6 +453,46 @@ class OpObjectExtraction(Operator):
         #  so all calls to __setitem__ are forwarded automatically
 
 
+class _ObjectBoundingBoxes(object):
+    """Bounding boxes (inclusive) of the objects in a label volume, merged block by block."""
+
+    def __init__(self, ndim):
+        self._lock = RequestLock()
+        self.mins = numpy.zeros((1, ndim), dtype=numpy.int64)
+        self.maxs = numpy.zeros((1, ndim), dtype=numpy.int64)
+
+    def add_block(self, labels, block_start):
+        flat = numpy.asarray(labels).ravel()
+        positions = numpy.flatnonzero(flat)
+        if len(positions) == 0:
+            return
+        block_labels = flat[positions]
+        order = numpy.argsort(block_labels, kind="stable")
+        ids, first = numpy.unique(block_labels[order], return_index=True)
+        coords = numpy.unravel_index(positions[order], labels.shape)
+        mins = numpy.stack([numpy.minimum.reduceat(c, first) for c in coords], axis=1) + block_start
+        maxs = numpy.stack([numpy.maximum.reduceat(c, first) for c in coords], axis=1) + block_start
+
+        with self._lock:
+            missing = int(ids[-1]) + 1 - len(self.mins)
+            if missing > 0:
+                ndim = self.mins.shape[1]
+                self.mins = numpy.vstack((self.mins, numpy.full((missing, ndim), numpy.iinfo(numpy.int64).max)))
+                self.maxs = numpy.vstack((self.maxs, numpy.full((missing, ndim), -1)))
+            self.mins[ids] = numpy.minimum(self.mins[ids], mins)
+            self.maxs[ids] = numpy.maximum(self.maxs[ids], maxs)
+
+    @property
+    def num_labels(self):
+        """The highest label + 1"""
+        return len(self.mins)
+
+    def labels(self):
+        """The labels that were found, in ascending order"""
+        found = numpy.flatnonzero(self.maxs[:, 0] >= 0)
+        return found[found > 0]
+
+
 class OpRegionFeatures(Operator):
     """Produces region features for time-stacked 3d+c volumes
 
@@ -463,6 +509,12 @@ class OpRegionFeatures(Operator):
     * Features : a nested dictionary of features to compute.
       Features[plugin name][feature name][parameter name] = parameter value
 
+    * BlockShape : (optional) if given, every time slice is processed
+      in spatial blocks of this shape (same axis order as RawVolume,
+      t and c are ignored), in parallel and without ever loading the
+      whole volume. Only used if all selected features support it
+      (see ObjectFeaturesPlugin.supports_blockwise()).
+
     Outputs:
 
     * Output : a nested dictionary of features.
@@ -474,6 +526,7 @@ class OpRegionFeatures(Operator):
     Atlas = InputSlot(optional=True)
     LabelVolume = InputSlot()
     Features = InputSlot(rtype=List, stype=Opaque)
+    BlockShape = InputSlot(optional=True)
 
     Output = OutputSlot()
 
@@ -502,7 +555,13 @@ class OpRegionFeatures(Operator):
         t_ind = self.RawVolume.meta.axistags.index("t")
         assert t_ind < len(self.RawVolume.meta.shape)
 
+        blockwise = self.BlockShape.ready() and self._supports_blockwise()
+
         def compute_features_for_time_slice(res_t_ind, t):
+            if blockwise:
+                result[res_t_ind] = self._compute_features_blockwise(t)
+                return
+
             axes4d = [k for k in self.RawVolume.meta.getTaggedShape().keys() if k in "xyzc"]
 
             # Process entire spatial volume
@@ -547,6 +606,175 @@ class OpRegionFeatures(Operator):
         pool.wait()
         return result
 
+    def _supports_blockwise(self):
+        feature_names = self._augmentFeatureNames(self.Features([]).wait())
+        for plugin_name, feature_dict in feature_names.items():
+            if plugin_name == default_features_key:
+                continue
+            plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
+            if not plugin.plugin_object.supports_blockwise(feature_dict):
+                logger.info("{} can't be computed blockwise, processing whole time slices".format(plugin_name))
+                return False
+        return True
+
+    def _request_box(self, slot, t, box):
+        """Request the spatial box ({axis key: (start, stop)}) of time slice t from slot, as 4D xyzc array"""
+        tagged_shape = slot.meta.getTaggedShape()
+        start = []
+        stop = []
+        for key, size in tagged_shape.items():
+            if key == "t":
+                start.append(t)
+                stop.append(t + 1)
+            else:
+                start.append(box.get(key, (0, size))[0])
+                stop.append(box.get(key, (0, size))[1])
+        data = slot(start, stop).wait()
+        data = vigra.taggedView(data, axistags=slot.meta.axistags)
+        return data.withAxes(*[k for k in tagged_shape.keys() if k in "xyzc"])
+
+    def _compute_features_blockwise(self, t):
+        """
+        Compute the features of time slice t block by block.
+
+        First, the bounding boxes of all objects are collected from the label
+        volume, one block at a time. Then every object is assigned to the block
+        that contains the start of its bounding box, and the features of each
+        block's objects are computed on the union of their bounding boxes (plus
+        the margin, if there are neighborhood features), with all other objects
+        masked out. If that union is larger than a block plus margin, the objects
+        are split into several groups, so an object that is bigger than a block
+        is computed on its own. Both passes run in parallel.
+
+        The result is the same as for whole time slices: the first row (the
+        background) is all zeros. The only difference are labels that do not
+        occur in the label volume, their rows are zeros as well.
+        """
+        tagged_shape = self.RawVolume.meta.getTaggedShape()
+        spatial_keys = [k for k in tagged_shape.keys() if k in "xyz"]
+        shape = numpy.array([tagged_shape[k] for k in spatial_keys])
+        block_shape = dict(zip(tagged_shape.keys(), self.BlockShape.value))
+        block_shape = numpy.minimum([block_shape[k] for k in spatial_keys], shape)
+
+        def make_box(start, stop):
+            return dict(zip(spatial_keys, zip(start, stop)))
+
+        # Pass 1: bounding boxes
+        bboxes = _ObjectBoundingBoxes(len(spatial_keys))
+
+        def collect_bboxes(block_start):
+            block_stop = numpy.minimum(block_start + block_shape, shape)
+            labels = self._request_box(self.LabelVolume, t, make_box(block_start, block_stop))
+            bboxes.add_block(labels.withAxes(*spatial_keys), block_start)
+
+        pool = RequestPool()
+        for block_start in numpy.ndindex(*(-(-shape // block_shape))):
+            pool.add(Request(partial(collect_bboxes, numpy.array(block_start) * block_shape)))
+        pool.wait()
+
+        # Pass 2: features, grouped by the block that contains the start of the bounding box
+        halo = numpy.asarray(max_margin(self.Features([]).wait()))[: len(spatial_keys)]
+        object_ids = bboxes.labels()
+        mins = bboxes.mins[object_ids]
+        maxs = bboxes.maxs[object_ids]
+        starts = numpy.maximum(mins - halo, 0)
+        stops = numpy.minimum(maxs + 1 + halo, shape)
+        # a group never reads more than a block plus halo, unless one of its objects alone is bigger
+        max_box_volume = numpy.prod(numpy.minimum(block_shape + 2 * halo, shape))
+        groups = []
+        if len(object_ids) > 0:
+            _, group_index = numpy.unique(mins // block_shape, axis=0, return_inverse=True)
+            group_index = group_index.ravel()
+            group_ends = numpy.cumsum(numpy.bincount(group_index))[:-1]
+            for in_group in numpy.split(numpy.argsort(group_index, kind="stable"), group_ends):
+                groups += self._split_group(object_ids, starts, stops, in_group, max_box_volume)
+        else:
+            # no objects, but we still need the (empty) feature arrays
+            groups.append((object_ids, numpy.zeros_like(shape), block_shape.copy()))
+
+        features = collections.defaultdict(dict)
+        features_lock = RequestLock()
+
+        def compute_group(ids, box_start, box_stop):
+            # Make sure the subvolume has the same dimensionality as the whole volume,
+            # the plugins treat singleton axes differently.
+            for a in numpy.flatnonzero((shape > 1) & (box_stop - box_start < 2)):
+                if box_stop[a] < shape[a]:
+                    box_stop[a] += 1
+                else:
+                    box_start[a] -= 1
+
+            box = make_box(box_start, box_stop)
+            raw = self._request_box(self.RawVolume, t, box)
+            labels = self._request_box(self.LabelVolume, t, box)
+            atlas = self._request_box(self.Atlas, t, box) if self.Atlas.ready() else None
+
+            # relabel the objects of this group consecutively, and mask out all others
+            mapping = numpy.zeros(bboxes.num_labels, dtype=numpy.uint32)
+            mapping[ids] = numpy.arange(1, len(ids) + 1, dtype=numpy.uint32)
+            labels = vigra.taggedView(mapping[numpy.asarray(labels)], axistags=labels.axistags)
+
+            group_features = self._extract(raw, labels, atlas)
+            with features_lock:
+                for plugin_name, plugin_features in group_features.items():
+                    coordinate_features = self._coordinate_features(plugin_name)
+                    for key, value in plugin_features.items():
+                        # the first row is the background
+                        value = value[1:]
+                        if key in coordinate_features:
+                            if value.shape[1] == len(box_start):
+                                value = value + box_start
+                            else:
+                                # singleton axes have been squeezed away
+                                value = value + box_start[shape > 1]
+                        if key not in features[plugin_name]:
+                            features[plugin_name][key] = numpy.zeros(
+                                (bboxes.num_labels, value.shape[1]), dtype=numpy.float32
+                            )
+                        features[plugin_name][key][ids] = value
+
+        pool = RequestPool()
+        for ids, box_start, box_stop in groups:
+            pool.add(Request(partial(compute_group, ids, box_start, box_stop)))
+        pool.wait()
+
+        return dict(features)
+
+    @staticmethod
+    def _split_group(object_ids, starts, stops, in_group, max_box_volume):
+        """
+        Split the objects in_group (indices into object_ids, starts and stops) into
+        groups of (ids, box_start, box_stop), such that each box contains at most
+        max_box_volume pixels. Objects that are bigger than that form their own group.
+        """
+        box_start = starts[in_group].min(axis=0)
+        box_stop = stops[in_group].max(axis=0)
+        if numpy.prod(box_stop - box_start) <= max_box_volume:
+            return [(object_ids[in_group], box_start, box_stop)]
+
+        groups = []
+        members = []
+        for i in in_group:
+            if members:
+                merged_start = numpy.minimum(box_start, starts[i])
+                merged_stop = numpy.maximum(box_stop, stops[i])
+                if numpy.prod(merged_stop - merged_start) <= max_box_volume:
+                    members.append(i)
+                    box_start, box_stop = merged_start, merged_stop
+                    continue
+                groups.append((object_ids[members], box_start, box_stop))
+            members = [i]
+            box_start, box_stop = starts[i].copy(), stops[i].copy()
+        groups.append((object_ids[members], box_start, box_stop))
+        return groups
+
+    def _coordinate_features(self, plugin_name):
+        if plugin_name == default_features_key:
+            # the default features are computed by the standard plugin
+            plugin_name = "Standard Object Features"
+        plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
+        return plugin.plugin_object.coordinate_features
+
     def compute_extent(self, i, image, mincoords, maxcoords, axes, margin):
         """Make a slicing to extract object i from the image."""
         # find the bounding box (margin is always 'xyz' order)
@@ -707,24 +935,38 @@ class OpRegionFeatures(Operator):
 
         if numpy.any(margin) > 0:
             # starting from 0, we stripped 0th background object in global computation
-            for i in range(0, nobj):
-                logger.debug("processing object {}".format(i))
-                extent = self.compute_extent(i, image, mincoords, maxcoords, axes, margin)
-                rawbbox = self.compute_rawbbox(image, extent, axes)
-                # it's i+1 here, because the background has label 0
-                binary_bbox = numpy.where(labels[tuple(extent)] == i + 1, 1, 0).astype(numpy.bool)
-                for plugin_name, feature_dict in feature_names.items():
-                    if not has_local_features[plugin_name]:
-                        continue
-                    plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
-                    feats = plugin.plugin_object.compute_local(rawbbox, binary_bbox, feature_dict, axes)
-                    local_features[plugin_name] = dictextend(local_features[plugin_name], feats)
+            extents = [self.compute_extent(i, image, mincoords, maxcoords, axes, margin) for i in range(0, nobj)]
+
+            # plugins that can, compute the local features of all objects at once
+            per_object_plugins = []
+            for plugin_name, feature_dict in feature_names.items():
+                if not has_local_features[plugin_name]:
+                    continue
+                plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
+                feats = plugin.plugin_object.compute_local_batch(image, labels, extents, feature_dict, axes)
+                if feats is None:
+                    per_object_plugins.append((plugin_name, plugin, feature_dict))
+                else:
+                    local_features[plugin_name] = feats
+
+            if per_object_plugins:
+                for i, extent in enumerate(extents):
+                    logger.debug("processing object {}".format(i))
+                    rawbbox = self.compute_rawbbox(image, extent, axes)
+                    # it's i+1 here, because the background has label 0
+                    binary_bbox = numpy.where(labels[tuple(extent)] == i + 1, 1, 0).astype(numpy.bool)
+                    for plugin_name, plugin, feature_dict in per_object_plugins:
+                        feats = plugin.plugin_object.compute_local(rawbbox, binary_bbox, feature_dict, axes)
+                        local_features[plugin_name] = dictextend(local_features[plugin_name], feats)
 
         logger.debug("computing done, removing failures")
         # remove local features that failed
         for pname, pfeats in local_features.items():
             for key in list(pfeats.keys()):
                 value = pfeats[key]
+                if isinstance(value, numpy.ndarray):
+                    # batched computation, already one row per object
+                    continue
                 try:
                     pfeats[key] = numpy.vstack(list(v.reshape(1, -1) for v in value))
                 except:
@@ -763,7 +1005,7 @@ class OpRegionFeatures(Operator):
         return all_features
 
     def propagateDirty(self, slot, subindex, roi):
-        if slot is self.Features:
+        if slot is self.Features or slot is self.BlockShape:
             self.Output.setDirty(slice(None))
         else:
             axes = list(self.RawVolume.meta.getTaggedShape().keys())
@@ -32,6 +32,7 @@ import numpy
 
 from lazyflow.rtype import Roi, SubRegion
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OrderedSignal
+from lazyflow.request import PriorityClass
 from lazyflow.utility import BigRequestStreamer
 from lazyflow.utility.io_util.blockwiseFileset import BlockwiseFileset
 from lazyflow.utility.timer import Timer
@@ -114,7 +115,9 @@ class OpTaskWorker(Operator):
             request_blockshape = (
                 self._primaryBlockwiseFileset.description.sub_block_shape
             )  # Could be None.  That's okay.
-            streamer = BigRequestStreamer(self.Input, (roi.start, roi.stop), request_blockshape)
+            streamer = BigRequestStreamer(
+                self.Input, (roi.start, roi.stop), request_blockshape, priorityClass=PriorityClass.BATCH
+            )
             streamer.progressSignal.subscribe(self.progressSignal)
             streamer.resultSignal.subscribe(self._handlePrimaryResultBlock)
             streamer.execute()
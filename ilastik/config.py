@@ -43,6 +43,15 @@ plugin_directories: ~/.ilastik/plugins,
 [lazyflow]
 threads: -1
 total_ram_mb: 0
+spill_dir:
+spill_mb: 0
+cache_codec:
+blosc_release_gil: true
+multiprocess_hdf5_readers: 0
+adaptive_export_batching: true
+parallel_page_reads: false
+incremental_training: false
+incremental_smoothing: false
 
 [hbp]
 token_url: https://web.ilastik.org/token/
@@ -44,6 +44,10 @@ class ObjectFeaturesPlugin(IPlugin):
 
     name = "Base object features plugin"
 
+    # names of the features whose values are absolute pixel coordinates
+    # (they are shifted when features are computed on subvolumes, see supports_blockwise())
+    coordinate_features = set()
+
     # TODO for now, only one margin will be set in the dialog. however, it
     # should be repeated for each feature, because in the future it
     # might be different, or each feature might take other parameters.
@@ -94,6 +98,42 @@ class ObjectFeaturesPlugin(IPlugin):
         """
         return dict()
 
+    def compute_local_batch(self, image, labels, extents, features, axes):
+        """Calculate the local features of many objects at once.
+
+        Optional vectorized alternative to calling compute_local() for
+        every object. Plugins that don't implement it return None, in
+        which case compute_local() is called per object.
+
+        :param image: np.ndarray - the whole image
+        :param labels: np.ndarray, dtype=int - the whole label image (without channel axis)
+        :param extents: list of slicings, extents[i] is the expanded bounding box of object i+1
+        :param features: which features to compute
+        :param axes: axis tags
+
+        :returns: None, or a dictionary with one entry per feature.
+            dict[feature_name] is a numpy.ndarray with ndim=2 and
+            shape[0] == len(extents)
+
+        """
+        return None
+
+    def supports_blockwise(self, features):
+        """Whether the given features can be computed on subvolumes.
+
+        This is the case if the features of an object only depend on the
+        object (and its neighborhood, for local features), i.e. they come
+        out the same for every subvolume that contains the object, up to
+        the offset of coordinate_features. Features that depend on global
+        image statistics, or objects other than the one at hand, can't.
+
+        :param features: which features to compute
+
+        :returns: bool
+
+        """
+        return False
+
     def fill_properties(self, feature_dict):
         """
         For every feature in the feature dictionary, fill in its properties,
@@ -67,8 +67,25 @@ class VigraObjFeats(ObjectFeaturesPlugin):
     local_suffix = " in neighborhood"  # note the space in front, it's important
     local_out_suffixes = [local_suffix, " in object and neighborhood"]
 
+    coordinate_features = set(
+        [
+            "Coord<Minimum>",
+            "Coord<Maximum>",
+            "Coord<ArgMinWeight>",
+            "Coord<ArgMaxWeight>",
+            "Coord<Mean>",
+            "RegionCenter",
+            "Weighted<Coord<Mean>>",
+            "Weighted<RegionCenter>",
+            "CenterOfMass",
+        ]
+    )
+
     ndim = None
 
+    # upper bound for the size (in pixels) of one mosaic in compute_local_batch
+    local_batch_pixels = 2 ** 24
+
     def availableFeatures(self, image, labels):
         names = vigra.analysis.supportedRegionFeatures(image, labels)
         names = list(f.replace(" ", "") for f in names)
@@ -273,13 +290,24 @@ class VigraObjFeats(ObjectFeaturesPlugin):
 
         return self._do_4d(image, labels, features, axes)
 
-    def compute_local(self, image, binary_bbox, feature_dict, axes):
-        """helper that deals with individual objects"""
-
+    def _local_featurenames(self, feature_dict):
         featurenames = list(feature_dict.keys())
         local = [x + self.local_suffix for x in self.local_features]
         featurenames = list(set(featurenames) & set(local))
-        featurenames = [x.split(" ")[0] for x in featurenames]
+        return [x.split(" ")[0] for x in featurenames]
+
+    def supports_blockwise(self, features):
+        for name in features:
+            # global statistics, the histogram range (global min/max) and coordinate sums
+            # are the only features that change with the subvolume
+            if "Global<" in name or name.startswith("Histogram") or "Coord<Sum>" in name:
+                return False
+        return True
+
+    def compute_local(self, image, binary_bbox, feature_dict, axes):
+        """helper that deals with individual objects"""
+
+        featurenames = self._local_featurenames(feature_dict)
         results = []
         margin = ilastik.applets.objectExtraction.opObjectExtraction.max_margin({"": feature_dict})
         # FIXME: this is done globally as if all the features have the same margin
@@ -291,3 +319,92 @@ class VigraObjFeats(ObjectFeaturesPlugin):
             result = self._do_4d(image, label, featurenames, axes)
             results.append(self.update_keys(result, suffix=suffix))
         return self.combine_dicts(results)
+
+    def compute_local_batch(self, image, labels, extents, feature_dict, axes):
+        """compute_local for all objects at once.
+
+        The neighborhood crops of the objects are tiled next to each other along x
+        into mosaics, so that the distance transform and the region accumulators run
+        once per mosaic instead of once per object. Neighboring crops are separated by
+        a gap wider than the margin, which keeps their neighborhoods from touching.
+        Since every crop keeps its pixel order, the results are identical to those of
+        compute_local.
+
+        Returns None if the per-object path has to be used instead.
+        """
+        featurenames = self._local_featurenames(feature_dict)
+        if "Histogram" in featurenames:
+            # the histogram range is derived from the intensities of the crop
+            return None
+
+        margin = ilastik.applets.objectExtraction.opObjectExtraction.max_margin({"": feature_dict})
+        gap = int(np.max(margin)) + 1
+        spatial = [axes.x, axes.y, axes.z]
+        shapes = [tuple(extent[a].stop - extent[a].start for a in spatial) for extent in extents]
+
+        # group objects with similar crop shapes to keep the padding small
+        order = sorted(range(len(extents)), key=lambda i: shapes[i][1:])
+        results = {}
+        start = 0
+        while start < len(order):
+            stop = start + 1
+            width, height, depth = shapes[order[start]]
+            while stop < len(order):
+                next_width, next_height, next_depth = shapes[order[stop]]
+                width += gap + next_width
+                height, depth = max(height, next_height), max(depth, next_depth)
+                if width * height * depth > self.local_batch_pixels:
+                    break
+                stop += 1
+
+            batch = order[start:stop]
+            batch_results = self._compute_mosaic(image, labels, extents, batch, featurenames, margin, gap, axes)
+            if batch_results is None:
+                return None
+            for key, value in batch_results.items():
+                if key not in results:
+                    results[key] = np.zeros((len(extents), value.shape[1]), dtype=value.dtype)
+                results[key][batch] = value
+            start = stop
+        return results
+
+    def _compute_mosaic(self, image, labels, extents, batch, featurenames, margin, gap, axes):
+        spatial = [axes.x, axes.y, axes.z]
+        mosaic_shape = [0] * 3
+        for a in spatial:
+            sizes = [extents[i][a].stop - extents[i][a].start for i in batch]
+            mosaic_shape[a] = sum(sizes) + gap * (len(batch) - 1) if a == axes.x else max(sizes)
+        raw_shape = list(mosaic_shape)
+        raw_shape.insert(axes.c, image.shape[axes.c])
+
+        binary = np.zeros(mosaic_shape, dtype=np.bool)
+        regions = np.zeros(mosaic_shape, dtype=np.uint32)
+        raw = np.zeros(raw_shape, dtype=image.dtype)
+        offset = 0
+        for region, i in enumerate(batch, start=1):
+            extent = extents[i]
+            target = [slice(0, s.stop - s.start) for s in extent]
+            target[axes.x] = slice(offset, offset + extent[axes.x].stop - extent[axes.x].start)
+            offset = target[axes.x].stop + gap
+
+            # it's i+1 here, because the background has label 0
+            binary[tuple(target)] = labels[tuple(extent)] == i + 1
+            regions[tuple(target)] = region
+            raw_target, raw_extent = list(target), list(extent)
+            raw_target.insert(axes.c, slice(None))
+            raw_extent.insert(axes.c, slice(None))
+            raw[tuple(raw_target)] = image[tuple(raw_extent)]
+
+        passed, excl = ilastik.applets.objectExtraction.opObjectExtraction.make_bboxes(binary, margin)
+        passed = np.where(passed, regions, 0)
+        excl = np.where(excl, regions, 0)
+        if np.bincount(excl.ravel(), minlength=len(batch) + 1)[1:].min() == 0:
+            # an object without neighborhood yields no rows in compute_local
+            return None
+        raw = vigra.taggedView(raw, axistags=image.axistags)
+
+        results = []
+        for label, suffix in zip([excl, passed], self.local_out_suffixes):
+            result = self._do_4d(raw, label, featurenames, axes)
+            results.append(self.update_keys(result, suffix=suffix))
+        return self.combine_dicts(results)
@@ -37,6 +37,9 @@ from . import stype
 from . import graph
 from . import slot
 from . import operators
+from .utility import requestProfiler
+
+requestProfiler.start_from_env()  # no-op unless LAZYFLOW_PROFILE is set
 
 
 class N5JsonEncoder(json.JSONEncoder):
@@ -1,7 +1,27 @@
 from builtins import object
 import abc
+import logging
 from future.utils import with_metaclass
 
+logger = logging.getLogger(__name__)
+
+# Whether classifiers are retrained incrementally (see create_and_train_incremental()).
+# Can be set via configure() (resp. incremental_training in the [lazyflow] section of .ilastikrc).
+_incremental_training = False
+
+
+def configure(incremental_training=False):
+    """
+    Enable or disable incremental retraining in OpTrainClassifierFromFeatureVectors.
+    """
+    global _incremental_training
+    _incremental_training = bool(incremental_training)
+    logger.info("Incremental classifier training {}".format("enabled" if _incremental_training else "disabled"))
+
+
+def incremental_training():
+    return _incremental_training
+
 
 def _has_attribute(cls, attr):
     return any(attr in B.__dict__ for B in cls.__mro__)
@@ -31,6 +51,15 @@ class LazyflowVectorwiseClassifierFactoryABC(with_metaclass(abc.ABCMeta, object)
         """
         raise NotImplementedError
 
+    def create_and_train_incremental(self, previous_classifier, X, y, feature_names=None):
+        """
+        Like create_and_train(), but the factory may reuse parts of ``previous_classifier``,
+        which it trained on an earlier version of the feature matrix and label vector.
+        (The default implementation always trains from scratch.)
+        OpTrainClassifierFromFeatureVectors only calls this if enabled via configure().
+        """
+        return self.create_and_train(X, y, feature_names)
+
     @abc.abstractproperty
     def description(self):
         """
@@ -38,6 +38,7 @@ import tempfile
 from functools import partial
 import pickle as pickle
 import collections
+import threading
 
 import numpy
 import vigra
@@ -45,13 +46,48 @@ import h5py
 import random
 
 from lazyflow.utility import Timer
-from lazyflow.request import Request, RequestPool, RequestLock
+from lazyflow.request import Request, RequestPool
+from . import lazyflowClassifier
 from .lazyflowClassifier import LazyflowVectorwiseClassifierABC, LazyflowVectorwiseClassifierFactoryABC
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Prediction streams the feature rows through all forests in batches of (roughly) this size,
+# so that the features and per-forest predictions of a batch stay in the cache.
+PREDICTION_BATCH_BYTES = 2 ** 20
+
+# Per-thread scratch buffer for the predictions of a single forest (reused across batches and blocks).
+_prediction_scratch = threading.local()
+
+
+def _scratch_buffer(shape):
+    """
+    Return a float32 array of the given shape, backed by this thread's scratch buffer.
+    The contents are only valid until the next call (in the same thread).
+    """
+    size = int(numpy.prod(shape))
+    buf = getattr(_prediction_scratch, "buffer", None)
+    if buf is None or buf.size < size:
+        buf = _prediction_scratch.buffer = numpy.empty(size, dtype=numpy.float32)
+    return buf[:size].reshape(shape)
+
+
+def _row_hashes(X, y, block_rows=2 ** 16):
+    """
+    Return a 64-bit hash of each training sample (feature row and label),
+    to find the samples that were added since the last training.
+    """
+    rows = numpy.concatenate((numpy.asarray(X, numpy.float32).view(numpy.uint32), y.reshape(len(y), -1)), axis=1)
+    multipliers = numpy.random.RandomState(0).randint(1, 2 ** 62, rows.shape[1], dtype=numpy.uint64) | 1
+    hashes = numpy.empty(len(rows), dtype=numpy.uint64)
+    for start in range(0, len(rows), block_rows):
+        block = rows[start : start + block_rows].astype(numpy.uint64)
+        # (Integer overflow is intended.)
+        hashes[start : start + block_rows] = (block * multipliers).sum(axis=1, dtype=numpy.uint64)
+    return hashes
+
 
 class ParallelVigraRfLazyflowClassifierFactory(LazyflowVectorwiseClassifierFactoryABC):
     """
@@ -61,6 +97,17 @@ class ParallelVigraRfLazyflowClassifierFactory(LazyflowVectorwiseClassifierFacto
     VERSION = 2  # This is used to determine compatibility of pickled classifier factories.
     # You must bump this if any instance members are added/removed/renamed.
 
+    # Incremental training (see create_and_train_incremental()):
+    # Fraction of the forests that is replaced after labels were added.
+    INCREMENTAL_REPLACE_FRACTION = 0.25
+    # Forests that haven't seen more than this fraction of the current training samples
+    # are retrained on all samples (if that applies to all forests, everything is retrained).
+    INCREMENTAL_MAX_STALENESS = 0.5
+    # Number of samples the replaced forests are trained with (the new samples, plus a random subset of the old ones)
+    INCREMENTAL_MAX_SAMPLES = 50000
+    # How many times the new samples are included in the training samples of the replaced forests
+    INCREMENTAL_NEW_SAMPLE_WEIGHT = 3
+
     def __init__(
         self,
         num_trees_total=100,
@@ -108,15 +155,26 @@ class ParallelVigraRfLazyflowClassifierFactory(LazyflowVectorwiseClassifierFacto
     def set_label_proportion(self, label_proportion):
         self._label_proportion = label_proportion
 
-    def create_and_train(self, X, y, feature_names=None):
-        logger.debug("Training parallel vigra RF")
-
+    def _tree_counts(self):
         # Distribute trees as evenly as possible
         tree_counts = numpy.array([self._num_trees // self._num_forests] * self._num_forests)
         tree_counts[: self._num_trees % self._num_forests] += 1
         assert tree_counts.sum() == self._num_trees
         tree_counts = list(map(int, tree_counts))
         tree_counts[:] = (tree_count for tree_count in tree_counts if tree_count != 0)
+        return tree_counts
+
+    def create_and_train(self, X, y, feature_names=None):
+        return self._create_and_train(X, y, feature_names)
+
+    def _create_and_train(self, X, y, feature_names=None, row_hashes=None):
+        """
+        Train all forests.
+        row_hashes: The hashes of the training samples (see _row_hashes), if they are already known.
+        """
+        logger.debug("Training parallel vigra RF")
+
+        tree_counts = self._tree_counts()
 
         # Save for future reference
         known_labels = numpy.unique(y)
@@ -129,6 +187,12 @@ class ParallelVigraRfLazyflowClassifierFactory(LazyflowVectorwiseClassifierFacto
         assert X.ndim == 2
         assert len(X) == len(y)
 
+        # Remember the training samples, if they are needed for incremental training.
+        if self._label_proportion:
+            row_hashes = None
+        elif row_hashes is None and lazyflowClassifier.incremental_training():
+            row_hashes = _row_hashes(X, y)
+
         # Sample X and y
         if self._label_proportion:
             proportion = self._label_proportion
@@ -166,7 +230,116 @@ class ParallelVigraRfLazyflowClassifierFactory(LazyflowVectorwiseClassifierFacto
             oobs = self._train_forests(forests, X, y)
 
         logger.info("Training complete. Average OOB: {}".format(numpy.average(oobs)))
-        return ParallelVigraRfLazyflowClassifier(forests, oobs, known_labels, feature_names, named_importances)
+        return ParallelVigraRfLazyflowClassifier(
+            forests,
+            oobs,
+            known_labels,
+            feature_names,
+            named_importances,
+            training_row_hashes=row_hashes,
+            forest_training_rows=[len(X)] * len(forests),
+        )
+
+    def create_and_train_incremental(self, previous_classifier, X, y, feature_names=None):
+        """
+        Retrain only some of the forests of previous_classifier, if labels were only added since it was trained:
+        The INCREMENTAL_REPLACE_FRACTION of the forests which have seen the fewest of the current samples are
+        replaced by forests that are trained with a sample of (at most) INCREMENTAL_MAX_SAMPLES, in which the new
+        samples are overrepresented (see _incremental_sample). That way, the training time doesn't depend on the
+        total number of labels.
+        Forests that haven't seen more than INCREMENTAL_MAX_STALENESS of the samples are retrained with all samples.
+        If labels were removed or changed (or the classifier can't be reused), all forests are retrained.
+        """
+        X = numpy.asarray(X, numpy.float32)
+        y = numpy.asarray(y, numpy.uint32)
+        if not self._can_train_incrementally(previous_classifier, X, y, feature_names):
+            return self.create_and_train(X, y, feature_names)
+
+        row_hashes = _row_hashes(X, y)
+        previous_row_hashes = previous_classifier._training_row_hashes
+        if not numpy.isin(previous_row_hashes, row_hashes).all():
+            logger.debug("Labels were removed or changed: Training all forests.")
+            return self._create_and_train(X, y, feature_names, row_hashes)
+
+        is_new = ~numpy.isin(row_hashes, previous_row_hashes)
+        if not is_new.any() and len(X) == len(previous_row_hashes):
+            return previous_classifier
+
+        # Fraction of the current samples that each forest hasn't seen
+        staleness = 1.0 - numpy.array(previous_classifier._forest_training_rows) / len(X)
+        stale_forests = set(numpy.flatnonzero(staleness > self.INCREMENTAL_MAX_STALENESS))
+        if len(stale_forests) == len(staleness):
+            logger.debug("All forests are stale: Training all forests.")
+            return self._create_and_train(X, y, feature_names, row_hashes)
+
+        num_replaced = max(1, int(round(self.INCREMENTAL_REPLACE_FRACTION * len(staleness))))
+        # (Stalest first; among equally stale forests, the ones that were replaced longest ago.)
+        replaced_forests = set(numpy.argsort(-staleness, kind="stable")[:num_replaced]) - stale_forests
+
+        logger.debug(
+            "Incremental training: {} new samples, retraining {} forest(s) with all samples and {} forest(s) "
+            "with a sample.".format(is_new.sum(), len(stale_forests), len(replaced_forests))
+        )
+
+        forests = list(previous_classifier._forests)
+        oobs = list(previous_classifier.oobs)
+        forest_training_rows = list(previous_classifier._forest_training_rows)
+
+        y_column = y[:, numpy.newaxis] if y.ndim == 1 else y
+        sample = self._incremental_sample(y_column[:, 0], is_new)
+        # (The replaced forests have only seen the distinct samples in the sample, so they become stale eventually.)
+        for indexes, features, labels, num_rows in (
+            (sorted(stale_forests), X, y_column, len(X)),
+            (sorted(replaced_forests), X[sample], y_column[sample], len(numpy.unique(sample))),
+        ):
+            new_forests = [vigra.learning.RandomForest(forests[i].treeCount(), **self._kwargs) for i in indexes]
+            new_oobs = self._train_forests(new_forests, features, labels)
+            for i, forest, oob in zip(indexes, new_forests, new_oobs):
+                forests[i] = forest
+                oobs[i] = oob
+                forest_training_rows[i] = num_rows
+
+        # Keep the least recently replaced forests at the front, so they are the next to be replaced.
+        order = sorted(range(len(forests)), key=lambda i: (i in stale_forests or i in replaced_forests, i))
+        return ParallelVigraRfLazyflowClassifier(
+            [forests[i] for i in order],
+            [oobs[i] for i in order],
+            previous_classifier.known_classes,
+            feature_names,
+            training_row_hashes=row_hashes,
+            forest_training_rows=[forest_training_rows[i] for i in order],
+        )
+
+    def _can_train_incrementally(self, previous_classifier, X, y, feature_names):
+        return (
+            isinstance(previous_classifier, ParallelVigraRfLazyflowClassifier)
+            and previous_classifier._training_row_hashes is not None
+            and not self._label_proportion
+            and not self._variable_importance_enabled
+            and sorted(forest.treeCount() for forest in previous_classifier._forests) == sorted(self._tree_counts())
+            and list(previous_classifier.known_classes) == list(numpy.unique(y))
+            and previous_classifier.feature_count == X.shape[1]
+            and previous_classifier.feature_names == feature_names
+        )
+
+    def _incremental_sample(self, y, is_new):
+        """
+        Return the indexes of the training samples for the replaced forests:
+        The new samples (INCREMENTAL_NEW_SAMPLE_WEIGHT times, but at most half of the sample),
+        and a random subset of the old samples (which includes some samples of each label class).
+        """
+        rng = numpy.random.RandomState()
+        new_rows = numpy.repeat(numpy.flatnonzero(is_new), self.INCREMENTAL_NEW_SAMPLE_WEIGHT)
+        if len(new_rows) > self.INCREMENTAL_MAX_SAMPLES // 2:
+            new_rows = rng.choice(new_rows, self.INCREMENTAL_MAX_SAMPLES // 2, replace=False)
+        old_rows = numpy.flatnonzero(~is_new)
+        num_old = min(len(old_rows), self.INCREMENTAL_MAX_SAMPLES - len(new_rows))
+        sample = [new_rows, rng.choice(old_rows, num_old, replace=False)]
+
+        # Each forest must know all label classes.
+        for label in numpy.setdiff1d(y, y[numpy.concatenate(sample)]):
+            sample.append(numpy.flatnonzero(y == label)[:10])
+        return numpy.concatenate(sample)
 
     @staticmethod
     def _train_forests(forests, X, y):
@@ -233,7 +406,9 @@ class ParallelVigraRfLazyflowClassifierFactory(LazyflowVectorwiseClassifierFacto
         return oobs, named_importances
 
     def estimated_ram_usage_per_requested_predictionchannel(self):
-        return (Request.global_thread_pool.num_workers) * 4
+        # The forests accumulate their votes in a single float32 result array
+        # (the per-forest predictions only need small, reused batch buffers).
+        return 4
 
     @property
     def description(self):
@@ -315,7 +490,20 @@ class ParallelVigraRfLazyflowClassifier(LazyflowVectorwiseClassifierABC):
     Adapt the vigra RandomForest class to the interface lazyflow expects.
     """
 
-    def __init__(self, forests, oobs, known_labels, feature_names=None, named_importances=None):
+    def __init__(
+        self,
+        forests,
+        oobs,
+        known_labels,
+        feature_names=None,
+        named_importances=None,
+        training_row_hashes=None,
+        forest_training_rows=None,
+    ):
+        """
+        training_row_hashes: Hashes of the training samples (see _row_hashes), for incremental training.
+        forest_training_rows: For each forest, the number of (distinct) training samples it was trained with.
+        """
         self._known_labels = known_labels
         self._forests = forests
         self._feature_names = feature_names
@@ -328,7 +516,14 @@ class ParallelVigraRfLazyflowClassifier(LazyflowVectorwiseClassifierABC):
         # Named importances for the variable importance table
         self._named_importances = named_importances
 
+        # For incremental training (not serialized)
+        self._training_row_hashes = training_row_hashes
+        self._forest_training_rows = forest_training_rows
+
     def predict_probabilities(self, X):
+        """
+        Predict with all forests, in parallel batches of feature rows.
+        """
         logger.debug("Predicting with parallel vigra RF")
         X = numpy.asarray(X, dtype=numpy.float32)
         assert X.ndim == 2
@@ -340,30 +535,36 @@ class ParallelVigraRfLazyflowClassifier(LazyflowVectorwiseClassifierABC):
                 "Expected features: {}".format(X.shape[1], len(self._feature_names), self._feature_names)
             )
 
-        # As each forest completes, aggregate results in a shared array.
-        # (Must put in a list so we can update it in this closure.)
-        total_predictions = [None]
-        prediction_lock = RequestLock()
+        num_rows = len(X)
+        num_classes = self._forests[0].labelCount()
+        predictions = numpy.zeros((num_rows, num_classes), dtype=numpy.float32)
+        if num_rows == 0:
+            return predictions
 
-        def update_predictions(forest, forest_predictions):
-            forest_predictions *= forest.treeCount()
-            with prediction_lock:
-                if total_predictions[0] is None:
-                    total_predictions[0] = forest_predictions
-                else:
-                    total_predictions[0] += forest_predictions
+        # Cache-sized batches, but enough of them to keep all workers busy.
+        batch_rows = max(64, PREDICTION_BATCH_BYTES // (4 * max(X.shape[1], num_classes)))
+        num_workers = max(1, Request.global_thread_pool.num_workers)
+        batch_rows = min(batch_rows, -(-num_rows // num_workers))
 
-        # Create a request for each forest
         pool = RequestPool()
-        for forest in self._forests:
-            req = Request(partial(forest.predictProbabilities, X))
-            req.notify_finished(partial(update_predictions, forest))
-            pool.add(req)
-        del req
+        for start in range(0, num_rows, batch_rows):
+            stop = min(start + batch_rows, num_rows)
+            pool.add(Request(partial(self._predict_batch, X[start:stop], predictions[start:stop])))
         pool.wait()
+        return predictions
 
-        total_predictions[0] /= self._num_trees
-        return total_predictions[0]
+    def _predict_batch(self, X, votes):
+        """
+        Accumulate the (tree-count weighted) predictions of all forests for the given
+        feature rows into votes, and normalize them to probabilities.
+        """
+        for forest in self._forests:
+            # Note: Nothing in here may wait for a request (another request could use the scratch buffer meanwhile).
+            forest_predictions = _scratch_buffer(votes.shape)
+            forest.predictProbabilities(X, out=forest_predictions)
+            forest_predictions *= forest.treeCount()
+            votes += forest_predictions
+        votes /= self._num_trees
 
     @property
     def oobs(self):
@@ -0,0 +1,237 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2020, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+# 		   http://ilastik.org/license/
+###############################################################################
+"""
+Eviction policies for the cache memory manager.
+
+A policy assigns a priority to every cache entry (a single block of a
+ManagedBlockedCache or a whole ManagedCache). Entries with the *lowest*
+priority are evicted first. The manager keeps all entries in an
+EvictionQueue (a lazily invalidated min-heap), which is updated
+incrementally between cleanup cycles instead of being re-sorted each time.
+
+Usage::
+
+    from lazyflow.operators import cacheMemoryManager
+    from lazyflow.operators.cacheEvictionPolicies import GDSFEvictionPolicy
+
+    cacheMemoryManager.setEvictionPolicy(GDSFEvictionPolicy())
+"""
+
+import collections
+import heapq
+import itertools
+import weakref
+
+# Statistics a cache reports for each of its blocks.
+#  key: block id as accepted by ManagedBlockedCache.freeBlock()
+#  last_access: python timestamp of the last access
+#  size: memory occupied by the block in bytes (None if unknown)
+#  cost: time in seconds it took to compute the block (None if unknown)
+BlockStatistics = collections.namedtuple("BlockStatistics", ["key", "last_access", "size", "cost"])
+
+
+class CacheEntry(object):
+    """
+    An evictable unit as seen by an eviction policy.
+    If key is None, the entry stands for a whole (non-blocked) cache.
+    """
+
+    __slots__ = ("cache_ref", "cache_name", "key", "last_access", "size", "cost", "hits")
+
+    def __init__(self, cache, key, last_access, size, cost, hits=1):
+        self.cache_ref = weakref.ref(cache)
+        self.cache_name = cache.name
+        self.key = key
+        self.last_access = last_access
+        self.size = size
+        self.cost = cost
+        self.hits = hits
+
+
+class EvictionPolicy(object):
+    """
+    Base class for eviction policies.
+    """
+
+    # If True, the priorities depend on global state that changes between cycles,
+    # so all entries must be re-prioritized in every cleanup cycle.
+    reprioritize_every_cycle = False
+
+    def begin_cycle(self, entries):
+        """
+        Called once per cleanup cycle with all current entries, before any eviction happens.
+        """
+        pass
+
+    def priority(self, entry):
+        """
+        Return the priority of the given CacheEntry. Lower priorities are evicted first.
+        """
+        raise NotImplementedError()
+
+    def evicted(self, entry, priority):
+        """
+        Called after the given entry was chosen for eviction.
+        """
+        pass
+
+
+class LRUEvictionPolicy(EvictionPolicy):
+    """
+    Evict the least recently used entries first (the classic behavior).
+    """
+
+    def priority(self, entry):
+        return entry.last_access
+
+
+class GDSFEvictionPolicy(EvictionPolicy):
+    """
+    Greedy-Dual-Size-Frequency: priority = L + hits * cost / size
+
+    Entries that were expensive to compute, are small, or are accessed often
+    are kept longer. The "inflation" value L is raised to the priority of each
+    evicted entry, so entries that have not been touched for a long time
+    eventually become evictable no matter how expensive they were.
+
+    Entries without a reported cost fall back to ``default_cost`` seconds,
+    entries without a reported size to ``default_size`` bytes.
+    """
+
+    def __init__(self, default_cost=0.0, default_size=1.0):
+        self._inflation = 0.0
+        self._default_cost = default_cost
+        self._default_size = default_size
+
+    def priority(self, entry):
+        cost = entry.cost if entry.cost is not None else self._default_cost
+        size = entry.size if entry.size else self._default_size
+        return self._inflation + entry.hits * cost / size
+
+    def evicted(self, entry, priority):
+        self._inflation = max(self._inflation, priority)
+
+
+class QuotaEvictionPolicy(EvictionPolicy):
+    """
+    Per-cache memory quotas on top of another policy.
+
+    ``quotas`` maps a cache's name to the fraction of the total cache memory it
+    may occupy; caches that are not listed get ``default_quota``. Entries of
+    caches that are over their quota are evicted before any other entry, and
+    within each group the ``base_policy`` decides.
+    """
+
+    reprioritize_every_cycle = True
+
+    def __init__(self, quotas=None, default_quota=1.0, base_policy=None):
+        self._quotas = dict(quotas or {})
+        self._default_quota = default_quota
+        self._base_policy = base_policy or LRUEvictionPolicy()
+        self._over_quota = set()
+
+    def begin_cycle(self, entries):
+        usage = collections.defaultdict(float)
+        for entry in entries:
+            usage[entry.cache_name] += entry.size or 0.0
+        total = sum(usage.values())
+        self._over_quota = {
+            name for name, used in usage.items() if used > self._quotas.get(name, self._default_quota) * total
+        }
+        self._base_policy.begin_cycle(entries)
+
+    def priority(self, entry):
+        in_quota = entry.cache_name not in self._over_quota
+        return (in_quota, self._base_policy.priority(entry))
+
+    def evicted(self, entry, priority):
+        self._base_policy.evicted(entry, priority[1])
+
+
+class EvictionQueue(object):
+    """
+    Min-heap of cache entries ordered by an EvictionPolicy.
+
+    The heap persists between cleanup cycles. On refresh(), only new entries and
+    entries whose access time changed are (re-)pushed; outdated heap items are
+    skipped when they surface in pop(). This class is not thread-safe.
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def refresh(self, cache_stats):
+        """
+        Synchronize the queue with the current cache contents.
+
+        :param cache_stats: iterable of (cache, BlockStatistics) pairs
+        """
+        previous = self._entries
+        self._entries = {}
+        changed = []
+        for cache, stats in cache_stats:
+            ident = (id(cache), stats.key)
+            old = previous.get(ident)
+            if old is not None and old.cache_ref() is cache:
+                if old.last_access == stats.last_access:
+                    old.size = stats.size
+                    old.cost = stats.cost
+                    self._entries[ident] = old
+                    continue
+                hits = old.hits + 1
+            else:
+                hits = 1
+            entry = CacheEntry(cache, stats.key, stats.last_access, stats.size, stats.cost, hits)
+            self._entries[ident] = entry
+            changed.append((ident, entry))
+
+        self.policy.begin_cycle(list(self._entries.values()))
+        if self.policy.reprioritize_every_cycle or len(self._heap) > 2 * len(self._entries) + 64:
+            # Drop all outdated heap items at once
+            self._heap = [
+                (self.policy.priority(entry), next(self._counter), ident, entry)
+                for ident, entry in self._entries.items()
+            ]
+            heapq.heapify(self._heap)
+        else:
+            for ident, entry in changed:
+                heapq.heappush(self._heap, (self.policy.priority(entry), next(self._counter), ident, entry))
+
+    def pop(self):
+        """
+        Remove and return the entry that should be evicted next, or None if the queue is empty.
+        """
+        while self._heap:
+            priority, _, ident, entry = heapq.heappop(self._heap)
+            if self._entries.get(ident) is not entry:
+                # Outdated heap item (entry was updated or removed since it was pushed)
+                continue
+            del self._entries[ident]
+            self.policy.evicted(entry, priority)
+            return entry
+        return None
@@ -26,15 +26,14 @@ from __future__ import division
 import gc
 import threading
 import weakref
-import functools
 import atexit
 import warnings
 
-
 # lazyflow
 from lazyflow.utility import OrderedSignal
 from lazyflow.utility import log_exception
 from lazyflow.utility import Memory
+from lazyflow.operators.cacheEvictionPolicies import BlockStatistics, EvictionQueue, LRUEvictionPolicy
 
 
 import logging
@@ -72,6 +71,11 @@ class _CacheMemoryManager(threading.Thread):
 
     the interval is measured in seconds. Each change of refresh interval
     triggers cleanup.
+
+    Which cache entries are released first is decided by an eviction policy
+    (least recently used by default), see cacheEvictionPolicies.py::
+
+        cache_mem_manager.setEvictionPolicy(GDSFEvictionPolicy())
     """
 
     totalCacheMemory = OrderedSignal()
@@ -91,6 +95,7 @@ class _CacheMemoryManager(threading.Thread):
         self._disabled = False
         self._refresh_interval = default_refresh_interval
         self._first_class_caches_lock = threading.Lock()
+        self._eviction_queue = EvictionQueue(LRUEvictionPolicy())
 
         # maximum fraction of *allowed memory* used
         self._max_usage = 1.0
@@ -204,27 +209,27 @@ class _CacheMemoryManager(threading.Thread):
             if total <= self._max_usage * cache_memory:
                 return
 
-            cache_entries = []
-            cache_entries += [
-                (cache.lastAccessTime(), cache.name, cache.freeMemory) for cache in list(self._managed_caches)
-            ]
-            cache_entries += [
-                (lastAccessTime, f"{cache.name}: {blockKey}", functools.partial(cache.freeBlock, blockKey))
-                for cache in list(self._managed_blocked_caches)
-                for blockKey, lastAccessTime in cache.getBlockAccessTimes()
-            ]
-            cache_entries.sort(key=lambda entry: entry[0])
-
-            for lastAccessTime, info, cleanupFun in cache_entries:
-                if total <= self._target_usage * cache_memory:
+            self._eviction_queue.refresh(self._getCacheStatistics())
+
+            while total > self._target_usage * cache_memory:
+                entry = self._eviction_queue.pop()
+                if entry is None:
                     break
-                mem = cleanupFun()
+                cache = entry.cache_ref()
+                if cache is None:
+                    continue
+                if entry.key is None:
+                    mem = cache.freeMemory()
+                    info = cache.name
+                else:
+                    mem = cache.freeBlock(entry.key)
+                    info = f"{cache.name}: {entry.key}"
                 logger.debug(f"Cleaned up {info} ({Memory.format(mem)})")
                 total -= mem
 
             # Remove references to cache entries before triggering garbage collection.
-            cleanupFun = None
-            cache_entries = None
+            cache = None
+            entry = None
             gc.collect()
 
             msg = "Done cleaning up, cache memory usage is now at {}".format(Memory.format(total))
@@ -234,6 +239,27 @@ class _CacheMemoryManager(threading.Thread):
         except:
             log_exception(logger)
 
+    def _getCacheStatistics(self):
+        """
+        yield (cache, BlockStatistics) for every evictable entry
+
+        Non-blocked managed caches are represented by a single entry with key None.
+        """
+        for cache in list(self._managed_caches):
+            yield cache, BlockStatistics(None, cache.lastAccessTime(), cache.usedMemory(), None)
+        for cache in list(self._managed_blocked_caches):
+            for stats in cache.getBlockStatistics():
+                yield cache, stats
+
+    def setEvictionPolicy(self, policy):
+        """
+        set the policy (see cacheEvictionPolicies.py) that decides which cache entries are freed first
+
+        This method blocks until current memory management tasks are finished.
+        """
+        with self._disable_lock:
+            self._eviction_queue = EvictionQueue(policy)
+
     def _wait(self):
         """
         sleep for _refresh_interval seconds or until woken up
@@ -300,3 +326,7 @@ def addFirstClassCache(cache):
 
 def setRefreshInterval(seconds):
     _cache_memory_manager.setRefreshInterval(seconds)
+
+
+def setEvictionPolicy(policy):
+    _cache_memory_manager.setEvictionPolicy(policy)
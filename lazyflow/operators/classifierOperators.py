@@ -41,6 +41,7 @@ from lazyflow.classifiers import (
     LazyflowPixelwiseClassifierABC,
     LazyflowPixelwiseClassifierFactoryABC,
 )
+from lazyflow.classifiers import lazyflowClassifier
 
 from .opFeatureMatrixCache import OpFeatureMatrixCache
 from .opConcatenateFeatureMatrices import OpConcatenateFeatureMatrices
@@ -313,6 +314,9 @@ class OpTrainClassifierFromFeatureVectors(Operator):
         super(OpTrainClassifierFromFeatureVectors, self).__init__(*args, **kwargs)
         self.trainingCompleteSignal = OrderedSignal()
 
+        # The last classifier and the factory that trained it (if incremental training is enabled)
+        self._previous_training = (None, None)
+
         # TODO: Progress...
         # self.progressSignal = OrderedSignal()
 
@@ -344,7 +348,16 @@ class OpTrainClassifierFromFeatureVectors(Operator):
         )
 
         logger.debug("Training new classifier: {}".format(classifier_factory.description))
-        classifier = classifier_factory.create_and_train(featMatrix, labelsMatrix[:, 0], channel_names)
+        incremental = lazyflowClassifier.incremental_training()
+        previous_factory, previous_classifier = self._previous_training
+        if incremental and previous_classifier is not None and previous_factory == classifier_factory:
+            classifier = classifier_factory.create_and_train_incremental(
+                previous_classifier, featMatrix, labelsMatrix[:, 0], channel_names
+            )
+        else:
+            classifier = classifier_factory.create_and_train(featMatrix, labelsMatrix[:, 0], channel_names)
+        # (Don't hold on to the previous classifier unless we need it.)
+        self._previous_training = (copy.copy(classifier_factory), classifier) if incremental else (None, None)
         result[0] = classifier
         if classifier is not None:
             assert issubclass(type(classifier), LazyflowVectorwiseClassifierABC), (
@@ -29,6 +29,7 @@ import glob
 import h5py
 import z5py
 from collections import OrderedDict
+from functools import partial
 
 logger = logging.getLogger(__name__)
 traceLogger = logging.getLogger("TRACE." + __name__)
@@ -40,7 +41,14 @@ import vigra
 
 from lazyflow.graph import OrderedSignal, Operator, OutputSlot, InputSlot
 from lazyflow.roi import roiToSlice, roiFromShape, determineBlockShape
+from lazyflow.request import PriorityClass
 from lazyflow.utility.bigRequestStreamer import BigRequestStreamer
+from lazyflow.utility import adaptiveRequestController
+from lazyflow.utility.asyncBlockWriter import AsyncBlockWriter
+from lazyflow.utility import pageCache
+from lazyflow.utility.pageCache import PageCache, io_executor
+from lazyflow.operators.opCache import ManagedBlockedCache
+from lazyflow.operators.cacheEvictionPolicies import BlockStatistics
 
 
 class OpImageReader(Operator):
@@ -107,14 +115,60 @@ class OpImageReader(Operator):
             assert False, "Unknown dirty input slot."
 
 
-class OpStackLoader(Operator):
+class PagedReaderCache(ManagedBlockedCache):
+    """
+    Cache interface for the readers that keep their decoded pages in self._pages
+    (a lazyflow.utility.pageCache.PageCache, or None if parallel page reads are disabled).
+    Each page is a block for the cache memory manager.
+    """
+
+    def _createPageCache(self, read_page, num_pages, prefetch):
+        """
+        Return a PageCache, or None if parallel page reads are disabled.
+        """
+        if not pageCache.parallel_reads():
+            return None
+        self.registerWithMemoryManager()
+        return PageCache(read_page, num_pages=num_pages, prefetch=prefetch)
+
+    def usedMemory(self):
+        pages = self._pages
+        return pages.used_bytes() if pages is not None else 0
+
+    def fractionOfUsedMemoryDirty(self):
+        # Pages never become dirty, new inputs get a new PageCache.
+        return 0.0
+
+    def getBlockAccessTimes(self):
+        return [(stats.key, stats.last_access) for stats in self.getBlockStatistics()]
+
+    def getBlockStatistics(self):
+        pages = self._pages
+        if pages is None:
+            return []
+        return [BlockStatistics(*stats) for stats in pages.page_statistics()]
+
+    def freeBlock(self, block_id):
+        pages = self._pages
+        return pages.free_page(block_id) if pages is not None else 0
+
+    def freeMemory(self):
+        pages = self._pages
+        return pages.clear() if pages is not None else 0
+
+    def freeDirtyMemory(self):
+        return 0
+
+
+class OpStackLoader(Operator, PagedReaderCache):
     """Imports an image stack.
 
-    Note: This operator does NOT cache the images, so direct access
-          via the execute() function is very inefficient, especially
-          through the Z-axis. Typically, you'll want to connect this
-          operator to a cache whose block size is large in the X-Y
-          plane.
+    Note: This operator does NOT cache the images (unless parallel page
+          reads are enabled, see lazyflow.utility.pageCache, and then only
+          the most recent ones), so direct access via the execute()
+          function is very inefficient, especially through the Z-axis.
+          Typically, you'll want to connect this operator to a cache
+          whose block size is large in the X-Y plane.
 
     :param globstring: A glob string as defined by the glob module. We
         also support the following special extension to globstring
@@ -145,6 +199,13 @@ class OpStackLoader(Operator):
             self.msg = f"Unable to open file: {filename}"
             super().__init__(self.msg)
 
+    #: Number of pages to decode ahead of each request (in the direction of the previous requests)
+    PREFETCH_PAGES = 4
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pages = None
+
     def setupOutputs(self):
         self.fileNameList = self.expandGlobStrings(self.globstring.value)
 
@@ -152,12 +213,15 @@ class OpStackLoader(Operator):
         if len(self.fileNameList) == 0:
             self.stack.meta.NOTREADY = True
             return
-        try:
-            self.info = vigra.impex.ImageInfo(self.fileNameList[0])
-            self.slices_per_file = vigra.impex.numberImages(self.fileNameList[0])
-        except RuntimeError as e:
-            logger.error(str(e))
-            raise OpStackLoader.FileOpenError(self.fileNameList[0]) from e
+        self.info, self.slices_per_file = self._readFileInfo(self.fileNameList[0])
+        self._validateFiles()
+
+        # Page position: file index * slices_per_file + image index
+        self._pages = self._createPageCache(
+            partial(self._readPage, tuple(self.fileNameList), self.slices_per_file),
+            num_pages=num_files * self.slices_per_file,
+            prefetch=self.PREFETCH_PAGES,
+        )
 
         slice_shape = self.info.getShape()
         X, Y, C = slice_shape
@@ -199,6 +263,41 @@ class OpStackLoader(Operator):
         self.stack.meta.axistags = axistags
         self.stack.meta.dtype = self.info.getDtype()
 
+    @staticmethod
+    def _readFileInfo(fileName):
+        try:
+            return vigra.impex.ImageInfo(fileName), vigra.impex.numberImages(fileName)
+        except RuntimeError as e:
+            logger.error(str(e))
+            raise OpStackLoader.FileOpenError(fileName) from e
+
+    def _validateFiles(self):
+        """
+        Check (once, reading the file headers in parallel) that all files have the same shape.
+        """
+        for fileName, (info, images_per_file) in zip(
+            self.fileNameList[1:], io_executor().map(self._readFileInfo, self.fileNameList[1:])
+        ):
+            if self.info.getShape() != info.getShape():
+                raise RuntimeError(f"not all files have the same shape: {fileName}")
+            if self.slices_per_file != images_per_file:
+                raise RuntimeError(f"Not all files have the same number of slices: {fileName}")
+
+    @staticmethod
+    def _readPage(fileNameList, slices_per_file, position):
+        file_index, image_index = divmod(position, slices_per_file)
+        traceLogger.debug(f"Reading image: {fileNameList[file_index]}, index {image_index}")
+        return vigra.impex.readImage(fileNameList[file_index], index=image_index)
+
+    def _readPages(self, file_image_indexes):
+        """
+        Decode the given (file index, image index) pages (in parallel, if enabled), and iterate over them in order.
+        """
+        positions = (file_index * self.slices_per_file + image_index for file_index, image_index in file_image_indexes)
+        if self._pages is None:
+            return (self._readPage(self.fileNameList, self.slices_per_file, position) for position in positions)
+        return self._pages.read(positions)
+
     def propagateDirty(self, slot, subindex, roi):
         assert slot == self.globstring
         # Any change to the globstring means our entire output is dirty.
@@ -224,18 +323,9 @@ class OpStackLoader(Operator):
         C = self.info.getShape()[2]
 
         # Copy each c-slice one at a time.
-        for i, fileName in enumerate(self.fileNameList[c_start // C : c_stop // C]):
-            traceLogger.debug(f"Reading image: {fileName}")
-            file_shape = vigra.impex.ImageInfo(fileName).getShape()
-            if self.info.getShape() != file_shape:
-                raise RuntimeError("not all files have the same shape")
-            images_per_file = vigra.impex.numberImages(self.fileNameList[0])
-            if self.slices_per_file != images_per_file:
-                raise RuntimeError("Not all files have the same number of " "slices")
-
-            result[:, :, i * C : (i + 1) * C] = vigra.impex.readImage(fileName)[
-                x_start:x_stop, y_start:y_stop, :
-            ].withAxes(*"xyc")
+        pages = self._readPages((file_index, 0) for file_index in range(c_start // C, c_stop // C))
+        for i, image in enumerate(pages):
+            result[:, :, i * C : (i + 1) * C] = image[x_start:x_stop, y_start:y_stop, :].withAxes(*"xyc")
         return result
 
     def _execute_4d(self, roi, result):
@@ -247,26 +337,20 @@ class OpStackLoader(Operator):
         # get C of slice
         C = self.info.getShape()[2]
 
-        # Copy each z-slice one at a time.
-        for result_z, fileName in enumerate(self.fileNameList[z_start:z_stop]):
-            traceLogger.debug(f"Reading image: {fileName}")
-            file_shape = vigra.impex.ImageInfo(fileName).getShape()
-            if self.info.getShape() != file_shape:
-                raise RuntimeError("not all files have the same shape")
-            images_per_file = vigra.impex.numberImages(self.fileNameList[0])
-            if self.slices_per_file != images_per_file:
-                raise RuntimeError("Not all files have the same number of " "slices")
-
-            if self.stack.meta.axistags.channelIndex == 0:
-                # czyx order -> read slice along z (here y)
-                for result_y, y in enumerate(range(y_start, y_stop)):
-                    result[result_z * C : (result_z + 1) * C, result_y, ...] = vigra.impex.readImage(fileName, index=y)[
+        file_indexes = range(z_start, min(z_stop, len(self.fileNameList)))
+        if self.stack.meta.axistags.channelIndex == 0:
+            # czyx order -> read slice along z (here y)
+            keys = ((file_index, y) for file_index in file_indexes for y in range(y_start, y_stop))
+            pages = self._readPages(keys)
+            for result_z in range(len(file_indexes)):
+                for result_y in range(y_stop - y_start):
+                    result[result_z * C : (result_z + 1) * C, result_y, ...] = next(pages)[
                         c_start:c_stop, x_start:x_stop
                     ].withAxes(*"cyx")
-            else:
-                result[result_z, ...] = vigra.impex.readImage(fileName)[
-                    x_start:x_stop, y_start:y_stop, c_start:c_stop
-                ].withAxes(*"yxc")
+        else:
+            pages = self._readPages((file_index, 0) for file_index in file_indexes)
+            for result_z, image in enumerate(pages):
+                result[result_z, ...] = image[x_start:x_stop, y_start:y_stop, c_start:c_stop].withAxes(*"yxc")
         return result
 
     def _execute_5d(self, roi, result):
@@ -275,11 +359,10 @@ class OpStackLoader(Operator):
         t_start, z_start, y_start, x_start, c_start = roi.start
         t_stop, z_stop, y_stop, x_stop, c_stop = roi.stop
 
-        # Use *enumerated* range to get global t coords and result t coords
-        for result_t, t in enumerate(range(t_start, t_stop)):
-            file_name = self.fileNameList[t]
-            for result_z, z in enumerate(range(z_start, z_stop)):
-                img = vigra.readImage(file_name, index=z)
+        pages = self._readPages((t, z) for t in range(t_start, t_stop) for z in range(z_start, z_stop))
+        for result_t in range(t_stop - t_start):
+            for result_z in range(z_stop - z_start):
+                img = next(pages)
                 result[result_t, result_z, :, :, :] = img[x_start:x_stop, y_start:y_stop, c_start:c_stop].withAxes(
                     *"yxc"
                 )
@@ -345,7 +428,13 @@ class OpStackWriter(Operator):
                     "Not enough RAM to export to the selected format. " "Consider exporting to hdf5 (h5)."
                 )
 
-        streamer = BigRequestStreamer(self.Input, roiFromShape(self.Input.meta.shape), slice_shape, parallel_requests)
+        streamer = BigRequestStreamer(
+            self.Input,
+            roiFromShape(self.Input.meta.shape),
+            slice_shape,
+            parallel_requests,
+            priorityClass=PriorityClass.BATCH,
+        )
 
         # Write the slices as they come in (possibly out-of-order, but probably not)
         streamer.resultSignal.subscribe(self._write_slice)
@@ -542,6 +631,9 @@ class OpH5N5WriterBigDataset(Operator):
 
     WriteImage = OutputSlot()
 
+    #: Number of threads that compress and write chunks in parallel (for N5, not for hdf5)
+    NUM_N5_WRITER_THREADS = max(1, min(4, psutil.cpu_count() or 1))
+
     loggingName = __name__ + ".OpH5N5WriterBigDataset"
     logger = logging.getLogger(loggingName)
     traceLogger = logging.getLogger("TRACE." + loggingName)
@@ -615,6 +707,9 @@ class OpH5N5WriterBigDataset(Operator):
             tagged_maxshape["c"] = 1
 
         self.chunkShape = determineBlockShape(list(tagged_maxshape.values()), 512_000.0 / dtypeBytes)
+        ideal_blockshape = self.Image.meta.ideal_blockshape
+        if ideal_blockshape is not None and len(ideal_blockshape) == len(self.chunkShape):
+            self.chunkShape = self._alignChunksWithBlocks(self.chunkShape, ideal_blockshape)
 
         if datasetName in list(g.keys()):
             del g[datasetName]
@@ -642,20 +737,31 @@ class OpH5N5WriterBigDataset(Operator):
         # Save the axistags as a dataset attribute
         self.d.attrs["axistags"] = self.Image.meta.axistags.toJSON()
 
-        def handle_block_result(roi, data):
-            slicing = roiToSlice(*roi)
+        def write_block(slicing, data):
             if data.flags.c_contiguous:
                 self.d.write_direct(data.view(numpy.ndarray), dest_sel=slicing)
             else:
                 self.d[slicing] = data
 
+        # Blocks are compressed and written on separate threads, while the next blocks are computed.
+        # (h5py serializes all calls anyway, so there's no point in more than one writer thread for hdf5.)
+        num_writer_threads = 1 if isinstance(self.f, (h5py.File, h5py.Group)) else self.NUM_N5_WRITER_THREADS
+
         batch_size = None
         if self.BatchSize.ready():
             batch_size = self.BatchSize.value
-        requester = BigRequestStreamer(self.Image, roiFromShape(self.Image.meta.shape), batchSize=batch_size)
-        requester.resultSignal.subscribe(handle_block_result)
+        requester = BigRequestStreamer(
+            self.Image,
+            roiFromShape(self.Image.meta.shape),
+            batchSize=batch_size,
+            chunkshape=self.chunkShape,
+            adaptive=adaptiveRequestController.adaptive_exports(),
+            priorityClass=PriorityClass.BATCH,
+        )
         requester.progressSignal.subscribe(self.progressSignal)
-        requester.execute()
+        with AsyncBlockWriter(write_block, chunkshape=self.chunkShape, num_threads=num_writer_threads) as writer:
+            requester.resultSignal.subscribe(writer.submit)
+            requester.execute()
 
         # Be paranoid: Flush right now.
         if isinstance(self.f, h5py.File):
@@ -666,6 +772,29 @@ class OpH5N5WriterBigDataset(Operator):
 
         self.progressSignal(100)
 
+    @staticmethod
+    def _alignChunksWithBlocks(chunkshape, ideal_blockshape):
+        """
+        Adjust the chunk shape so that the chunk grid lines up with the blocks the upstream operators
+        compute best (ideal_blockshape, 0 means "any"): In each axis, the chunks either tile an ideal block,
+        or span a whole number of them.  (Unless that would make the chunks much smaller.)
+
+        >>> OpH5N5WriterBigDataset._alignChunksWithBlocks((1, 80, 80, 80, 1), (1, 256, 100, 0, 1))
+        (1, 64, 50, 80, 1)
+        >>> OpH5N5WriterBigDataset._alignChunksWithBlocks((1, 80, 80, 1), (1, 97, 30, 1))
+        (1, 80, 60, 1)
+        """
+        aligned = []
+        for chunk, ideal in zip(chunkshape, ideal_blockshape):
+            if ideal <= 0 or chunk % ideal == 0:
+                aligned.append(chunk)
+            elif chunk > ideal:
+                aligned.append(chunk // ideal * ideal)
+            else:
+                divisor = max(d for d in range(1, chunk + 1) if ideal % d == 0)
+                aligned.append(divisor if 2 * divisor >= chunk else chunk)
+        return tuple(aligned)
+
     def propagateDirty(self, slot, subindex, roi):
         # The output from this operator isn't generally connected to other operators.
         # If someone is using it that way, we'll assume that the user wants to know that
@@ -18,6 +18,7 @@ import contextlib
 import numpy
 
 from lazyflow.graph import Operator, InputSlot
+from lazyflow.request import PriorityClass
 from lazyflow.utility import OrderedSignal, BigRequestStreamer
 from lazyflow.roi import roiFromShape
 
@@ -102,7 +103,9 @@ class OpExportDvidVolume(Operator):
                 stop = tuple(reversed(stop))
                 client.post_ndarray(start, stop, data)
 
-        requester = BigRequestStreamer(self.Input, roiFromShape(self.Input.meta.shape))
+        requester = BigRequestStreamer(
+            self.Input, roiFromShape(self.Input.meta.shape), priorityClass=PriorityClass.BATCH
+        )
         requester.resultSignal.subscribe(handle_block_result)
         requester.progressSignal.subscribe(self.progressSignal)
         requester.execute()
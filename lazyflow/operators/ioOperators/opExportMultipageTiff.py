@@ -33,6 +33,7 @@ import tifffile
 import vigra
 
 from lazyflow.graph import InputSlot, Operator
+from lazyflow.request import PriorityClass
 from lazyflow.operators.opReorderAxes import OpReorderAxes
 from lazyflow.utility import OrderedSignal, RoiRequestBatch
 
@@ -88,6 +89,7 @@ class OpExportMultipageTiff(Operator):
             roiIterator=_page_rois(*self._opReorderAxes.Output.meta.shape),
             totalVolume=np.prod(self._opReorderAxes.Output.meta.shape),
             batchSize=self._batch_size,
+            priorityClass=PriorityClass.BATCH,
         )
         batch.progressSignal.subscribe(self.progressSignal)
         batch.resultSignal.subscribe(self._write_buffered_pages)
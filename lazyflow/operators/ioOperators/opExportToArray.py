@@ -1,5 +1,6 @@
 import numpy
 from lazyflow.graph import Operator, InputSlot
+from lazyflow.request import PriorityClass
 from lazyflow.utility import BigRequestStreamer, OrderedSignal
 from lazyflow.roi import roiFromShape, roiToSlice
 
@@ -25,7 +26,12 @@ class OpExportToArray(Operator):
         final_result = numpy.ndarray(dtype=self.Input.meta.dtype, shape=self.Input.meta.shape)
 
         # Prepare streamer
-        streamer = BigRequestStreamer(self.Input, roiFromShape(self.Input.meta.shape), allowParallelResults=True)
+        streamer = BigRequestStreamer(
+            self.Input,
+            roiFromShape(self.Input.meta.shape),
+            allowParallelResults=True,
+            priorityClass=PriorityClass.BATCH,
+        )
 
         def handle_block_result(roi, block_result):
             final_result[roiToSlice(*roi)] = block_result
@@ -73,6 +73,7 @@ import re
 import logging
 from typing import List, Tuple
 
+from lazyflow.utility.io_util import multiprocessHdf5File
 from lazyflow.utility.io_util.multiprocessHdf5File import MultiProcessHdf5File
 
 
@@ -408,10 +409,8 @@ class OpInputDataReader(Operator):
             # If the h5 dataset is compressed, we'll have better performance
             #  with a multi-process hdf5 access object.
             # (Otherwise, single-process is faster.)
-            allow_multiprocess_hdf5 = (
-                "LAZYFLOW_MULTIPROCESS_HDF5" in os.environ and os.environ["LAZYFLOW_MULTIPROCESS_HDF5"] != ""
-            )
-            if compression_setting is not None and allow_multiprocess_hdf5 and isinstance(h5N5File, h5py.File):
+            # (See multiprocess_hdf5_readers in the [lazyflow] config section.)
+            if compression_setting is not None and multiprocessHdf5File.enabled() and isinstance(h5N5File, h5py.File):
                 h5N5File.close()
                 h5N5File = MultiProcessHdf5File(externalPath, "r")
 
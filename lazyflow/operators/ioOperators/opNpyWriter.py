@@ -23,7 +23,8 @@ import numpy
 from lazyflow.graph import Operator, InputSlot
 
 from lazyflow.roi import roiToSlice, roiFromShape
-from lazyflow.utility import BigRequestStreamer, OrderedSignal
+from lazyflow.request import PriorityClass
+from lazyflow.utility import BigRequestStreamer, OrderedSignal, adaptiveRequestController
 
 import logging
 
@@ -68,7 +69,12 @@ class OpNpyWriter(Operator):
             slicing = roiToSlice(*roi)
             final_data[slicing] = data
 
-        requester = BigRequestStreamer(self.Input, roiFromShape(self.Input.meta.shape))
+        requester = BigRequestStreamer(
+            self.Input,
+            roiFromShape(self.Input.meta.shape),
+            adaptive=adaptiveRequestController.adaptive_exports(),
+            priorityClass=PriorityClass.BATCH,
+        )
         requester.resultSignal.subscribe(handle_block_result)
         requester.progressSignal.subscribe(self.progressSignal)
         requester.execute()
@@ -1,5 +1,7 @@
 from __future__ import print_function
 from builtins import map
+from functools import partial
+
 import numpy
 
 # Note: tifffile can also be imported from skimage.external.tifffile.tifffile_local,
@@ -17,22 +19,29 @@ import tifffile
 
 import vigra
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.roi import roiToSlice
+from lazyflow.roi import roiToSlice, getIntersection
 from lazyflow.request import RequestLock
 from lazyflow.utility.helpers import get_default_axisordering
+from lazyflow.utility import pageCache
+from lazyflow.operators.ioOperators.ioOperators import PagedReaderCache
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-class OpTiffReader(Operator):
+class OpTiffReader(Operator, PagedReaderCache):
     """
     Reads TIFF files as an ND array. We use two different libraries:
 
     - To read the image metadata (determine axis order), we use tifffile.py (by Christoph Gohlke)
     - To actually read the data, we use vigra (which supports more compression types, e.g. JPEG)
 
+    If parallel page reads are enabled (see lazyflow.utility.pageCache), uncompressed pages are
+    an exception: We read the requested region straight from the file, touching only the strips
+    (or tiles, if the TIFF is tiled) that intersect it. Other pages are decoded in parallel,
+    and the most recent ones are cached.
+
     Note: This operator intentionally ignores any colormap
           information and uses only the raw stored pixel values.
           (In fact, avoiding the colormapping is not trivial using the tifffile implementation.)
@@ -45,12 +54,27 @@ class OpTiffReader(Operator):
 
     TIFF_EXTS = [".tif", ".tiff"]
 
+    #: Number of pages to decode ahead of each request (in the direction of the previous requests)
+    PREFETCH_PAGES = 4
+
     def __init__(self, *args, **kwargs):
         super(OpTiffReader, self).__init__(*args, **kwargs)
         self._filepath = None
         self._page_shape = None
+        self._pages = None
+        self._uncompressed_pages = None
+
+    def cleanUp(self):
+        self._closeUncompressedPages()
+        super(OpTiffReader, self).cleanUp()
+
+    def _closeUncompressedPages(self):
+        if self._uncompressed_pages is not None:
+            self._uncompressed_pages.close()
+            self._uncompressed_pages = None
 
     def setupOutputs(self):
+        self._closeUncompressedPages()
         self._filepath = self.Filepath.value
         with tifffile.TiffFile(self._filepath) as tiff_file:
             series = tiff_file.series[0]
@@ -131,6 +155,16 @@ class OpTiffReader(Operator):
                 logger.warning("Unknown axistags detected - assuming default axis order.")
                 axes = get_default_axisordering(shape)
 
+            if pageCache.parallel_reads() and not first_page.is_palette:
+                self._uncompressed_pages = _UncompressedPages.create(
+                    self._filepath, tiff_file.byteorder, pages, self._page_shape, dtype_code
+                )
+            self._pages = self._createPageCache(
+                partial(self._readPage, self._filepath, self._page_axes),
+                num_pages=len(pages),
+                prefetch=self.PREFETCH_PAGES,
+            )
+
             self.Output.meta.shape = shape
             self.Output.meta.axistags = vigra.defaultAxistags(str(axes))
             self.Output.meta.dtype = numpy.dtype(dtype_code).type
@@ -138,7 +172,7 @@ class OpTiffReader(Operator):
 
     def execute(self, slot, subindex, roi, result):
         """
-        Use vigra (not tifffile) to read the result.
+        Use vigra (not tifffile) to decode compressed pages.
         This allows us to support JPEG-compressed TIFFs.
         """
         num_page_axes = len(self._page_shape)
@@ -148,32 +182,141 @@ class OpTiffReader(Operator):
 
         logger.debug("Roi: {}".format(list(map(tuple, roi))))
 
-        # Read each page out individually
         page_index_roi_shape = page_index_roi[1] - page_index_roi[0]
-        for roi_page_ndindex in numpy.ndindex(*page_index_roi_shape):
-            if self._non_page_shape:
-                tiff_page_ndindex = roi_page_ndindex + page_index_roi[0]
-                tiff_page_list_index = numpy.ravel_multi_index(tiff_page_ndindex, self._non_page_shape)
-                logger.debug("Reading page: {} = {}".format(tuple(tiff_page_ndindex), tiff_page_list_index))
-                page_data = vigra.impex.readImage(
-                    self._filepath, dtype="NATIVE", index=int(tiff_page_list_index), order="C"
-                )
-            else:
-                # Only a single page
-                page_data = vigra.impex.readImage(self._filepath, dtype="NATIVE", index=0, order="C")
-
-            page_data = page_data.withAxes(self._page_axes)
+        roi_page_ndindexes = list(numpy.ndindex(*page_index_roi_shape))
+        if self._non_page_shape:
+            tiff_page_list_indexes = [
+                int(numpy.ravel_multi_index(roi_page_ndindex + page_index_roi[0], self._non_page_shape))
+                for roi_page_ndindex in roi_page_ndindexes
+            ]
+        else:
+            # Only a single page
+            tiff_page_list_indexes = [0]
+
+        if self._uncompressed_pages is not None:
+            for roi_page_ndindex, tiff_page_list_index in zip(roi_page_ndindexes, tiff_page_list_indexes):
+                self._uncompressed_pages.read(tiff_page_list_index, roi_within_page, result[roi_page_ndindex])
+            return
+
+        if self._pages is None:
+            pages = (self._readPage(self._filepath, self._page_axes, index) for index in tiff_page_list_indexes)
+        else:
+            # Decode the pages in parallel
+            pages = self._pages.read(tiff_page_list_indexes)
+        for roi_page_ndindex, page_data in zip(roi_page_ndindexes, pages):
             assert page_data.shape == self._page_shape, "Unexpected page shape: {} vs {}".format(
                 page_data.shape, self._page_shape
             )
-
             result[roi_page_ndindex] = page_data[roiToSlice(*roi_within_page)]
 
+    @staticmethod
+    def _readPage(filepath, page_axes, tiff_page_list_index):
+        logger.debug("Reading page: {}".format(tiff_page_list_index))
+        page_data = vigra.impex.readImage(filepath, dtype="NATIVE", index=tiff_page_list_index, order="C")
+        return page_data.withAxes(page_axes)
+
     def propagateDirty(self, slot, subindex, roi):
         if slot == self.Filepath:
             self.Output.setDirty(slice(None))
 
 
+class _UncompressedPages(object):
+    """
+    Reads regions of uncompressed TIFF pages directly from the (memory-mapped) file.
+    Only the strips or tiles that intersect the requested region are touched.
+    """
+
+    @classmethod
+    def create(cls, filepath, byteorder, pages, page_shape, dtype):
+        """
+        Return a reader for the given pages, or None if they aren't all
+        uncompressed pages with the same (simple) strip/tile layout.
+        """
+        Y, X = page_shape[:2]
+        S = page_shape[2] if len(page_shape) == 3 else 1
+        dtype = numpy.dtype(dtype).newbyteorder(byteorder)
+        try:
+            first_page = pages[0]
+            if first_page.is_tiled:
+                segment_shape = (first_page.tilelength, first_page.tilewidth)
+            else:
+                # Strips: all but the last one have the same size
+                row_bytes = X * S * dtype.itemsize
+                segment_shape = (max(1, first_page.databytecounts[0] // row_bytes), X)
+
+            page_offsets = []
+            for page in pages:
+                # (Newer tifffile versions give us lightweight frames, which refer to a 'keyframe' for the tags.)
+                keyframe = getattr(page, "keyframe", page)
+                if (
+                    keyframe.compression != 1
+                    or keyframe.bitspersample != 8 * dtype.itemsize
+                    or (S > 1 and keyframe.planarconfig not in (1, "contig"))
+                    or bool(keyframe.is_tiled) != bool(first_page.is_tiled)
+                    or (keyframe.is_tiled and (keyframe.tilelength, keyframe.tilewidth) != segment_shape)
+                    or (not keyframe.is_tiled and page.databytecounts[0] != first_page.databytecounts[0])
+                ):
+                    return None
+                offsets = numpy.asarray(page.dataoffsets, dtype=numpy.int64)
+                if len(offsets) != _num_segments(page_shape, segment_shape) or (offsets == 0).any():
+                    return None
+                page_offsets.append(offsets)
+        except (AttributeError, IndexError, TypeError):
+            # Unexpected tifffile version (or page type)
+            return None
+
+        return cls(filepath, dtype, page_shape, segment_shape, bool(first_page.is_tiled), page_offsets)
+
+    def __init__(self, filepath, dtype, page_shape, segment_shape, is_tiled, page_offsets):
+        self._file = numpy.memmap(filepath, dtype=numpy.uint8, mode="r")
+        self._dtype = dtype
+        self._page_shape = page_shape
+        self._segment_shape = segment_shape
+        self._is_tiled = is_tiled
+        self._page_offsets = page_offsets
+        self._num_segment_columns = -(-page_shape[1] // segment_shape[1])
+
+    def close(self):
+        self._file = None
+
+    def read(self, page_index, roi_within_page, out):
+        """
+        Copy roi_within_page ([start, stop] in (y, x[, c])) of the given page to out.
+        """
+        Y, X = self._page_shape[:2]
+        S = self._page_shape[2] if len(self._page_shape) == 3 else 1
+        segment_h, segment_w = self._segment_shape
+        (y_start, x_start), (y_stop, x_stop) = roi_within_page[0][:2], roi_within_page[1][:2]
+        channels = slice(*roi_within_page[:, 2]) if len(self._page_shape) == 3 else slice(None)
+
+        for row in range(y_start // segment_h, -(-y_stop // segment_h)):
+            for column in range(x_start // segment_w, -(-x_stop // segment_w)):
+                segment_start = numpy.array([row * segment_h, column * segment_w])
+                if self._is_tiled:
+                    # Tiles are always stored with their full size (padded at the image border)
+                    stored_rows = segment_h
+                else:
+                    stored_rows = min(segment_h, Y - segment_start[0])
+
+                offset = self._page_offsets[page_index][row * self._num_segment_columns + column]
+                num_bytes = stored_rows * segment_w * S * self._dtype.itemsize
+                segment = self._file[offset : offset + num_bytes].view(self._dtype)
+                segment = segment.reshape((stored_rows, segment_w, S))
+
+                segment_roi = (segment_start, segment_start + (stored_rows, segment_w))
+                start, stop = getIntersection(segment_roi, ([y_start, x_start], [y_stop, x_stop]))
+                source = segment[roiToSlice(start - segment_start, stop - segment_start)]
+                destination = out[roiToSlice(start - (y_start, x_start), stop - (y_start, x_start))]
+                if len(self._page_shape) == 3:
+                    destination[:] = source[..., channels]
+                else:
+                    destination[:] = source[..., 0]
+
+
+def _num_segments(page_shape, segment_shape):
+    return -(-page_shape[0] // segment_shape[0]) * -(-page_shape[1] // segment_shape[1])
+
+
 if __name__ == "__main__":
     from lazyflow.graph import Graph
 
@@ -123,6 +123,9 @@ class OpBlockedArrayCache(Operator, ManagedBlockedCache):
     def getBlockAccessTimes(self):
         return self._opSimpleBlockedArrayCache.getBlockAccessTimes()
 
+    def getBlockStatistics(self):
+        return self._opSimpleBlockedArrayCache.getBlockStatistics()
+
     def freeMemory(self):
         return self._opSimpleBlockedArrayCache.freeMemory()
 
@@ -26,6 +26,7 @@ from abc import abstractmethod, ABCMeta
 
 # lazyflow
 from lazyflow.operators import cacheMemoryManager
+from lazyflow.operators.cacheEvictionPolicies import BlockStatistics
 from future.utils import with_metaclass
 
 
@@ -188,6 +189,16 @@ class ManagedBlockedCache(ManagedCache):
         """
         raise NotImplementedError("No default implementation for getBlockAccessTimes()")
 
+    def getBlockStatistics(self):
+        """
+        get a list of BlockStatistics(key, last_access, size, cost) for all blocks
+
+        Size (bytes) and cost (seconds it took to compute the block) are used by
+        cost-aware eviction policies. The default implementation reports them
+        as unknown (None); override this if the cache can do better.
+        """
+        return [BlockStatistics(key, t, None, None) for key, t in self.getBlockAccessTimes()]
+
     @abstractmethod
     def freeBlock(self, block_id):
         """
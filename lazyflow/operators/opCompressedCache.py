@@ -29,7 +29,6 @@ from builtins import map
 import logging
 from functools import partial
 import collections
-import itertools
 import time
 
 # Third-party
@@ -39,28 +38,24 @@ import h5py
 # Lazyflow
 from lazyflow.request import Request, RequestPool, RequestLock
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.roi import TinyVector, getIntersectingBlocks, getBlockBounds, roiToSlice, getIntersection
+from lazyflow.roi import TinyVector, getIntersectingBlocks, getBlockBounds, roiToSlice, getIntersection, roiFromShape
 from lazyflow.operators.opCache import ManagedBlockedCache
+from lazyflow.operators.cacheEvictionPolicies import BlockStatistics
 from lazyflow.utility.chunkHelpers import chooseChunkShape
+from lazyflow.utility import spillStore, compressedBlockStore
 
 logger = logging.getLogger(__name__)
 
 
-def get_storage_size(h5dataset):
-    """
-    get the storage size allocated for this hdf5 dataset in bytes
-
-    (shorthand for the hidden h5py functionality)
-    """
-    return h5py.h5d.DatasetID.get_storage_size(h5dataset.id)
-
-
 class OpUnmanagedCompressedCache(Operator):
     """
-    A blockwise cache that stores each block as a separate in-memory hdf5 file with a compressed dataset.
+    A blockwise cache that stores each block in compressed form.
+
+    How blocks are compressed is determined by the codec (see lazyflow.utility.compressedBlockStore):
+    By default, each block is stored as separately compressed chunks, which are decoded in parallel.
+    The codec "hdf5" stores each block as a separate in-memory hdf5 file with a compressed dataset.
 
-    The files for each block have an internal chunk-shape, which corresponds to
-    the amount of data that has to be decompressed for a single pixel lookup.
+    The chunk shape corresponds to the amount of data that has to be decompressed for a single pixel lookup.
     The chunk shape is prioritized as follows:
         1. Input.meta.ideal_blockshape
            (make sure to set BlockShape to a multiple of ideal_blockshape!)
@@ -80,7 +75,7 @@ class OpUnmanagedCompressedCache(Operator):
     # Also used to asynchronously force data into the cache via __setitem__ (see setInSlot(), below()
     Input = InputSlot(allow_mask=True)
 
-    # shape of internal in-memory hdf5 files (defaults to the whole volume)
+    # shape of the compressed blocks (defaults to the whole volume)
     BlockShape = InputSlot(optional=True)
 
     # Output as numpy arrays
@@ -92,25 +87,33 @@ class OpUnmanagedCompressedCache(Operator):
     # Provides data as hdf5 datasets.  Only allowed for rois that exactly match a block.
     OutputHdf5 = OutputSlot(allow_mask=True)
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, codec=None, **kwargs):
+        """
+        :param codec: The block codec (see lazyflow.utility.compressedBlockStore.available_codecs()).
+                      By default, the configured default codec is used.
+        """
         super(OpUnmanagedCompressedCache, self).__init__(*args, **kwargs)
         self._lock = RequestLock()
+        self._codec = codec
+        # Incremented whenever blocks become dirty (see _getBlock)
+        self._dirty_generation = 0
         self._init_cache(None)
-        self._block_id_counter = itertools.count()  # Used to ensure unique in-memory file names
         self._ignore_ideal_blockshape = False
 
     def _init_cache(self, new_blockshape):
         with self._lock:
+            self._dirty_generation += 1
             self._blockshape = new_blockshape
-            self._cacheFiles = {}
+            self._blocks = {}
             self._dirtyBlocks = set()
             self._blockLocks = {}
             self._chunkshape = self._chooseChunkshape(self._blockshape)
             self._last_access_times = collections.defaultdict(float)
+            self._compute_times = {}
 
     def cleanUp(self):
         logger.debug("Cleaning up")
-        self._closeAllCacheFiles()
+        self._closeAllBlocks()
         super(OpUnmanagedCompressedCache, self).cleanUp()
 
     def setupOutputs(self):
@@ -161,7 +164,7 @@ class OpUnmanagedCompressedCache(Operator):
         block_starts = getIntersectingBlocks(self._blockshape, (roi.start, roi.stop))
         block_starts = list(map(tuple, block_starts))
 
-        # Ensure all block cache files are up-to-date
+        # Ensure all blocks are up-to-date
         self._waitForBlocks(block_starts)
         self._copyData(roi, destination, block_starts)
         return destination
@@ -181,7 +184,7 @@ class OpUnmanagedCompressedCache(Operator):
 
     def _copyData(self, roi, destination, block_starts):
         # Copy data from each block
-        # (Parallelism not needed here: h5py will serialize these requests anyway)
+        # (Blocks decode their chunks in parallel.)
         logger.debug("Copying data from {} blocks...".format(len(block_starts)))
         for block_start in block_starts:
             entire_block_roi = getBlockBounds(self.Output.meta.shape, self._blockshape, block_start)
@@ -193,20 +196,12 @@ class OpUnmanagedCompressedCache(Operator):
             destination_relative_intersection = numpy.subtract(intersecting_roi, roi.start)
             block_relative_intersection = numpy.subtract(intersecting_roi, block_start)
             destination_relative_intersection_slicing = roiToSlice(*destination_relative_intersection)
-            block_relative_intersection_slicing = roiToSlice(*block_relative_intersection)
 
             # Copy from block to destination
-            dataset = self._getBlockDataset(entire_block_roi)
+            block = self._getBlock(entire_block_roi)
+            block.read(block_relative_intersection, destination[destination_relative_intersection_slicing])
             if self.Output.meta.has_mask:
-                destination.data[destination_relative_intersection_slicing] = dataset["data"][
-                    block_relative_intersection_slicing
-                ]
-                destination.mask[destination_relative_intersection_slicing] = dataset["mask"][
-                    block_relative_intersection_slicing
-                ]
-                destination.fill_value = dataset["fill_value"][()]
-            else:
-                destination[destination_relative_intersection_slicing] = dataset[block_relative_intersection_slicing]
+                destination.fill_value = block.fill_value
             self._last_access_times[block_start] = time.time()
 
     def _executeCleanBlocks(self, destination):
@@ -215,7 +210,7 @@ class OpUnmanagedCompressedCache(Operator):
         an *unsorted* list of block rois that the cache currently holds.
         """
         # Set difference: clean = existing - dirty
-        clean_block_starts = set(self._cacheFiles.keys()) - self._dirtyBlocks
+        clean_block_starts = set(self._blocks.keys()) - self._dirtyBlocks
 
         output_shape = self.Output.meta.shape
         clean_block_rois = list(map(partial(getBlockBounds, output_shape, self._blockshape), clean_block_starts))
@@ -239,9 +234,9 @@ class OpUnmanagedCompressedCache(Operator):
 
         block_roi = [roi.start, roi.stop]
         self._ensureCached(block_roi)
-        dataset = self._getBlockDataset(block_roi)
+        block = self._getBlock(block_roi)
         assert str(block_roi) not in destination, "destination hdf5 group already has a dataset with this block's name"
-        destination.copy(dataset, str(block_roi))
+        block.write_hdf5(destination, str(block_roi))
         return destination
 
     def propagateDirty(self, slot, subindex, roi):
@@ -249,6 +244,7 @@ class OpUnmanagedCompressedCache(Operator):
             # Keep track of dirty blocks
             if self._blockshape is not None:
                 with self._lock:
+                    self._dirty_generation += 1
                     block_starts = getIntersectingBlocks(self._blockshape, (roi.start, roi.stop))
                     block_starts = list(map(tuple, block_starts))
 
@@ -358,7 +354,7 @@ class OpUnmanagedCompressedCache(Operator):
     def _usedMemory(self):
         tot = 0.0
         unc = 0.0
-        for key in list(self._cacheFiles.keys()):
+        for key in list(self._blocks.keys()):
             real, virt = self._memoryForBlock(key)
             tot += real
             unc += virt
@@ -366,94 +362,88 @@ class OpUnmanagedCompressedCache(Operator):
 
     def _memoryForBlock(self, key):
         try:
-            group = self._cacheFiles[key]
+            block = self._blocks[key]
         except KeyError:
             # entry was removed, ignore it
-            return 0
-        tot = 0
-        unc = 0
-        if "data" in group:
-            ds = group["data"]
-            # actual size
-            tot += get_storage_size(ds)
-            # uncompressed size
-            unc += ds.size * self._getDtypeBytes(ds.dtype)
-        if "mask" in group:
-            tot += group["mask"].size * self._getDtypeBytes(group["mask"].dtype)
-        if "fill_value" in group:
-            tot += group["fill_value"].size * self._getDtypeBytes(group["fill_value"].dtype)
-        return tot, unc
+            return 0, 0
+        # actual size, uncompressed size
+        return block.storage_size(), block.uncompressed_size()
 
-    def _getCacheFile(self, entire_block_roi):
+    def _getBlock(self, entire_block_roi):
         """
-        Get the cache file for the block that starts at block_start.
+        Get the block that starts at block_start.
         If it doesn't exist yet, create it first.
         """
         block_start = tuple(entire_block_roi[0])
-        if block_start in self._cacheFiles:
-            return self._cacheFiles[block_start]
-        with self._lock:
-            if block_start not in self._cacheFiles:
-                # Create an in-memory hdf5 file with a unique name
-                # (the counter ensures that even blocks that have been deleted previously get a unique name when they are re-created).
-                logger.debug("Creating a cache file for block: {}".format(list(block_start)))
-                filename = (
-                    str(id(self)) + str(id(self._cacheFiles)) + str(block_start) + str(next(self._block_id_counter))
-                )
-                mem_file = h5py.File(filename, driver="core", backing_store=False, mode="w")
-
-                # h5py will crash if the chunkshape is larger than the dataset shape.
-                datashape = tuple(entire_block_roi[1] - entire_block_roi[0])
-                chunkshape = numpy.minimum(numpy.array(datashape), self._chunkshape)
-                chunkshape = tuple(chunkshape)
-
-                # Make a compressed dataset
-                mem_file.create_dataset(
-                    "data", shape=datashape, dtype=self.Output.meta.dtype, chunks=chunkshape, compression="lzf"
-                )  # lzf should be faster than gzip,
-                # with a slightly worse compression ratio
-                # Add mask information if needed.
-                if self.Output.meta.has_mask:
-                    mem_file.create_dataset(
-                        "mask", shape=datashape, dtype=bool, chunks=chunkshape, compression="lzf"
-                    )  # lzf should be faster than gzip,
-                    # with a slightly worse compression ratio
-                    mem_file.create_dataset("fill_value", shape=tuple(), dtype=self.Output.meta.dtype)
+        if block_start in self._blocks:
+            return self._blocks[block_start]
+
+        # A spilled copy of the block is restored before the block is published in self._blocks,
+        # since other requests take blocks from there without checking any lock.
+        # (And without holding self._lock, which would block all other lookups during the disk read.)
+        restored_block = None
+        dirty_generation = self._dirty_generation
+        spilled = self._takeSpilledBlock(block_start)
+        if spilled is not None:
+            data, compute_time = spilled
+            restored_block = self._createBlock(entire_block_roi)
+            restored_block.write(roiFromShape(restored_block.shape), data)
+            del data
 
+        with self._lock:
+            if block_start in self._blocks:
+                # Another request was faster
+                if restored_block is not None:
+                    restored_block.close()
+            elif restored_block is not None and dirty_generation == self._dirty_generation:
+                logger.debug("Restored spilled block {}".format(block_start))
                 self._blockLocks[block_start] = RequestLock()
-                self._cacheFiles[block_start] = mem_file
+                self._blocks[block_start] = restored_block
+                self._compute_times[block_start] = compute_time
+            else:
+                # (The restored data may be outdated if something became dirty while we were reading it.)
+                if restored_block is not None:
+                    restored_block.close()
+                logger.debug("Creating a cache block: {}".format(list(block_start)))
+                self._blockLocks[block_start] = RequestLock()
+                self._blocks[block_start] = self._createBlock(entire_block_roi)
                 self._dirtyBlocks.add(block_start)
-            return self._cacheFiles[block_start]
+            return self._blocks[block_start]
+
+    def _createBlock(self, entire_block_roi):
+        datashape = tuple(entire_block_roi[1] - entire_block_roi[0])
+        return compressedBlockStore.create_block(
+            datashape, self.Output.meta.dtype, self._chunkshape, self.Output.meta.has_mask, self._codec
+        )
+
+    def _takeSpilledBlock(self, block_start):
+        """
+        Remove a previously spilled copy of the block from the spill store and return it
+        as (data, compute_time), or None. (Unmanaged caches never spill.)
+        """
+        return None
 
     def _ensureCached(self, entire_block_roi):
         """
-        Ensure that the cache file for the given block is up-to-date.
+        Ensure that the given block is up-to-date.
         (Refresh it if it's dirty.)
         """
         block_start = tuple(entire_block_roi[0])
-        block_file = self._getCacheFile(entire_block_roi)
+        block = self._getBlock(entire_block_roi)
         if block_start in self._dirtyBlocks:
             updated_cache = False
             with self._blockLocks[block_start]:
                 # Check AGAIN now that we have the lock.
                 # (Avoid doing this twice in parallel requests.)
                 if block_start in self._dirtyBlocks:
-                    # Can't write directly into the hdf5 dataset because
-                    #  h5py.dataset.__getitem__ creates a copy, not a view.
-                    # We must use a temporary numpy array to hold the data.
+                    start_time = time.time()
                     data = self.Input(*entire_block_roi).wait()
-                    block_file["data"][...] = data
-                    if self.Output.meta.has_mask:
-                        block_file["mask"][...] = data.mask
-                        block_file["fill_value"][...] = data.fill_value
+                    self._compute_times[block_start] = time.time() - start_time
+                    block.write(roiFromShape(block.shape), data)
 
                     if logger.isEnabledFor(logging.DEBUG):
-                        uncompressed_size = numpy.prod(data.shape) * self._getDtypeBytes(data.dtype)
-                        storage_size = block_file["data"].id.get_storage_size()
-                        if "mask" in block_file:
-                            storage_size += block_file["mask"].id.get_storage_size()
-                        if "fill_value" in block_file:
-                            storage_size += block_file["fill_value"].id.get_storage_size()
+                        uncompressed_size = block.uncompressed_size()
+                        storage_size = block.storage_size()
                         logger.debug(
                             "Storage for block: {} is {}. ({}% of original)".format(
                                 block_start, storage_size, 100 * storage_size / uncompressed_size
@@ -508,41 +498,27 @@ class OpUnmanagedCompressedCache(Operator):
             source_relative_intersection = numpy.subtract(intersecting_roi, roi.start)
             block_relative_intersection = numpy.subtract(intersecting_roi, block_start)
             source_relative_intersection_slicing = roiToSlice(*source_relative_intersection)
-            block_relative_intersection_slicing = roiToSlice(*block_relative_intersection)
 
             new_block_data = value[source_relative_intersection_slicing]
             new_block_sum = new_block_data.sum()
-            if not store_zero_blocks and new_block_sum == 0 and block_start not in self._cacheFiles:
+            if not store_zero_blocks and new_block_sum == 0 and block_start not in self._blocks:
                 # Special fast-path: If this block doesn't exist yet,
                 #  don't bother creating if we're just going to fill it with zeros.
                 # (This feature is used by the OpCompressedUserLabelArray)
                 pass
             else:
                 # Copy from source to block
-                dataset = self._getBlockDataset(entire_block_roi)
-                if self.Output.meta.has_mask:
-                    dataset["data"][block_relative_intersection_slicing] = new_block_data.data
-                    dataset["mask"][block_relative_intersection_slicing] = new_block_data.mask
-                    dataset["fill_value"][()] = new_block_data.fill_value
-
-                    # Untested. Write a test to use this.
-                    # # If we can, remove this block entirely.
-                    # if not store_zero_blocks and new_block_sum == 0 and (dataset["data"][:] == 0).all() and (dataset["mask"]).any() and (dataset["fill_value"] == 0).all():
-                    #     with self._lock:
-                    #         with self._blockLocks[block_start]:
-                    #            self._cacheFiles[block_start].close()
-                    #            del self._cacheFiles[block_start]
-                    #         del self._blockLocks[block_start]
-                else:
-                    dataset[block_relative_intersection_slicing] = new_block_data
+                block = self._getBlock(entire_block_roi)
+                block.write(block_relative_intersection, new_block_data)
 
-                    # If we can, remove this block entirely.
-                    if not store_zero_blocks and new_block_sum == 0 and (dataset[:] == 0).all():
-                        with self._lock:
-                            with self._blockLocks[block_start]:
-                                self._cacheFiles[block_start].close()
-                                del self._cacheFiles[block_start]
-                            del self._blockLocks[block_start]
+                # If we can, remove this block entirely.
+                # (Not for masked data, which would need checks for the mask and fill_value. Untested.)
+                if not self.Output.meta.has_mask and not store_zero_blocks and new_block_sum == 0 and block.is_zero():
+                    with self._lock:
+                        with self._blockLocks[block_start]:
+                            self._blocks[block_start].close()
+                            del self._blocks[block_start]
+                        del self._blockLocks[block_start]
 
             # Here, we assume that if this function is used to update ANY PART of a
             #  block, he is responsible for updating the ENTIRE block.
@@ -570,25 +546,9 @@ class OpUnmanagedCompressedCache(Operator):
         roi_is_exactly_one_block &= ((roi.start % self._blockshape) == 0).all()
         roi_is_exactly_one_block &= (block_roi == numpy.array((roi.start, roi.stop))).all()
         if roi_is_exactly_one_block:
-            cachefile = self._getCacheFile(block_roi)
+            block = self._getBlock(block_roi)
             logger.debug("Copying HDF5 data directly into block {}".format(block_roi))
-
-            if self.Output.meta.has_mask:
-                assert len(value) == 3
-
-                for each in ["data", "mask", "fill_value"]:
-                    assert each in value
-                    assert cachefile[each].dtype == value[each].dtype
-                    assert cachefile[each].shape == value[each].shape
-
-                for each in ["data", "mask", "fill_value"]:
-                    del cachefile[each]
-                    cachefile.copy(value[each], each)
-            else:
-                assert cachefile["data"].dtype == value.dtype
-                assert cachefile["data"].shape == value.shape
-                del cachefile["data"]
-                cachefile.copy(value, "data")
+            block.read_hdf5(value)
 
             block_start = tuple(roi.start)
             self._dirtyBlocks.discard(block_start)
@@ -611,38 +571,59 @@ class OpUnmanagedCompressedCache(Operator):
     #        self.OutputHdf5._sig_value_changed()
     #        self.CleanBlocks._sig_value_changed()
 
-    def _getBlockDataset(self, entire_block_roi):
-        """
-        Get the correct cache file and return the *dataset* handle,
-        not a numpy array of its contents.
-        """
-        block_file = self._getCacheFile(entire_block_roi)
-        if self.Output.meta.has_mask:
-            return block_file["/"]
-        else:
-            return block_file["data"]
-
-    def _closeAllCacheFiles(self):
+    def _closeAllBlocks(self):
         logger.debug("Closing all caches")
-        cacheFiles = self._cacheFiles
-        for k, v in list(cacheFiles.items()):
+        blocks = self._blocks
+        for k, v in list(blocks.items()):
             with self._blockLocks[k]:
                 v.close()
         with self._lock:
             self._blockLocks = {}
-            self._cacheFiles = {}
+            self._blocks = {}
 
 
 class OpCompressedCache(OpUnmanagedCompressedCache, ManagedBlockedCache):
+    """
+    The managed version of OpUnmanagedCompressedCache.
+
+    If spilling is enabled (see lazyflow.utility.spillStore), clean blocks evicted by the
+    cache memory manager are written to disk and read back when they are needed again.
+    """
+
     def __init__(self, *args, **kwargs):
+        self._spill_namespace = spillStore.new_namespace()
         super(OpCompressedCache, self).__init__(*args, **kwargs)
         # Now that we're initialized, it's safe to register with the memory manager
         self.registerWithMemoryManager()
 
+    def _init_cache(self, new_blockshape):
+        # All blocks are invalidated, including spilled ones
+        self._discardSpilledBlocks()
+        super(OpCompressedCache, self)._init_cache(new_blockshape)
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.Input and self._blockshape is not None:
+            store = spillStore.getSpillStore()
+            if store is not None:
+                for block_start in map(tuple, getIntersectingBlocks(self._blockshape, (roi.start, roi.stop))):
+                    store.discard(self._spill_namespace, block_start)
+        super(OpCompressedCache, self).propagateDirty(slot, subindex, roi)
+
+    def _takeSpilledBlock(self, block_start):
+        store = spillStore.getSpillStore()
+        if store is None:
+            return None
+        return store.get(self._spill_namespace, block_start)
+
+    def _discardSpilledBlocks(self):
+        store = spillStore.getSpillStore()
+        if store is not None:
+            store.discard_namespace(self._spill_namespace)
+
     def fractionOfUsedMemoryDirty(self):
         tot = 0.0
         dirty = 0.0
-        for key in list(self._cacheFiles.keys()):
+        for key in list(self._blocks.keys()):
             real, virt = self._memoryForBlock(key)
             tot += real
             if key in self._dirtyBlocks:
@@ -660,40 +641,46 @@ class OpCompressedCache(OpUnmanagedCompressedCache, ManagedBlockedCache):
 
     def freeMemory(self):
         mem = self.usedMemory()
-        self._closeAllCacheFiles()
+        self._discardSpilledBlocks()
+        self._closeAllBlocks()
         with self._lock:
-            self._cacheFiles = {}
+            self._blocks = {}
             self._dirtyBlocks = set()
         return mem
 
     def freeDirtyMemory(self):
         dirty = 0.0
-        for key in list(self._cacheFiles.keys()):
+        for key in list(self._blocks.keys()):
             if key in self._dirtyBlocks:
-                dirty += self.freeBlock(key)
+                dirty += self._freeBlock(key, spill=False)
                 with self._lock:
                     self._dirtyBlocks.discard(key)
         return dirty
 
     def freeBlock(self, block_id):
+        # Blocks evicted by the memory manager may be spilled to disk, unless they're dirty anyway.
+        return self._freeBlock(block_id, spill=True)
+
+    def _freeBlock(self, block_id, spill):
         if block_id not in self._blockLocks:
             return 0
         with self._blockLocks[block_id]:
             try:
-                f = self._cacheFiles[block_id]
+                block = self._blocks[block_id]
             except KeyError:
-                # this file was deleted
-                return 0
-            if "data" not in f:
+                # this block was deleted
                 return 0
-            ds = f["data"]
             # use actual size, not number of bytes in
             # *uncompressed* array
-            mem = get_storage_size(ds)
-            f.close()
+            mem = block.storage_size()
+            store = spillStore.getSpillStore()
+            if spill and store is not None and not self.Output.meta.has_mask and block_id not in self._dirtyBlocks:
+                store.put(self._spill_namespace, block_id, block.read_all(), self._compute_times.get(block_id))
+            block.close()
             with self._lock:
-                del self._cacheFiles[block_id]
+                del self._blocks[block_id]
                 del self._last_access_times[block_id]
+                self._compute_times.pop(block_id, None)
             return mem
 
     def getBlockAccessTimes(self):
@@ -701,3 +688,16 @@ class OpCompressedCache(OpUnmanagedCompressedCache, ManagedBlockedCache):
             # needs to be locked because dicts must not change size
             # during iteration
             return [(key, self._last_access_times[key]) for key in self._last_access_times]
+
+    def getBlockStatistics(self):
+        with self._lock:
+            keys_and_times = list(self._last_access_times.items())
+        stats = []
+        for key, t in keys_and_times:
+            try:
+                size = self._blocks[key].storage_size()
+            except (KeyError, ValueError):
+                # block was freed in the meantime
+                size = None
+            stats.append(BlockStatistics(key, t, size, self._compute_times.get(key)))
+        return stats
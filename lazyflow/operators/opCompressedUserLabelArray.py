@@ -47,6 +47,9 @@ from lazyflow.rtype import SubRegion
 
 logger = logging.getLogger(__name__)
 
+# Label values are stored as uint8
+_NUM_LABEL_VALUES = 256
+
 
 class OpCompressedUserLabelArray(OpUnmanagedCompressedCache):
     """
@@ -90,6 +93,36 @@ class OpCompressedUserLabelArray(OpUnmanagedCompressedCache):
         # to get the volume shape
         self._ignore_ideal_blockshape = True
 
+    def _init_cache(self, new_blockshape):
+        super(OpCompressedUserLabelArray, self)._init_cache(new_blockshape)
+        with self._lock:
+            # Label index, maintained in _setInSlotInput():
+            # block start -> histogram of the label values in the block (_NUM_LABEL_VALUES bins, bin 0 unused)
+            self._block_label_counts = {}
+            # label value -> set of the starts of the blocks that contain it (no entry for 0)
+            self._label_blocks = collections.defaultdict(set)
+
+    def _setBlockLabelCounts(self, block_start, counts, delta=False):
+        """
+        Update the label index with the new label histogram of the given block.
+        If delta is True, counts is the change of the block's histogram instead.
+        """
+        with self._lock:
+            old_counts = self._block_label_counts.pop(block_start, None)
+            if delta and old_counts is not None:
+                counts = old_counts + counts
+            counts[0] = 0
+            if old_counts is not None:
+                for label in numpy.flatnonzero(old_counts[1:]) + 1:
+                    self._label_blocks[label].discard(block_start)
+            if counts[1:].any():
+                self._block_label_counts[block_start] = counts
+                for label in numpy.flatnonzero(counts[1:]) + 1:
+                    self._label_blocks[label].add(block_start)
+
+    def _blockStart(self, roi_start):
+        return tuple(numpy.asarray(roi_start) // self._blockshape * self._blockshape)
+
     def clearLabel(self, label_value):
         """
         Clear (reset to 0) all pixels of the given label value.
@@ -154,40 +187,53 @@ class OpCompressedUserLabelArray(OpUnmanagedCompressedCache):
 
     def _purge_label(self, label_to_purge, decrement_remaining, replacement_value=0):
         """
-        Scan through all labeled pixels.
+        Relabel all labeled pixels.
         (1) Reassign all pixels of the given value (set to replacement_value)
         (2) If decrement_remaining=True, decrement all labels above that
             value so the set of stored labels remains consecutive.
             Note that the decrement is performed AFTER replacement.
+
+        Only the blocks that contain one of the changed labels are visited (see the label index).
         """
+        label_values = numpy.arange(_NUM_LABEL_VALUES)
+        lut = label_values.astype(numpy.uint8)
+        lut[label_to_purge] = replacement_value
+        if decrement_remaining:
+            lut[lut > label_to_purge] -= numpy.uint8(1)
+
+        changed_labels = numpy.flatnonzero(lut != label_values)
+        with self._lock:
+            if lut[0] != 0:
+                # Background changes, too (not indexed).
+                block_starts = set(self._blocks.keys())
+            else:
+                block_starts = set().union(*(self._label_blocks.get(label, ()) for label in changed_labels))
+            block_counts = {block_start: self._block_label_counts.get(block_start) for block_start in block_starts}
+
         changed_block_rois = []
-        # stored_block_rois = self.CleanBlocks.value
-        stored_block_roi_destination = [None]
-        self.execute(self.CleanBlocks, (), SubRegion(self.Output, (0,), (1,)), stored_block_roi_destination)
-        stored_block_rois = stored_block_roi_destination[0]
+        for block_start in sorted(block_starts):
+            block_roi = getBlockBounds(self.Output.meta.shape, self._blockshape, block_start)
+            block_slot_roi = SubRegion(self.Output, *block_roi)
 
-        for block_roi in stored_block_rois:
             # Get data
-            block_shape = numpy.subtract(block_roi[1], block_roi[0])
-            block = self.Output.stype.allocateDestination(SubRegion(self.Output, *roiFromShape(block_shape)))
-
-            self.execute(self.Output, (), SubRegion(self.Output, *block_roi), block)
-
-            # Locate pixels to change
-            matching_label_coords = numpy.nonzero(block == label_to_purge)
+            block = self.Output.stype.allocateDestination(block_slot_roi)
+            self.execute(self.Output, (), block_slot_roi, block)
 
             # Change the data
-            block[matching_label_coords] = replacement_value
-            coords_to_decrement = block > label_to_purge
-            if decrement_remaining:
-                block[coords_to_decrement] -= numpy.uint8(1)
-
-            # Update cache with the new data (only if something really changed)
-            if len(matching_label_coords[0]) > 0 or (decrement_remaining and coords_to_decrement.sum() > 0):
-                super(OpCompressedUserLabelArray, self)._setInSlotInput(
-                    self.Input, (), SubRegion(self.Output, *block_roi), block, store_zero_blocks=False
-                )
-                changed_block_rois.append(block_roi)
+            block_data = numpy.ma.getdata(block)
+            block_data[...] = lut[block_data]
+
+            super(OpCompressedUserLabelArray, self)._setInSlotInput(
+                self.Input, (), block_slot_roi, block, store_zero_blocks=False
+            )
+            counts = block_counts[block_start]
+            if counts is None or lut[0] != 0:
+                counts = numpy.bincount(block_data.ravel(), minlength=_NUM_LABEL_VALUES)
+                self._setBlockLabelCounts(block_start, counts)
+            else:
+                new_counts = numpy.bincount(lut, weights=counts, minlength=_NUM_LABEL_VALUES).astype(numpy.int64)
+                self._setBlockLabelCounts(block_start, new_counts - counts, delta=True)
+            changed_block_rois.append(block_roi)
 
         for block_roi in changed_block_rois:
             # FIXME: Shouldn't this dirty notification be handled in OpUnmanagedCompressedCache?
@@ -268,10 +314,9 @@ class OpCompressedUserLabelArray(OpUnmanagedCompressedCache):
         # Get the logical blocking.
         block_starts = getIntersectingBlocks(self._blockshape, (input_roi.start, input_roi.stop))
 
-        # (Parallelism wouldn't help here: h5py will serialize these requests anyway)
         block_starts = list(map(tuple, block_starts))
         for block_start in block_starts:
-            if block_start not in self._cacheFiles:
+            if block_start not in self._blocks:
                 # No label data in this block.  Move on.
                 continue
 
@@ -283,19 +328,8 @@ class OpCompressedUserLabelArray(OpUnmanagedCompressedCache):
             # Compute slicing within the deep array and slicing within this block
             deep_relative_intersection = numpy.subtract(intersecting_roi, input_roi.start)
             block_relative_intersection = numpy.subtract(intersecting_roi, block_start)
-            block_relative_intersection_slicing = roiToSlice(*block_relative_intersection)
-
-            block = self._getBlockDataset(entire_block_roi)
-            deep_data = None
-            if self.Output.meta.has_mask:
-                deep_data = numpy.ma.masked_array(
-                    block["data"][block_relative_intersection_slicing],
-                    mask=block["mask"][block_relative_intersection_slicing],
-                    fill_value=block["fill_value"][()],
-                    shrink=False,
-                )
-            else:
-                deep_data = block[block_relative_intersection_slicing]
+
+            deep_data = self._getBlock(entire_block_roi).read(block_relative_intersection)
 
             # make binary and convert to float (must copy)
             deep_data_float = deep_data.astype(numpy.float32)
@@ -351,7 +385,6 @@ class OpCompressedUserLabelArray(OpUnmanagedCompressedCache):
         Copy data from each block into the destination array.
         For blocks that aren't currently stored, just write zeros.
         """
-        # (Parallelism not needed here: h5py will serialize these requests anyway)
         block_starts = list(map(tuple, block_starts))
         for block_start in block_starts:
             entire_block_roi = getBlockBounds(self.Output.meta.shape, self._blockshape, block_start)
@@ -363,24 +396,13 @@ class OpCompressedUserLabelArray(OpUnmanagedCompressedCache):
             destination_relative_intersection = numpy.subtract(intersecting_roi, roi.start)
             block_relative_intersection = numpy.subtract(intersecting_roi, block_start)
             destination_relative_intersection_slicing = roiToSlice(*destination_relative_intersection)
-            block_relative_intersection_slicing = roiToSlice(*block_relative_intersection)
 
-            if block_start in self._cacheFiles:
+            if block_start in self._blocks:
                 # Copy from block to destination
-                dataset = self._getBlockDataset(entire_block_roi)
-
+                block = self._getBlock(entire_block_roi)
+                block.read(block_relative_intersection, destination[destination_relative_intersection_slicing])
                 if self.Output.meta.has_mask:
-                    destination[destination_relative_intersection_slicing] = dataset["data"][
-                        block_relative_intersection_slicing
-                    ]
-                    destination.mask[destination_relative_intersection_slicing] = dataset["mask"][
-                        block_relative_intersection_slicing
-                    ]
-                    destination.fill_value = dataset["fill_value"][()]
-                else:
-                    destination[destination_relative_intersection_slicing] = dataset[
-                        block_relative_intersection_slicing
-                    ]
+                    destination.fill_value = block.fill_value
             else:
                 # Not stored yet.  Overwrite with zeros.
                 destination[destination_relative_intersection_slicing] = 0
@@ -431,6 +453,7 @@ class OpCompressedUserLabelArray(OpUnmanagedCompressedCache):
             # Extract the data to modify
             original_block_data = self.Output.stype.allocateDestination(block_slot_roi)
             self.execute(self.Output, (), block_slot_roi, original_block_data)
+            old_counts = numpy.bincount(numpy.ma.getdata(original_block_data).ravel(), minlength=_NUM_LABEL_VALUES)
 
             # Reset the pixels we need to change (so we can use |= below)
             original_block_data[new_block_pixels.nonzero()] = 0
@@ -447,6 +470,11 @@ class OpCompressedUserLabelArray(OpUnmanagedCompressedCache):
                 slot, subindex, block_slot_roi, cleaned_block_data, store_zero_blocks=False
             )
 
+            # Update the label index. (block_roi may only be part of the block.)
+            block_start = self._blockStart(block_roi[0])
+            new_counts = numpy.bincount(numpy.ma.getdata(cleaned_block_data).ravel(), minlength=_NUM_LABEL_VALUES)
+            self._setBlockLabelCounts(block_start, new_counts - old_counts, delta=True)
+
             max_label = max(max_label, cleaned_block_data.max())
 
             # We could wait to send out one big dirty notification (instead of one per block),
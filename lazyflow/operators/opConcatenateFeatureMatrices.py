@@ -125,7 +125,11 @@ class OpConcatenateFeatureMatrices(Operator):
         #  we have to unpack them from their single-element lists.
         subresult_list = list(itertools.chain(*subresults))
 
-        total_matrix = numpy.concatenate(subresult_list, axis=0)
+        if len(subresult_list) == 1:
+            # Nothing to concatenate: pass the (read-only, shared) matrix through without copying it.
+            total_matrix = subresult_list[0]
+        else:
+            total_matrix = numpy.concatenate(subresult_list, axis=0)
         self.progressSignal(100.0)
         result[0] = total_matrix
 
@@ -34,12 +34,187 @@ from lazyflow.utility import OrderedSignal
 from lazyflow.roi import getBlockBounds, getIntersectingBlocks, determineBlockShape
 
 
+class _FeatureMatrixStore(object):
+    """
+    Label & feature rows of all labeled pixels, in a preallocated, append-only matrix.
+
+    Each row belongs to one labeled pixel, identified by its block (the block's start
+    coordinate) and its flat index within that block. For each block, the pixel indices
+    (sorted) and the positions of their rows in the matrix are kept in two arrays, so
+    applying a label delta to a block only touches that block's rows, using array operations.
+    The order of the rows is arbitrary.
+
+    matrix() returns a read-only view of the used part of the matrix. Rows that were handed
+    out that way are never modified, so consumers (e.g. a classifier that is still training)
+    may keep them: new rows are appended behind them, and if they are changed afterwards, they
+    are appended again (with their new values). Removed and replaced rows leave holes, which are
+    compacted (i.e. copied to a new matrix) by the next call to matrix(). Thus, adding labels
+    costs time proportional to the number of new rows, not to the size of the matrix.
+
+    This class is not thread-safe; callers are expected to hold their own lock.
+    """
+
+    MIN_CAPACITY = 1024
+
+    def __init__(self, num_columns=1):
+        self._matrix = numpy.zeros((self.MIN_CAPACITY, num_columns), dtype=numpy.float32)
+        self._size = 0  # Number of used rows (including holes)
+        self._holes = 0  # Number of unused rows below _size
+        self._shared = 0  # Number of rows that were handed out by matrix() (must not be modified)
+        self._blocks = {}  # block_start -> (pixel_indices, row_positions)
+        self._snapshot = None
+
+    @property
+    def num_columns(self):
+        return self._matrix.shape[1]
+
+    def __len__(self):
+        return self._size - self._holes
+
+    def reset(self, num_columns):
+        self.__init__(num_columns)
+
+    def block_starts(self):
+        return list(self._blocks.keys())
+
+    def block_labels(self, block_start):
+        """
+        Return (pixel_indices, labels) of the rows stored for the given block, sorted by pixel index.
+        """
+        pixel_indices, positions = self._blocks.get(block_start, self._empty_block())
+        return pixel_indices, self._matrix[positions, 0]
+
+    def update_block(self, block_start, removed, relabeled, relabeled_labels, added, added_rows):
+        """
+        Apply a label delta to the given block.
+        Re-applying the same delta is harmless: removing missing pixels is a no-op
+        and adding pixels that are already stored overwrites their rows.
+
+        :param removed: pixel indices whose rows should be deleted
+        :param relabeled: pixel indices whose label (column 0) changed
+        :param relabeled_labels: the new labels of the relabeled pixels
+        :param added: pixel indices of new rows
+        :param added_rows: the new rows (labels and features)
+        """
+        pixel_indices, positions = self._blocks.get(block_start, self._empty_block())
+
+        # (Boolean indexing copies, so the block's previous arrays are never modified.)
+        keep = ~numpy.isin(pixel_indices, removed)
+        self._holes += len(keep) - keep.sum()
+        pixel_indices, positions = pixel_indices[keep], positions[keep]
+
+        indexes, found = self._find(pixel_indices, relabeled)
+        indexes = indexes[found]
+        relabeled_rows = self._matrix[positions[indexes]]
+        relabeled_rows[:, 0] = relabeled_labels[found]
+        positions[indexes] = self._replace_rows(positions[indexes], relabeled_rows)
+
+        indexes, found = self._find(pixel_indices, added)
+        positions[indexes[found]] = self._replace_rows(positions[indexes[found]], added_rows[found])
+        if not found.all():
+            pixel_indices = numpy.concatenate((pixel_indices, added[~found]))
+            positions = numpy.concatenate((positions, self._append_rows(added_rows[~found])))
+            order = numpy.argsort(pixel_indices, kind="stable")
+            pixel_indices, positions = pixel_indices[order], positions[order]
+
+        if len(pixel_indices):
+            self._blocks[block_start] = (pixel_indices, positions)
+        else:
+            self._blocks.pop(block_start, None)
+        self._snapshot = None
+
+    def remove_block(self, block_start):
+        block = self._blocks.pop(block_start, None)
+        if block is not None:
+            self._holes += len(block[0])
+            self._snapshot = None
+
+    def matrix(self):
+        """
+        Return a read-only matrix of all stored rows (in arbitrary order).
+        """
+        if self._snapshot is None:
+            if self._holes:
+                self._compact()
+            snapshot = self._matrix[: self._size]
+            snapshot.flags.writeable = False
+            self._shared = self._size
+            self._snapshot = snapshot
+        return self._snapshot
+
+    def _replace_rows(self, positions, rows):
+        """
+        Overwrite the rows at the given positions, and return their (new) positions.
+        Rows that were already handed out are left alone; they become holes, and the new rows are appended instead.
+        """
+        in_place = positions >= self._shared
+        self._matrix[positions[in_place]] = rows[in_place]
+        positions = positions.copy()
+        self._holes += len(in_place) - in_place.sum()
+        positions[~in_place] = self._append_rows(rows[~in_place])
+        return positions
+
+    def _append_rows(self, rows):
+        """
+        Append the given rows, and return their positions.
+        """
+        if self._size + len(rows) > len(self._matrix):
+            self._reallocate(self._size + len(rows), numpy.arange(self._size))
+        positions = numpy.arange(self._size, self._size + len(rows))
+        self._matrix[positions] = rows
+        self._size += len(rows)
+        return positions
+
+    def _compact(self):
+        """
+        Move all rows into a new matrix without holes.
+        """
+        block_starts = list(self._blocks.keys())
+        positions = [self._blocks[block_start][1] for block_start in block_starts]
+        offsets = numpy.cumsum([0] + [len(p) for p in positions])
+        self._reallocate(offsets[-1], numpy.concatenate([self._empty_block()[1]] + positions))
+        self._holes = 0
+        for block_start, start, stop in zip(block_starts, offsets[:-1], offsets[1:]):
+            self._blocks[block_start] = (self._blocks[block_start][0], numpy.arange(start, stop))
+
+    def _reallocate(self, num_rows, positions):
+        """
+        Copy the rows at the given positions to the beginning of a new matrix with room for (at least) 2 * num_rows.
+        (The old matrix is left untouched, since parts of it may have been handed out.)
+        """
+        matrix = numpy.zeros((max(self.MIN_CAPACITY, 2 * num_rows), self.num_columns), dtype=numpy.float32)
+        matrix[: len(positions)] = self._matrix[positions]
+        self._matrix = matrix
+        self._size = len(positions)
+        self._shared = 0
+
+    def _empty_block(self):
+        return numpy.zeros((0,), dtype=numpy.intp), numpy.zeros((0,), dtype=numpy.intp)
+
+    @staticmethod
+    def _find(sorted_pixel_indices, pixel_indices):
+        """
+        Return the positions of the given pixel indices in sorted_pixel_indices,
+        and a mask of the pixel indices that were found at all.
+        """
+        pixel_indices = numpy.asarray(pixel_indices, dtype=numpy.intp)
+        positions = numpy.searchsorted(sorted_pixel_indices, pixel_indices)
+        found = positions < len(sorted_pixel_indices)
+        found[found] = sorted_pixel_indices[positions[found]] == pixel_indices[found]
+        return positions, found
+
+
 class OpFeatureMatrixCache(Operator):
     """
     - Request features and labels in blocks
     - For nonzero label pixels in each block, extract the label image
-    - Cache the feature matrix for each block separately
-    - Output the concatenation of all feature matrices
+    - Cache the labels and features of all labeled pixels, per block
+    - Output a read-only matrix of all of them, which is only copied after labels were removed or changed
+
+    When the labels of a block change, only the pixels whose label actually changed
+    are updated: features are requested for newly labeled pixels only, relabeled pixels
+    just get their label updated and unlabeled pixels are dropped.
+    If the features change, all stored blocks are recomputed.
 
     Note: This operator does not currently have "NonZeroLabelBlocks" input slot.
           Instead, it only requests labels for blocks that have been
@@ -56,6 +231,7 @@ class OpFeatureMatrixCache(Operator):
     # Output is a single 'value', which is a 2D ndarray.
     # The first row is labels, the rest are the features.
     # (As a consequence of this, labels are converted to float)
+    # The matrix is read-only, and may be shared with other consumers of this slot.
     LabelAndFeatureMatrix = OutputSlot()
 
     ProgressSignal = OutputSlot()  # For convenience of passing several progress signals
@@ -71,7 +247,8 @@ class OpFeatureMatrixCache(Operator):
 
         self._blockshape = None
         self._dirty_blocks = set()
-        self._blockwise_feature_matrices = {}
+        self._feature_dirty_blocks = set()  # Blocks whose stored features are outdated (subset of _dirty_blocks)
+        self._store = _FeatureMatrixStore()
         self._block_locks = {}  # One lock per stored block
 
         self._init_blocks(None, None)
@@ -82,7 +259,7 @@ class OpFeatureMatrixCache(Operator):
             # Nothing to do
             return
 
-        if len(self._dirty_blocks) != 0 or len(self._blockwise_feature_matrices) != 0:
+        if len(self._dirty_blocks) != 0 or len(self._store.block_starts()) != 0:
             raise RuntimeError(
                 "It's too late to change the dimensionality of your data after you've already started training.\n"
                 "Delete all your labels and try again."
@@ -102,9 +279,10 @@ class OpFeatureMatrixCache(Operator):
 
         # For now, we assume that the two input images have the same shape (except channel)
         # This constraint could be relaxed in the future if necessary
-        assert self.FeatureImage.meta.shape[:-1] == self.LabelImage.meta.shape[:-1], (
-            "FeatureImage and LabelImage shapes do not match: {} vs {}"
-            "".format(self.FeatureImage.meta.shape, self.LabelImage.meta.shape)
+        assert (
+            self.FeatureImage.meta.shape[:-1] == self.LabelImage.meta.shape[:-1]
+        ), "FeatureImage and LabelImage shapes do not match: {} vs {}" "".format(
+            self.FeatureImage.meta.shape, self.LabelImage.meta.shape
         )
 
         self.LabelAndFeatureMatrix.meta.shape = (1,)
@@ -116,6 +294,14 @@ class OpFeatureMatrixCache(Operator):
             self.LabelAndFeatureMatrix.meta.num_feature_channels = num_feature_channels
             self.LabelAndFeatureMatrix.setDirty()
 
+        if 1 + num_feature_channels != self._store.num_columns:
+            # The stored rows have the wrong width: start over, recomputing all stored blocks.
+            with self._lock:
+                block_starts = self._store.block_starts()
+                self._store.reset(1 + num_feature_channels)
+                self._dirty_blocks.update(block_starts)
+                self._feature_dirty_blocks.update(block_starts)
+
         self.ProgressSignal.meta.shape = (1,)
         self.ProgressSignal.meta.dtype = object
         self.ProgressSignal.setValue(self.progressSignal)
@@ -159,15 +345,16 @@ class OpFeatureMatrixCache(Operator):
         # It's better to do this now instead of inside each request
         #  to avoid contention over self._lock
         with self._lock:
-            for block_start in self._dirty_blocks:
+            dirty_blocks = list(self._dirty_blocks)
+            for block_start in dirty_blocks:
                 if block_start not in self._block_locks:
                     self._block_locks[block_start] = RequestLock()
 
         # Update each block in its own request.
         pool = RequestPool()
         reqs = {}
-        for block_start in self._dirty_blocks:
-            req = Request(partial(self._get_features_for_block, block_start))
+        for block_start in dirty_blocks:
+            req = Request(partial(self._get_block_delta, block_start))
             req.notify_finished(update_progress)
             reqs[block_start] = req
             pool.add(req)
@@ -181,32 +368,18 @@ class OpFeatureMatrixCache(Operator):
                 if req.result is None:
                     # 'None' means the block wasn't dirty. No need to update.
                     continue
-                labels_and_features_matrix = req.result
-                self._dirty_blocks.remove(block_start)
-
-                if labels_and_features_matrix.shape[0] > 0:
-                    # Update the block entry with the new matrix.
-                    self._blockwise_feature_matrices[block_start] = labels_and_features_matrix
-                else:
-                    # All labels were removed from the block,
-                    # So the new feature matrix is empty.
-                    # Just delete its entry from our list.
-                    try:
-                        del self._blockwise_feature_matrices[block_start]
-                    except KeyError:
-                        pass
-
-        # Concatenate the all blockwise results
-        if self._blockwise_feature_matrices:
-            total_feature_matrix = numpy.concatenate(list(self._blockwise_feature_matrices.values()), axis=0)
-        else:
-            # No label points at all.
-            # Return an empty label&feature matrix (of the correct shape)
-            num_feature_channels = self.FeatureImage.meta.shape[-1]
-            total_feature_matrix = numpy.ndarray(shape=(0, 1 + num_feature_channels), dtype=numpy.float32)
+                self._dirty_blocks.discard(block_start)
+                self._feature_dirty_blocks.discard(block_start)
+                self._store.update_block(block_start, *req.result)
+
+            total_feature_matrix = self._store.matrix()
 
         self.progressSignal(100.0)
-        logger.debug("After update, there are {} clean blocks".format(len(self._blockwise_feature_matrices)))
+        logger.debug(
+            "After update, there are {} labeled pixels in {} blocks".format(
+                len(total_feature_matrix), len(self._store.block_starts())
+            )
+        )
         result[0] = total_feature_matrix
 
     def propagateDirty(self, slot, subindex, roi):
@@ -222,53 +395,88 @@ class OpFeatureMatrixCache(Operator):
         #  the blocks that are actually stored already
         # For big dirty rois (e.g. the entire image),
         #  we avoid a lot of unnecessary entries in self._dirty_blocks
-        if slot == self.FeatureImage:
-            # We ignore the ROI and assume all blocks are dirty.
-            # Technically, this would be inefficient if it's possible for the features
-            # to become only partially dirty in a small ROI.
-            # But currently, there is no known use-case for that.
-            block_starts = list(self._blockwise_feature_matrices.keys())
-        else:
-            block_starts = getIntersectingBlocks(self._blockshape, (roi.start, roi.stop))
-            block_starts = list(map(tuple, block_starts))
-
         with self._lock:
-            self._dirty_blocks.update(set(block_starts))
+            if slot == self.FeatureImage:
+                # We ignore the ROI and assume all blocks are dirty.
+                # Technically, this would be inefficient if it's possible for the features
+                # to become only partially dirty in a small ROI.
+                # But currently, there is no known use-case for that.
+                block_starts = self._store.block_starts()
+                self._feature_dirty_blocks.update(block_starts)
+            else:
+                block_starts = getIntersectingBlocks(self._blockshape, (roi.start, roi.stop))
+                block_starts = list(map(tuple, block_starts))
+
+            self._dirty_blocks.update(block_starts)
 
         # Output has no notion of roi. It's all dirty.
         self.LabelAndFeatureMatrix.setDirty()
 
-    def _get_features_for_block(self, block_start):
+    def _get_block_delta(self, block_start):
         """
-        Computes the feature matrix for the given block IFF the block is dirty.
+        Computes the changes to the stored rows of the given block IFF the block is dirty.
         Otherwise, returns None.
+
+        The delta is returned as the argument tuple of _FeatureMatrixStore.update_block():
+        (removed, relabeled, relabeled_labels, added, added_rows)
         """
         # Caller must ensure that the lock for this block already exists!
         with self._block_locks[block_start]:
-            if block_start not in self._dirty_blocks:
-                # Nothing to do if this block isn't actually dirty
-                # (For parallel requests, its theoretically possible.)
-                return None
+            with self._lock:
+                if block_start not in self._dirty_blocks:
+                    # Nothing to do if this block isn't actually dirty
+                    # (For parallel requests, its theoretically possible.)
+                    return None
+                features_dirty = block_start in self._feature_dirty_blocks
+                old_indices, old_labels = self._store.block_labels(block_start)
+
             block_roi = getBlockBounds(self.LabelImage.meta.shape, self._blockshape, block_start)
             # TODO: Shrink the requested roi using the nonzero blocks slot...
             #       ...or just get rid of the nonzero blocks slot...
-            labels_and_features_matrix = self._extract_feature_matrix(block_roi)
-            return labels_and_features_matrix
-
-    def _extract_feature_matrix(self, label_block_roi):
+            labels = self.LabelImage(block_roi[0], block_roi[1]).wait()
+            labels = labels[..., 0].view(numpy.ndarray)
+            block_shape = labels.shape
+            labels = labels.reshape(-1)
+
+            new_indices = numpy.flatnonzero(labels)
+            new_labels = labels[new_indices].astype(numpy.float32)
+            del labels  # Done with dense labels block; delete immediately.
+
+            if features_dirty:
+                # Everything has to be recomputed
+                removed = old_indices
+                relabeled = numpy.zeros((0,), dtype=numpy.intp)
+                relabeled_labels = numpy.zeros((0,), dtype=numpy.float32)
+                added = new_indices
+                added_labels = new_labels
+            else:
+                removed = numpy.setdiff1d(old_indices, new_indices, assume_unique=True)
+                common, old_pos, new_pos = numpy.intersect1d(
+                    old_indices, new_indices, assume_unique=True, return_indices=True
+                )
+                changed = old_labels[old_pos] != new_labels[new_pos]
+                relabeled = common[changed]
+                relabeled_labels = new_labels[new_pos[changed]]
+                is_added = numpy.ones(len(new_indices), dtype=bool)
+                is_added[new_pos] = False
+                added = new_indices[is_added]
+                added_labels = new_labels[is_added]
+
+            features_matrix = self._extract_features(block_roi, numpy.unravel_index(added, block_shape))
+            added_rows = numpy.concatenate((added_labels[:, None], features_matrix), axis=1)
+            return removed, relabeled, relabeled_labels, added, added_rows
+
+    def _extract_features(self, label_block_roi, label_block_positions):
+        """
+        Returns the feature matrix of the given pixels (as a tuple of coordinate arrays within the block).
+        """
         num_feature_channels = self.FeatureImage.meta.shape[-1]
-        labels = self.LabelImage(label_block_roi[0], label_block_roi[1]).wait()
-        label_block_positions = numpy.nonzero(labels[..., 0].view(numpy.ndarray))
-        labels_matrix = labels[label_block_positions].astype(numpy.float32).view(numpy.ndarray)
-
-        del labels  # Done with dense labels block; delete immediately.
-
-        if len(label_block_positions) == 0 or len(label_block_positions[0]) == 0:
+        if len(label_block_positions[0]) == 0:
             # No label points in this roi.
-            # Return an empty label&feature matrix (of the correct shape)
-            return numpy.ndarray(shape=(0, 1 + num_feature_channels), dtype=numpy.float32)
+            # Return an empty feature matrix (of the correct shape)
+            return numpy.ndarray(shape=(0, num_feature_channels), dtype=numpy.float32)
 
-        # Shrink the roi to the bounding box of nonzero labels
+        # Shrink the roi to the bounding box of the requested pixels
         block_bounding_box_start = numpy.min(label_block_positions, axis=1)
         block_bounding_box_stop = 1 + numpy.max(label_block_positions, axis=1)
 
@@ -289,5 +497,4 @@ class OpFeatureMatrixCache(Operator):
         features = self.FeatureImage(feature_roi_start, feature_roi_stop).wait()
 
         # Cast as plain ndarray (not VigraArray), since we don't need/want axistags
-        features_matrix = features[bounding_box_positions].view(numpy.ndarray)
-        return numpy.concatenate((labels_matrix, features_matrix), axis=1)
+        return features[bounding_box_positions].view(numpy.ndarray).astype(numpy.float32, copy=False)
@@ -431,15 +431,10 @@ class OpLazyConnectedComponents(Operator, ObservableCache):
         numLabels = labeled.max()  # we ignore 0 here
         self._numIndices[chunkIndex] = numLabels
         if numLabels > 0:
-            with self._lock:
-                # determine the offset
-                # localLabel + offset = globalLabel (for localLabel>0)
-                offset = self._uf.makeNewIndex()
-                self._globalLabelOffset[chunkIndex] = offset - 1
-
-                # get n-1 more labels
-                for i in range(numLabels - 1):
-                    self._uf.makeNewIndex()
+            # determine the offset
+            # localLabel + offset = globalLabel (for localLabel>0)
+            offset = self._uf.makeNewIndices(int(numLabels))
+            self._globalLabelOffset[chunkIndex] = offset - 1
 
     # merge the labels of two adjacent chunks
     # the chunks have to be ordered lexicographically, e.g. by self._orderPair
@@ -468,18 +463,14 @@ class OpLazyConnectedComponents(Operator, ObservableCache):
         hyperplane_b = self._Input[hyperplane_index_b].wait()
         adjacent_bool_inds = np.logical_and(adjacent_bool_inds, hyperplane_a == hyperplane_b)
 
-        # union find manipulations are critical
-        with self._lock:
-            map_a = self.localToGlobal(chunkA)
-            map_b = self.localToGlobal(chunkB)
-            labels_a = map_a[label_hyperplane_a[adjacent_bool_inds]]
-            labels_b = map_b[label_hyperplane_b[adjacent_bool_inds]]
-            for a, b in zip(labels_a, labels_b):
-                assert a not in self._globalToFinal, "Invalid merge"
-                assert b not in self._globalToFinal, "Invalid merge"
-                self._uf.makeUnion(a, b)
-
-            logger.debug("merged chunks {} and {}".format(chunkA, chunkB))
+        # (the union find structure synchronizes union operations itself)
+        map_a = self.localToGlobal(chunkA)
+        map_b = self.localToGlobal(chunkB)
+        labels_a = map_a[label_hyperplane_a[adjacent_bool_inds]]
+        labels_b = map_b[label_hyperplane_b[adjacent_bool_inds]]
+        self._uf.makeUnions(labels_a, labels_b)
+
+        logger.debug("merged chunks {} and {}".format(chunkA, chunkB))
         correspondingLabelsA = label_hyperplane_a[adjacent_bool_inds]
         correspondingLabelsB = label_hyperplane_b[adjacent_bool_inds]
         return correspondingLabelsA, correspondingLabelsB
@@ -529,7 +520,7 @@ class OpLazyConnectedComponents(Operator, ObservableCache):
         numLabels = self._numIndices[chunkIndex]
         labels = np.arange(1, numLabels + 1, dtype=_LABEL_TYPE) + offset
 
-        labels = np.asarray(list(map(self._uf.findIndex, labels)), dtype=_LABEL_TYPE)
+        labels = self._uf.findIndices(labels)
 
         # we got 'numLabels' real labels, and one label '0', so our
         # output has to have numLabels+1 elements
@@ -542,19 +533,19 @@ class OpLazyConnectedComponents(Operator, ObservableCache):
     # UnionFind.makeUnion any more!
     @threadsafe
     def globalToFinal(self, t, c, labels):
-        newlabels = labels.copy()
         d = self._globalToFinal[(t, c)]
         labeler = self._labelIterators[(t, c)]
-        for k in vigra.analysis.unique(labels):
-            l = self._uf.findIndex(k)
+        keys = np.unique(labels)
+        finalKeys = np.zeros(keys.shape, dtype=labels.dtype)
+        for i, l in enumerate(self._uf.findIndices(keys)):
             if l == 0:
                 continue
 
             if l not in d:
                 nextLabel = next(labeler)
                 d[l] = nextLabel
-            newlabels[labels == k] = d[l]
-        return newlabels
+            finalKeys[i] = d[l]
+        return finalKeys[np.searchsorted(keys, labels)]
 
     ##########################################################################
     ##################### HELPER METHODS #####################################
@@ -790,50 +781,90 @@ class OpLazyConnectedComponents(Operator, ObservableCache):
 
 
 # python implementation of vigra's UnionFindArray structure
+#
+# The parent of each label is stored in a numpy array, which grows
+# geometrically. The representative of a set is always its smallest label.
+#
+# Synchronization: Union operations (and growing the array) are serialized
+# by a lock of this structure. Find operations walk the parents without the
+# lock (a concurrent union can only make the root they find stale, which is
+# the same as if the find had happened first). Path compression, however,
+# must not overwrite the parent set by a concurrent union, so it is done
+# under the lock, and only for entries that still hold the parent that was
+# read during the walk.
 class UnionFindArray(object):
-    def __init__(self, nextFree=1):
-        self._map = dict(list(zip(*(list(range(nextFree)),) * 2)))
+    def __init__(self, nextFree=1, dtype=_LABEL_TYPE):
         self._lock = HardLock()
-        self._nextFree = nextFree
-        self._it = None
+        self._nextFree = int(nextFree)
+        self._parent = np.arange(_get_next_power(max(self._nextFree, 1024)), dtype=dtype)
 
     ## join regions a and b
-    # callback is called whenever two regions are joined that were
-    # separate before, signature is
-    #   callback(smaller_label, larger_label)
-    @threadsafe
     def makeUnion(self, a, b):
-        assert a in self._map
-        assert b in self._map
-
-        a = self._findIndex(a)
-        b = self._findIndex(b)
+        self.makeUnions([a], [b])
 
-        # avoid cycles by choosing the smallest label as the common one
-        # swap such that a is smaller
-        if a > b:
-            a, b = b, a
+    ## join regions labels_a[i] and labels_b[i], for all i
+    @threadsafe
+    def makeUnions(self, labels_a, labels_b):
+        pairs = np.unique(np.stack((labels_a, labels_b)).astype(self._parent.dtype), axis=1)
+        assert (pairs < self._nextFree).all(), "Unknown label"
+        while pairs.size > 0:
+            found = self._findRoots(pairs)
+            self._compress(*found)
+            roots = found[2]
+            roots = roots[:, roots[0] != roots[1]]
+            # avoid cycles by choosing the smallest label as the common one
+            # (if a representative is joined with several others at once, only one
+            # of the assignments takes effect, the others are repeated in the next round)
+            self._parent[roots.max(axis=0)] = roots.min(axis=0)
+            pairs = roots
 
-        self._map[b] = a
+    def makeNewIndex(self):
+        return self.makeNewIndices(1)
 
+    ## reserve n consecutive new labels, returns the first one
     @threadsafe
-    def makeNewIndex(self):
+    def makeNewIndices(self, n):
         newLabel = self._nextFree
-        self._nextFree += 1
-        self._map[newLabel] = newLabel
+        self._nextFree += n
+        if self._nextFree > len(self._parent):
+            # unused labels are their own parents already
+            parent = np.arange(_get_next_power(self._nextFree), dtype=self._parent.dtype)
+            parent[: len(self._parent)] = self._parent
+            self._parent = parent
         return newLabel
 
-    @threadsafe
     def findIndex(self, a):
-        return self._findIndex(a)
+        return self.findIndices(a)[()]
 
-    def _findIndex(self, a):
-        while a != self._map[a]:
-            a = self._map[a]
-        return a
+    ## findIndex() for an array of labels (of any shape)
+    def findIndices(self, labels):
+        labels, parents, roots = self._findRoots(labels)
+        if (parents != roots).any():
+            with self._lock:
+                self._compress(labels, parents, roots)
+        return roots
+
+    # returns the labels (as array), their parents and their roots
+    def _findRoots(self, labels):
+        parent = self._parent
+        labels = np.asarray(labels)
+        parents = roots = parent[labels]
+        while True:
+            grandparents = parent[roots]
+            if (grandparents == roots).all():
+                break
+            roots = grandparents
+        return labels, parents, roots
+
+    # path compression, the caller must hold the lock
+    def _compress(self, labels, parents, roots):
+        stale = parents != roots
+        labels, parents, roots = labels[stale], parents[stale], roots[stale]
+        unchanged = self._parent[labels] == parents
+        self._parent[labels[unchanged]] = roots[unchanged]
 
     def __str__(self):
-        s = "<UnionFindArray>\n{}".format(self._map)
+        return "<UnionFindArray>\n{}".format(self.findIndices(np.arange(self._nextFree)))
 
     def __getstate__(self):
         odict = self.__dict__.copy()
@@ -842,6 +873,7 @@ class UnionFindArray(object):
 
     def __setstate__(self, dict):
         self.__dict__.update(dict)
+        self._lock = HardLock()
 
 
 class InfiniteLabelIterator(object):
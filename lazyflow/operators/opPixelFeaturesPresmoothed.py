@@ -49,6 +49,23 @@ if WITH_FAST_FILTERS:
 
 logger = logging.getLogger(__name__)
 
+# Default of OpPixelFeaturesPresmoothed.IncrementalSmoothing.
+# Can be set via configure() (resp. incremental_smoothing in the [lazyflow] section of .ilastikrc).
+_incremental_smoothing = False
+
+
+def configure(incremental_smoothing=False):
+    """
+    Enable or disable incremental smoothing in (subsequently created) OpPixelFeaturesPresmoothed operators.
+    """
+    global _incremental_smoothing
+    _incremental_smoothing = bool(incremental_smoothing)
+    logger.info("Incremental feature smoothing {}".format("enabled" if _incremental_smoothing else "disabled"))
+
+
+def incremental_smoothing():
+    return _incremental_smoothing
+
 
 class OpPixelFeaturesPresmoothed(Operator):
     name = "OpPixelFeaturesPresmoothed"
@@ -58,6 +75,9 @@ class OpPixelFeaturesPresmoothed(Operator):
     Scales = InputSlot()
     SelectionMatrix = InputSlot()
     ComputeIn2d = InputSlot()
+    # If True, each pre-smoothed scale is derived from the next smaller one (see _executeIncremental)
+    # (Defaults to incremental_smoothing(), see configure())
+    IncrementalSmoothing = InputSlot(value=False)
 
     # Specify a default set & order for the features we compute
     FeatureIds = InputSlot(
@@ -80,6 +100,7 @@ class OpPixelFeaturesPresmoothed(Operator):
         Operator.__init__(self, *args, **kwargs)
         self.source = OpArrayPiper(parent=self)
         self.source.Input.connect(self.Input)
+        self.IncrementalSmoothing.setValue(incremental_smoothing())
 
     def getInvalidScales(self):
         """
@@ -287,6 +308,7 @@ class OpPixelFeaturesPresmoothed(Operator):
             or inputSlot == self.Scales
             or inputSlot == self.FeatureIds
             or inputSlot == self.ComputeIn2d
+            or inputSlot == self.IncrementalSmoothing
         ):
             self.Output.setDirty(slice(None))
         else:
@@ -386,6 +408,27 @@ class OpPixelFeaturesPresmoothed(Operator):
                 del source
                 source = sourceF
 
+            source_smooth_shape = tuple(smooth_filter_stop - smooth_filter_start)
+            full_source_smooth_shape = (
+                full_output_stop[0] - full_output_start[0],
+                self.Input.meta.shape[1],
+            ) + source_smooth_shape
+
+            closures = self._getFeatureClosures(slot_roi, target, full_output_slice, filter_target_slice)
+
+            if self.IncrementalSmoothing.value:
+                self._executeIncremental(
+                    source,
+                    self._getSmoothingChains(),
+                    closures,
+                    (input_filter_start, input_filter_stop),
+                    input_smooth_start,
+                    output_shape,
+                    axes2enlarge,
+                    full_source_smooth_shape,
+                )
+                return
+
             sourceV = source.view(vigra.VigraArray)
             sourceV.axistags = copy.copy(self.Input.meta.axistags)
 
@@ -394,11 +437,6 @@ class OpPixelFeaturesPresmoothed(Operator):
 
             presmoothed_source = [None] * dimCol
 
-            source_smooth_shape = tuple(smooth_filter_stop - smooth_filter_start)
-            full_source_smooth_shape = (
-                full_output_stop[0] - full_output_start[0],
-                self.Input.meta.shape[1],
-            ) + source_smooth_shape
             try:
                 for j in range(dimCol):
                     for i in range(dimRow):
@@ -409,10 +447,7 @@ class OpPixelFeaturesPresmoothed(Operator):
                         # There is no filter op at this scale
                         continue
 
-                    if self.scales[j] > 1.0:
-                        tempSigma = math.sqrt(self.scales[j] ** 2 - 1.0)
-                    else:
-                        tempSigma = self.scales[j]
+                    tempSigma = self._getPresmoothingSigma(j)
 
                     presmoothed_source[j] = numpy.ndarray(full_source_smooth_shape, numpy.float32)
 
@@ -426,13 +461,7 @@ class OpPixelFeaturesPresmoothed(Operator):
                         )
 
             except RuntimeError as e:
-                if "kernel longer than line" in str(e):
-                    raise RuntimeError(
-                        "Feature computation error:\nYour image is too small to apply a filter with "
-                        f"sigma={self.scales[j]:.1f}. Please select features with smaller sigmas."
-                    )
-                else:
-                    raise e
+                self._raiseFilterError(e, j)
 
             del sourceV
             try:
@@ -442,51 +471,9 @@ class OpPixelFeaturesPresmoothed(Operator):
                 logger.debug("Failed to free array memory.")
             del source
 
-            cnt = 0
-            written = 0
-            closures = []
-            # connect individual operators
-            for i in range(dimRow):
-                for j in range(dimCol):
-                    if self.matrix[i, j]:
-                        oslot = self.featureOps[i][j].Output
-                        req = None
-                        slices = oslot.meta.shape[1]
-                        if (
-                            cnt + slices >= slot_roi.start[1]
-                            and slot_roi.start[1] - cnt < slices
-                            and slot_roi.start[1] + written < slot_roi.stop[1]
-                        ):
-                            begin = 0
-                            if cnt < slot_roi.start[1]:
-                                begin = slot_roi.start[1] - cnt
-                            end = slices
-                            if cnt + end > slot_roi.stop[1]:
-                                end = slot_roi.stop[1] - cnt
-
-                            # feature slice in output frame
-                            feature_slice = (slice(None), slice(written, written + end - begin)) + (slice(None),) * 3
-
-                            subtarget = target[feature_slice]
-                            # readjust the roi for the new source array
-                            full_filter_target_slice = [full_output_slice[0], slice(begin, end), *filter_target_slice]
-                            filter_target_roi = SubRegion(oslot, pslice=full_filter_target_slice)
-
-                            closure = partial(
-                                oslot.operator.call_execute,
-                                oslot,
-                                (),
-                                filter_target_roi,
-                                subtarget,
-                                sourceArray=presmoothed_source[j],
-                            )
-                            closures.append(closure)
-
-                            written += end - begin
-                        cnt += slices
             pool = RequestPool()
-            for c in closures:
-                pool.request(c)
+            for j, closure in closures:
+                pool.request(partial(closure, sourceArray=presmoothed_source[j]))
             pool.wait()
             pool.clean()
 
@@ -497,6 +484,172 @@ class OpPixelFeaturesPresmoothed(Operator):
                     except Exception:
                         presmoothed_source[i] = None
 
+    def _getPresmoothingSigma(self, j):
+        # The feature operators smooth with sigma=1.0 for scales > 1.0 (see setupOutputs),
+        # so pre-smoothing only needs to cover the rest.
+        if self.scales[j] > 1.0:
+            return math.sqrt(self.scales[j] ** 2 - 1.0)
+        else:
+            return self.scales[j]
+
+    def _getSmoothingChains(self):
+        """
+        Group the selected scales for incremental smoothing.
+
+        Returns a list of (in2d, chain) tuples, where chain is a list of (scale_index, differential_sigma)
+        in order of increasing pre-smoothing sigma. Smoothing the result of the previous chain element
+        with the differential sigma yields the pre-smoothed image of the next scale, since
+        sigma_j ** 2 == sigma_{j-1} ** 2 + differential_sigma ** 2.
+        Scales computed in 2d and in 3d can't be derived from each other, so they form separate chains.
+        """
+        scales_by_dimension = {}
+        for j in range(len(self.scales)):
+            if self.matrix[:, j].any():
+                scales_by_dimension.setdefault(self.ComputeIn2d.value[j], []).append(j)
+
+        chains = []
+        for in2d, scale_indexes in scales_by_dimension.items():
+            chain = []
+            previous_sigma = 0.0
+            for j in sorted(scale_indexes, key=self._getPresmoothingSigma):
+                sigma = self._getPresmoothingSigma(j)
+                chain.append((j, math.sqrt(max(sigma ** 2 - previous_sigma ** 2, 0.0))))
+                previous_sigma = sigma
+            chains.append((in2d, chain))
+        return chains
+
+    def _getFeatureClosures(self, slot_roi, target, full_output_slice, filter_target_slice):
+        """
+        Returns a list of (scale_index, closure) for all feature operators that contribute to the requested
+        output channels. Each closure must be called with the pre-smoothed sourceArray of its scale.
+        """
+        dimCol = len(self.scales)
+        dimRow = self.matrix.shape[0]
+
+        cnt = 0
+        written = 0
+        closures = []
+        # connect individual operators
+        for i in range(dimRow):
+            for j in range(dimCol):
+                if self.matrix[i, j]:
+                    oslot = self.featureOps[i][j].Output
+                    slices = oslot.meta.shape[1]
+                    if (
+                        cnt + slices >= slot_roi.start[1]
+                        and slot_roi.start[1] - cnt < slices
+                        and slot_roi.start[1] + written < slot_roi.stop[1]
+                    ):
+                        begin = 0
+                        if cnt < slot_roi.start[1]:
+                            begin = slot_roi.start[1] - cnt
+                        end = slices
+                        if cnt + end > slot_roi.stop[1]:
+                            end = slot_roi.stop[1] - cnt
+
+                        # feature slice in output frame
+                        feature_slice = (slice(None), slice(written, written + end - begin)) + (slice(None),) * 3
+
+                        subtarget = target[feature_slice]
+                        # readjust the roi for the new source array
+                        full_filter_target_slice = [full_output_slice[0], slice(begin, end), *filter_target_slice]
+                        filter_target_roi = SubRegion(oslot, pslice=full_filter_target_slice)
+
+                        closure = partial(oslot.operator.call_execute, oslot, (), filter_target_roi, subtarget)
+                        closures.append((j, closure))
+
+                        written += end - begin
+                    cnt += slices
+        return closures
+
+    def _executeIncremental(
+        self,
+        source,
+        smoothing_chains,
+        closures,
+        input_filter_roi,
+        input_smooth_start,
+        output_shape,
+        axes2enlarge,
+        full_source_smooth_shape,
+    ):
+        """
+        Incremental scale-space: Instead of smoothing the raw source separately for every scale,
+        each scale is derived from the previous (smaller) one with the differential sigma.
+
+        The source is read with the same halo as in the direct mode. After every step, the intermediate
+        image is cropped to the halo of the steps that remain in the chain. These compose to a single
+        gaussian with sigma sqrt(sigma_last ** 2 - sigma_j ** 2), so the chain never depends on a larger
+        region than direct smoothing with sigma_last does.
+        The features of a scale are computed as soon as its pre-smoothed image is ready, so all scales
+        share a single pre-smoothed buffer.
+        """
+        sourceV = source.view(vigra.VigraArray)
+        sourceV.axistags = copy.copy(self.Input.meta.axistags)
+        time_slices = list(sourceV.timeIter())
+        channel_axistags = time_slices[0].axistags
+        num_channels = full_source_smooth_shape[1]
+
+        input_filter_start, input_filter_stop = input_filter_roi
+        presmoothed = numpy.ndarray(full_source_smooth_shape, numpy.float32)
+
+        for in2d, chain in smoothing_chains:
+            enlarge_axes = (0, 1, 1) if in2d else axes2enlarge
+            current = list(time_slices)
+            current_start = roi.TinyVector(input_smooth_start)
+            last_sigma = self._getPresmoothingSigma(chain[-1][0])
+
+            for j, differential_sigma in chain:
+                remaining_sigma = math.sqrt(max(last_sigma ** 2 - self._getPresmoothingSigma(j) ** 2, 0.0))
+
+                # The region (input frame) that the remaining steps of this chain depend on
+                needed_start, needed_stop = roi.enlargeRoiForHalo(
+                    input_filter_start,
+                    input_filter_stop,
+                    output_shape,
+                    remaining_sigma,
+                    self.WINDOW_SIZE,
+                    enlarge_axes=enlarge_axes,
+                )
+                droi = (
+                    (0, *tuple(roi.TinyVector(needed_start - current_start)._asint())),
+                    (num_channels, *tuple(roi.TinyVector(needed_stop - current_start)._asint())),
+                )
+
+                try:
+                    for i, vsa in enumerate(current):
+                        if differential_sigma > 0:
+                            vsa = self._computeGaussianSmoothing(vsa, differential_sigma, droi, in2d=in2d)
+                        else:
+                            vsa = vsa[roiToSlice(*droi)]
+                        current[i] = vsa.view(vigra.VigraArray)
+                        current[i].axistags = copy.copy(channel_axistags)
+                except RuntimeError as e:
+                    self._raiseFilterError(e, j)
+                current_start = roi.TinyVector(needed_start)
+
+                filter_slice = roiToSlice(
+                    (0, *(input_filter_start - current_start)), (num_channels, *(input_filter_stop - current_start))
+                )
+                for i, vsa in enumerate(current):
+                    presmoothed[i, ...] = vsa[filter_slice]
+
+                pool = RequestPool()
+                for scale_index, closure in closures:
+                    if scale_index == j:
+                        pool.request(partial(closure, sourceArray=presmoothed))
+                pool.wait()
+                pool.clean()
+
+    def _raiseFilterError(self, e, j):
+        if "kernel longer than line" in str(e):
+            raise RuntimeError(
+                "Feature computation error:\nYour image is too small to apply a filter with "
+                f"sigma={self.scales[j]:.1f}. Please select features with smaller sigmas."
+            )
+        else:
+            raise e
+
     def _computeGaussianSmoothing(self, vol, sigma, roi, in2d):
         if WITH_FAST_FILTERS:
             # Use fast filters (if available)
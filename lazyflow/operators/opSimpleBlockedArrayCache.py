@@ -35,6 +35,7 @@ class OpSimpleBlockedArrayCache(OpUnblockedArrayCache):
         self._blockshape = tuple(numpy.where(self._blockshape, self._blockshape, self.Input.meta.shape))
 
         self.Output.meta.ideal_blockshape = tuple(numpy.minimum(self._blockshape, self.Input.meta.shape))
+        self._setIndexCellShape(self.Output.meta.ideal_blockshape)
 
         # Estimate ram usage per requested pixel
         ram_per_pixel = 0
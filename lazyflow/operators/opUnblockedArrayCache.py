@@ -30,8 +30,11 @@ import vigra
 
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.operators.opCache import ManagedBlockedCache
+from lazyflow.operators.cacheEvictionPolicies import BlockStatistics
 from lazyflow.request import RequestLock
-from lazyflow.roi import getIntersection, roiFromShape, roiToSlice, containing_rois, sliceToRoi
+from lazyflow.roi import roiFromShape, roiToSlice
+from lazyflow.utility import spillStore
+from lazyflow.utility.roiIndex import RoiIndex
 
 import logging
 
@@ -47,6 +50,8 @@ class OpUnblockedArrayCache(Operator, ManagedBlockedCache):
         be stored multiple times, except for the special case where the new request happens
         to fall ENTIRELY within an existing block of data.
     - If any portion of a stored block is marked dirty, the entire block is discarded.
+    - If spilling is enabled (see lazyflow.utility.spillStore), blocks evicted by the
+        cache memory manager are written to disk and read back when they are requested again.
 
     Unlike other caches, this cache does not impose its own blocking on the data.
     Instead, it is assumed that the downstream operators have chosen some reasonable blocking.
@@ -63,6 +68,10 @@ class OpUnblockedArrayCache(Operator, ManagedBlockedCache):
     def __init__(self, *args, **kwargs):
         super(OpUnblockedArrayCache, self).__init__(*args, **kwargs)
         self._lock = RequestLock()
+        self._spill_namespace = spillStore.new_namespace()
+        self._dirty_generation = 0
+        # Grid cell shape of the block indexes (None: the shape of the first stored block)
+        self._index_cell_shape = None
         self._resetBlocks()
 
         self.Input.notifyUnready(self._resetBlocks)
@@ -111,15 +120,30 @@ class OpUnblockedArrayCache(Operator, ManagedBlockedCache):
         # Data isn't in the cache, so request it and cache it
         self._fetch_and_store_block(request_roi, out=result)
 
+    def _setIndexCellShape(self, cell_shape):
+        """
+        Subclasses that impose a blocking on the data should index the stored blocks with their block shape.
+        """
+        cell_shape = tuple(map(int, cell_shape))
+        with self._lock:
+            if cell_shape == self._index_cell_shape:
+                return
+            self._index_cell_shape = cell_shape
+            block_index = RoiIndex(cell_shape)
+            spilled_index = RoiIndex(cell_shape)
+            for block_roi in self._block_index:
+                block_index.add(block_roi)
+            for block_roi in self._spilled_index:
+                spilled_index.add(block_roi)
+            self._block_index = block_index
+            self._spilled_index = spilled_index
+
     def _get_containing_block_roi(self, request_roi):
         # Does this roi happen to fit ENTIRELY within an existing stored block?
+        # (The spatial index only inspects the blocks near the request, not every stored block.
+        #  It may be looked up without holding the lock.)
         request_roi = self._standardize_roi(*request_roi)
-        outer_rois = containing_rois(list(self._block_data.keys()), request_roi)
-        if len(outer_rois) > 0:
-            # Standardize roi for usage as dict key
-            block_roi = self._standardize_roi(*outer_rois[0])
-            return block_roi
-        return None
+        return self._block_index.find_containing(request_roi)
 
     def _fetch_and_store_block(self, block_roi, out):
         if out is not None:
@@ -144,17 +168,56 @@ class OpUnblockedArrayCache(Operator, ManagedBlockedCache):
                     self.Output.stype.copy_data(out, self._block_data[block_roi][:])
                     return out
 
+            spilled = self._restoreSpilledBlock(block_roi)
+            if spilled is not None:
+                block_data, compute_time = spilled
+                self._store_block_data(block_roi, block_data, compute_time=compute_time)
+                if out is None:
+                    # The spilled data is a read-only memory map
+                    return numpy.array(block_data)
+                self.Output.stype.copy_data(out, block_data)
+                return out
+
             req = self.Input(*block_roi)
             if out is not None:
                 req.writeInto(out)
+            start_time = time.time()
             block_data = req.wait()
-            self._store_block_data(block_roi, block_data)
+            self._store_block_data(block_roi, block_data, compute_time=time.time() - start_time)
         return block_data
 
-    def _store_block_data(self, block_roi, block_data):
+    def _restoreSpilledBlock(self, block_roi):
+        """
+        Read the given block back from the spill directory, if it was spilled.
+        Returns (block_data, compute_time) or None.
+        """
+        store = spillStore.getSpillStore()
+        if store is None:
+            return None
+        with self._lock:
+            self._spilled_index.remove(block_roi)
+        return store.get(self._spill_namespace, block_roi)
+
+    def _spillBlock(self, key, block, compute_time, dirty_generation):
+        store = spillStore.getSpillStore()
+        if store is None:
+            return
+        # Extra [:] here is in case we are decompressing from a chunkedarray
+        if not store.put(self._spill_namespace, key, block[:], compute_time):
+            return
+        with self._lock:
+            if self._dirty_generation != dirty_generation:
+                # The block was marked dirty while we were writing it (see propagateDirty)
+                store.discard(self._spill_namespace, key)
+            else:
+                self._spilled_index.add(key)
+
+    def _store_block_data(self, block_roi, block_data, compute_time=None):
         """
         Copy block_data and store it into the cache.
         The block_lock is not obtained here, so lock it before you call this.
+
+        compute_time: seconds it took to compute the block (reported to the cache memory manager)
         """
         with self._lock:
             if self.CompressionEnabled.value and numpy.dtype(block_data.dtype) in [
@@ -176,6 +239,8 @@ class OpUnblockedArrayCache(Operator, ManagedBlockedCache):
             # (Could have happened via propagateDirty() or eventually the arrayCacheMemoryMgr)
             if block_roi in self._block_locks:
                 self._block_data[block_roi] = block_storage_data
+                self._block_index.add(block_roi)
+                self._block_compute_times[block_roi] = compute_time
 
         self._last_access_times[block_roi] = time.time()
 
@@ -195,6 +260,11 @@ class OpUnblockedArrayCache(Operator, ManagedBlockedCache):
             block_lock = self._block_locks[block_roi]
 
         with block_lock:
+            store = spillStore.getSpillStore()
+            if store is not None:
+                with self._lock:
+                    self._spilled_index.remove(block_roi)
+                store.discard(self._spill_namespace, block_roi)
             self._store_block_data(block_roi, block_data)
 
     def propagateDirty(self, slot, subindex, roi):
@@ -210,11 +280,19 @@ class OpUnblockedArrayCache(Operator, ManagedBlockedCache):
             # Everything is dirty, so no need to loop
             self._resetBlocks()
         else:
-            # FIXME: This is O(N) for now.
-            #        We should speed this up by maintaining a bookkeeping data structure in execute().
-            for block_roi in list(self._block_data.keys()):
-                if getIntersection(block_roi, dirty_roi, assertIntersect=False):
-                    self.freeBlock(block_roi)
+            with self._lock:
+                self._dirty_generation += 1
+                dirty_blocks = self._block_index.intersecting(dirty_roi)
+                spilled_blocks = self._spilled_index.intersecting(dirty_roi)
+                for block_roi in spilled_blocks:
+                    self._spilled_index.remove(block_roi)
+            for block_roi in dirty_blocks:
+                self._freeBlock(block_roi, spill=False)
+
+            store = spillStore.getSpillStore()
+            if store is not None:
+                for block_roi in spilled_blocks:
+                    store.discard(self._spill_namespace, block_roi)
 
         self.Output.setDirty(roi.start, roi.stop)
 
@@ -251,12 +329,25 @@ class OpUnblockedArrayCache(Operator, ManagedBlockedCache):
             l = [(k, self._last_access_times[k]) for k in self._last_access_times]
         return l
 
+    def getBlockStatistics(self):
+        with self._lock:
+            stats = []
+            for key, t in self._last_access_times.items():
+                block = self._block_data.get(key)
+                size = None if block is None else block.size * numpy.dtype(block.dtype).itemsize
+                stats.append(BlockStatistics(key, t, size, self._block_compute_times.get(key)))
+        return stats
+
     def freeMemory(self):
         used = self.usedMemory()
         self._resetBlocks()
         return used
 
     def freeBlock(self, key):
+        # Blocks evicted by the memory manager are still clean, so they may be spilled to disk.
+        return self._freeBlock(key, spill=True)
+
+    def _freeBlock(self, key, spill):
         with self._lock:
             if key not in self._block_locks:
                 return 0
@@ -265,14 +356,29 @@ class OpUnblockedArrayCache(Operator, ManagedBlockedCache):
             mem = block.size * bytes_per_pixel
             del self._block_data[key]
             del self._block_locks[key]
+            self._block_index.remove(key)
             del self._last_access_times[key]
-            return mem
+            compute_time = self._block_compute_times.pop(key, None)
+            dirty_generation = self._dirty_generation
+
+        if spill:
+            self._spillBlock(key, block, compute_time, dirty_generation)
+        return mem
 
     def freeDirtyMemory(self):
         return 0.0
 
     def _resetBlocks(self, *_):
         with self._lock:
+            self._dirty_generation += 1
+            store = spillStore.getSpillStore()
+            if store is not None:
+                store.discard_namespace(self._spill_namespace)
             self._block_data = {}
+            self._block_index = RoiIndex(self._index_cell_shape)
+            # The blocks we have spilled. (The spill store may have dropped some of them since,
+            # discarding those is a no-op.)
+            self._spilled_index = RoiIndex(self._index_cell_shape)
             self._block_locks = {}
+            self._block_compute_times = {}
             self._last_access_times = collections.defaultdict(float)
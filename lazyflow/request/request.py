@@ -23,6 +23,7 @@ from future.utils import raise_with_traceback
 ###############################################################################
 # Built-in
 import collections
+import contextlib
 import sys
 import heapq
 import functools
@@ -46,6 +47,7 @@ import greenlet
 
 # lazyflow
 from . import threadPool
+from .threadPool import PriorityClass
 
 # This module's code needs to be sanitized if you're not using CPython.
 # In particular, check that set operations like remove() are still atomic.
@@ -197,10 +199,18 @@ class Request(object):
 
     _root_request_counter = itertools.count()
 
-    def __init__(self, fn, root_priority=[0]):
+    # The priority class of requests without a parent, per thread (see root_priority_class())
+    _root_priority_class = threading.local()
+
+    def __init__(self, fn, root_priority=[0], priority_class=None):
         """
         Constructor.
         Postconditions: The request has the same cancelled status as its parent (the request that is creating this one).
+
+        :param priority_class: The ``PriorityClass`` the thread pool schedules this request with.
+                               By default, requests inherit the class of their parent request
+                               (INTERACTIVE for requests without a parent, see root_priority_class()).
+                               The class may be changed by setting ``priority_class`` before the request is submitted.
         """
 
         self._lock = threading.Lock()  # NOT an RLock, since requests may share threads
@@ -245,7 +255,9 @@ class Request(object):
         self._max_child_priority = 0
         if current_request is None:
             self._priority = root_priority + [next(Request._root_request_counter)]
+            self.priority_class = getattr(Request._root_priority_class, "value", PriorityClass.INTERACTIVE)
         else:
+            self.priority_class = current_request.priority_class
             with current_request._lock:
                 current_request.child_requests.add(self)
                 # We must ensure that we get the same cancelled status as our parent.
@@ -253,6 +265,8 @@ class Request(object):
                 # We acquire the same priority as our parent, plus our own sub-priority
                 current_request._max_child_priority += 1
                 self._priority = current_request._priority + root_priority + [current_request._max_child_priority]
+        if priority_class is not None:
+            self.priority_class = priority_class
 
     def __lt__(self, other):
         """
@@ -792,6 +806,24 @@ class Request(object):
             for child in child_requests:
                 child.cancel()
 
+    @classmethod
+    @contextlib.contextmanager
+    def root_priority_class(cls, priority_class):
+        """
+        Context manager: Requests without a parent request that are created in the current thread
+        (while in the context) get the given ``PriorityClass`` instead of INTERACTIVE.
+        Their child requests inherit it. For example, to prefetch in the background::
+
+            with Request.root_priority_class(PriorityClass.PREFETCH):
+                scene.triggerPrefetch(...)
+        """
+        previous = getattr(cls._root_priority_class, "value", PriorityClass.INTERACTIVE)
+        cls._root_priority_class.value = priority_class
+        try:
+            yield
+        finally:
+            cls._root_priority_class.value = previous
+
     @classmethod
     def _current_request(cls):
         """
@@ -21,24 +21,116 @@
 ###############################################################################
 
 import atexit
+import collections
+import enum
+import heapq
+import itertools
 import logging
-import queue
 import threading
-from typing import Callable, List
+import time
+from typing import Callable, Dict, List
 
 logger = logging.getLogger(__name__)
 
 
+class PriorityClass(enum.IntEnum):
+    """Global scheduling classes, in order of precedence.
+
+    A task's class is read from its ``priority_class`` attribute (INTERACTIVE if it has none).
+    Within a class, tasks are ordered by their own ``__lt__`` (if they have one).
+    """
+
+    INTERACTIVE = 0  # e.g. tiles that are visible in the viewer
+    PREFETCH = 1  # e.g. tiles that will probably be visible soon
+    BATCH = 2  # e.g. exports and headless processing
+
+
+class _QueueItem:
+    """A queued task together with its scheduling state."""
+
+    __slots__ = ("task", "priority_class", "seq", "enqueue_time", "queue", "taken")
+
+    _counter = itertools.count()
+
+    def __init__(self, task, queue):
+        self.task = task
+        self.priority_class = getattr(task, "priority_class", PriorityClass.INTERACTIVE)
+        self.seq = next(self._counter)
+        self.enqueue_time = time.monotonic()
+        self.queue = queue
+        self.taken = False
+
+    def __lt__(self, other):
+        if self.priority_class != other.priority_class:
+            return self.priority_class < other.priority_class
+        try:
+            if self.task < other.task:
+                return True
+            if other.task < self.task:
+                return False
+        except (TypeError, AttributeError):
+            # Plain callables (or tasks of different types) have no ordering
+            pass
+        return self.seq < other.seq
+
+
+class _TaskQueue:
+    """Priority queue of _QueueItems.
+
+    Items may also be taken out of order (see ThreadPool._take()), in which case they are
+    only marked as taken and dropped lazily once they reach the top of the heap.
+    Not thread-safe: all access happens under the lock of the owning ThreadPool.
+    """
+
+    def __init__(self, owner=None):
+        self.owner = owner
+        self._heap = []
+        self._size = 0
+
+    def qsize(self) -> int:
+        return self._size
+
+    def push(self, item: _QueueItem) -> None:
+        heapq.heappush(self._heap, item)
+        self._size += 1
+
+    def peek(self):
+        while self._heap and self._heap[0].taken:
+            heapq.heappop(self._heap)
+        return self._heap[0] if self._heap else None
+
+    def item_taken(self) -> None:
+        self._size -= 1
+
+
 class ThreadPool:
     """Manages a set of worker threads and dispatches tasks to them.
 
+    Scheduling:
+      - A task that already ran on a worker (e.g. a suspended request) is bound to it
+        and is queued in that worker's ``job_queue``.
+      - New tasks that are submitted from a worker are queued in that worker's
+        ``local_tasks``; tasks from other threads are queued in ``unassigned_tasks``.
+      - An idle worker runs a task of the highest priority class that is available. Within
+        that class, it prefers its own ``job_queue``, then its ``local_tasks``, then
+        ``unassigned_tasks``, and only then steals from the local queues of other workers.
+      - To avoid starvation, a task that has been waiting for longer than
+        ``starvation_timeout`` seconds is run before tasks of higher priority classes.
+
     Attributes:
         num_workers: The number of worker threads.
     """
 
-    def __init__(self, num_workers: int):
+    def __init__(self, num_workers: int, starvation_timeout: float = 2.0):
         """Start all workers."""
-        self.unassigned_tasks = queue.PriorityQueue()
+        self.starvation_timeout = starvation_timeout
+
+        self._lock = threading.Lock()
+        self.unassigned_tasks = _TaskQueue()
+        # Unassigned tasks of each class in order of submission (for starvation protection)
+        self._waiting = {c: collections.deque() for c in PriorityClass}
+        self._queue_depths = {c: 0 for c in PriorityClass}
+        self._idle_workers = set()
 
         self.workers = {_Worker(self, i) for i in range(num_workers)}
         for w in self.workers:
@@ -53,15 +145,30 @@ class ThreadPool:
     def wake_up(self, task: Callable[[], None]) -> None:
         """Schedule the given task on the worker that is assigned to it.
 
-        If it has no assigned worker yet, assign it to the first worker that becomes available.
+        If it has no assigned worker yet, assign it to the first worker that picks it up.
         """
-        if hasattr(task, "assigned_worker") and task.assigned_worker is not None:
-            task.assigned_worker.wake_up(task)
-        else:
-            self.unassigned_tasks.put_nowait(task)
-            for worker in self.workers:
-                with worker.job_queue_condition:
-                    worker.job_queue_condition.notify()
+        assigned_worker = getattr(task, "assigned_worker", None)
+        current_thread = threading.current_thread()
+
+        with self._lock:
+            if assigned_worker is not None:
+                item = _QueueItem(task, assigned_worker.job_queue)
+                assigned_worker.job_queue.push(item)
+                self._queue_depths[item.priority_class] += 1
+                assigned_worker.job_queue_condition.notify()
+                return
+
+            if isinstance(current_thread, _Worker) and current_thread.thread_pool is self:
+                queue = current_thread.local_tasks
+            else:
+                queue = self.unassigned_tasks
+            item = _QueueItem(task, queue)
+            queue.push(item)
+            self._queue_depths[item.priority_class] += 1
+            self._waiting[item.priority_class].append(item)
+
+            if self._idle_workers:
+                self._idle_workers.pop().job_queue_condition.notify()
 
     def stop(self) -> None:
         """Stop all threads in the pool, and block for them to complete.
@@ -77,6 +184,71 @@ class ThreadPool:
     def get_states(self) -> List[str]:
         return [w.state for w in self.workers]
 
+    def get_queue_depths(self) -> Dict[str, int]:
+        """Number of queued (not yet running) tasks per priority class."""
+        with self._lock:
+            return {c.name.lower(): n for c, n in self._queue_depths.items()}
+
+    def get_idle_worker_count(self) -> int:
+        """Number of workers that are currently waiting for work."""
+        with self._lock:
+            return len(self._idle_workers)
+
+    def get_steal_counts(self) -> Dict[str, int]:
+        """Number of tasks each worker has stolen from the local queues of other workers."""
+        return {w.name: w.steal_count for w in self.workers}
+
+    def _pop_job(self, worker):
+        """Take the next task that the given worker should run (or None).
+
+        Must be called with self._lock held.
+        """
+        # Within a priority class, prefer resuming our own tasks, then tasks spawned by our own tasks,
+        # then newly submitted tasks, and only steal if we have nothing else to do.
+        best = None
+        queues = [worker.job_queue, worker.local_tasks, self.unassigned_tasks]
+        queues += [other.local_tasks for other in self.workers if other is not worker]
+        for queue in queues:
+            item = queue.peek()
+            if item is not None and (best is None or item.priority_class < best.priority_class):
+                best = item
+
+        if best is None:
+            return None
+
+        # Starvation protection
+        now = time.monotonic()
+        for priority_class in PriorityClass:
+            if priority_class <= best.priority_class:
+                continue
+            oldest = self._oldest_waiting(priority_class)
+            if oldest is not None and now - oldest.enqueue_time > self.starvation_timeout:
+                best = oldest
+                break
+
+        self._take(best)
+        if best.queue.owner is not None and best.queue.owner is not worker:
+            worker.steal_count += 1
+        return best
+
+    def _oldest_waiting(self, priority_class):
+        waiting = self._waiting[priority_class]
+        while waiting and waiting[0].taken:
+            waiting.popleft()
+        return waiting[0] if waiting else None
+
+    def _take(self, item):
+        item.taken = True
+        item.queue.item_taken()
+        self._queue_depths[item.priority_class] -= 1
+
+        # Drop taken items from the submission order, and compact it from time to time.
+        waiting = self._waiting[item.priority_class]
+        while waiting and waiting[0].taken:
+            waiting.popleft()
+        if len(waiting) > 2 * self._queue_depths[item.priority_class] + 64:
+            self._waiting[item.priority_class] = collections.deque(i for i in waiting if not i.taken)
+
 
 class _Worker(threading.Thread):
     """Run in a loop until stopped.
@@ -88,8 +260,10 @@ class _Worker(threading.Thread):
         super().__init__(name=f"Worker #{index}", daemon=True)
         self.thread_pool = thread_pool
         self.stopped = False
-        self.job_queue_condition = threading.Condition()
-        self.job_queue = queue.PriorityQueue()
+        self.job_queue_condition = threading.Condition(thread_pool._lock)
+        self.job_queue = _TaskQueue(self)  # Tasks that must run on this worker
+        self.local_tasks = _TaskQueue(self)  # Unassigned tasks that were submitted from this worker
+        self.steal_count = 0
         self.state = "initialized"
 
     def run(self):
@@ -134,9 +308,7 @@ class _Worker(threading.Thread):
         The task may or not be started already.
         """
         assert task.assigned_worker is self
-        with self.job_queue_condition:
-            self.job_queue.put_nowait(task)
-            self.job_queue_condition.notify()
+        self.thread_pool.wake_up(task)
 
     def _get_next_job(self):
         """Get the next available job to perform.
@@ -147,38 +319,26 @@ class _Worker(threading.Thread):
         with self.job_queue_condition:
             if self.stopped:
                 return None
-            next_task = self._pop_job()
+            item = self.thread_pool._pop_job(self)
 
-            while next_task is None and not self.stopped:
+            while item is None and not self.stopped:
                 # Wait for work to become available
+                self.thread_pool._idle_workers.add(self)
                 self.job_queue_condition.wait()
+                self.thread_pool._idle_workers.discard(self)
                 if self.stopped:
                     return None
-                next_task = self._pop_job()
-
-        if not self.stopped:
-            assert next_task is not None
-            assert next_task.assigned_worker is self
+                item = self.thread_pool._pop_job(self)
 
-        return next_task
+        if self.stopped:
+            return None
 
-    def _pop_job(self):
-        """If possible, get a job from our own job queue; otherwise, get one from the global job queue.
+        next_task = item.task
+        if item.queue is not self.job_queue:
+            # If this fails, then your callable is some built-in that doesn't allow arbitrary
+            # members (e.g. .assigned_worker) to be "monkey-patched" onto it.
+            # You may have to wrap it in a custom class first.
+            next_task.assigned_worker = self
 
-        Return None if neither queue has work to do.
-
-        Non-blocking.
-        """
-        try:
-            return self.job_queue.get_nowait()
-        except queue.Empty:
-            try:
-                task = self.thread_pool.unassigned_tasks.get_nowait()
-            except queue.Empty:
-                return None
-            else:
-                # If this fails, then your callable is some built-in that doesn't allow arbitrary
-                # members (e.g. .assigned_worker) to be "monkey-patched" onto it.
-                # You may have to wrap it in a custom class first.
-                task.assigned_worker = self
-                return task
+        assert next_task.assigned_worker is self
+        return next_task
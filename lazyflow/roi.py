@@ -801,6 +801,68 @@ def determine_optimal_request_blockshape(
     return tuple(blockshape)
 
 
+def alignBlockShape(blockshape, chunkshape, shape, max_blockshape=None):
+    """
+    Round the given blockshape to whole multiples of chunkshape, so that (absolutely aligned)
+    blocks never straddle the chunks of a chunked dataset, e.g. when exporting to hdf5 or n5.
+
+    The volume of the given blockshape (usually determined by the RAM budget) is not exceeded,
+    unless a single chunk is already larger.  Leftover volume after rounding down is used to
+    grow the block by more chunks.  The result never exceeds the dataset shape (an axis that is
+    clipped to the shape is covered completely by one block, so it doesn't straddle chunks either),
+    nor max_blockshape (if given).
+
+    >>> alignBlockShape( (100, 100, 1), (64, 64, 1), (1000, 1000, 10) )
+    (128, 64, 1)
+
+    >>> alignBlockShape( (10, 500, 500), (32, 32, 32), (1000, 1000, 1000) )
+    (32, 256, 288)
+
+    >>> alignBlockShape( (10, 300), (64, 64), (10, 1000) )
+    (10, 256)
+
+    >>> alignBlockShape( (100, 100), (64, 64), (300, 300), max_blockshape=(100, 100) )
+    (64, 64)
+    """
+    blockshape = numpy.asarray(blockshape)
+    shape = numpy.asarray(shape)
+    chunkshape = numpy.minimum(chunkshape, shape)
+    target_volume = numpy.prod(blockshape)
+
+    # Number of chunks per axis: round down, but at least one chunk,
+    # and no more than needed to cover the whole axis (or allowed by max_blockshape).
+    max_chunks = -(-shape // chunkshape)
+    if max_blockshape is not None:
+        max_chunks = numpy.where(
+            numpy.less(max_blockshape, shape), numpy.maximum(1, max_blockshape // chunkshape), max_chunks
+        )
+    num_chunks = numpy.minimum(numpy.maximum(1, blockshape // chunkshape), max_chunks)
+
+    # Starting with one chunk (per axis) may exceed the volume: Shrink the longest axes.
+    while numpy.prod(num_chunks * chunkshape) > target_volume and (num_chunks > 1).any():
+        candidates = numpy.where(num_chunks > 1, num_chunks * chunkshape, 0)
+        num_chunks[numpy.argmax(candidates)] -= 1
+
+    # Use the volume that was lost by rounding down: Grow the axes that lost the most.
+    while True:
+        volume = numpy.prod(num_chunks * chunkshape)
+        candidates = [
+            axis
+            for axis in range(len(num_chunks))
+            if num_chunks[axis] < max_chunks[axis]
+            and volume // num_chunks[axis] * (num_chunks[axis] + 1) <= target_volume
+        ]
+        if not candidates:
+            break
+        axis = min(candidates, key=lambda axis: num_chunks[axis] * chunkshape[axis] / blockshape[axis])
+        num_chunks[axis] += 1
+
+    blockshape = numpy.minimum(num_chunks * chunkshape, shape)
+    if max_blockshape is not None:
+        blockshape = numpy.minimum(blockshape, max_blockshape)
+    return tuple(int(x) for x in blockshape)
+
+
 def slicing_to_string(slicing, max_shape=None):
     """
     Returns a string representation of the given slicing, which has been
@@ -32,6 +32,7 @@ from .fileLock import FileLock
 from .tracer import Tracer, traceLogged
 from .pathHelpers import PathComponents, getPathVariants, isUrl, make_absolute, globH5N5, globList, mkdir_p, lsH5N5
 
+from .adaptiveRequestController import AdaptiveRequestController
 from .roiRequestBatch import RoiRequestBatch
 from .bigRequestStreamer import BigRequestStreamer
 from . import io_util
@@ -0,0 +1,168 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2020, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+# 		   http://ilastik.org/license/
+###############################################################################
+import threading
+import logging
+
+import numpy
+
+from lazyflow.request import Request
+from .memory import Memory
+
+logger = logging.getLogger(__name__)
+
+# Whether the writers that export whole images (e.g. OpH5N5WriterBigDataset) use an AdaptiveRequestController.
+# Can be set via configure() (resp. adaptive_export_batching in the [lazyflow] section of .ilastikrc).
+_adaptive_exports = True
+
+
+def configure(adaptive_exports=True):
+    """
+    Enable or disable adaptive request batching for image exports.
+    """
+    global _adaptive_exports
+    _adaptive_exports = bool(adaptive_exports)
+    logger.info("Adaptive request batching for exports {}".format("enabled" if _adaptive_exports else "disabled"))
+
+
+def adaptive_exports():
+    return _adaptive_exports
+
+
+class AdaptiveRequestController(object):
+    """
+    Tunes the number of requests a RoiRequestBatch keeps in flight, and the number of
+    blocks a BigRequestStreamer merges into a single request, while they are running.
+
+    Every finished request is reported via record(). Once enough requests have finished
+    (one "window", as many as are in flight), the controller decides based on:
+
+    * memory headroom: if the process uses more than (1 - memory_headroom) of
+      Memory.getAvailableRam(), both the requests in flight and the blocks per
+      request are halved.
+    * consumer backpressure: if finished results wait longer for the result handler
+      than the handler needs per result, results are produced faster than they are
+      consumed. One request less is kept in flight.
+    * idle workers: if workers of the thread pool are idle, one more request is kept
+      in flight (as long as the RAM for one more request is available).
+    * request duration: requests that take much less than target_request_seconds are
+      dominated by the per-request overhead, so more blocks are merged into one
+      request. Requests that take much longer are made smaller again.
+    """
+
+    def __init__(
+        self,
+        in_flight=2,
+        min_in_flight=1,
+        max_in_flight=None,
+        max_blocks_per_request=1,
+        ram_per_block=None,
+        target_request_seconds=1.0,
+        memory_headroom=0.1,
+    ):
+        """
+        :param in_flight: The initial number of requests in flight.
+        :param min_in_flight: Never keep less requests in flight.
+        :param max_in_flight: Never keep more requests in flight (default: twice the number of workers).
+        :param max_blocks_per_request: Never merge more blocks into one request.
+        :param ram_per_block: Estimated RAM (in bytes) needed to compute one block, if known.
+        :param target_request_seconds: The duration of a single request to aim for.
+        :param memory_headroom: The fraction of the available RAM to keep free.
+        """
+        if max_in_flight is None:
+            max_in_flight = 2 * max(1, Request.global_thread_pool.num_workers)
+        self.min_in_flight = max(1, min_in_flight)
+        self.max_in_flight = max(self.min_in_flight, max_in_flight)
+        self.max_blocks_per_request = max(1, max_blocks_per_request)
+        self.ram_per_block = ram_per_block or 0
+        self.target_request_seconds = target_request_seconds
+        self.memory_headroom = memory_headroom
+
+        self._lock = threading.Lock()
+        self._in_flight = int(numpy.clip(in_flight, self.min_in_flight, self.max_in_flight))
+        self._blocks_per_request = 1
+
+        # (request seconds, seconds waiting for the result handler, result handler seconds)
+        self._samples = []
+
+    @property
+    def in_flight(self):
+        """The number of requests that should be in flight."""
+        return self._in_flight
+
+    @property
+    def blocks_per_request(self):
+        """The number of blocks that should be merged into one request."""
+        return self._blocks_per_request
+
+    def record(self, request_seconds, wait_seconds, handler_seconds):
+        """
+        Report a finished request.
+
+        :param request_seconds: Time from submitting the request until it finished.
+        :param wait_seconds: Time the finished result was queued behind other results before the result handler
+                             was called (always 0 if results are handled in parallel).
+        :param handler_seconds: Time spent in the result handler.
+        """
+        with self._lock:
+            self._samples.append((request_seconds, wait_seconds, handler_seconds))
+            if len(self._samples) >= max(2, self._in_flight):
+                self._update(numpy.array(self._samples))
+                self._samples = []
+
+    def _update(self, samples):
+        request_seconds = numpy.median(samples[:, 0])
+        wait_seconds, handler_seconds = samples[:, 1:].mean(axis=0)
+
+        ram_budget = (1 - self.memory_headroom) * Memory.getAvailableRam()
+        spare_ram = ram_budget - Memory.getMemoryUsage()
+        if spare_ram < 0:
+            self._in_flight = max(self.min_in_flight, self._in_flight // 2)
+            self._blocks_per_request = max(1, self._blocks_per_request // 2)
+            logger.debug(
+                "Low memory: {} requests in flight, {} blocks per request".format(
+                    self._in_flight, self._blocks_per_request
+                )
+            )
+            return
+
+        ram_per_request = self.ram_per_block * self._blocks_per_request
+        if wait_seconds > handler_seconds and self._in_flight > self.min_in_flight:
+            # results queue up in front of the consumer
+            self._in_flight -= 1
+            logger.debug("Consumer is too slow: {} requests in flight".format(self._in_flight))
+        elif self._idle_worker_count() > 0 and self._in_flight < self.max_in_flight and spare_ram > ram_per_request:
+            self._in_flight += 1
+            logger.debug("Idle workers: {} requests in flight".format(self._in_flight))
+
+        if (
+            request_seconds < self.target_request_seconds / 4
+            and self._blocks_per_request < self.max_blocks_per_request
+            and spare_ram > ram_per_request * self._in_flight
+        ):
+            self._blocks_per_request = min(2 * self._blocks_per_request, self.max_blocks_per_request)
+            logger.debug("Short requests: {} blocks per request".format(self._blocks_per_request))
+        elif request_seconds > 4 * self.target_request_seconds and self._blocks_per_request > 1:
+            self._blocks_per_request //= 2
+            logger.debug("Long requests: {} blocks per request".format(self._blocks_per_request))
+
+    def _idle_worker_count(self):
+        return Request.global_thread_pool.get_idle_worker_count()
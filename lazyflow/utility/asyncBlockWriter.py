@@ -0,0 +1,153 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2020, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+# 		   http://ilastik.org/license/
+###############################################################################
+import logging
+import queue
+import sys
+import threading
+
+import numpy
+
+from lazyflow.roi import getIntersectingBlocks, getIntersection, roiToSlice
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBlockWriter(object):
+    """
+    Writes the blocks of a blockwise export on dedicated writer threads, so that computing
+    the next blocks doesn't have to wait for (compressing and) writing the previous ones.
+
+    submit() only enqueues a block. If max_pending blocks are already waiting to be written,
+    it blocks until one of them is written (backpressure, to keep the RAM usage bounded).
+
+    With more than one writer thread, blocks are split along the chunk grid of the dataset, and
+    writes to the same chunk are serialized. This way, independent chunks can be compressed and
+    written in parallel (for formats that allow this, e.g. N5 or zarr), even if the blocks
+    aren't aligned to the chunks.
+
+    Example usage:
+
+    >>> dataset = numpy.zeros((100, 100), dtype=numpy.uint8)
+    >>> def write(slicing, data):
+    ...     dataset[slicing] = data
+
+    >>> with AsyncBlockWriter(write, chunkshape=(32, 32), num_threads=4) as writer:
+    ...     writer.submit(((0, 0), (50, 100)), numpy.ones((50, 100), dtype=numpy.uint8))
+    ...     writer.submit(((50, 0), (100, 100)), 2 * numpy.ones((50, 100), dtype=numpy.uint8))
+    >>> print(dataset.sum())
+    15000
+    """
+
+    _NUM_CHUNK_LOCKS = 64
+
+    def __init__(self, write, chunkshape=None, num_threads=1, max_pending=None):
+        """
+        :param write: Function ``f(slicing, data)`` that writes a block to the dataset.
+        :param chunkshape: Chunk shape of the dataset (only needed for num_threads > 1).
+        :param num_threads: Number of writer threads.
+        :param max_pending: Maximum number of blocks waiting to be written (default: 2 * num_threads).
+        """
+        assert num_threads == 1 or chunkshape is not None, "Parallel writes need the chunk shape of the dataset."
+        self._write = write
+        self._chunkshape = None if chunkshape is None else numpy.asarray(chunkshape)
+        self._queue = queue.Queue(maxsize=max_pending or 2 * num_threads)
+        self._chunk_locks = [threading.Lock() for _ in range(self._NUM_CHUNK_LOCKS)]
+
+        self._failure_excinfo = None
+        self._discard = False
+
+        self._threads = [
+            threading.Thread(target=self._run, name=f"AsyncBlockWriter-{i}", daemon=True) for i in range(num_threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, roi, data):
+        """
+        Enqueue the given block (data for roi) for writing.
+        Raises if writing an earlier block failed.
+        """
+        self._raise_failure()
+        self._queue.put((roi, data))
+
+    def close(self):
+        """
+        Wait for all pending blocks to be written and stop the writer threads.
+        Raises if writing any of the blocks failed.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._raise_failure()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't bother writing the remaining blocks, and don't hide the original exception.
+            self._discard = True
+            try:
+                self.close()
+            except Exception:
+                logger.debug("Writing a block failed, too", exc_info=True)
+
+    def _raise_failure(self):
+        if self._failure_excinfo is not None:
+            exc_type, exc_value, exc_tb = self._failure_excinfo
+            raise exc_value.with_traceback(exc_tb)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._failure_excinfo is not None or self._discard:
+                # Keep draining the queue, so that submit() never blocks forever.
+                continue
+            roi, data = item
+            try:
+                self._write_block(roi, data)
+            except Exception:
+                logger.debug("Failed to write block {}".format(roi), exc_info=True)
+                self._failure_excinfo = sys.exc_info()
+
+    def _write_block(self, roi, data):
+        if len(self._threads) == 1:
+            self._write(roiToSlice(*roi), data)
+            return
+
+        block_start = numpy.asarray(roi[0])
+        for chunk_start in getIntersectingBlocks(self._chunkshape, roi):
+            start, stop = getIntersection(roi, (chunk_start, chunk_start + self._chunkshape))
+            chunk_index = tuple(chunk_start // self._chunkshape)
+            with self._chunk_locks[hash(chunk_index) % self._NUM_CHUNK_LOCKS]:
+                self._write(roiToSlice(start, stop), data[roiToSlice(start - block_start, stop - block_start)])
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -26,13 +26,14 @@ from builtins import object
 ###############################################################################
 import numpy
 from lazyflow.request import Request
-from lazyflow.utility import RoiRequestBatch
+from lazyflow.utility import RoiRequestBatch, AdaptiveRequestController
 from lazyflow.roi import (
     getIntersectingBlocks,
     getBlockBounds,
     getIntersection,
     determine_optimal_request_blockshape,
     determineBlockShape,
+    alignBlockShape,
 )
 
 import logging
@@ -93,8 +94,20 @@ class BigRequestStreamer(object):
     Processed 6 result blocks with a total sum of: 68400
     """
 
+    # With adaptive=True, never merge more blocks than this into one request.
+    MAX_BLOCKS_PER_REQUEST = 16
+
     def __init__(
-        self, outputSlot, roi, blockshape=None, batchSize=None, blockAlignment="absolute", allowParallelResults=False
+        self,
+        outputSlot,
+        roi,
+        blockshape=None,
+        batchSize=None,
+        blockAlignment="absolute",
+        allowParallelResults=False,
+        adaptive=False,
+        chunkshape=None,
+        priorityClass=None,
     ):
         """
         Constructor.
@@ -106,6 +119,14 @@ class BigRequestStreamer(object):
         :param blockAlignment: Determines how block the requests. Choices are 'absolute' or 'relative'.
         :param allowParallelResults: If False, The resultSignal will not be called in parallel.
                                      In that case, your handler function has no need for locks.
+        :param adaptive: If True, the number of requests in parallel (starting at batchSize) and the number of
+                         blocks per request are tuned while executing.
+                         See :py:class:`AdaptiveRequestController<lazyflow.utility.AdaptiveRequestController>`.
+        :param chunkshape: The chunk shape of the dataset the results are written to (if any).
+                           The default blockshape is rounded to whole multiples of it, so that (with 'absolute'
+                           blockAlignment) no request straddles a chunk of the dataset.
+                           Ignored if a blockshape is given.
+        :param priorityClass: The thread pool priority class of the requests (see :py:class:`RoiRequestBatch`).
         """
         self._outputSlot = outputSlot
         self._bigRoi = roi
@@ -118,6 +139,11 @@ class BigRequestStreamer(object):
 
         if blockshape is None:
             blockshape = self._determine_blockshape(outputSlot)
+            if chunkshape is not None:
+                blockshape = alignBlockShape(
+                    blockshape, chunkshape, outputSlot.meta.shape, outputSlot.meta.max_blockshape
+                )
+                logger.info("Aligned blockshape to chunks {}: {}".format(tuple(chunkshape), blockshape))
 
         assert blockAlignment in ["relative", "absolute"]
         if blockAlignment == "relative":
@@ -126,8 +152,8 @@ class BigRequestStreamer(object):
             block_starts = getIntersectingBlocks(blockshape, offsetRoi)
             block_starts += roi[0]  # Un-offset
 
-            # For now, simply iterate over the min blocks
-            # TODO: Auto-dialate block sizes based on CPU/RAM usage.
+            # Simply iterate over the min blocks
+            # (with adaptive=True, consecutive blocks may be merged, see _merge_rois())
             def roiGen():
                 block_iter = block_starts.__iter__()
                 while True:
@@ -173,7 +199,77 @@ class BigRequestStreamer(object):
                         logger.debug("Requesting Roi: {}".format(block_bounds))
                         yield block_intersecting_portion
 
-        self._requestBatch = RoiRequestBatch(self._outputSlot, roiGen(), totalVolume, batchSize, allowParallelResults)
+        self._controller = None
+        rois = roiGen()
+        if adaptive:
+            self._controller = AdaptiveRequestController(
+                in_flight=batchSize,
+                max_blocks_per_request=self.MAX_BLOCKS_PER_REQUEST,
+                ram_per_block=self._estimate_ram_per_block(outputSlot, blockshape),
+            )
+            rois = self._merge_rois(rois, outputSlot)
+
+        self._requestBatch = RoiRequestBatch(
+            self._outputSlot,
+            rois,
+            totalVolume,
+            batchSize,
+            allowParallelResults,
+            priorityClass=priorityClass,
+            controller=self._controller,
+        )
+
+    def _merge_rois(self, rois, outputSlot):
+        """
+        Merge consecutive rois (as many as the controller asks for) into one,
+        if they are adjacent along the same axis (never along time or channel).
+        """
+        axis_keys = outputSlot.meta.getAxisKeys()
+        max_blockshape = outputSlot.meta.max_blockshape or outputSlot.meta.shape
+
+        def merge_axis(a, b):
+            (a_start, a_stop), (b_start, b_stop) = a, b
+            differing = numpy.flatnonzero((a_start != b_start) | (a_stop != b_stop))
+            if len(differing) != 1:
+                return None
+            axis = differing[0]
+            if axis_keys[axis] in "tc" or a_stop[axis] != b_start[axis]:
+                return None
+            return axis
+
+        merged = None
+        num_blocks = 0
+        merge_along = None
+        for roi in rois:
+            roi = (numpy.asarray(roi[0]), numpy.asarray(roi[1]))
+            if merged is not None:
+                axis = merge_axis(merged, roi)
+                if (
+                    num_blocks < self._controller.blocks_per_request
+                    and axis is not None
+                    and merge_along in (None, axis)
+                    and roi[1][axis] - merged[0][axis] <= max_blockshape[axis]
+                ):
+                    merged = (merged[0], roi[1])
+                    num_blocks += 1
+                    merge_along = axis
+                    continue
+                yield merged
+            merged = roi
+            num_blocks = 1
+            merge_along = None
+        if merged is not None:
+            yield merged
+
+    @staticmethod
+    def _estimate_ram_per_block(outputSlot, blockshape):
+        tagged_blockshape = dict(zip(outputSlot.meta.getAxisKeys(), blockshape))
+        num_channels = tagged_blockshape.pop("c", 1)
+        ram_usage_per_requested_pixel = outputSlot.meta.ram_usage_per_requested_pixel
+        if ram_usage_per_requested_pixel is None:
+            # Same guess as in _determine_blockshape
+            ram_usage_per_requested_pixel = 2 * outputSlot.meta.dtype().nbytes * num_channels + 4
+        return ram_usage_per_requested_pixel * numpy.prod(list(tagged_blockshape.values()))
 
     def _determine_blockshape(self, outputSlot):
         """
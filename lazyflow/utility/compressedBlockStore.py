@@ -0,0 +1,468 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2020, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+# 		   http://ilastik.org/license/
+###############################################################################
+"""
+Compressed in-memory storage for the blocks of the compressed caches
+(see lazyflow.operators.opCompressedCache).
+
+A block is stored as individually compressed chunks (plain byte buffers).
+Chunks are decoded in parallel, directly into the destination array if
+possible, and chunks that only contain zeros are not stored at all (which
+is most of a typical label block).
+
+The codec is chosen by name:
+
+    * blosc-lz4, blosc-zstd, ... : Blosc with the given compressor (requires the 'blosc' package)
+    * zlib: fallback if blosc is not installed
+    * hdf5: the original storage, one in-memory hdf5 file with an lzf-compressed dataset per block
+
+The default (blosc-lz4, if available) can be changed with configure(), or via the
+LAZYFLOW_CACHE_CODEC environment variable (resp. cache_codec in the [lazyflow]
+section of .ilastikrc). Blosc only (de)compresses chunks in parallel once
+configure() has let it release the GIL (blosc_release_gil in .ilastikrc).
+"""
+
+import itertools
+import logging
+import zlib
+from functools import partial
+
+import numpy
+import h5py
+
+from lazyflow.request import Request, RequestPool, RequestLock
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiFromShape, roiToSlice
+
+try:
+    import blosc
+
+    _blosc_available = True
+except ImportError:
+    _blosc_available = False
+
+logger = logging.getLogger(__name__)
+
+HDF5 = "hdf5"
+
+
+def get_storage_size(h5dataset):
+    """
+    get the storage size allocated for this hdf5 dataset in bytes
+
+    (shorthand for the hidden h5py functionality)
+    """
+    return h5py.h5d.DatasetID.get_storage_size(h5dataset.id)
+
+
+class BloscCodec(object):
+    """
+    Multi-threaded Blosc compression (shuffle filter + the given compressor).
+    """
+
+    def __init__(self, cname="lz4", clevel=5):
+        assert _blosc_available, "BloscCodec requires the 'blosc' package"
+        assert cname in blosc.compressor_list(), "Compressor not supported by blosc: {}".format(cname)
+        self.cname = cname
+        self.clevel = clevel
+
+    def encode(self, array):
+        """Compress the given C-contiguous array into a bytes object."""
+        return blosc.compress_ptr(
+            array.__array_interface__["data"][0],
+            array.size,
+            typesize=array.dtype.itemsize,
+            clevel=self.clevel,
+            shuffle=blosc.SHUFFLE,
+            cname=self.cname,
+        )
+
+    def decode_into(self, buf, out):
+        """Decompress buf into the given C-contiguous array (which must have the original shape and dtype)."""
+        blosc.decompress_ptr(buf, out.__array_interface__["data"][0])
+
+
+class ZlibCodec(object):
+    """
+    Fallback codec for when blosc is not installed.
+    """
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def encode(self, array):
+        return zlib.compress(array.view(numpy.ndarray).reshape(-1).view(numpy.uint8), self.level)
+
+    def decode_into(self, buf, out):
+        out.view(numpy.ndarray).reshape(-1).view(numpy.uint8)[:] = numpy.frombuffer(zlib.decompress(buf), numpy.uint8)
+
+
+def available_codecs():
+    """
+    Names of all codecs that can be passed to configure() or create_block().
+    """
+    names = ["zlib", HDF5]
+    if _blosc_available:
+        names += ["blosc-" + cname for cname in blosc.compressor_list()]
+    return names
+
+
+_codecs = {}
+
+
+def get_codec(name):
+    """
+    Return the (stateless, shared) codec instance with the given name.
+    """
+    if name not in _codecs:
+        if name == "zlib":
+            _codecs[name] = ZlibCodec()
+        elif name.startswith("blosc-") and name in available_codecs():
+            _codecs[name] = BloscCodec(name[len("blosc-") :])
+        else:
+            raise ValueError("Unknown block codec: {} (available: {})".format(name, ", ".join(available_codecs())))
+    return _codecs[name]
+
+
+def _run_parallel(tasks):
+    if len(tasks) == 1:
+        tasks[0]()
+    elif tasks:
+        pool = RequestPool()
+        for task in tasks:
+            pool.add(Request(task))
+        pool.wait()
+
+
+class ChunkedArray(object):
+    """
+    An n-dimensional array that is stored as individually compressed chunks.
+    Chunks that contain only zeros are not stored.
+
+    The chunks of a write are swapped in all at once, so a concurrent read sees
+    either none or all of them.
+    """
+
+    def __init__(self, shape, dtype, chunkshape, codec):
+        self.shape = tuple(map(int, shape))
+        self.dtype = numpy.dtype(dtype)
+        self.chunkshape = tuple(map(int, numpy.maximum(1, numpy.minimum(chunkshape, self.shape))))
+        self._codec = codec
+        # chunk start -> compressed chunk. Never modified, only replaced (see write()).
+        self._chunks = {}
+
+        # Partially overwritten chunks are decoded, modified and encoded again,
+        # so writes must not overlap.
+        self._write_lock = RequestLock()
+
+    @property
+    def nbytes(self):
+        return int(numpy.prod(self.shape)) * self.dtype.itemsize
+
+    def storage_size(self):
+        return sum(len(buf) for buf in list(self._chunks.values()))
+
+    def is_zero(self):
+        return not self._chunks
+
+    def clear(self):
+        self._chunks = {}
+
+    def read(self, roi, out):
+        """
+        Decode the given roi (relative to this array) into out, which must have the shape of the roi.
+        """
+        chunks = self._chunks
+        tasks = [partial(self._readChunk, chunks, roi[0], out, *chunk) for chunk in self._intersectingChunks(roi)]
+        _run_parallel(tasks)
+
+    def write(self, roi, data):
+        """
+        Overwrite the given roi (relative to this array) with data.
+        """
+        with self._write_lock:
+            chunks = dict(self._chunks)
+            tasks = [partial(self._writeChunk, chunks, roi[0], data, *chunk) for chunk in self._intersectingChunks(roi)]
+            _run_parallel(tasks)
+            self._chunks = chunks
+
+    def _intersectingChunks(self, roi):
+        if (numpy.subtract(roi[1], roi[0]) <= 0).any():
+            return []
+        chunks = []
+        for chunk_start in map(tuple, getIntersectingBlocks(self.chunkshape, roi)):
+            chunk_roi = getBlockBounds(self.shape, self.chunkshape, chunk_start)
+            chunks.append((chunk_start, chunk_roi, getIntersection(roi, chunk_roi)))
+        return chunks
+
+    def _readChunk(self, chunks, roi_start, out, chunk_start, chunk_roi, intersection):
+        out_view = out[roiToSlice(*numpy.subtract(intersection, roi_start))]
+        buf = chunks.get(chunk_start)
+        if buf is None:
+            out_view[...] = 0
+        elif (
+            (numpy.asarray(intersection) == numpy.asarray(chunk_roi)).all()
+            and out_view.flags.c_contiguous
+            and out_view.dtype == self.dtype
+        ):
+            # Decode directly into the destination.
+            self._codec.decode_into(buf, out_view)
+        else:
+            chunk = numpy.empty(numpy.subtract(chunk_roi[1], chunk_roi[0]), dtype=self.dtype)
+            self._codec.decode_into(buf, chunk)
+            out_view[...] = chunk[roiToSlice(*numpy.subtract(intersection, chunk_roi[0]))]
+
+    def _writeChunk(self, chunks, roi_start, data, chunk_start, chunk_roi, intersection):
+        data_view = data[roiToSlice(*numpy.subtract(intersection, roi_start))]
+        if (numpy.asarray(intersection) == numpy.asarray(chunk_roi)).all():
+            chunk = numpy.ascontiguousarray(data_view, dtype=self.dtype)
+        else:
+            chunk = numpy.empty(numpy.subtract(chunk_roi[1], chunk_roi[0]), dtype=self.dtype)
+            self._readChunk(chunks, chunk_roi[0], chunk, chunk_start, chunk_roi, chunk_roi)
+            chunk[roiToSlice(*numpy.subtract(intersection, chunk_roi[0]))] = data_view
+
+        if chunk.any():
+            chunks[chunk_start] = self._codec.encode(chunk)
+        else:
+            chunks.pop(chunk_start, None)
+
+
+class CodecBlock(object):
+    """
+    A cache block, stored as a ChunkedArray (plus a ChunkedArray for the mask of masked data).
+    """
+
+    def __init__(self, shape, dtype, chunkshape, codec, has_mask=False):
+        self.shape = tuple(map(int, shape))
+        self.dtype = numpy.dtype(dtype)
+        self.has_mask = has_mask
+        self.fill_value = self.dtype.type(0)
+        self._data = ChunkedArray(shape, dtype, chunkshape, codec)
+        self._mask = ChunkedArray(shape, bool, chunkshape, codec) if has_mask else None
+
+    def read(self, roi, out=None):
+        """
+        Copy the given roi (relative to the block) into out (allocated if None) and return it.
+        For masked data, the fill_value of out is not changed.
+        """
+        out = _allocate(out, numpy.subtract(roi[1], roi[0]), self.dtype, self.has_mask, self.fill_value)
+        self._data.read(roi, numpy.ma.getdata(out))
+        if self.has_mask:
+            self._mask.read(roi, out.mask)
+        return out
+
+    def read_all(self):
+        return self.read(roiFromShape(self.shape))
+
+    def write(self, roi, data):
+        """
+        Overwrite the given roi (relative to the block) with data.
+        """
+        self._data.write(roi, numpy.ma.getdata(data).view(numpy.ndarray))
+        if self.has_mask:
+            self._mask.write(roi, numpy.ma.getmaskarray(data))
+            self.fill_value = data.fill_value
+
+    def is_zero(self):
+        """True if all (data) pixels of the block are zero."""
+        return self._data.is_zero()
+
+    def storage_size(self):
+        size = self._data.storage_size()
+        if self.has_mask:
+            size += self._mask.storage_size() + self.dtype.itemsize
+        return size
+
+    def uncompressed_size(self):
+        return self._data.nbytes
+
+    def read_hdf5(self, value):
+        """
+        Overwrite the whole block with the contents of an hdf5 dataset
+        (or group with data, mask and fill_value datasets for masked data),
+        as written by write_hdf5().
+        """
+        if self.has_mask:
+            for each in ["data", "mask", "fill_value"]:
+                assert each in value
+            data = numpy.ma.masked_array(
+                value["data"][()], mask=value["mask"][()], fill_value=value["fill_value"][()], shrink=False
+            )
+        else:
+            data = value[()]
+        assert data.dtype == self.dtype
+        assert data.shape == self.shape
+        self.write(roiFromShape(self.shape), data)
+
+    def write_hdf5(self, group, name):
+        """
+        Store a copy of this block in the given hdf5 group, as an lzf-compressed dataset
+        (or group with data, mask and fill_value datasets for masked data).
+        """
+        data = self.read_all()
+        chunks = self._data.chunkshape
+        if self.has_mask:
+            block_group = group.create_group(name)
+            block_group.create_dataset("data", data=data.data, chunks=chunks, compression="lzf")
+            block_group.create_dataset("mask", data=data.mask, chunks=chunks, compression="lzf")
+            block_group.create_dataset("fill_value", data=self.fill_value)
+        else:
+            group.create_dataset(name, data=data, chunks=chunks, compression="lzf")
+
+    def close(self):
+        self._data.clear()
+        if self.has_mask:
+            self._mask.clear()
+
+
+class Hdf5Block(object):
+    """
+    A cache block, stored as lzf-compressed dataset(s) in an in-memory hdf5 file.
+    """
+
+    _file_counter = itertools.count()  # Used to ensure unique in-memory file names
+
+    def __init__(self, shape, dtype, chunkshape, has_mask=False):
+        self.shape = tuple(map(int, shape))
+        self.dtype = numpy.dtype(dtype)
+        self.has_mask = has_mask
+
+        filename = "lazyflow-block-{}".format(next(Hdf5Block._file_counter))
+        self._file = h5py.File(filename, driver="core", backing_store=False, mode="w")
+
+        # h5py will crash if the chunkshape is larger than the dataset shape.
+        chunkshape = tuple(numpy.minimum(self.shape, chunkshape))
+
+        # lzf should be faster than gzip, with a slightly worse compression ratio
+        self._file.create_dataset("data", shape=self.shape, dtype=self.dtype, chunks=chunkshape, compression="lzf")
+        if has_mask:
+            self._file.create_dataset("mask", shape=self.shape, dtype=bool, chunks=chunkshape, compression="lzf")
+            self._file.create_dataset("fill_value", shape=tuple(), dtype=self.dtype)
+
+    @property
+    def fill_value(self):
+        return self._file["fill_value"][()]
+
+    def read(self, roi, out=None):
+        out = _allocate(out, numpy.subtract(roi[1], roi[0]), self.dtype, self.has_mask, None)
+        slicing = roiToSlice(*roi)
+        # (h5py.Dataset.__getitem__ creates a copy, not a view.)
+        numpy.ma.getdata(out)[...] = self._file["data"][slicing]
+        if self.has_mask:
+            out.mask[...] = self._file["mask"][slicing]
+        return out
+
+    def read_all(self):
+        return self.read(roiFromShape(self.shape))
+
+    def write(self, roi, data):
+        slicing = roiToSlice(*roi)
+        if self.has_mask:
+            self._file["data"][slicing] = data.data
+            self._file["mask"][slicing] = data.mask
+            self._file["fill_value"][()] = data.fill_value
+        else:
+            self._file["data"][slicing] = data
+
+    def is_zero(self):
+        return (self._file["data"][:] == 0).all()
+
+    def storage_size(self):
+        size = get_storage_size(self._file["data"])
+        if self.has_mask:
+            size += get_storage_size(self._file["mask"]) + self.dtype.itemsize
+        return size
+
+    def uncompressed_size(self):
+        return int(numpy.prod(self.shape)) * self.dtype.itemsize
+
+    def read_hdf5(self, value):
+        # Copy the compressed datasets as they are.
+        if self.has_mask:
+            assert len(value) == 3
+
+            for each in ["data", "mask", "fill_value"]:
+                assert each in value
+                assert self._file[each].dtype == value[each].dtype
+                assert self._file[each].shape == value[each].shape
+
+            for each in ["data", "mask", "fill_value"]:
+                del self._file[each]
+                self._file.copy(value[each], each)
+        else:
+            assert self._file["data"].dtype == value.dtype
+            assert self._file["data"].shape == value.shape
+            del self._file["data"]
+            self._file.copy(value, "data")
+
+    def write_hdf5(self, group, name):
+        if self.has_mask:
+            group.copy(self._file["/"], name)
+        else:
+            group.copy(self._file["data"], name)
+
+    def close(self):
+        self._file.close()
+
+
+def _allocate(out, shape, dtype, has_mask, fill_value):
+    if out is not None:
+        return out
+    if has_mask:
+        return numpy.ma.masked_array(
+            numpy.empty(shape, dtype=dtype), mask=numpy.zeros(shape, dtype=bool), fill_value=fill_value, shrink=False
+        )
+    return numpy.empty(shape, dtype=dtype)
+
+
+_default_codec = "blosc-lz4" if _blosc_available else "zlib"
+
+
+def configure(codec=None, release_gil=True):
+    """
+    Set the codec of the blocks that compressed caches create from now on (see available_codecs()).
+    The current default is kept if codec is None.
+
+    release_gil: Allow chunks to be (de)compressed by several requests in parallel.
+        This is a process-wide blosc setting (blosc uses its thread-safe, context based API then).
+    """
+    global _default_codec
+    if codec is not None:
+        if codec != HDF5:
+            get_codec(codec)
+        _default_codec = codec
+    if _blosc_available and hasattr(blosc, "set_releasegil"):
+        blosc.set_releasegil(release_gil)
+    logger.info("Compressing cache blocks with {}".format(_default_codec))
+
+
+def default_codec():
+    return _default_codec
+
+
+def create_block(shape, dtype, chunkshape, has_mask=False, codec=None):
+    """
+    Create an empty (all zero) block with the given codec (the configured default if None).
+    The chunk shape is the amount of data that has to be decompressed for a single pixel lookup.
+    """
+    codec = codec or _default_codec
+    if codec == HDF5:
+        return Hdf5Block(shape, dtype, chunkshape, has_mask)
+    return CodecBlock(shape, dtype, chunkshape, get_codec(codec), has_mask)
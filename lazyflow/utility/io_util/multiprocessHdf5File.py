@@ -5,17 +5,36 @@ standard_library.install_aliases()
 from builtins import zip
 from builtins import range
 from builtins import object
+import atexit
+import collections
+import ctypes
+import logging
 import os
 import copy
+import queue
 import h5py
 import threading
 import warnings
 import multiprocessing
 import numpy
 
-# This code uses multiprocessing to read hdf5 datasets faster
-# I'm still experimenting with implementation details,
-#  and switching between implementation variants via the METHOD setting below.
+try:
+    from multiprocessing import shared_memory
+
+    _shared_memory_available = True
+except ImportError:
+    # Python < 3.8: Results are sent through the pipe instead.
+    _shared_memory_available = False
+
+logger = logging.getLogger(__name__)
+
+# This code uses multiprocessing to read (compressed) hdf5 datasets faster:
+# In a single process, all hdf5 calls (including the decompression) are serialized by the hdf5 library lock.
+#
+# A fixed pool of reader processes is shared by all MultiProcessHdf5File objects (and threads).
+# Each reader process keeps the most recently used files open.  For each read, the requesting thread
+# creates a shared memory block, the reader process decompresses the data directly into it, and the
+# result is returned as a numpy view of that block (no copy, no pickling).
 #
 # NOTES:
 # - So far, this code is:
@@ -23,112 +42,281 @@ import numpy
 #  -- somewhat slower for chunked uncompressed datasets
 #  -- *much slower* for unchunked datasets
 #
-# THINGS TO TRY:
-#  -- Right now we launch the process only once, which means it must serve requests of varying sizes
-#     Instead, we might try launching a new throwaway process for every request.
-#     Overhead would be increased, but it would allow us to pass a shared-memory Array to the process,
-#         since we know the request size in advance.
-#  -- Could memory-sharing be achieved instead via memory-mapped files and/or mem-mapped arrays?
-#  -- Create a pool of processes instead of creating a processes for every thread and volume combo.
-
-# DEBUG: In this file (including the __main__ section), we are experimenting with various implementations.
-#        The METHOD setting switches between each.
-# METHOD = 'plain-h5py' # 4.6 seconds
-# METHOD = 'pipe-array' # 3.8 - 4.5 (inconsistent...)
-METHOD = "pipe-bytes"  # 2.5 seconds
-# METHOD = 'shared-array' # 4.3 (2.0 without copy...)
-
-
-class ReaderProcess(multiprocessing.Process):
-    # This class is not threadsafe.
-    # The reader process is not supposed to be shared by multiple threads.
-    # Each thread should create its own reader process.
-
-    def __init__(self, filepath):
-        name = "ilastik_helper-" + os.path.split(filepath)[1]
-        super(ReaderProcess, self).__init__(name=name)
-        self._filepath = filepath
-        self._request_queue_recv, self._request_queue_send = multiprocessing.Pipe(duplex=False)
-        self._result_queue_recv, self._result_queue_send = multiprocessing.Pipe(duplex=False)
-        self.daemon = True
-
-        if METHOD == "shared-array":
-            self.available_bytes = 100 * 1024 ** 2
-            self.transfer_buffer = multiprocessing.RawArray("b", self.available_bytes)
-
-    def run(self):
-        with h5py.File(self._filepath, "r") as h5_file:
-            (internal_path, slicing) = self._request_queue_recv.recv()
-            # 'None' means stop the process.
-            while internal_path is not None:
-                try:
-                    if METHOD == "shared-array":
-                        read_roi = slice_to_roi(slicing, h5_file[internal_path].shape)
-                        read_roi = numpy.array(read_roi)
-                        read_shape = read_roi[1] - read_roi[0]
-                        num_bytes = h5_file[internal_path].dtype.itemsize * numpy.prod(read_shape)
-                        assert num_bytes <= self.available_bytes, "I don't yet support really big slicings"
-                        read_array = numpy.frombuffer(self.transfer_buffer, dtype=numpy.uint8, count=num_bytes)
-                        read_array.setflags(write=True)
-                        read_array = read_array.view(h5_file[internal_path].dtype).reshape(read_shape)
-
-                        h5_file[internal_path].read_direct(read_array, slicing)
-
-                    if METHOD == "pipe-bytes" or METHOD == "pipe-array":
-                        read_array = h5_file[internal_path][slicing]
-                except Exception as ex:
-                    self._result_queue_send.send(ex)
-                    raise
+# The pool size can be set via configure(), or via the LAZYFLOW_MULTIPROCESS_HDF5 environment variable
+# (resp. multiprocess_hdf5_readers in the [lazyflow] section of .ilastikrc):
+# Any non-empty value enables multiprocess reading, a number > 1 is used as the number of reader processes.
+
+DEFAULT_NUM_READERS = min(8, multiprocessing.cpu_count())
+
+# Number of files each reader process keeps open
+MAX_OPEN_FILES = 16
+
+
+def _num_readers_from_env():
+    setting = os.environ.get("LAZYFLOW_MULTIPROCESS_HDF5", "")
+    if setting.isdigit() and int(setting) > 1:
+        return int(setting)
+    return DEFAULT_NUM_READERS if setting else 0
+
+
+_num_readers = _num_readers_from_env()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def configure(num_readers=DEFAULT_NUM_READERS):
+    """
+    Set the number of reader processes (0 disables multiprocess hdf5 reading).
+    (Waits for running reads to finish, if the number changes.)
+    """
+    global _num_readers, _pool
+    assert num_readers >= 0
+    with _pool_lock:
+        _num_readers = num_readers
+        if _pool is not None and _pool.num_readers != num_readers:
+            _pool.shutdown()
+            _pool = None
+
+
+def enabled():
+    """
+    Whether (compressed) hdf5 files should be opened as MultiProcessHdf5File.
+    """
+    return _num_readers > 0
+
+
+def get_reader_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ReaderPool(max(1, _num_readers))
+        return _pool
+
+
+def _reader_main(connection):
+    """
+    Main loop of a reader process: Serve read requests until the connection is closed.
+    """
+    open_files = collections.OrderedDict()
+
+    def get_file(filepath):
+        try:
+            open_files.move_to_end(filepath)
+        except KeyError:
+            open_files[filepath] = h5py.File(filepath, "r")
+            if len(open_files) > MAX_OPEN_FILES:
+                open_files.popitem(last=False)[1].close()
+        return open_files[filepath]
+
+    try:
+        while True:
+            try:
+                request = connection.recv()
+            except EOFError:
+                return
+            if request is None:
+                return
+
+            if request[0] == "close":
+                f = open_files.pop(request[1], None)
+                if f is not None:
+                    f.close()
+                connection.send(None)
+                continue
+
+            _, filepath, internal_path, roi, shm_name = request
+            try:
+                dataset = get_file(filepath)[internal_path]
+                slicing = tuple(slice(start, stop) for start, stop in zip(*roi))
+                shape = tuple(numpy.subtract(roi[1], roi[0]))
+                if shm_name is None:
+                    data = numpy.empty(shape, dtype=dataset.dtype)
+                    dataset.read_direct(data, slicing)
                 else:
-                    self._result_queue_send.send((read_array.shape, read_array.dtype))
+                    shm = shared_memory.SharedMemory(name=shm_name)
+                    try:
+                        data = numpy.ndarray(shape, dtype=dataset.dtype, buffer=shm.buf)
+                        dataset.read_direct(data, slicing)
+                        del data
+                    finally:
+                        shm.close()
+            except Exception as ex:
+                connection.send(ex)
+            else:
+                connection.send(None)
+                if shm_name is None:
+                    connection.send_bytes(data.data)
+    finally:
+        for f in open_files.values():
+            f.close()
+
+
+class _SharedMemoryArrayBase(object):
+    """
+    Owns a shared memory block and exposes it via the numpy array interface,
+    so that the block is closed once the last array (view) that uses it is gone.
+    """
 
-                    if METHOD == "pipe-array":
-                        self._result_queue_send.send(read_array)
+    def __init__(self, shm, shape, dtype):
+        self._shm = shm
+        # Note: We must not keep a buffer export of shm.buf alive, otherwise shm.close() fails.
+        address_holder = ctypes.c_char.from_buffer(shm.buf)
+        address = ctypes.addressof(address_holder)
+        del address_holder
+        self.__array_interface__ = {
+            "shape": tuple(shape),
+            "typestr": numpy.dtype(dtype).str,
+            "data": (address, False),
+            "version": 3,
+        }
 
-                    if METHOD == "pipe-bytes":
-                        self._result_queue_send.send_bytes(numpy.getbuffer(read_array))
+    def __del__(self):
+        self._shm.close()
 
-                # Wait for the next request
-                (internal_path, slicing) = self._request_queue_recv.recv()
 
-    def read_subvolume(self, internal_path, slicing):
-        self._request_queue_send.send((internal_path, slicing))
-        response_info = self._result_queue_recv.recv()
-        if isinstance(response_info, Exception):
-            raise response_info
-        shape, dtype = response_info
+class ReaderPool(object):
+    """
+    A fixed pool of reader processes.
+    Reads block (in the calling thread) while all reader processes are busy.
+    """
 
-        if METHOD == "pipe-array":
-            result = self._result_queue_recv.recv()
+    def __init__(self, num_readers):
+        self.num_readers = num_readers
+        # Fork is not safe in a process with (many) running threads, and h5py holds locks.
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = queue.Queue()
+        self._readers = []
+        # Serializes the operations that need all readers at once (otherwise, two of them could deadlock).
+        self._all_readers_lock = threading.Lock()
+        for _ in range(num_readers):
+            self._idle.put(self._start_reader())
+
+    def _start_reader(self):
+        parent_connection, child_connection = self._context.Pipe()
+        process = self._context.Process(target=_reader_main, args=(child_connection,), name="ilastik_hdf5_reader")
+        process.daemon = True
+        process.start()
+        child_connection.close()
+        self._readers.append(process)
+        return process, parent_connection
+
+    def _replace_reader(self, process, connection):
+        """
+        Stop a reader whose connection is in an unknown state (e.g. an unread reply), and start a new one.
+        """
+        connection.close()
+        process.terminate()
+        self._readers.remove(process)
+        return self._start_reader()
+
+    def read(self, filepath, internal_path, roi, dtype):
+        """
+        Read the given roi (start, stop) of a dataset. Returns a new array.
+        """
+        roi = numpy.asarray(roi)
+        shape = tuple(roi[1] - roi[0])
+        num_bytes = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+        if num_bytes == 0:
+            return numpy.empty(shape, dtype=dtype)
+
+        shm = None
+        if _shared_memory_available:
+            shm = shared_memory.SharedMemory(create=True, size=num_bytes)
 
-        if METHOD == "pipe-bytes":
-            raw_buffer = self._result_queue_recv.recv_bytes()
-            result = numpy.frombuffer(raw_buffer, dtype=dtype).reshape(shape)
-            result.setflags(write=True)
+        else:
+            data = numpy.empty(shape, dtype=dtype)
+
+        process, connection = self._idle.get()
+        try:
+            connection.send(("read", filepath, internal_path, roi.tolist(), shm and shm.name))
+            response = connection.recv()
+            if shm is None and response is None:
+                connection.recv_bytes_into(data.reshape(-1).view(numpy.uint8))
+        except BaseException as ex:
+            # The reply may not have been read (completely), so this reader can't be used anymore.
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            process, connection = self._replace_reader(process, connection)
+            if isinstance(ex, (EOFError, OSError)):
+                # The reader process died.
+                raise RuntimeError(
+                    "hdf5 reader process failed while reading {}{}".format(filepath, internal_path)
+                ) from ex
+            raise
+        finally:
+            self._idle.put((process, connection))
+
+        if shm is not None:
+            # The name is not needed anymore (the memory is freed once it's not used anymore).
+            shm.unlink()
+            if response is not None:
+                shm.close()
+            else:
+                data = numpy.asarray(_SharedMemoryArrayBase(shm, shape, dtype))
+
+        if response is not None:
+            raise response
+        return data
+
+    def close_file(self, filepath):
+        """
+        Make all readers close the given file (waits for running reads to finish).
+        """
+        with self._all_readers_lock:
+            readers = [self._idle.get() for _ in range(len(self._readers))]
+            try:
+                for i, (process, connection) in enumerate(readers):
+                    try:
+                        connection.send(("close", filepath))
+                        connection.recv()
+                    except BaseException as ex:
+                        readers[i] = self._replace_reader(process, connection)
+                        if not isinstance(ex, (EOFError, OSError)):
+                            raise
+                        # (A reader that died has released its files anyway.)
+            finally:
+                for reader in readers:
+                    self._idle.put(reader)
+
+    def shutdown(self):
+        with self._all_readers_lock:
+            for _ in range(len(self._readers)):
+                process, connection = self._idle.get()
+                try:
+                    connection.send(None)
+                except OSError:
+                    pass
+                connection.close()
+                process.join(5)
+            self._readers = []
 
-        if METHOD == "shared-array":
-            result = numpy.frombuffer(self.transfer_buffer, dtype=dtype, count=numpy.prod(shape)).copy()
-            result = result.reshape(shape)
-        return result
 
-    def join(self):
-        self._request_queue_send.send((None, None))
-        super(ReaderProcess, self).join()
+@atexit.register
+def _shutdown_pool():
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
 
 
 class _Dataset(object):
     """
     Stand-in proxy object for a h5py.Dataset object.
-    For __getitem__, we retrieve the requested data from our helper process.
+    For __getitem__, we retrieve the requested data from the reader processes.
     For all other attributes, we *open* the file temporarily and read the attribute.
-    (This makes attribute access very slow.)
+    (This makes attribute access very slow, except for shape, dtype and compression, which are cached.)
     """
 
-    def __init__(self, mp_file, reader_process, internal_path):
+    def __init__(self, mp_file, internal_path):
         self._internal_path = internal_path
-        self._reader_process = reader_process
         self.mp_file = mp_file
 
+        with h5py.File(self.mp_file._filepath, "r") as f:
+            dataset = f[internal_path]
+            self.shape = dataset.shape
+            self.dtype = dataset.dtype
+            self.compression = dataset.compression
+
         if self.compression is None:
             warnings.warn(
                 "MultiProcessHdf5File does not improve performance for non-compressed datasets! "
@@ -136,7 +324,15 @@ class _Dataset(object):
             )
 
     def __getitem__(self, slicing):
-        return self._reader_process.read_subvolume(self._internal_path, slicing)
+        slicing = expandSlicing(slicing, self.shape)
+        roi = slice_to_roi(slicing, self.shape)
+        data = get_reader_pool().read(self.mp_file._filepath, self._internal_path, roi, self.dtype)
+
+        # Drop the axes that were indexed with an int (as h5py does).
+        squeezed_axes = tuple(i for i, sl in enumerate(slicing) if not isinstance(sl, slice))
+        if squeezed_axes:
+            data = data.squeeze(axis=squeezed_axes)
+        return data
 
     def __getattribute__(self, name):
         try:
@@ -145,7 +341,7 @@ class _Dataset(object):
             return object.__getattribute__(self, name)
         except:
             # Briefly open the file and read the attribute directly from h5py
-            with h5py.File(self.mp_file._filepath) as f:
+            with h5py.File(self.mp_file._filepath, "r") as f:
                 val = getattr(f[self._internal_path], name)
                 assert not callable(val), "MultiprocessingHdf5File Datasets cannot provide access to callable items."
 
@@ -187,7 +383,7 @@ class _Group(object):
         return iter(self.keys())
 
     def keys(self):
-        return list(self.keys())
+        return list(self.iterkeys())
 
     def iterkeys(self):
         internal_path = self._internal_path
@@ -228,7 +424,7 @@ class _Group(object):
             return object.__getattribute__(self, name)
         except:
             # Briefly open the file and read the attribute directly from h5py
-            with h5py.File(self.mp_file._filepath) as f:
+            with h5py.File(self.mp_file._filepath, "r") as f:
                 val = getattr(f[self._internal_path], name)
                 assert not callable(val), "MultiprocessingHdf5File Groups cannot provide access to callable items."
                 return copy.copy(val)
@@ -237,15 +433,13 @@ class _Group(object):
 class MultiProcessHdf5File(_Group):
     """
     Stand-in proxy object for an h5py.File object.
-    Users requesting a group or
+    Users requesting a group or dataset get proxy objects, data is read by the shared pool of reader processes.
     """
 
     def __init__(self, filepath, mode="r"):
         super(MultiProcessHdf5File, self).__init__(self, "")
         assert mode == "r", "Only read-only access is permitted when using MultiProcessHdf5File objects."
-        self._filepath = filepath
-        self._reader_processes = {}
-        self._lock = threading.Lock()
+        self._filepath = os.path.abspath(filepath)
 
         self._all_paths = {}
 
@@ -260,23 +454,18 @@ class MultiProcessHdf5File(_Group):
             f.visititems(add_path)
 
     def _get_dataset(self, internal_path):
-        thread_id = threading.current_thread().ident
-        if thread_id not in self._reader_processes:
-            with self._lock:
-                if thread_id not in self._reader_processes:
-                    self._reader_processes[thread_id] = ReaderProcess(self._filepath)
-                    self._reader_processes[thread_id].start()
-        return _Dataset(self, self._reader_processes[thread_id], internal_path)
+        return _Dataset(self, internal_path)
 
     def __setitem__(self, *args):
         raise NotImplementedError("Not permitted to write to a file via MultiProcessHdf5File")
 
     def close(self):
-        with self._lock:
-            readers = list(self._reader_processes.values())
-            self._reader_processes.clear()
-            for reader in readers:
-                reader.join()
+        # The reader processes are shared with other files, but they must release this one
+        # (e.g. so that it can be opened for writing again).
+        with _pool_lock:
+            pool = _pool
+        if pool is not None:
+            pool.close_file(self._filepath)
 
     def __enter__(self):
         return self
@@ -374,7 +563,7 @@ if __name__ == "__main__":
     datapath = "mygroup/bigdata"
 
     # Switch File type
-    if METHOD == "plain-h5py":
+    if os.environ.get("MULTIPROCESS_HDF5_BENCHMARK_METHOD") == "plain-h5py":
         fileclass = h5py.File
     else:
         fileclass = MultiProcessHdf5File
@@ -390,7 +579,7 @@ if __name__ == "__main__":
         whole_vol = mphf[datapath][:]
         assert (whole_vol == testvol).all()
 
-        print(mphf[u"mygroup"].name)
+        print(mphf["mygroup"].name)
         print(list(mphf[datapath].attrs.keys()))
         print(mphf[datapath].shape)
         print(mphf[datapath].dtype)
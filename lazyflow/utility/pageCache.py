@@ -0,0 +1,281 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2020, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+# 		   http://ilastik.org/license/
+###############################################################################
+"""
+Decoded image pages for the image file readers (OpStackLoader, OpTiffReader).
+
+Pages are decoded on a small, bounded pool of I/O threads, so that a request
+spanning many pages reads them in parallel without flooding the disk (and without
+occupying the lazyflow worker threads).  The most recently decoded pages are kept
+in an LRU, so that the many small requests for the same page (e.g. the tiles of
+a slice in the viewer) only decode it once.  Optionally, the next few pages are
+decoded ahead of time, in the direction in which the requests move through the
+file(s) (e.g. when scrolling through a stack, or during a blockwise export).
+These are decoded in PREFETCH requests of the lazyflow thread pool, i.e. only
+when the workers have no interactive work to do.
+
+The readers only use it if parallel page reads were enabled with configure().
+Their page caches report to the cache memory manager, which evicts the pages
+like the blocks of any other cache.
+"""
+
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+
+import psutil
+
+from lazyflow.request import PriorityClass, Request
+
+logger = logging.getLogger(__name__)
+
+#: Maximum number of pages that are decoded in parallel (process-wide)
+NUM_IO_THREADS = min(8, psutil.cpu_count() or 1)
+
+#: Default upper limit of the decoded pages kept by each PageCache (the cache memory manager may evict them earlier)
+DEFAULT_MAX_BYTES = 256 * 2 ** 20
+
+_io_executor = None
+_io_executor_lock = threading.Lock()
+_parallel_reads = False
+
+
+def configure(parallel_reads=False):
+    """
+    Enable (or disable) parallel, cached page reads in the image file readers (OpStackLoader, OpTiffReader).
+    Readers that were set up before keep their mode until their next setupOutputs().
+    """
+    global _parallel_reads
+    _parallel_reads = bool(parallel_reads)
+
+
+def parallel_reads():
+    return _parallel_reads
+
+
+def io_executor():
+    """
+    The thread pool shared by all page caches.
+    """
+    global _io_executor
+    with _io_executor_lock:
+        if _io_executor is None:
+            _io_executor = ThreadPoolExecutor(max_workers=NUM_IO_THREADS, thread_name_prefix="lazyflow-io")
+        return _io_executor
+
+
+class PageCache(object):
+    """
+    Thread-safe LRU of decoded pages.
+
+    Pages are identified by their position (0 <= position < num_pages), and decoded with read_page(position).
+    A page that is requested while it is being decoded is not decoded a second time.
+
+    >>> import numpy
+    >>> cache = PageCache(lambda i: numpy.full((10, 10), i, dtype=numpy.uint8), num_pages=10, max_bytes=250)
+    >>> [int(page[0, 0]) for page in cache.read([1, 2, 3])]
+    [1, 2, 3]
+    >>> cache.wait()
+    >>> sorted(cache.keys())
+    [2, 3]
+    """
+
+    def __init__(self, read_page, num_pages, prefetch=0, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param read_page: Function that decodes the page at the given position (called from the I/O threads).
+        :param num_pages: Total number of pages.
+        :param prefetch: Number of pages to decode ahead of each read().
+        :param max_bytes: Memory budget of the decoded pages.
+        """
+        self._read_page = read_page
+        self._num_pages = num_pages
+        self._prefetch = prefetch
+        self._max_bytes = max_bytes
+        self._last_start = 0
+        self._lock = threading.Lock()
+        self._pages = collections.OrderedDict()  # key -> Future, least recently used first
+        self._page_sizes = {}  # key -> bytes (decoded pages only)
+        self._access_times = {}  # key -> time of the last request
+        self._decode_times = {}  # key -> seconds it took to decode the page (decoded pages only)
+        self._used_bytes = 0
+        self._generation = 0  # incremented by clear()
+
+    def request(self, key, prefetch=False):
+        """
+        Return a future for the page at the given position, and mark it as most recently used.
+        If prefetch is True, a page that isn't cached yet is decoded in a PREFETCH request.
+        """
+        with self._lock:
+            self._access_times[key] = time.time()
+            future = self._pages.get(key)
+            if future is not None:
+                self._pages.move_to_end(key)
+                return future
+            if not prefetch:
+                future = io_executor().submit(self._decode, key, self._generation)
+                self._pages[key] = future
+                return future
+            future = self._pages[key] = Future()
+            decode = partial(self._decode_into, future, key, self._generation)
+
+        request = Request(decode, priority_class=PriorityClass.PREFETCH)
+        # The request is cancelled with its parent (e.g. the read that triggered the prefetch),
+        # but others may be waiting for the page already.
+        request.notify_cancelled(partial(io_executor().submit, decode))
+        request.submit()
+        return future
+
+    def read(self, positions):
+        """
+        Decode the given pages in parallel, and return an iterator over them (in order).
+        """
+        positions = list(positions)
+        futures = [self.request(position) for position in positions]
+
+        if self._prefetch and positions:
+            start, stop = min(positions), max(positions) + 1
+            if start < self._last_start:
+                self.prefetch(range(max(0, start - self._prefetch), start))
+            else:
+                self.prefetch(range(stop, min(self._num_pages, stop + self._prefetch)))
+            self._last_start = start
+
+        return (future.result() for future in futures)
+
+    def prefetch(self, positions):
+        """
+        Start decoding the given pages (if not cached already), without waiting for them.
+        """
+        for position in positions:
+            self.request(position, prefetch=True)
+
+    def wait(self):
+        """
+        Wait until all pending pages are decoded.
+        """
+        with self._lock:
+            futures = list(self._pages.values())
+        for future in futures:
+            future.exception()
+
+    def keys(self):
+        with self._lock:
+            return list(self._pages.keys())
+
+    def used_bytes(self):
+        return self._used_bytes
+
+    def page_statistics(self):
+        """
+        (key, last access time, bytes, decode seconds) of each decoded page
+        (cf. lazyflow.operators.cacheEvictionPolicies.BlockStatistics)
+        """
+        with self._lock:
+            return [
+                (key, self._access_times[key], size, self._decode_times[key]) for key, size in self._page_sizes.items()
+            ]
+
+    def free_page(self, key):
+        """
+        Drop the given page, if it is decoded. Return the number of bytes freed.
+        """
+        with self._lock:
+            if key not in self._page_sizes:
+                return 0
+            return self._drop(key)
+
+    def clear(self):
+        """
+        Drop all pages, and return the number of bytes freed.
+        """
+        with self._lock:
+            freed = self._used_bytes
+            self._pages.clear()
+            self._page_sizes.clear()
+            self._access_times.clear()
+            self._decode_times.clear()
+            self._used_bytes = 0
+            self._generation += 1
+            return freed
+
+    def _decode_into(self, future, key, generation):
+        if future.running() or future.done():
+            # A cancelled request that did run anyway
+            return
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(self._decode(key, generation))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def _decode(self, key, generation):
+        start = time.perf_counter()
+        try:
+            page = self._read_page(key)
+        except BaseException:
+            with self._lock:
+                if generation == self._generation:
+                    # Don't keep failures, the next request retries.
+                    del self._pages[key]
+                    self._access_times.pop(key, None)
+            raise
+
+        # The bookkeeping happens before the future is done,
+        # so waiting for a page also means waiting for its eviction decisions.
+        with self._lock:
+            if generation == self._generation:
+                page_bytes = getattr(page, "nbytes", 0)
+                self._page_sizes[key] = page_bytes
+                self._decode_times[key] = time.perf_counter() - start
+                self._used_bytes += page_bytes
+                self._evict()
+        return page
+
+    def _evict(self):
+        """
+        Drop the least recently used decoded pages until we're within budget.
+        (Requires self._lock.)
+        """
+        for key in list(self._pages.keys()):
+            if self._used_bytes <= self._max_bytes:
+                break
+            if key in self._page_sizes:
+                self._drop(key)
+
+    def _drop(self, key):
+        """
+        Drop the decoded page, and return its size. (Requires self._lock.)
+        """
+        del self._pages[key]
+        del self._access_times[key]
+        del self._decode_times[key]
+        page_bytes = self._page_sizes.pop(key)
+        self._used_bytes -= page_bytes
+        return page_bytes
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,413 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2020, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+# 		   http://ilastik.org/license/
+###############################################################################
+"""
+Opt-in profiler for operator executions.
+
+While the profiler is running, every Operator.call_execute() (i.e. every slot request
+and every direct execution) is recorded with its operator, slot, roi, wall time,
+the time its request was suspended waiting for other requests, the number of
+greenlet switches and the number of bytes it produced. The time the workers of the
+request thread pool spend waiting for work is recorded, too.
+
+The result can be written as a Chrome trace (open it in chrome://tracing or
+https://ui.perfetto.dev) and as a table of the time spent per operator and slot.
+
+Start it with the LAZYFLOW_PROFILE environment variable (or ilastik's --profile_requests
+argument), which names the trace file that is written when the process exits
+(only the main process is profiled, not e.g. its hdf5 reader processes):
+
+    LAZYFLOW_PROFILE=/tmp/export-trace.json ilastik --headless ...
+
+or programmatically:
+
+>>> from lazyflow.utility import requestProfiler
+>>> requestProfiler.start()
+>>> # ... run some requests ...
+>>> profile = requestProfiler.stop()
+>>> print(profile.operator_table())  # doctest: +SKIP
+
+When the profiler isn't running, nothing is hooked, so there is no overhead at all.
+"""
+
+import atexit
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import greenlet
+
+logger = logging.getLogger(__name__)
+
+ENV_VAR = "LAZYFLOW_PROFILE"
+
+_Record = collections.namedtuple(
+    "_Record", "operator_type operator_name slot_name roi start wall wait switches nested nbytes lane"
+)
+
+
+class RequestProfile(object):
+    """
+    The executions recorded between start() and stop().
+    """
+
+    def __init__(self, records, lane_names, start_time, idle_records=()):
+        self.records = records
+        # (worker name, start, duration) of the time the thread pool workers waited for work
+        self.idle_records = list(idle_records)
+        self._lane_names = lane_names
+        self._start_time = start_time
+
+    def chrome_trace(self):
+        """
+        The executions as a dict in the Chrome trace event format.
+        Each greenlet gets its own track (reused after the greenlet is done), so that the executions nest properly.
+        """
+        pid = os.getpid()
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": lane, "args": {"name": name}}
+            for lane, name in self._lane_names.items()
+        ]
+        # The idle times of each worker get their own track, after the greenlet tracks.
+        idle_lanes = {}
+        for worker_name, start, duration in self.idle_records:
+            if worker_name not in idle_lanes:
+                idle_lanes[worker_name] = len(self._lane_names) + len(idle_lanes) + 1
+                events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": pid,
+                        "tid": idle_lanes[worker_name],
+                        "args": {"name": "{} (idle)".format(worker_name)},
+                    }
+                )
+            events.append(
+                {
+                    "name": "idle",
+                    "cat": "ThreadPool",
+                    "ph": "X",
+                    "ts": (start - self._start_time) * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": pid,
+                    "tid": idle_lanes[worker_name],
+                }
+            )
+        for r in self.records:
+            events.append(
+                {
+                    "name": "{}.{}".format(r.operator_name, r.slot_name),
+                    "cat": r.operator_type,
+                    "ph": "X",
+                    "ts": (r.start - self._start_time) * 1e6,
+                    "dur": r.wall * 1e6,
+                    "pid": pid,
+                    "tid": r.lane,
+                    "args": {
+                        "roi": str(r.roi),
+                        "wait_ms": r.wait * 1e3,
+                        "switches": r.switches,
+                        "bytes": r.nbytes,
+                    },
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def operator_totals(self):
+        """
+        Totals per (operator type, slot name): a dict of calls, wall, self, wait, switches and bytes.
+        "self" is the wall time minus the time spent waiting for other requests and
+        minus the executions that were nested directly (in the same greenlet).
+        """
+        totals = collections.OrderedDict()
+        for r in self.records:
+            key = (r.operator_type, r.slot_name)
+            t = totals.get(key)
+            if t is None:
+                t = totals[key] = dict(calls=0, wall=0.0, self=0.0, wait=0.0, switches=0, bytes=0)
+            t["calls"] += 1
+            t["wall"] += r.wall
+            t["self"] += max(0.0, r.wall - r.wait - r.nested)
+            t["wait"] += r.wait
+            t["switches"] += r.switches
+            t["bytes"] += r.nbytes
+        return totals
+
+    def operator_table(self):
+        """
+        The operator totals as a text table, sorted by self time.
+        """
+        header = "{:<50} {:>9} {:>11} {:>11} {:>11} {:>10} {:>11}".format(
+            "operator.slot", "calls", "self [s]", "wall [s]", "wait [s]", "switches", "MB"
+        )
+        lines = [header, "-" * len(header)]
+        totals = sorted(self.operator_totals().items(), key=lambda item: item[1]["self"], reverse=True)
+        for (operator_type, slot_name), t in totals:
+            lines.append(
+                "{:<50} {:>9} {:>11.3f} {:>11.3f} {:>11.3f} {:>10} {:>11.1f}".format(
+                    "{}.{}".format(operator_type, slot_name)[:50],
+                    t["calls"],
+                    t["self"],
+                    t["wall"],
+                    t["wait"],
+                    t["switches"],
+                    t["bytes"] / 2.0 ** 20,
+                )
+            )
+        if self.idle_records:
+            lines.append("")
+            lines.append(
+                "thread pool workers waited {:.3f} s for work in total".format(sum(r[2] for r in self.idle_records))
+            )
+        return "\n".join(lines)
+
+    def write(self, path):
+        """
+        Write the Chrome trace to the given path, and the operator table next to it (as <path>.operators.txt).
+        """
+        self.write_chrome_trace(path)
+        table_path = os.path.splitext(path)[0] + ".operators.txt"
+        with open(table_path, "w") as f:
+            f.write(self.operator_table() + "\n")
+        logger.info("Wrote request profile to {} and {}".format(path, table_path))
+
+
+class _GreenletState(object):
+    """
+    Per-greenlet bookkeeping (stored as an attribute of the greenlet).
+    """
+
+    __slots__ = ("session", "stack", "lane", "suspended_at", "wait", "switches")
+
+    def __init__(self, session):
+        self.session = session
+        self.stack = []  # one entry per open execution: the wall time of its nested executions
+        self.lane = None
+        self.suspended_at = None
+        self.wait = 0.0
+        self.switches = 0
+
+
+class _Session(object):
+    def __init__(self, path):
+        self.path = path
+        self.start_time = time.perf_counter()
+        self.records = []
+        self.idle_records = []
+        self.lane_names = {}
+        self._lanes_lock = threading.Lock()
+        self._free_lanes = collections.defaultdict(list)  # thread ident -> free lanes
+
+    def acquire_lane(self):
+        thread = threading.current_thread()
+        with self._lanes_lock:
+            free_lanes = self._free_lanes[thread.ident]
+            if free_lanes:
+                return free_lanes.pop()
+            lane = len(self.lane_names) + 1
+            self.lane_names[lane] = "{} ({})".format(thread.name, lane)
+            return lane
+
+    def release_lane(self, lane):
+        with self._lanes_lock:
+            self._free_lanes[threading.current_thread().ident].append(lane)
+
+
+_session = None
+_session_lock = threading.Lock()
+_original_call_execute = None
+_original_get_next_job = None
+_thread_local = threading.local()
+_atexit_registered = False
+
+
+def _greenlet_state(session):
+    current = greenlet.getcurrent()
+    state = getattr(current, "_lazyflow_profile", None)
+    if state is None or state.session is not session:
+        state = current._lazyflow_profile = _GreenletState(session)
+    if not getattr(_thread_local, "trace_installed", False):
+        # The trace function is installed once per thread (e.g. in each worker of the thread pool),
+        # and does nothing after the profiler was stopped.
+        _thread_local.previous_trace = greenlet.settrace(_trace_switches)
+        _thread_local.trace_installed = True
+    return state
+
+
+def _uninstall_trace():
+    if getattr(_thread_local, "trace_installed", False):
+        if greenlet.gettrace() is _trace_switches:
+            greenlet.settrace(_thread_local.previous_trace)
+        _thread_local.previous_trace = None
+        _thread_local.trace_installed = False
+
+
+def _trace_switches(event, args):
+    if _session is None:
+        # The profiler was stopped (in another thread), restore the previous trace function of this thread.
+        previous = getattr(_thread_local, "previous_trace", None)
+        _uninstall_trace()
+        if previous is not None:
+            previous(event, args)
+        return
+
+    if event in ("switch", "throw"):
+        origin, target = args
+        now = time.perf_counter()
+        state = getattr(origin, "_lazyflow_profile", None)
+        if state is not None and state.stack:
+            state.suspended_at = now
+            state.switches += 1
+        state = getattr(target, "_lazyflow_profile", None)
+        if state is not None and state.suspended_at is not None:
+            state.wait += now - state.suspended_at
+            state.suspended_at = None
+    previous = getattr(_thread_local, "previous_trace", None)
+    if previous is not None:
+        previous(event, args)
+
+
+def _profiled_call_execute(self, slot, subindex, roi, result, **kwargs):
+    session = _session
+    if session is None:
+        return _original_call_execute(self, slot, subindex, roi, result, **kwargs)
+
+    state = _greenlet_state(session)
+    if not state.stack:
+        state.lane = session.acquire_lane()
+    state.stack.append(0.0)
+    wait, switches = state.wait, state.switches
+    start = time.perf_counter()
+    try:
+        return _original_call_execute(self, slot, subindex, roi, result, **kwargs)
+    finally:
+        wall = time.perf_counter() - start
+        nested = state.stack.pop()
+        session.records.append(
+            _Record(
+                type(self).__name__,
+                self.name,
+                slot.name,
+                roi,
+                start,
+                wall,
+                state.wait - wait,
+                state.switches - switches,
+                nested,
+                getattr(result, "nbytes", 0),
+                state.lane,
+            )
+        )
+        if state.stack:
+            state.stack[-1] += wall
+        else:
+            session.release_lane(state.lane)
+
+
+def _profiled_get_next_job(self):
+    session = _session
+    if session is None:
+        return _original_get_next_job(self)
+
+    start = time.perf_counter()
+    try:
+        return _original_get_next_job(self)
+    finally:
+        session.idle_records.append((self.name, start, time.perf_counter() - start))
+
+
+def is_running():
+    return _session is not None
+
+
+def start(path=None):
+    """
+    Start recording all operator executions.
+    If a path is given, the profile is written there (see RequestProfile.write()) by stop(), or at exit.
+    """
+    global _session, _original_call_execute, _original_get_next_job, _atexit_registered
+    from lazyflow.operator import Operator
+    from lazyflow.request.threadPool import _Worker
+
+    with _session_lock:
+        if _session is not None:
+            raise RuntimeError("The request profiler is already running.")
+        _session = _Session(path)
+        if _original_call_execute is None:
+            _original_call_execute = Operator.call_execute
+        Operator.call_execute = _profiled_call_execute
+        if _original_get_next_job is None:
+            _original_get_next_job = _Worker._get_next_job
+        _Worker._get_next_job = _profiled_get_next_job
+        if path and not _atexit_registered:
+            atexit.register(_stop_at_exit)
+            _atexit_registered = True
+    logger.info("Request profiling started")
+
+
+def stop():
+    """
+    Stop recording, and return the RequestProfile (or None if the profiler wasn't running).
+    Executions that are still running at this point are not included.
+    """
+    global _session
+    from lazyflow.operator import Operator
+    from lazyflow.request.threadPool import _Worker
+
+    with _session_lock:
+        session = _session
+        if session is None:
+            return None
+        Operator.call_execute = _original_call_execute
+        _Worker._get_next_job = _original_get_next_job
+        _session = None
+    # The other threads restore their previous trace function at their next greenlet switch.
+    _uninstall_trace()
+
+    profile = RequestProfile(
+        list(session.records), dict(session.lane_names), session.start_time, list(session.idle_records)
+    )
+    if session.path:
+        profile.write(session.path)
+    return profile
+
+
+def start_from_env():
+    """
+    Start the profiler if the LAZYFLOW_PROFILE environment variable names a trace file.
+    Child processes (which inherit the variable) are not profiled, they would overwrite the trace at exit.
+    """
+    path = os.environ.get(ENV_VAR)
+    if path and not is_running() and multiprocessing.current_process().name == "MainProcess":
+        start(path)
+
+
+def _stop_at_exit():
+    if is_running():
+        stop()
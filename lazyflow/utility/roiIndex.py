@@ -0,0 +1,167 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2020, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+# 		   http://ilastik.org/license/
+###############################################################################
+import itertools
+
+
+class RoiIndex(object):
+    """
+    Spatial index over a dynamic set of rois (tuple-of-tuples ``(start, stop)``).
+
+    Rois are bucketed into a uniform grid. Caches should pass their block shape as
+    ``cell_shape``; otherwise it is taken from the first roi that is added.
+    Every roi is registered in each grid cell it overlaps, so both "which stored roi
+    contains this roi?" and "which stored rois intersect this roi?" only need to inspect
+    the rois in a handful of cells instead of all of them.
+
+    Rois that would span more than ``max_cells_per_roi`` cells (e.g. one huge block among
+    many small tiles) are kept in a separate list that is always scanned.
+
+    Lookups may run concurrently with add(), remove() and clear(), since those replace
+    the (small) per-cell sets instead of modifying them. Callers only need to hold
+    a lock to serialize the modifications.
+
+    >>> index = RoiIndex()
+    >>> index.add(((0, 0), (10, 10)))
+    >>> index.add(((10, 0), (20, 10)))
+    >>> index.find_containing(((12, 2), (15, 5)))
+    ((10, 0), (20, 10))
+    >>> sorted(index.intersecting(((5, 5), (15, 6))))
+    [((0, 0), (10, 10)), ((10, 0), (20, 10))]
+    >>> index.remove(((10, 0), (20, 10)))
+    >>> index.find_containing(((12, 2), (15, 5))) is None
+    True
+    """
+
+    def __init__(self, cell_shape=None, max_cells_per_roi=64):
+        self._fixed_cell_shape = cell_shape and tuple(max(1, int(c)) for c in cell_shape)
+        self._max_cells_per_roi = max_cells_per_roi
+        self.clear()
+
+    def clear(self):
+        self._rois = set()
+        self._cells = {}
+        self._oversized = frozenset()
+        self._cell_shape = self._fixed_cell_shape
+
+    @property
+    def cell_shape(self):
+        return self._cell_shape
+
+    def __len__(self):
+        return len(self._rois)
+
+    def __contains__(self, roi):
+        return roi in self._rois
+
+    def __iter__(self):
+        return iter(list(self._rois))
+
+    def add(self, roi):
+        if roi in self._rois:
+            return
+        if self._cell_shape is None:
+            self._cell_shape = tuple(max(1, stop - start) for start, stop in zip(*roi))
+
+        cell_ranges = self._cell_ranges(roi)
+        if self._num_cells(cell_ranges) > self._max_cells_per_roi:
+            self._oversized = self._oversized | {roi}
+        else:
+            for cell in itertools.product(*cell_ranges):
+                self._cells[cell] = self._cells.get(cell, frozenset()) | {roi}
+        self._rois.add(roi)
+
+    def remove(self, roi):
+        """
+        Remove the given roi from the index. Unknown rois are ignored.
+        """
+        if roi not in self._rois:
+            return
+        self._rois.discard(roi)
+        if roi in self._oversized:
+            self._oversized = self._oversized - {roi}
+            return
+
+        for cell in itertools.product(*self._cell_ranges(roi)):
+            bucket = self._cells[cell] - {roi}
+            if bucket:
+                self._cells[cell] = bucket
+            else:
+                del self._cells[cell]
+
+    def find_containing(self, inner_roi):
+        """
+        Return a stored roi that entirely envelops ``inner_roi``, or None.
+        If the inner roi itself is stored, it is returned.
+        """
+        if inner_roi in self._rois:
+            return inner_roi
+        cell_shape = self._cell_shape
+        if not self._rois or cell_shape is None:
+            return None
+
+        inner_start, inner_stop = inner_roi
+        # Any roi that contains inner_roi must also contain its start coordinate,
+        # so it is registered in that coordinate's cell.
+        cell = tuple(s // c for s, c in zip(inner_start, cell_shape))
+        for candidates in (self._cells.get(cell, ()), self._oversized):
+            for roi in candidates:
+                start, stop = roi
+                if all(a <= b for a, b in zip(start, inner_start)) and all(a >= b for a, b in zip(stop, inner_stop)):
+                    return roi
+        return None
+
+    def intersecting(self, query_roi):
+        """
+        Return the set of stored rois that have a non-empty intersection with ``query_roi``.
+        """
+        cell_shape = self._cell_shape
+        if not self._rois or cell_shape is None:
+            return set()
+
+        cell_ranges = self._cell_ranges(query_roi, cell_shape)
+        if self._num_cells(cell_ranges) > len(self._rois):
+            # Cheaper to check everything than to visit every cell
+            candidates = list(self._rois)
+        else:
+            candidates = set(self._oversized)
+            for cell in itertools.product(*cell_ranges):
+                candidates.update(self._cells.get(cell, ()))
+
+        query_start, query_stop = query_roi
+        return {roi for roi in candidates if self._intersects(roi, query_start, query_stop)}
+
+    @staticmethod
+    def _intersects(roi, query_start, query_stop):
+        start, stop = roi
+        return all(a < d for a, d in zip(start, query_stop)) and all(b > c for b, c in zip(stop, query_start))
+
+    def _cell_ranges(self, roi, cell_shape=None):
+        start, stop = roi
+        cell_shape = cell_shape or self._cell_shape
+        return [range(s // c, max(s, e - 1) // c + 1) for s, e, c in zip(start, stop, cell_shape)]
+
+    @staticmethod
+    def _num_cells(cell_ranges):
+        n = 1
+        for r in cell_ranges:
+            n *= len(r)
+        return n
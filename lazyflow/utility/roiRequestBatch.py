@@ -25,13 +25,14 @@ from builtins import range
 from builtins import object
 from future.utils import raise_with_traceback
 import sys
+import time
 from functools import partial
 
 import numpy
 
 import lazyflow.stype
 from lazyflow.utility import OrderedSignal
-from lazyflow.request import Request, SimpleRequestCondition, log_exception
+from lazyflow.request import Request, RequestLock, SimpleRequestCondition, log_exception
 
 
 import logging
@@ -97,7 +98,16 @@ class RoiRequestBatch(object):
     Processed 5 result blocks with a total sum of: 14500
     """
 
-    def __init__(self, outputSlot, roiIterator, totalVolume=None, batchSize=2, allowParallelResults=False):
+    def __init__(
+        self,
+        outputSlot,
+        roiIterator,
+        totalVolume=None,
+        batchSize=2,
+        allowParallelResults=False,
+        priorityClass=None,
+        controller=None,
+    ):
         """
         Constructor.
 
@@ -109,6 +119,11 @@ class RoiRequestBatch(object):
         :param batchSize: The maximum number of requests to launch in parallel.
         :param allowParallelResults: If False, The resultSignal will not be called in parallel.
                                      In that case, your handler function has no need for locks.
+        :param priorityClass: The thread pool priority class of the requests (and their children).
+                              By default, they get the class of the current request (INTERACTIVE if none).
+                              Exports use PriorityClass.BATCH, to yield to interactive work (e.g. the viewer).
+        :param controller: An optional :py:class:`AdaptiveRequestController<lazyflow.utility.AdaptiveRequestController>`.
+                           If given, it determines the number of requests in flight (instead of batchSize).
         """
         self._resultSignal = OrderedSignal()
         self._progressSignal = OrderedSignal()
@@ -120,8 +135,11 @@ class RoiRequestBatch(object):
         self._roiIter = roiIterator
         self._batchSize = batchSize
         self._allowParallelResults = allowParallelResults
+        self._priorityClass = priorityClass
+        self._controller = controller
 
         self._condition = SimpleRequestCondition()
+        self._resultLock = RequestLock()  # Serializes the resultSignal (unless allowParallelResults)
 
         self._activated_count = 0
         self._completed_count = 0
@@ -166,7 +184,7 @@ class RoiRequestBatch(object):
 
         try:
             # Start by activating a batch of N requests
-            for _ in range(self._batchSize):
+            for _ in range(self._currentBatchSize()):
                 with self._condition:
                     self._activateNewRequest()
                     self._activated_count += 1
@@ -176,7 +194,8 @@ class RoiRequestBatch(object):
                 # Wait for at least one active request to finish
                 with self._condition:
                     while (
-                        not self._failure_excinfo and (self._activated_count - self._completed_count) == self._batchSize
+                        not self._failure_excinfo
+                        and (self._activated_count - self._completed_count) >= self._currentBatchSize()
                     ):
                         self._condition.wait()
 
@@ -185,7 +204,10 @@ class RoiRequestBatch(object):
                     raise_with_traceback(exc_type(exc_value), exc_tb)
 
                 # Launch new requests until we have the correct number of active requests
-                while not self._failure_excinfo and self._activated_count - self._completed_count < self._batchSize:
+                while (
+                    not self._failure_excinfo
+                    and self._activated_count - self._completed_count < self._currentBatchSize()
+                ):
                     with self._condition:
                         self._activateNewRequest()  # Eventually raises StopIteration
                         self._activated_count += 1
@@ -207,6 +229,11 @@ class RoiRequestBatch(object):
 
         self.progressSignal(100)
 
+    def _currentBatchSize(self):
+        if self._controller is not None:
+            return self._controller.in_flight
+        return self._batchSize
+
     def _activateNewRequest(self):
         """
         Creates and activates a new request if there are more rois to process.
@@ -221,16 +248,27 @@ class RoiRequestBatch(object):
         # (This can happen if array data was given to a slot via setValue().)
         assert isinstance(req, Request), "Can't use RoiRequestBatch with non-standard requests.  See comment above."
 
-        req.notify_finished(partial(self._handleCompletedRequest, roi))
+        if self._priorityClass is not None:
+            req.priority_class = self._priorityClass
+        req.notify_finished(partial(self._handleCompletedRequest, roi, time.perf_counter()))
         req.notify_failed(partial(self._handleFailedRequest, roi))
         req.notify_cancelled(partial(self._handleCancelledRequest, roi))
         req.submit()
 
-    def _handleCompletedRequest(self, roi, result):
+    def _handleCompletedRequest(self, roi, submit_time, result):
+        finish_time = time.perf_counter()
         try:
             if self._allowParallelResults:
                 # Signal the user with the result before the critical section
+                handler_start = finish_time
                 self.resultSignal(roi, result)
+            else:
+                # Only result handlers take this lock, so the time spent waiting for it
+                # is the time this result is queued behind the results that are still being handled.
+                with self._resultLock:
+                    handler_start = time.perf_counter()
+                    self.resultSignal(roi, result)
+            handler_seconds = time.perf_counter() - handler_start
         except Exception:
             # Always notify.
             with self._condition:
@@ -240,9 +278,8 @@ class RoiRequestBatch(object):
 
         with self._condition:
             try:
-                if not self._allowParallelResults:
-                    # Signal here, inside the critical section.
-                    self.resultSignal(roi, result)
+                if self._controller is not None:
+                    self._controller.record(finish_time - submit_time, handler_start - finish_time, handler_seconds)
 
                 # Report progress (if possible)
                 if self._totalVolume is not None:
@@ -254,7 +291,7 @@ class RoiRequestBatch(object):
                 self._completed_count += 1
             finally:
                 # Always notify in this finally section,
-                #  even if the client result/progress handler raised.
+                #  even if the client progress handler raised.
                 self._condition.notify()
 
     def _handleFailedRequest(self, roi, exc, exc_info):
@@ -0,0 +1,226 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2020, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+# 		   http://ilastik.org/license/
+###############################################################################
+"""
+Optional second (disk) tier for managed caches.
+
+When the cache memory manager evicts a clean block from a cache that supports
+spilling, the block is written to a spill directory instead of being dropped.
+A later request for the same block reads it back from disk instead of
+recomputing the upstream pipeline. The spill directory has its own byte
+budget; when it is exceeded, the least recently spilled blocks are deleted.
+
+Spilling is disabled by default. Enable it with::
+
+    from lazyflow.utility import spillStore
+    spillStore.configure("/scratch/ilastik-spill", max_bytes=200 * 1024 ** 3)
+
+or via the LAZYFLOW_SPILL_DIR / LAZYFLOW_SPILL_MB environment variables
+(resp. spill_dir / spill_mb in the [lazyflow] section of .ilastikrc).
+"""
+
+import atexit
+import collections
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+
+import numpy
+
+from .memory import Memory
+
+logger = logging.getLogger(__name__)
+
+
+class SpillStore(object):
+    """
+    A byte-budgeted, thread-safe store of numpy arrays on disk.
+
+    Arrays are stored per namespace (one namespace per cache instance, see
+    new_namespace()) and key (the cache's block id). Each array is a
+    separate .npy file that is memory-mapped when read back.
+    """
+
+    def __init__(self, directory=None, max_bytes=0):
+        self._owns_directory = directory is None
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="lazyflow-spill-")
+        else:
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        # (namespace, key) -> (filename, nbytes, cost), in order of spilling
+        self._entries = collections.OrderedDict()
+        self._keys_by_namespace = collections.defaultdict(set)
+        self._used_bytes = 0
+        self._file_counter = itertools.count()
+
+    @property
+    def used_bytes(self):
+        return self._used_bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, namespace_and_key):
+        return namespace_and_key in self._entries
+
+    def put(self, namespace, key, data, cost=None):
+        """
+        Write data to disk. Returns False if the data can not be spilled
+        (unsupported array type or larger than the whole budget).
+
+        cost: seconds it took to compute the data, handed back by get()
+        """
+        if not isinstance(data, numpy.ndarray) or isinstance(data, numpy.ma.MaskedArray):
+            return False
+        if data.dtype == object or data.nbytes > self.max_bytes:
+            return False
+
+        filename = os.path.join(self.directory, "{}.npy".format(next(self._file_counter)))
+        numpy.save(filename, numpy.asarray(data), allow_pickle=False)
+
+        with self._lock:
+            self._remove((namespace, key))
+            self._entries[(namespace, key)] = (filename, data.nbytes, cost)
+            self._keys_by_namespace[namespace].add(key)
+            self._used_bytes += data.nbytes
+
+            while self._used_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                logger.debug("Spill budget exceeded, deleting {}".format(oldest))
+                self._remove(oldest)
+        logger.debug("Spilled {} ({}), spill usage: {}".format(key, Memory.format(data.nbytes), self))
+        return True
+
+    def get(self, namespace, key):
+        """
+        Read a spilled array back (and remove it from the store).
+
+        Returns (data, cost) or None if nothing was spilled for this key.
+        data is a read-only memory map of the spilled file, which is deleted once data
+        (and all views of it) are garbage collected.
+        """
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is None:
+                return None
+            # Detach the file from the bookkeeping, but delete it only after we've read it.
+            del self._entries[(namespace, key)]
+            self._keys_by_namespace[namespace].discard(key)
+            self._used_bytes -= entry[1]
+
+        filename, _, cost = entry
+        try:
+            data = numpy.load(filename, mmap_mode="r")
+        except Exception:
+            self._delete_file(filename)
+            raise
+        # The file can only be deleted (on all platforms) once the memory map is released.
+        weakref.finalize(data, self._delete_file, filename)
+        return data, cost
+
+    def keys(self, namespace):
+        with self._lock:
+            return list(self._keys_by_namespace.get(namespace, ()))
+
+    def discard(self, namespace, key):
+        with self._lock:
+            self._remove((namespace, key))
+
+    def discard_namespace(self, namespace):
+        with self._lock:
+            for key in list(self._keys_by_namespace.pop(namespace, ())):
+                self._remove((namespace, key))
+
+    def clear(self):
+        with self._lock:
+            for namespace_and_key in list(self._entries):
+                self._remove(namespace_and_key)
+
+    def close(self):
+        self.clear()
+        if self._owns_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _remove(self, namespace_and_key):
+        entry = self._entries.pop(namespace_and_key, None)
+        if entry is None:
+            return
+        namespace, key = namespace_and_key
+        self._keys_by_namespace[namespace].discard(key)
+        self._used_bytes -= entry[1]
+        self._delete_file(entry[0])
+
+    @staticmethod
+    def _delete_file(filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            logger.warning("Could not delete spill file {}".format(filename))
+
+    def __str__(self):
+        return "{} of {} in {}".format(Memory.format(self._used_bytes), Memory.format(self.max_bytes), self.directory)
+
+
+_spill_store = None
+_namespace_counter = itertools.count()
+
+
+def configure(directory=None, max_bytes=0):
+    """
+    Enable spilling of evicted cache blocks to the given directory (a fresh temporary
+    directory if None). A max_bytes of 0 disables spilling.
+    """
+    global _spill_store
+    if _spill_store is not None:
+        _spill_store.close()
+        _spill_store = None
+    if max_bytes > 0:
+        _spill_store = SpillStore(directory, max_bytes)
+        logger.info("Spilling evicted cache blocks to {}".format(_spill_store))
+
+
+def getSpillStore():
+    """
+    Return the active SpillStore, or None if spilling is disabled.
+    """
+    return _spill_store
+
+
+def new_namespace():
+    """
+    Return a namespace id that is unique for the lifetime of the process.
+    (Caches must not use id(self), which can be reused after garbage collection.)
+    """
+    return next(_namespace_counter)
+
+
+@atexit.register
+def _cleanup():
+    if _spill_store is not None:
+        _spill_store.close()
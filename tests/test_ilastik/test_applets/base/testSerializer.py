@@ -531,6 +531,51 @@ class TestSerialBlockSlot(unittest.TestCase):
         os.remove(h5_filepath)
         shutil.rmtree(tmp_dir)
 
+    def testIncrementalSave(self):
+        tmp_dir = tempfile.mkdtemp()
+        h5_filepath = os.path.join(tmp_dir, "serial_blockslot_test.h5")
+
+        opLabelArrays, slotSerializer = self._init_objects()
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 1 * numpy.ones((1, 10, 10, 1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][30:31, 30:40, 30:40, 0:1] = 2 * numpy.ones((1, 10, 10, 1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 1 * numpy.ones((1, 10, 10, 1), dtype=numpy.uint8)
+
+        with h5py.File(h5_filepath, "w") as f:
+            label_group = f.create_group("label_data")
+            slotSerializer.serialize(label_group)
+            blocks_group = label_group[slotSerializer.name][slotSerializer.subname.format(0)]
+            assert len(blocks_group) == 3
+
+            # Mark the saved blocks, so we can see which ones are rewritten
+            for block in blocks_group.values():
+                block.attrs["saved_before"] = True
+
+            assert not slotSerializer.shouldSerialize(label_group)
+
+            # Change one block, erase another one, and add a new one
+            opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 2 * numpy.ones((1, 10, 10, 1), dtype=numpy.uint8)
+            opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 255 * numpy.ones((1, 10, 10, 1), dtype=numpy.uint8)
+            opLabelArrays.Input[0][70:71, 70:80, 70:80, 0:1] = 3 * numpy.ones((1, 10, 10, 1), dtype=numpy.uint8)
+            assert slotSerializer.shouldSerialize(label_group)
+            slotSerializer.serialize(label_group)
+
+            assert len(blocks_group) == 3
+            rewritten = {name for name, block in blocks_group.items() if "saved_before" not in block.attrs}
+            assert len(rewritten) == 2
+            assert not slotSerializer.shouldSerialize(label_group)
+
+        opLabelArrays, slotSerializer = self._init_objects()
+        with h5py.File(h5_filepath, "r") as f:
+            slotSerializer.deserialize(f["label_data"])
+
+        assert (opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 2).all()
+        assert (opLabelArrays.Output[0][30:31, 30:40, 30:40, 0:1].wait() == 2).all()
+        assert (opLabelArrays.Output[0][50:51, 50:60, 50:60, 0:1].wait() == 0).all()
+        assert (opLabelArrays.Output[0][70:71, 70:80, 70:80, 0:1].wait() == 3).all()
+
+        os.remove(h5_filepath)
+        shutil.rmtree(tmp_dir)
+
 
 class TestSerialBlockSlot2(unittest.TestCase):
     def _init_objects(self):
@@ -20,6 +20,7 @@
 ###############################################################################
 from __future__ import division
 from builtins import range
+import itertools
 import sys
 import warnings
 import tempfile
@@ -113,6 +114,43 @@ class TestOpBlockwiseObjectClassification(unittest.TestCase):
                 "as the non-blockwise prediction operator!"
             )
 
+    def testPipelinePool(self):
+        # With more blocks than pipelines, the pipelines are re-targeted to other blocks
+        self.op.MAX_BLOCK_PIPELINES = 2
+        self.op.BlockShape3dDict.setValue({"x": 40, "y": 40, "z": 40})
+        self.op.HaloPadding3dDict.setValue({"x": 10, "y": 10, "z": 10})
+        self.op.ShareHaloData.setValue(True)
+
+        pred = numpy.zeros_like(self.prediction_volume)
+        for x, y, z in itertools.product(range(0, 100, 40), repeat=3):
+            block = numpy.s_[:, x : x + 40, y : y + 40, z : z + 40, :]
+            pred[block] = self.op.PredictionImage[block].wait()
+            assert len(self.op._blockPipelines) + len(self.op._idlePipelines) <= 2
+
+        if not (pred == self.prediction_volume).all():
+            self.logImage(pred, "pipeline_pool_prediction_")
+            assert False, (
+                "Blockwise prediction operator did not produce the same prediction image"
+                "as the non-blockwise prediction operator!"
+            )
+
+        # The blocks of the input caches can be evicted by the memory manager, too
+        keys = [key for key, _ in self.op.getBlockAccessTimes()]
+        assert {key[0] for key in keys if isinstance(key[0], str)} == {"RawImage", "BinaryImage"}
+        for key in keys:
+            self.op.freeBlock(key)
+        assert self.op.usedMemory() == 0
+
+        # Without ShareHaloData, there are no input caches
+        self.op.ShareHaloData.setValue(False)
+        assert not self.op._inputCaches
+
+        # Evicted pipelines are re-targeted, too
+        self.op.freeMemory()
+        assert not self.op._blockPipelines
+        pred = self.op.PredictionImage[:].wait()
+        assert (pred == self.prediction_volume).all()
+
     def testZeroHalo(self):
         # If we shrink the halo down to zero, then we get different predictions...
         # This block shape/halo combination will slice through some of the big blocks, causing mis-classification.
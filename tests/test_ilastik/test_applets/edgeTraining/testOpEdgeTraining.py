@@ -1,10 +1,13 @@
 import numpy as np
 import pandas as pd
+import vigra
 
+from ilastikrag import Rag
 from ilastikrag.util import generate_random_voronoi
 
 from lazyflow.graph import Graph
 from ilastik.applets.edgeTraining import OpEdgeTraining
+from ilastik.applets.edgeTraining.opEdgeTraining import OpComputeEdgeFeatures
 
 import logging
 
@@ -57,3 +60,96 @@ class TestOpEdgeTraining(object):
         # ON
         assert edge_prob_dict[edge_C] > 0.5, "Expected > 0.5, got {}".format(edge_prob_dict[edge_C])
         assert edge_prob_dict[edge_D] > 0.5, "Expected > 0.5, got {}".format(edge_prob_dict[edge_D])
+
+
+class TestOpComputeEdgeFeatures(object):
+    def testChannelFeatures(self):
+        superpixels = generate_random_voronoi((50, 50, 50), 50)
+        rag = Rag(superpixels)
+
+        voxel_data = np.random.RandomState(0).rand(50, 50, 50, 3).astype(np.float32)
+        voxel_data = vigra.taggedView(voxel_data, "zyxc")
+
+        op = OpComputeEdgeFeatures(graph=Graph())
+        op.VoxelData.setValue(voxel_data, extra_meta={"channel_names": ["a", "b", "c"]})
+        op.Rag.setValue(rag)
+        op.WatershedSelectedInput.setValue(voxel_data)
+        op.TrainRandomForest.setValue(True)
+        op.FeatureNames.setValue({"a": ["standard_edge_mean"], "c": ["standard_edge_mean", "standard_edge_count"]})
+
+        df = op.EdgeFeaturesDataFrame.value
+        assert list(df.columns) == [
+            "sp1",
+            "sp2",
+            "a standard_edge_mean",
+            "c standard_edge_mean",
+            "c standard_edge_count",
+        ]
+        assert (df[["sp1", "sp2"]].values == rag.edge_ids).all()
+        expected = rag.compute_features(voxel_data[..., 2], ["standard_edge_mean"])
+        assert np.allclose(df["c standard_edge_mean"].values, expected["standard_edge_mean"].values)
+
+        # Changing the features of one channel doesn't recompute the other ones
+        features_a = op._channel_features[("a", ("standard_edge_mean",))][1]
+        op.FeatureNames.setValue({"a": ["standard_edge_mean"], "c": ["standard_edge_mean"]})
+        df = op.EdgeFeaturesDataFrame.value
+        assert list(df.columns) == ["sp1", "sp2", "a standard_edge_mean", "c standard_edge_mean"]
+        assert op._channel_features[("a", ("standard_edge_mean",))][1] is features_a
+
+    def testCacheClearedDuringComputation(self):
+        superpixels = generate_random_voronoi((30, 30, 30), 20)
+        rag = Rag(superpixels)
+
+        voxel_data = np.random.RandomState(0).rand(30, 30, 30, 2).astype(np.float32)
+        voxel_data = vigra.taggedView(voxel_data, "zyxc")
+
+        op = OpComputeEdgeFeatures(graph=Graph())
+        op.VoxelData.setValue(voxel_data, extra_meta={"channel_names": ["a", "b"]})
+        op.Rag.setValue(rag)
+        op.WatershedSelectedInput.setValue(voxel_data)
+        op.TrainRandomForest.setValue(True)
+        op.FeatureNames.setValue({"a": ["standard_edge_mean"], "b": ["standard_edge_mean"]})
+
+        # The stored features are discarded (e.g. by a dirty notification) right after they were computed.
+        compute_channel_features = op._compute_channel_features
+
+        def compute_and_forget(*args):
+            features = compute_channel_features(*args)
+            with op._channel_features_lock:
+                op._channel_features.clear()
+            return features
+
+        op._compute_channel_features = compute_and_forget
+        df = op.EdgeFeaturesDataFrame.value
+        assert list(df.columns) == ["sp1", "sp2", "a standard_edge_mean", "b standard_edge_mean"]
+        expected = rag.compute_features(voxel_data[..., 1], ["standard_edge_mean"])
+        assert np.allclose(df["b standard_edge_mean"].values, expected["standard_edge_mean"].values)
+
+    def testChannelDirtyDuringComputation(self):
+        superpixels = generate_random_voronoi((30, 30, 30), 20)
+        rag = Rag(superpixels)
+
+        voxel_data = np.random.RandomState(0).rand(30, 30, 30, 2).astype(np.float32)
+        voxel_data = vigra.taggedView(voxel_data, "zyxc")
+
+        op = OpComputeEdgeFeatures(graph=Graph())
+        op.VoxelData.setValue(voxel_data, extra_meta={"channel_names": ["a", "b"]})
+        op.Rag.setValue(rag)
+        op.WatershedSelectedInput.setValue(voxel_data)
+        op.TrainRandomForest.setValue(True)
+        op.FeatureNames.setValue({"a": ["standard_edge_mean"], "b": ["standard_edge_mean"]})
+
+        # Channel "a" becomes dirty while the features are computed.
+        compute_features = rag.compute_features
+
+        def compute_and_invalidate(*args, **kwargs):
+            features = compute_features(*args, **kwargs)
+            op.VoxelData.setDirty(np.s_[:, :, :, 0:1])
+            return features
+
+        rag.compute_features = compute_and_invalidate
+        op.EdgeFeaturesDataFrame.value
+
+        # The (possibly stale) features of channel "a" must not be cached, but the ones of "b" are still valid.
+        assert ("a", ("standard_edge_mean",)) not in op._channel_features
+        assert ("b", ("standard_edge_mean",)) in op._channel_features
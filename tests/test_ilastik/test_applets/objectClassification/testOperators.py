@@ -94,6 +94,24 @@ class TestOpRelabelSegmentation(unittest.TestCase):
         assert np.all(img[1, 10:20, 10:20, 10:20, 0] == 60)
         assert np.all(img[1, 20:25, 20:25, 20:25, 0] == 70)
 
+    def testMapChanges(self):
+        segimg = segImage()
+        self.op.Image.setValue(segimg)
+        self.op.ObjectMap.setValue({0: np.array([10, 20, 30]), 1: np.array([40, 50])})
+        self.op.Features._setReady()  # hack because we do not use features
+
+        img = self.op.Output.value
+        # objects that are not in the map are painted with 0
+        assert np.all(img[1, 0:10, 0:10, 0:10, 0] == 50)
+        assert np.all(img[1, 10:20, 10:20, 10:20, 0] == 0)
+        assert np.all(img[1, 20:25, 20:25, 20:25, 0] == 0)
+
+        # the cached lookup tables must not be used after the map changed
+        self.op.ObjectMap.setValue({0: np.array([10, 21, 31]), 1: np.array([40, 50, 60, 70])})
+        img = self.op.Output.value
+        assert np.all(img[0, 0:10, 0:10, 0:10, 0] == 21)
+        assert np.all(img[1, 20:25, 20:25, 20:25, 0] == 70)
+
 
 class TestOpObjectTrain(unittest.TestCase):
 
@@ -59,3 +59,40 @@ class TestTransferLabelsFunction(object):
         newmin4 = coords_new["Coord<Minimum>"][4]
         newmax4 = coords_new["Coord<Maximum>"][4]
         assert numpy.all(newlost["conflict"] == (newmin4 + (newmax4 - newmin4) / 2.0))
+
+    def test_many_objects(self):
+        rng = numpy.random.RandomState(0)
+        mins_old = rng.randint(0, 500, (2000, 2))
+        maxs_old = mins_old + rng.randint(0, 20, (2000, 2))
+        # the new segmentation is the old one, slightly shifted (axis order yx)
+        mins_new = mins_old[:, ::-1] + rng.randint(-2, 3, (2000, 2))
+        maxs_new = mins_new + (maxs_old - mins_old)[:, ::-1]
+        labels = rng.randint(0, 3, 2000)
+
+        newlabels, oldlost, newlost = OpObjectClassification.transferLabels(
+            labels,
+            {"Coord<Minimum>": mins_old[:, ::-1], "Coord<Maximum>": maxs_old[:, ::-1]},
+            {"Coord<Minimum>": mins_new, "Coord<Maximum>": maxs_new},
+            "yx",
+        )
+
+        # brute force: the overlap of all pairs of labeled old objects and new objects (without background)
+        nonzeros = numpy.nonzero(labels)[0]
+        rad_old, rad_new = 0.5 * (maxs_old - mins_old), 0.5 * (maxs_new - mins_new)[1:, ::-1]
+        cent_old, cent_new = mins_old + rad_old, mins_new[1:, ::-1] + rad_new
+        sides = rad_old[nonzeros, None] + rad_new[None] - numpy.abs(cent_old[nonzeros, None] - cent_new[None])
+        overlaps = numpy.where((sides > 0).all(axis=2), sides.prod(axis=2), 0)
+
+        best = overlaps.argmax(axis=1)
+        assigned = overlaps.any(axis=1)
+        expected = numpy.zeros(2000, dtype=numpy.uint32)
+        num_assigned = numpy.bincount(best[assigned], minlength=1999)
+        for iobj, inew in zip(nonzeros[assigned], best[assigned]):
+            if num_assigned[inew] == 1:
+                expected[inew + 1] = labels[iobj]
+
+        assert numpy.all(newlabels == expected)
+        assert len(oldlost["full"]) == (~assigned).sum()
+        assert len(oldlost["partial"]) == ((overlaps > 0).sum(axis=1) > 1).sum()
+        assert len(newlost["conflict"]) == (num_assigned > 1).sum()
+        assert all(c[2] == 0 for c in newlost["conflict"])
@@ -211,3 +211,143 @@ class TestOpRegionFeaturesAgainstNumpy(unittest.TestCase):
                 # that means bounding box centers can differ with a maximum of 0.5
                 bbox_center = mins[iobj] + ((maxs[iobj] - mins[iobj]) / 2.0)
                 np.testing.assert_allclose(centers[iobj], bbox_center, atol=0.5)
+
+
+class TestOpRegionFeaturesLocalBatch(unittest.TestCase):
+    def setUp(self):
+        self.features = {
+            NAME: {
+                "Count": {},
+                "Mean in neighborhood": {"margin": (30, 30, 1)},
+                "Sum in neighborhood": {"margin": (30, 30, 1)},
+                "Variance in neighborhood": {"margin": (30, 30, 1)},
+                "Maximum in neighborhood": {"margin": (30, 30, 1)},
+            }
+        }
+        self.plugin = pluginManager.getPluginByName(NAME, "ObjectFeatures").plugin_object
+
+    def _compute(self):
+        g = Graph()
+        labelop = OpLabelVolume(graph=g)
+        op = OpRegionFeatures(graph=g)
+        op.LabelVolume.connect(labelop.Output)
+        op.RawVolume.setValue(rawImage())
+        op.Features.setValue(self.features)
+        labelop.Input.setValue(binaryImage())
+
+        opAdapt = OpAdaptTimeListRoi(graph=g)
+        opAdapt.Input.connect(op.Output)
+        return opAdapt.Output([0, 1]).wait()
+
+    def test_same_as_per_object(self):
+        # small mosaics, so that the objects are spread over several batches
+        self.plugin.local_batch_pixels = 100000
+        try:
+            batched = self._compute()
+        finally:
+            del self.plugin.local_batch_pixels
+
+        self.plugin.compute_local_batch = lambda *args: None
+        try:
+            per_object = self._compute()
+        finally:
+            del self.plugin.compute_local_batch
+
+        for t in per_object:
+            keys = [k for k in per_object[t][NAME] if "neighborhood" in k]
+            assert len(keys) == 8
+            for key in keys:
+                np.testing.assert_array_equal(batched[t][NAME][key], per_object[t][NAME][key])
+
+
+class TestOpRegionFeaturesBlockwise(unittest.TestCase):
+    def setUp(self):
+        self.features = {
+            NAME: {
+                "Count": {},
+                "RegionCenter": {},
+                "Mean": {},
+                "Variance": {},
+                "Coord<Minimum>": {},
+                "Coord<Maximum>": {},
+                "Coord<Principal<Kurtosis>>": {},
+                "Mean in neighborhood": {"margin": (30, 30, 1)},
+                "Sum in neighborhood": {"margin": (30, 30, 1)},
+            }
+        }
+
+    def _compute(self, blockShape=None):
+        g = Graph()
+        labelop = OpLabelVolume(graph=g)
+        op = OpRegionFeatures(graph=g)
+        op.LabelVolume.connect(labelop.Output)
+        op.RawVolume.setValue(rawImage())
+        op.Features.setValue(self.features)
+        if blockShape is not None:
+            op.BlockShape.setValue(blockShape)
+        labelop.Input.setValue(binaryImage())
+
+        opAdapt = OpAdaptTimeListRoi(graph=g)
+        opAdapt.Input.connect(op.Output)
+        return opAdapt.Output([0, 1]).wait()
+
+    def test_same_as_whole_volume(self):
+        whole = self._compute()
+        # blocks that cut through the objects
+        blockwise = self._compute(blockShape=(1, 16, 16, 16, 1))
+
+        for t in whole:
+            assert set(blockwise[t].keys()) == set(whole[t].keys())
+            for plugin_name in whole[t]:
+                assert set(blockwise[t][plugin_name].keys()) == set(whole[t][plugin_name].keys())
+                for key, value in whole[t][plugin_name].items():
+                    np.testing.assert_allclose(blockwise[t][plugin_name][key], value, rtol=1e-5, atol=1e-4, err_msg=key)
+
+    def test_unsupported_features(self):
+        # the histogram range depends on the whole volume, so this falls back to whole time slices
+        self.features[NAME]["Histogram"] = {}
+        whole = self._compute()
+        blockwise = self._compute(blockShape=(1, 16, 16, 16, 1))
+        for t in whole:
+            np.testing.assert_array_equal(blockwise[t][NAME]["Histogram"], whole[t][NAME]["Histogram"])
+
+    def test_large_objects_computed_alone(self):
+        del self.features[NAME]["Mean in neighborhood"]
+        del self.features[NAME]["Sum in neighborhood"]
+
+        # a hollow cube around the whole volume and two small objects, all starting in the first block
+        labels = np.zeros((1, 50, 50, 50, 1), dtype=np.uint32)
+        labels[0] = 1
+        labels[0, 1:-1, 1:-1, 1:-1] = 0
+        labels[0, 2:4, 2:4, 2:4] = 2
+        labels[0, 6:9, 6:9, 6:9] = 3
+        labels = vigra.taggedView(labels, "txyzc")
+        raw = vigra.taggedView(np.random.random(labels.shape).astype(np.float32), "txyzc")
+
+        def compute(blockShape=None):
+            op = OpRegionFeatures(graph=Graph())
+            op.LabelVolume.setValue(labels)
+            op.RawVolume.setValue(raw)
+            op.Features.setValue(self.features)
+            if blockShape is not None:
+                op.BlockShape.setValue(blockShape)
+
+            box_volumes = []
+            request_box = op._request_box
+
+            def recording_request_box(slot, t, box):
+                if slot is op.RawVolume:
+                    box_volumes.append(np.prod([stop - start for start, stop in box.values()]))
+                return request_box(slot, t, box)
+
+            op._request_box = recording_request_box
+            return op.Output([0], [1]).wait()[0], sorted(box_volumes)
+
+        whole, _ = compute()
+        blockwise, box_volumes = compute(blockShape=(1, 16, 16, 16, 1))
+
+        # the cube is read on its own, the small objects only need their own bounding box
+        assert box_volumes == [7 ** 3, 50 ** 3]
+        for key, value in whole[NAME].items():
+            np.testing.assert_allclose(blockwise[NAME][key], value, rtol=1e-5, atol=1e-4, err_msg=key)
+        assert not blockwise[NAME]["Count"][0].any()
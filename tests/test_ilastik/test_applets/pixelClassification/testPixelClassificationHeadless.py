@@ -236,6 +236,34 @@ class TestPixelClassificationHeadless(object):
         for result in predictions:
             assert result.shape == (2, 20, 20, 5, 2)
 
+    def testParallelBatchProcessing(self):
+        args = app.parse_args([])
+        args.headless = True
+        args.project = self.PROJECT_FILE
+        shell = app.main(args)
+        assert isinstance(shell.workflow, PixelClassificationWorkflow)
+
+        opPixelClassification = shell.workflow.pcApplet.topLevelOperator
+        num_lanes = len(opPixelClassification.InputImages)
+
+        input_datas = [numpy.random.randint(0, 255, (2, 20, 20, 5, 1)).astype(numpy.uint8) for _ in range(5)]
+        role_data_dict = {
+            "Raw Data": [
+                PreloadedArrayDatasetInfo(preloaded_array=input_data, axistags=vigra.AxisTags("tzyxc"))
+                for input_data in input_datas
+            ]
+        }
+
+        batch_applet = shell.workflow.batchProcessingApplet
+        serial_predictions = batch_applet.run_export(role_data_dict, export_to_array=True)
+        parallel_predictions = batch_applet.run_export(role_data_dict, export_to_array=True, parallel_lanes=2)
+
+        # Results are returned in input order, and all batch lanes are removed again.
+        assert len(parallel_predictions) == len(input_datas)
+        for serial, parallel in zip(serial_predictions, parallel_predictions):
+            numpy.testing.assert_array_almost_equal(serial, parallel)
+        assert len(opPixelClassification.InputImages) == num_lanes
+
     @timeLogged(logger)
     def testLotsOfOptions(self):
         # OLD_LAZYFLOW_STATUS_MONITOR_SECONDS = os.getenv("LAZYFLOW_STATUS_MONITOR_SECONDS", None)
@@ -1,6 +1,7 @@
 from builtins import object
 import numpy
 from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory, ParallelVigraRfLazyflowClassifier
+from lazyflow.classifiers import lazyflowClassifier
 
 
 class TestParallelVigraRfLazyflowClassifier(object):
@@ -56,6 +57,82 @@ class TestParallelVigraRfLazyflowClassifier(object):
         assert (0 <= probabilities).all() and (probabilities <= 1.0).all()
         assert (numpy.argmax(probabilities, axis=-1) + 1 == self.expected_classes).all()
 
+    def test_batched_prediction(self):
+        factory = ParallelVigraRfLazyflowClassifierFactory(10, num_forests=3)
+        classifier = factory.create_and_train(self.training_feature_matrix, self.training_labels)
+
+        # Enough rows for several prediction batches
+        features = numpy.random.RandomState(0).uniform(-5, 5, (100000, 2)).astype(numpy.float32)
+        probabilities = classifier.predict_probabilities(features)
+        assert probabilities.shape == (100000, 2)
+        assert numpy.allclose(probabilities.sum(axis=-1), 1.0, atol=1e-4)
+
+        expected = sum(forest.predictProbabilities(features) * forest.treeCount() for forest in classifier._forests)
+        expected /= 10
+        assert numpy.allclose(probabilities, expected, atol=1e-5)
+
+    def test_incremental_training(self):
+        lazyflowClassifier.configure(incremental_training=True)
+        try:
+            factory = ParallelVigraRfLazyflowClassifierFactory(12, num_forests=4)
+            classifier = factory.create_and_train(self.training_feature_matrix[:80], self.training_labels[:80])
+
+            # Labels were added: Only some forests are replaced
+            updated = factory.create_and_train_incremental(
+                classifier, self.training_feature_matrix, self.training_labels
+            )
+            assert 0 < sum(forest in classifier._forests for forest in updated._forests) < 4
+            assert list(updated.known_classes) == [1, 2]
+            probabilities = updated.predict_probabilities(self.prediction_data)
+            assert (numpy.argmax(probabilities, axis=-1) + 1 == self.expected_classes).all()
+
+            # Nothing changed
+            assert (
+                factory.create_and_train_incremental(updated, self.training_feature_matrix, self.training_labels)
+                is updated
+            )
+
+            # Labels were removed: All forests are replaced
+            retrained = factory.create_and_train_incremental(
+                updated, self.training_feature_matrix[1:], self.training_labels[1:]
+            )
+            assert not any(forest in updated._forests for forest in retrained._forests)
+        finally:
+            lazyflowClassifier.configure(incremental_training=False)
+
+    def test_incremental_training_staleness(self):
+        lazyflowClassifier.configure(incremental_training=True)
+        try:
+            factory = ParallelVigraRfLazyflowClassifierFactory(12, num_forests=4)
+            factory.INCREMENTAL_MAX_SAMPLES = 20
+            classifier = factory.create_and_train(self.training_feature_matrix[:60], self.training_labels[:60])
+            assert classifier._forest_training_rows == [60] * 4
+
+            # The replaced forest is trained with a sample, and records how many samples it has seen.
+            updated = factory.create_and_train_incremental(
+                classifier, self.training_feature_matrix[:80], self.training_labels[:80]
+            )
+            assert updated._forest_training_rows[:3] == [60] * 3
+            assert updated._forest_training_rows[3] < 50
+
+            # Now it hasn't seen more than half of the samples, so it is retrained with all of them.
+            retrained = factory.create_and_train_incremental(
+                updated, self.training_feature_matrix, self.training_labels
+            )
+            assert updated._forests[3] not in retrained._forests
+            assert sorted(retrained._forest_training_rows) == [60, 60, 60, 100]
+        finally:
+            lazyflowClassifier.configure(incremental_training=False)
+
+    def test_no_row_hashes_without_incremental_training(self):
+        factory = ParallelVigraRfLazyflowClassifierFactory(12, num_forests=4)
+        classifier = factory.create_and_train(self.training_feature_matrix[:80], self.training_labels[:80])
+        assert classifier._training_row_hashes is None
+
+        # The classifier can't be updated incrementally: All forests are replaced
+        updated = factory.create_and_train_incremental(classifier, self.training_feature_matrix, self.training_labels)
+        assert not any(forest in classifier._forests for forest in updated._forests)
+
     def test_pickle_fields(self):
         """
         Classifier factories are meant to be pickled and restored, but that only
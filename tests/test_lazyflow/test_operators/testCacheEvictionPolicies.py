@@ -0,0 +1,81 @@
+from lazyflow.operators.cacheEvictionPolicies import (
+    BlockStatistics,
+    EvictionQueue,
+    GDSFEvictionPolicy,
+    LRUEvictionPolicy,
+    QuotaEvictionPolicy,
+)
+
+
+class FakeCache(object):
+    def __init__(self, name):
+        self.name = name
+
+
+def drain(queue):
+    order = []
+    entry = queue.pop()
+    while entry is not None:
+        order.append((entry.cache_name, entry.key))
+        entry = queue.pop()
+    return order
+
+
+def test_lru_order():
+    cache = FakeCache("c")
+    queue = EvictionQueue(LRUEvictionPolicy())
+    queue.refresh([(cache, BlockStatistics(k, t, 10, None)) for k, t in [("a", 3.0), ("b", 1.0), ("c", 2.0)]])
+    assert drain(queue) == [("c", "b"), ("c", "c"), ("c", "a")]
+
+
+def test_incremental_refresh():
+    cache = FakeCache("c")
+    queue = EvictionQueue(LRUEvictionPolicy())
+    queue.refresh([(cache, BlockStatistics(k, t, 10, None)) for k, t in [("a", 1.0), ("b", 2.0)]])
+
+    # "a" was accessed again, "b" vanished, "c" is new
+    queue.refresh([(cache, BlockStatistics(k, t, 10, None)) for k, t in [("a", 5.0), ("c", 3.0)]])
+    assert len(queue) == 2
+    assert drain(queue) == [("c", "c"), ("c", "a")]
+
+
+def test_gdsf_prefers_expensive_blocks():
+    raw = FakeCache("raw")
+    features = FakeCache("features")
+    queue = EvictionQueue(GDSFEvictionPolicy())
+    queue.refresh(
+        [
+            # The expensive block is older, but should still survive longer than the cheap ones
+            (features, BlockStatistics("f", 1.0, 100, 10.0)),
+            (raw, BlockStatistics("r1", 2.0, 100, 0.01)),
+            (raw, BlockStatistics("r2", 3.0, 100, 0.02)),
+        ]
+    )
+    assert drain(queue) == [("raw", "r1"), ("raw", "r2"), ("features", "f")]
+
+
+def test_gdsf_inflation_ages_entries():
+    cache = FakeCache("c")
+    policy = GDSFEvictionPolicy()
+    queue = EvictionQueue(policy)
+    queue.refresh([(cache, BlockStatistics("old", 1.0, 1, 5.0)), (cache, BlockStatistics("cheap", 1.0, 1, 1.0))])
+    assert queue.pop().key == "cheap"
+
+    # After evicting, new entries start out at the inflated priority
+    queue.refresh([(cache, BlockStatistics("old", 1.0, 1, 5.0)), (cache, BlockStatistics("new", 2.0, 1, 4.5))])
+    assert drain(queue) == [("c", "old"), ("c", "new")]
+
+
+def test_quota():
+    small = FakeCache("small")
+    greedy = FakeCache("greedy")
+    queue = EvictionQueue(QuotaEvictionPolicy(quotas={"greedy": 0.5}))
+    queue.refresh(
+        [
+            (small, BlockStatistics("s", 1.0, 100, None)),
+            (greedy, BlockStatistics("g1", 2.0, 200, None)),
+            (greedy, BlockStatistics("g2", 3.0, 200, None)),
+        ]
+    )
+    # greedy uses 80% of the cache memory, so its blocks go first even though "s" is older
+    assert drain(queue) == [("greedy", "g1"), ("greedy", "g2"), ("small", "s")]
@@ -122,6 +122,11 @@ class TestOpBlockedArrayCache(unittest.TestCase):
             opProvider.accessCount, expectedAccessCount
         )
 
+    def testBlockIndexCellShape(self):
+        # The block index grid follows the block shape, not the shape of the first stored block
+        block_index = self.opCache._opSimpleBlockedArrayCache._block_index
+        assert block_index.cell_shape == (1, 20, 20, 10, 1)
+
     def testCompressed(self):
         self.opCache.CompressionEnabled.setValue(True)
         self.testCacheAccess()
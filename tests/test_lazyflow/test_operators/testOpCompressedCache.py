@@ -44,6 +44,7 @@ from numpy.testing import assert_array_equal
 
 from lazyflow.graph import Graph
 from lazyflow.operators import OpCompressedCache, OpArrayPiper
+from lazyflow.utility import compressedBlockStore, spillStore
 from lazyflow.utility.slicingtools import slicing2shape
 from lazyflow.operators.opCache import MemInfoNode
 from lazyflow.operators.cacheMemoryManager import CacheMemoryManager
@@ -795,6 +796,52 @@ class TestOpCompressedCache(object):
         op.freeBlock(key)
         assert op.usedMemory() < mem
 
+    def testSpillConcurrentReaders(self, tmp_path, monkeypatch):
+        sampleData = numpy.indices((100, 200, 150), dtype=numpy.float32).sum(0)
+        sampleData = vigra.taggedView(sampleData, axistags="xyz")
+
+        graph = Graph()
+        opData = OpArrayPiperWithAccessCount(graph=graph)
+        opData.Input.setValue(sampleData)
+
+        op = OpCompressedCache(graph=graph)
+        op.BlockShape.setValue([100, 75, 50])
+        op.Input.connect(opData.Output)
+
+        spillStore.configure(str(tmp_path), max_bytes=100 * 1024 ** 2)
+        try:
+            op.Output[...].wait()
+            for key, _ in op.getBlockAccessTimes():
+                assert op.freeBlock(key) > 0
+            assert len(spillStore.getSpillStore()) > 0
+
+            # Make reading the spilled blocks slow, so that other requests come along in the meantime
+            store = spillStore.getSpillStore()
+            get = store.get
+
+            def slow_get(*args):
+                time.sleep(0.05)
+                return get(*args)
+
+            monkeypatch.setattr(store, "get", slow_get)
+
+            results = [None] * 4
+
+            def read(i):
+                results[i] = op.Output[...].wait()
+
+            threads = [threading.Thread(target=read, args=(i,)) for i in range(len(results))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # No request may see a block before it has been restored
+            for result in results:
+                assert_array_equal(result, sampleData.view(numpy.ndarray))
+        finally:
+            spillStore.configure(max_bytes=0)
+
     def testHDF5(self):
         logger.info("Generating sample data...")
         sampleData = numpy.indices((150, 250, 150), dtype=numpy.float32).sum(0)
@@ -926,6 +973,31 @@ class TestOpCompressedCache(object):
         finally:
             shutil.rmtree(tempdir)
 
+    def testCodecs(self):
+        sampleData = numpy.indices((150, 250, 150), dtype=numpy.float32).sum(0)
+        sampleData = vigra.taggedView(sampleData, axistags="xyz")
+
+        for codec in compressedBlockStore.available_codecs():
+            graph = Graph()
+            opData = OpArrayPiper(graph=graph)
+            opData.Input.setValue(sampleData)
+
+            op = OpCompressedCache(parent=None, graph=graph, codec=codec)
+            op.BlockShape.setValue([75, 125, 150])
+            op.Input.connect(opData.Output)
+
+            slicing = numpy.s_[10:140, 100:200, 0:150]
+            assert_array_equal(op.Output[slicing].wait(), sampleData[slicing].view(numpy.ndarray))
+            assert 0 < op.usedMemory() < sampleData.nbytes
+
+            # The export path always produces hdf5 datasets
+            with h5py.File("data.h5", driver="core", backing_store=False, mode="w") as h5_file:
+                op.OutputHdf5[0:75, 0:125, 0:150].writeInto(h5_file).wait()
+                assert_array_equal(
+                    h5_file["[[0, 0, 0], [75, 125, 150]]"][()], sampleData[0:75, 0:125, 0:150].view(numpy.ndarray)
+                )
+            op.cleanUp()
+
     def testIdealBlockShapeChoice(self):
         sampleData = numpy.indices((150, 250, 350), dtype=numpy.float32).sum(0)
         sampleData = vigra.taggedView(sampleData, axistags="xyz")
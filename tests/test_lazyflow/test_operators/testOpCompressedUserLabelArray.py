@@ -157,6 +157,39 @@ class TestOpCompressedUserLabelArray(object):
 
         # assert op.maxLabel.value == expectedData.max() == 1
 
+    def testPurgeVisitsOnlyLabeledBlocks(self):
+        """
+        Clearing or merging a label must only touch the blocks that contain it.
+        """
+        op = self.op
+
+        # A rare label in a single block, far away from the other labels
+        slicing = numpy.s_[0:1, 80:85, 80:85, 3:7, 0:1]
+        op.Input[slicing] = 5 * numpy.ones(slicing2shape(slicing), dtype=numpy.uint8)
+        assert op._label_blocks[5] == {(0, 80, 80, 0, 0)}
+
+        executed_rois = []
+        execute_output = op._executeOutput
+
+        def count_executeOutput(roi, destination):
+            executed_rois.append(roi)
+            return execute_output(roi, destination)
+
+        op._executeOutput = count_executeOutput
+        op.mergeLabels(5, 2)
+        assert len(executed_rois) == 1
+        del op._executeOutput
+
+        expectedData = self.data.copy()
+        expectedData[slicing] = 2
+        assert (op.Output[...].wait() == expectedData).all()
+        assert not op._label_blocks[5]
+        assert (0, 80, 80, 0, 0) in op._label_blocks[2]
+
+        op.clearLabel(2)
+        assert (op.Output[...].wait() == numpy.where(expectedData == 2, 0, expectedData)).all()
+        assert not op._label_blocks[2]
+
     def testEraser(self):
         """
         Check that some labels can be deleted correctly from the sparse array.
@@ -3,8 +3,9 @@ import numpy
 import vigra
 
 from lazyflow.graph import Graph
-from lazyflow.operators.opFeatureMatrixCache import OpFeatureMatrixCache
+from lazyflow.operators.opFeatureMatrixCache import OpFeatureMatrixCache, _FeatureMatrixStore
 from lazyflow.operators.opBlockedArrayCache import OpBlockedArrayCache
+from lazyflow.utility.testing import OpArrayPiperWithAccessCount
 
 
 class TestOpFeatureMatrixCache(object):
@@ -51,3 +52,123 @@ class TestOpFeatureMatrixCache(object):
         # Just check that all features are present, regardless of order.
         for feature_vec in [[10.5, 10.5], [10.5, 11.5], [20.5, 20.5], [20.5, 21.5]]:
             assert feature_vec in labels_and_features[:, 1:]
+
+    def testLabelDeltas(self):
+        features = numpy.indices((100, 100)).astype(numpy.float32) + 0.5
+        features = numpy.rollaxis(features, 0, 3)
+        features = vigra.taggedView(features, "xyc")
+
+        labels = numpy.zeros((100, 100, 1), dtype=numpy.uint8)
+        labels = vigra.taggedView(labels, "xyc")
+
+        graph = Graph()
+        opLabelCache = OpBlockedArrayCache(graph=graph)
+        opLabelCache.BlockShape.setValue((10, 10, 1))
+        opLabelCache.Input.setValue(labels)
+
+        opFeatureProvider = OpArrayPiperWithAccessCount(graph=graph)
+        opFeatureProvider.Input.setValue(features)
+
+        opFeatureMatrixCache = OpFeatureMatrixCache(graph=graph)
+        opFeatureMatrixCache.LabelImage.connect(opLabelCache.Output)
+        opFeatureMatrixCache.FeatureImage.connect(opFeatureProvider.Output)
+
+        def set_labels(key, value):
+            labels[key] = value
+            opLabelCache.Input.setDirty(key)
+
+        def check(expected):
+            labels_and_features = opFeatureMatrixCache.LabelAndFeatureMatrix.value
+            assert sorted(map(tuple, labels_and_features.tolist())) == sorted(expected)
+
+        set_labels(numpy.s_[10:11, 10:12], 1)
+        set_labels(numpy.s_[20:21, 20:21], 2)
+        check([(1, 10.5, 10.5), (1, 10.5, 11.5), (2, 20.5, 20.5)])
+        assert opFeatureProvider.accessCount == 2
+
+        # Relabeling a pixel only updates its label, no features are requested
+        set_labels(numpy.s_[10:11, 11:12], 2)
+        check([(1, 10.5, 10.5), (2, 10.5, 11.5), (2, 20.5, 20.5)])
+        assert opFeatureProvider.accessCount == 2
+
+        # Dirty features invalidate all stored blocks
+        opFeatureProvider.Input.setDirty(slice(None))
+        opFeatureProvider.accessCount = 0
+        check([(1, 10.5, 10.5), (2, 10.5, 11.5), (2, 20.5, 20.5)])
+        assert opFeatureProvider.accessCount == 2
+
+        # Features are only requested for the new pixel
+        previous = opFeatureMatrixCache.LabelAndFeatureMatrix.value
+        previous_copy = previous.copy()
+        set_labels(numpy.s_[12:13, 12:13], 1)
+        set_labels(numpy.s_[20:21, 20:21], 0)
+        check([(1, 10.5, 10.5), (2, 10.5, 11.5), (1, 12.5, 12.5)])
+        assert opFeatureProvider.accessCount == 3
+
+        # Matrices that were handed out before are read-only and never change
+        assert not previous.flags.writeable
+        assert (previous == previous_copy).all()
+
+
+class TestFeatureMatrixStore(object):
+    def testAppendOnly(self):
+        rng = numpy.random.RandomState(0)
+        store = _FeatureMatrixStore(3)
+        expected = {}  # (block_start, pixel_index) -> row
+        snapshots = []
+
+        def rows(pixel_indices):
+            return rng.rand(len(pixel_indices), 3).astype(numpy.float32)
+
+        def update(block_start, removed=(), relabeled=(), added=()):
+            removed, relabeled, added = (numpy.array(a, dtype=numpy.intp) for a in (removed, relabeled, added))
+            relabeled_labels = rng.randint(1, 4, len(relabeled)).astype(numpy.float32)
+            added_rows = rows(added)
+            store.update_block(block_start, removed, relabeled, relabeled_labels, added, added_rows)
+            for i in removed:
+                expected.pop((block_start, i), None)
+            for i, label in zip(relabeled, relabeled_labels):
+                if (block_start, i) in expected:
+                    expected[(block_start, i)][0] = label
+            for i, row in zip(added, added_rows):
+                expected[(block_start, i)] = row.copy()
+
+        def check():
+            matrix = store.matrix()
+            assert not matrix.flags.writeable
+            assert len(store) == len(expected)
+            assert sorted(map(tuple, matrix.tolist())) == sorted(tuple(row.tolist()) for row in expected.values())
+            for block_start in store.block_starts():
+                pixel_indices, labels = store.block_labels(block_start)
+                assert list(labels) == [expected[(block_start, i)][0] for i in pixel_indices]
+            snapshots.append((matrix, matrix.copy()))
+            return matrix
+
+        update((0, 0), added=range(10))
+        update((0, 10), added=range(5, 15))
+        first = check()
+
+        # Adding rows doesn't copy the rows that were handed out before
+        update((0, 0), added=range(20, 30))
+        assert numpy.shares_memory(check(), first)
+
+        # Enough rows to grow the matrix
+        update((10, 0), added=range(2000))
+        check()
+
+        # Relabeling, overwriting and removing rows
+        update((0, 0), relabeled=[1, 2, 25])
+        update((0, 10), added=[5, 6, 100])
+        check()
+        update((0, 10), removed=range(8, 12), relabeled=[5, 13])
+        update((0, 0), removed=[0, 1])
+        check()
+        store.remove_block((10, 0))
+        for key in [key for key in expected if key[0] == (10, 0)]:
+            del expected[key]
+        update((0, 10), relabeled=[14], added=[200])
+        check()
+
+        # Matrices that were handed out never change
+        for matrix, copy in snapshots:
+            assert (matrix == copy).all()
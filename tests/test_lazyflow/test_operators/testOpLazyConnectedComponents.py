@@ -20,6 +20,7 @@
 #          http://ilastik.org/license/
 ###############################################################################
 import sys
+import threading
 
 import numpy as np
 import vigra
@@ -30,6 +31,7 @@ from numpy.testing import assert_array_equal, assert_array_almost_equal
 
 from lazyflow.utility.testing import assertEquivalentLabeling
 from lazyflow.operators.opLazyConnectedComponents import OpLazyConnectedComponents as OpLazyCC
+from lazyflow.operators.opLazyConnectedComponents import UnionFindArray
 
 from lazyflow.graph import Graph
 from lazyflow.operator import Operator
@@ -460,6 +462,72 @@ class TestOpLazyCC(unittest.TestCase):
         assert len(blocks) == 100, "Got {} clean blocks (expected {}".format(len(blocks), 100)
 
 
+class TestUnionFindArray(unittest.TestCase):
+    def testBatchUnion(self):
+        uf = UnionFindArray(1)
+        first = uf.makeNewIndices(5000)
+        assert first == 1
+        assert uf.makeNewIndex() == 5001
+
+        # chain 1 - 2 - ... - 1000, in reverse order, plus redundant pairs
+        labels = np.arange(1000, 1, -1)
+        uf.makeUnions(labels, labels - 1)
+        uf.makeUnions(labels, labels - 1)
+        uf.makeUnion(4000, 3000)
+
+        roots = uf.findIndices(np.arange(5002))
+        assert_array_equal(roots[1:1001], 1)
+        assert_array_equal(roots[1001:3000], np.arange(1001, 3000))
+        assert roots[3000] == roots[4000] == uf.findIndex(4000) == 3000
+
+    def testParallelUnion(self):
+        n = 100000
+        uf = UnionFindArray(1)
+        uf.makeNewIndices(n)
+        pairs = np.random.RandomState(0).randint(1, n + 1, (n, 2))
+
+        def union(chunk):
+            for part in np.array_split(chunk, 20):
+                uf.makeUnions(part[:, 0], part[:, 1])
+
+        threads = [threading.Thread(target=union, args=(chunk,)) for chunk in np.array_split(pairs, 8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        serial = UnionFindArray(1)
+        serial.makeNewIndices(n)
+        serial.makeUnions(pairs[:, 0], pairs[:, 1])
+        assert_array_equal(uf.findIndices(np.arange(n + 1)), serial.findIndices(np.arange(n + 1)))
+
+    def testFindDuringUnion(self):
+        # path compression of concurrent finds must not undo unions
+        n = 20000
+        uf = UnionFindArray(1)
+        uf.makeNewIndices(n)
+        pairs = np.random.RandomState(0).randint(1, n + 1, (30000, 2))
+        done = threading.Event()
+
+        def find(seed):
+            random = np.random.RandomState(seed)
+            while not done.is_set():
+                uf.findIndices(random.randint(1, n + 1, 5000))
+
+        threads = [threading.Thread(target=find, args=(seed,)) for seed in range(3)]
+        for thread in threads:
+            thread.start()
+        try:
+            for part in np.array_split(pairs, 300):
+                uf.makeUnions(part[:, 0], part[:, 1])
+        finally:
+            done.set()
+            for thread in threads:
+                thread.join()
+
+        assert_array_equal(uf.findIndices(pairs[:, 0]), uf.findIndices(pairs[:, 1]))
+
+
 class OpExecuteCounter(OpArrayPiper):
     def __init__(self, *args, **kwargs):
         self.numCalls = 0
@@ -6,34 +6,41 @@ from lazyflow.graph import Graph
 from lazyflow.operators.opFeatureMatrixCache import OpFeatureMatrixCache
 from lazyflow.operators.classifierOperators import OpTrainClassifierFromFeatureVectors
 from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory, ParallelVigraRfLazyflowClassifier
+from lazyflow.classifiers import lazyflowClassifier
+
+
+def create_training_operator(classifier_factory):
+    features = numpy.indices((100, 100)).astype(numpy.float32) + 0.5
+    features = numpy.rollaxis(features, 0, 3)
+    features = vigra.taggedView(features, "xyc")
+    labels = numpy.zeros((100, 100, 1), dtype=numpy.uint8)
+    labels = vigra.taggedView(labels, "xyc")
+
+    labels[10, 10] = 1
+    labels[10, 11] = 1
+    labels[20, 20] = 2
+    labels[20, 21] = 2
+
+    graph = Graph()
+    opFeatureMatrixCache = OpFeatureMatrixCache(graph=graph)
+    opFeatureMatrixCache.FeatureImage.setValue(features)
+    opFeatureMatrixCache.LabelImage.setValue(labels)
+
+    opFeatureMatrixCache.LabelImage.setDirty(numpy.s_[10:11, 10:12])
+    opFeatureMatrixCache.LabelImage.setDirty(numpy.s_[20:21, 20:22])
+    opFeatureMatrixCache.LabelImage.setDirty(numpy.s_[30:31, 30:32])
+
+    opTrain = OpTrainClassifierFromFeatureVectors(graph=graph)
+    opTrain.ClassifierFactory.setValue(classifier_factory)
+    opTrain.MaxLabel.setValue(2)
+    opTrain.LabelAndFeatureMatrix.connect(opFeatureMatrixCache.LabelAndFeatureMatrix)
+
+    return opTrain
 
 
 class TestOpTrainClassifierFromFeatureVectors(object):
     def testBasic(self):
-        features = numpy.indices((100, 100)).astype(numpy.float32) + 0.5
-        features = numpy.rollaxis(features, 0, 3)
-        features = vigra.taggedView(features, "xyc")
-        labels = numpy.zeros((100, 100, 1), dtype=numpy.uint8)
-        labels = vigra.taggedView(labels, "xyc")
-
-        labels[10, 10] = 1
-        labels[10, 11] = 1
-        labels[20, 20] = 2
-        labels[20, 21] = 2
-
-        graph = Graph()
-        opFeatureMatrixCache = OpFeatureMatrixCache(graph=graph)
-        opFeatureMatrixCache.FeatureImage.setValue(features)
-        opFeatureMatrixCache.LabelImage.setValue(labels)
-
-        opFeatureMatrixCache.LabelImage.setDirty(numpy.s_[10:11, 10:12])
-        opFeatureMatrixCache.LabelImage.setDirty(numpy.s_[20:21, 20:22])
-        opFeatureMatrixCache.LabelImage.setDirty(numpy.s_[30:31, 30:32])
-
-        opTrain = OpTrainClassifierFromFeatureVectors(graph=graph)
-        opTrain.ClassifierFactory.setValue(ParallelVigraRfLazyflowClassifierFactory(100))
-        opTrain.MaxLabel.setValue(2)
-        opTrain.LabelAndFeatureMatrix.connect(opFeatureMatrixCache.LabelAndFeatureMatrix)
+        opTrain = create_training_operator(ParallelVigraRfLazyflowClassifierFactory(100))
 
         assert opTrain.Classifier.ready()
 
@@ -43,3 +50,24 @@ class TestOpTrainClassifierFromFeatureVectors(object):
         assert isinstance(
             trained_classifier, ParallelVigraRfLazyflowClassifier
         ), "classifier is of the wrong type: {}".format(type(trained_classifier))
+
+    def testIncrementalTrainingIsOptIn(self):
+        incremental_calls = []
+
+        class RecordingFactory(ParallelVigraRfLazyflowClassifierFactory):
+            def create_and_train_incremental(self, *args, **kwargs):
+                incremental_calls.append(args)
+                return super().create_and_train_incremental(*args, **kwargs)
+
+        opTrain = create_training_operator(RecordingFactory(10))
+        opTrain.Classifier.value
+        opTrain.Classifier.value
+        assert incremental_calls == []
+
+        try:
+            lazyflowClassifier.configure(incremental_training=True)
+            opTrain.Classifier.value
+            opTrain.Classifier.value
+            assert len(incremental_calls) == 1
+        finally:
+            lazyflowClassifier.configure(incremental_training=False)
@@ -7,6 +7,7 @@ from lazyflow.request import RequestPool
 from lazyflow.graph import Graph
 from lazyflow.roi import roiToSlice
 from lazyflow.operators.opUnblockedArrayCache import OpUnblockedArrayCache
+from lazyflow.utility import spillStore
 from lazyflow.utility.testing import OpArrayPiperWithAccessCount
 
 import logging
@@ -168,3 +169,42 @@ class TestOpUnblockedArrayCacheCache(object):
         cache_data = opCache.Output(*inner_roi).wait()
         assert (cache_data == data[roiToSlice(*inner_roi)]).all()
         assert opDataProvider.accessCount == 0
+
+    def testSpill(self, tmp_path):
+        spillStore.configure(str(tmp_path), max_bytes=10 * 1024 ** 2)
+        try:
+            graph = Graph()
+            opDataProvider = OpArrayPiperWithAccessCount(graph=graph)
+            opCache = OpUnblockedArrayCache(graph=graph)
+
+            data = np.random.random((100, 100, 100)).astype(np.float32)
+            opDataProvider.Input.setValue(vigra.taggedView(data, "zyx"))
+            opCache.Input.connect(opDataProvider.Output)
+
+            roi = ((30, 30, 30), (50, 50, 50))
+            block_roi = tuple(map(tuple, roi))
+            opCache.Output(*roi).wait()
+            assert opDataProvider.accessCount == 1
+
+            # Evicted blocks are spilled and read back without recomputation
+            assert opCache.freeBlock(block_roi) > 0
+            assert opCache.CleanBlocks.value == []
+            cache_data = opCache.Output(*roi).wait()
+            assert (cache_data == data[roiToSlice(*roi)]).all()
+            assert opDataProvider.accessCount == 1
+            assert opCache.CleanBlocks.value == [roiToSlice(*roi)]
+
+            # Dirty notifications elsewhere keep the spilled block
+            opCache.freeBlock(block_roi)
+            opDataProvider.Input.setDirty((0, 0, 0), (10, 10, 10))
+            opCache.Output(*roi).wait()
+            assert opDataProvider.accessCount == 1
+
+            # Spilled blocks that become dirty are discarded
+            opCache.freeBlock(block_roi)
+            opDataProvider.Input.setDirty((30, 30, 30), (31, 31, 31))
+            cache_data = opCache.Output(*roi).wait()
+            assert (cache_data == data[roiToSlice(*roi)]).all()
+            assert opDataProvider.accessCount == 2
+        finally:
+            spillStore.configure(max_bytes=0)
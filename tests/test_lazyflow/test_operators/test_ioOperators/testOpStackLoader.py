@@ -27,16 +27,24 @@ import shutil
 import tempfile
 
 import numpy
+import pytest
 import vigra
 
 from lazyflow.graph import Graph
 from lazyflow.operators.ioOperators import OpStackLoader
+from lazyflow.utility import pageCache
 
 # from lazyflow.operators.ioOperators import OpInputDataReader
 import h5py
 
 
 class TestOpStackLoader(object):
+    @pytest.fixture(params=[False, True], ids=["serial", "parallel"], autouse=True)
+    def parallel_page_reads(self, request):
+        pageCache.configure(parallel_reads=request.param)
+        yield request.param
+        pageCache.configure()
+
     def setup_method(self, method):
         self._tmp_dir = tempfile.mkdtemp()
 
@@ -197,6 +205,41 @@ class TestOpStackLoader(object):
             vol_from_stack_tzyxc == expected_volume_tzyxc
         ).all(), "4D+c Volume from stack did not match expected data."
 
+    def test_sliced_reads(self, parallel_page_reads):
+        expected_volume, globstring = self._prepare_data("rand_3d_slices", (20, 64, 48), "zyx", "z")
+
+        op = OpStackLoader(graph=Graph())
+        op.globstring.setValue(globstring)
+
+        # Scroll back and forth, reading tiles (i.e. the same pages several times)
+        for z in list(range(0, 20, 3)) + list(range(19, 0, -4)):
+            for y in (0, 32):
+                tile = op.stack[z : z + 1, y : y + 32, 10:40, :].wait()
+                assert (tile[..., 0] == expected_volume[z : z + 1, y : y + 32, 10:40]).all()
+
+        if parallel_page_reads:
+            # The decoded pages can be evicted by the cache memory manager.
+            op._pages.wait()
+            stats = op.getBlockStatistics()
+            assert stats
+            assert op.usedMemory() == sum(s.size for s in stats) > 0
+            for s in stats:
+                assert op.freeBlock(s.key) == s.size
+            assert op.usedMemory() == 0
+        else:
+            assert op.usedMemory() == 0
+            assert not op.getBlockStatistics()
+
+    def test_mismatched_shapes(self):
+        _, globstring = self._prepare_data("rand_3d_mismatch", (3, 20, 30), "zyx", "z")
+        vigra.impex.writeImage(
+            numpy.zeros((10, 10), dtype=numpy.uint8), os.path.join(self._tmp_dir, "rand_3d_mismatch_003.tiff")
+        )
+
+        op = OpStackLoader(graph=Graph())
+        with pytest.raises(RuntimeError):
+            op.globstring.setValue(globstring)
+
     def test_stack_pngs(self, inputdata_dir):
         graph = Graph()
         op = OpStackLoader(graph=graph)
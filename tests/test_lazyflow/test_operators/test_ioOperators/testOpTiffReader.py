@@ -4,11 +4,13 @@ import shutil
 import contextlib
 
 import numpy
+import pytest
 from numpy.testing import assert_array_equal
 import vigra
 
 from lazyflow.graph import Graph
 from lazyflow.operators.ioOperators import OpTiffReader
+from lazyflow.utility import pageCache
 
 
 @contextlib.contextmanager
@@ -19,6 +21,12 @@ def tempdir():
 
 
 class TestOpTiffReader(object):
+    @pytest.fixture(params=[False, True], ids=["serial", "parallel"], autouse=True)
+    def parallel_page_reads(self, request):
+        pageCache.configure(parallel_reads=request.param)
+        yield request.param
+        pageCache.configure()
+
     def test_2d(self):
         data = numpy.random.randint(0, 255, (100, 200, 3)).astype(numpy.uint8)
         with tempdir() as d:
@@ -64,6 +72,20 @@ class TestOpTiffReader(object):
             assert op.Output.ready()
             assert (op.Output[20:30, 50:100, 50:150].wait() == data[20:30, 50:100, 50:150]).all()
 
+    def test_tiled(self):
+        import tifffile
+
+        data = numpy.random.randint(0, 2 ** 16, (5, 70, 90, 3)).astype(numpy.uint16)
+        with tempdir() as d:
+            tiff_path = d + "/test-tiled.tiff"
+            tifffile.imsave(tiff_path, data, tile=(32, 32))
+
+            op = OpTiffReader(graph=Graph())
+            op.Filepath.setValue(tiff_path)
+            assert op.Output.ready()
+            assert_array_equal(op.Output[1:4, 10:65, 40:90, 1:3].wait(), data[1:4, 10:65, 40:90, 1:3])
+            assert_array_equal(op.Output[:].wait(), data)
+
     def test_unknown_axes_tags(self):
         """
         This test is related to https://github.com/ilastik/ilastik/issues/1487
@@ -23,6 +23,7 @@ from builtins import object
 # 		   http://ilastik.org/license/
 ###############################################################################
 from lazyflow.request.request import Request, RequestLock, SimpleRequestCondition, RequestPool
+from lazyflow.request.threadPool import PriorityClass
 import os
 import time
 import random
@@ -678,6 +679,16 @@ class TestRequest(unittest.TestCase):
             # Set it back to what it was
             Request.reset_thread_pool(num_workers)
 
+    def testRootPriorityClass(self):
+        assert Request(lambda: None).priority_class == PriorityClass.INTERACTIVE
+        with Request.root_priority_class(PriorityClass.PREFETCH):
+            req = Request(lambda: Request(lambda: None).priority_class)
+            assert req.priority_class == PriorityClass.PREFETCH
+            # Child requests inherit the class of their parent
+            req.submit()
+            assert req.wait() == PriorityClass.PREFETCH
+        assert Request(lambda: None).priority_class == PriorityClass.INTERACTIVE
+
 
 class TestRequestExceptions(object):
     """
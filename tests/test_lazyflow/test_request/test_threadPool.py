@@ -5,7 +5,7 @@ import itertools
 
 import pytest
 
-from lazyflow.request.threadPool import ThreadPool
+from lazyflow.request.threadPool import PriorityClass, ThreadPool
 
 
 NUM_WORKERS = 4
@@ -119,3 +119,84 @@ def test_exception_in_task_logged(caplog, pool):
     record = caplog.records[0]
 
     assert issubclass(record.exc_info[0], MyExc)
+
+
+class ClassTask(Task):
+    def __init__(self, fn, priority_class):
+        super().__init__(fn)
+        self.priority_class = priority_class
+
+
+def _block_single_worker(pool):
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocker():
+        started.set()
+        release.wait()
+
+    pool.wake_up(Task(blocker))
+    assert started.wait(timeout=1)
+    return release
+
+
+def test_higher_priority_class_runs_first():
+    pool = ThreadPool(1)
+    release = _block_single_worker(pool)
+    order = []
+    done = threading.Event()
+
+    pool.wake_up(ClassTask(lambda: order.append("batch"), PriorityClass.BATCH))
+    pool.wake_up(ClassTask(lambda: order.append("prefetch"), PriorityClass.PREFETCH))
+    pool.wake_up(ClassTask(lambda: order.append("interactive"), PriorityClass.INTERACTIVE))
+    pool.wake_up(ClassTask(done.set, PriorityClass.BATCH))
+    assert pool.get_queue_depths() == {"interactive": 1, "prefetch": 1, "batch": 2}
+
+    release.set()
+    assert done.wait(timeout=1)
+    assert order == ["interactive", "prefetch", "batch"]
+    assert pool.get_queue_depths() == {"interactive": 0, "prefetch": 0, "batch": 0}
+    pool.stop()
+
+
+def test_starving_tasks_are_run():
+    pool = ThreadPool(1, starvation_timeout=0.05)
+    release = _block_single_worker(pool)
+    order = []
+    done = threading.Event()
+
+    pool.wake_up(ClassTask(lambda: order.append("batch"), PriorityClass.BATCH))
+    time.sleep(0.1)
+    pool.wake_up(ClassTask(lambda: order.append("interactive"), PriorityClass.INTERACTIVE))
+    pool.wake_up(ClassTask(done.set, PriorityClass.INTERACTIVE))
+
+    release.set()
+    assert done.wait(timeout=1)
+    assert order == ["batch", "interactive"]
+    pool.stop()
+
+
+def test_idle_workers_steal_local_tasks(pool: ThreadPool):
+    num_children = 20
+    finished = threading.Semaphore(0)
+    child_threads = set()
+
+    def child():
+        child_threads.add(threading.current_thread())
+        time.sleep(0.01)
+        finished.release()
+
+    def parent():
+        # Tasks submitted from a worker are queued locally...
+        for _ in range(num_children):
+            pool.wake_up(Task(child))
+        # ...and must be stolen while this worker is busy.
+        for _ in range(num_children):
+            assert finished.acquire(timeout=1)
+
+    done = threading.Event()
+    pool.wake_up(Task(lambda: (parent(), done.set())))
+    assert done.wait(timeout=5)
+
+    assert len(child_threads) > 1
+    assert sum(pool.get_steal_counts().values()) == num_children
@@ -0,0 +1,129 @@
+###############################################################################
+#   lazyflow: data flow based lazy parallel computation framework
+#
+#       Copyright (C) 2011-2020, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+# 		   http://ilastik.org/license/
+###############################################################################
+import time
+
+import numpy
+import pytest
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper
+from lazyflow.request import Request
+from lazyflow.utility import AdaptiveRequestController, Memory, RoiRequestBatch
+
+
+@pytest.fixture
+def memory(monkeypatch):
+    usage = {"used": 1 * 1024 ** 3, "available": 10 * 1024 ** 3}
+    monkeypatch.setattr(Memory, "getMemoryUsage", classmethod(lambda cls: usage["used"]))
+    monkeypatch.setattr(Memory, "getAvailableRam", classmethod(lambda cls: usage["available"]))
+    return usage
+
+
+def make_controller(monkeypatch, idle_workers, **kwargs):
+    controller = AdaptiveRequestController(**kwargs)
+    monkeypatch.setattr(controller, "_idle_worker_count", lambda: idle_workers)
+    return controller
+
+
+def test_grows_with_idle_workers(monkeypatch, memory):
+    controller = make_controller(monkeypatch, idle_workers=4, in_flight=2, max_in_flight=5)
+    for _ in range(20):
+        controller.record(1.0, 0.0, 0.01)
+    assert controller.in_flight == 5
+
+
+def test_shrinks_with_slow_consumer(monkeypatch, memory):
+    controller = make_controller(monkeypatch, idle_workers=4, in_flight=6, max_in_flight=8)
+    for _ in range(40):
+        # results wait for the handler much longer than it takes to handle one
+        controller.record(1.0, 0.5, 0.1)
+    assert controller.in_flight == 1
+
+
+def test_memory_pressure(monkeypatch, memory):
+    controller = make_controller(
+        monkeypatch, idle_workers=4, in_flight=2, max_in_flight=8, max_blocks_per_request=8, ram_per_block=1024
+    )
+    for _ in range(20):
+        controller.record(0.01, 0.0, 0.001)
+    assert controller.in_flight > 2
+    assert controller.blocks_per_request == 8
+
+    memory["used"] = memory["available"]
+    for _ in range(20):
+        controller.record(0.01, 0.0, 0.001)
+    assert controller.in_flight == 1
+    assert controller.blocks_per_request == 1
+
+
+def test_blocks_per_request(monkeypatch, memory):
+    controller = make_controller(
+        monkeypatch, idle_workers=0, in_flight=2, max_blocks_per_request=4, target_request_seconds=1.0
+    )
+    for _ in range(10):
+        controller.record(0.01, 0.0, 0.001)
+    assert controller.blocks_per_request == 4
+    assert controller.in_flight == 2
+
+    for _ in range(10):
+        controller.record(10.0, 0.0, 0.001)
+    assert controller.blocks_per_request == 1
+
+    # Not enough RAM for bigger requests
+    controller.ram_per_block = memory["available"]
+    for _ in range(10):
+        controller.record(0.01, 0.0, 0.001)
+    assert controller.blocks_per_request == 1
+
+
+class RecordingController(object):
+    in_flight = 4
+
+    def __init__(self):
+        self.samples = []
+
+    def record(self, *sample):
+        self.samples.append(sample)
+
+
+def test_batch_reports_queued_results():
+    op = OpArrayPiper(graph=Graph())
+    op.Input.setValue(numpy.zeros((10, 100), dtype=numpy.uint8))
+    rois = [((i, 0), (i + 1, 100)) for i in range(10)]
+
+    controller = RecordingController()
+    batch = RoiRequestBatch(op.Output, iter(rois), controller=controller)
+    # A slow consumer: The results of the (fast) requests queue up in front of it.
+    batch.resultSignal.subscribe(lambda roi, result: time.sleep(0.02))
+
+    # (Results can only queue up if several workers finish requests in parallel.)
+    num_workers = Request.global_thread_pool.num_workers
+    Request.reset_thread_pool(num_workers=4)
+    try:
+        batch.execute()
+    finally:
+        Request.reset_thread_pool(num_workers)
+
+    assert len(controller.samples) == 10
+    request_seconds, wait_seconds, handler_seconds = numpy.array(controller.samples).T
+    assert (handler_seconds >= 0.02).all()
+    assert wait_seconds.sum() >= 0.02
@@ -0,0 +1,83 @@
+import threading
+import time
+
+import numpy
+import pytest
+
+from lazyflow.roi import getIntersectingBlocks, roiFromShape, roiToSlice
+from lazyflow.utility.asyncBlockWriter import AsyncBlockWriter
+
+
+class ChunkedStore(object):
+    """
+    Mimics an N5/zarr dataset: every write is a read-modify-write of whole chunks.
+    Asserts that no chunk is written by two threads at the same time.
+    """
+
+    def __init__(self, shape, chunkshape):
+        self.data = numpy.zeros(shape, dtype=numpy.uint32)
+        self.chunkshape = numpy.array(chunkshape)
+        self._busy_chunks = set()
+        self._lock = threading.Lock()
+
+    def write(self, slicing, data):
+        start = numpy.array([s.start for s in slicing])
+        stop = numpy.array([s.stop for s in slicing])
+        chunks = [tuple(c) for c in getIntersectingBlocks(self.chunkshape, (start, stop))]
+        with self._lock:
+            assert not self._busy_chunks.intersection(chunks), "Concurrent writes to the same chunk"
+            self._busy_chunks.update(chunks)
+        time.sleep(0.001)
+        self.data[slicing] = data
+        with self._lock:
+            self._busy_chunks.difference_update(chunks)
+
+
+@pytest.mark.parametrize("num_threads", [1, 4])
+def test_unaligned_blocks(num_threads):
+    shape = (50, 70, 30)
+    store = ChunkedStore(shape, (16, 16, 16))
+    expected = numpy.random.RandomState(0).randint(1, 100, shape).astype(numpy.uint32)
+
+    with AsyncBlockWriter(store.write, chunkshape=store.chunkshape, num_threads=num_threads) as writer:
+        for block_start in getIntersectingBlocks((13, 17, 11), roiFromShape(shape)):
+            block_stop = numpy.minimum(block_start + (13, 17, 11), shape)
+            writer.submit((block_start, block_stop), expected[roiToSlice(block_start, block_stop)])
+
+    assert (store.data == expected).all()
+
+
+def test_backpressure():
+    release = threading.Event()
+
+    def write(slicing, data):
+        release.wait()
+
+    writer = AsyncBlockWriter(write, num_threads=1, max_pending=2)
+    submitted = []
+
+    def produce():
+        for i in range(5):
+            writer.submit(((i,), (i + 1,)), numpy.zeros(1))
+            submitted.append(i)
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    time.sleep(0.2)
+    # One block is being written, two are waiting.
+    assert len(submitted) == 3
+
+    release.set()
+    producer.join()
+    writer.close()
+    assert len(submitted) == 5
+
+
+def test_write_failure():
+    def write(slicing, data):
+        raise IOError("disk full")
+
+    with pytest.raises(IOError):
+        with AsyncBlockWriter(write) as writer:
+            for i in range(10):
+                writer.submit(((i,), (i + 1,)), numpy.zeros(1))
@@ -118,6 +118,47 @@ class TestBigRequestStreamer(unittest.TestCase):
 
         logger.debug("FINISHED")
 
+    def testAdaptive(self):
+        op = OpArrayPiper(graph=Graph())
+        inputData = numpy.indices((100, 100)).sum(0)
+        op.Input.setValue(inputData)
+
+        results = numpy.zeros((100, 100), dtype=numpy.int32)
+        rois = []
+
+        def handleResult(roi, result):
+            results[roiToSlice(*roi)] += result
+            rois.append(roi)
+
+        progressList = []
+        batch = BigRequestStreamer(op.Output, [(0, 0), (100, 100)], (5, 5), batchSize=2, adaptive=True)
+        batch.resultSignal.subscribe(handleResult)
+        batch.progressSignal.subscribe(progressList.append)
+        batch.execute()
+
+        # Every pixel is requested exactly once, even if blocks are merged
+        assert (results == inputData).all()
+        assert len(rois) <= 400
+        assert progressList[0] == 0
+        assert progressList[-1] == 100
+
+    def testChunkAligned(self):
+        op = OpArrayPiper(graph=Graph())
+        inputData = numpy.indices((300, 200)).sum(0)
+        op.Input.setValue(inputData)
+        op.Output.meta.max_blockshape = (100, 100)
+
+        rois = []
+        batch = BigRequestStreamer(op.Output, [(0, 0), (300, 200)], chunkshape=(64, 32))
+        batch.resultSignal.subscribe(lambda roi, result: rois.append(roi))
+        batch.execute()
+
+        # Blocks never straddle a chunk
+        for start, stop in rois:
+            assert (numpy.mod(start, (64, 32)) == 0).all()
+            assert ((numpy.mod(stop, (64, 32)) == 0) | (stop == (300, 200))).all()
+            assert (numpy.subtract(stop, start) <= 100).all()
+
 
 def test_pool_results_discarded():
     """
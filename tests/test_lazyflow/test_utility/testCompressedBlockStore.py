@@ -0,0 +1,130 @@
+import threading
+
+import h5py
+import numpy
+import pytest
+
+from lazyflow.request import Request
+from lazyflow.roi import roiToSlice
+from lazyflow.utility import compressedBlockStore
+
+
+@pytest.fixture(params=compressedBlockStore.available_codecs())
+def codec(request):
+    return request.param
+
+
+def test_partial_writes(codec):
+    shape = (37, 50, 23)
+    rng = numpy.random.RandomState(0)
+    expected = numpy.zeros(shape, dtype=numpy.uint32)
+    block = compressedBlockStore.create_block(shape, numpy.uint32, (10, 16, 23), codec=codec)
+    assert block.is_zero()
+
+    for _ in range(20):
+        start = rng.randint(0, shape, 3)
+        stop = numpy.minimum(start + rng.randint(1, 20, 3), shape)
+        data = rng.randint(0, 5, stop - start).astype(numpy.uint32)
+        block.write((start, stop), data)
+        expected[roiToSlice(start, stop)] = data
+
+        start = rng.randint(0, shape, 3)
+        stop = numpy.minimum(start + rng.randint(1, 30, 3), shape)
+        assert (block.read((start, stop)) == expected[roiToSlice(start, stop)]).all()
+
+        # Non-contiguous destination
+        destination = numpy.zeros(tuple(2 * (stop - start)), dtype=numpy.uint32)[::2, ::2, ::2]
+        block.read((start, stop), destination)
+        assert (destination == expected[roiToSlice(start, stop)]).all()
+
+    assert (block.read_all() == expected).all()
+    assert 0 < block.storage_size() < block.uncompressed_size()
+
+    block.write(((0, 0, 0), shape), numpy.zeros(shape, dtype=numpy.uint32))
+    assert block.is_zero()
+    block.close()
+
+
+def test_zero_chunks_are_not_stored():
+    shape = (100, 100)
+    block = compressedBlockStore.create_block(shape, numpy.uint8, (10, 10), codec="zlib")
+    assert block.storage_size() == 0
+
+    block.write(((0, 0), (1, 1)), numpy.ones((1, 1), dtype=numpy.uint8))
+    single_chunk_size = block.storage_size()
+    assert single_chunk_size > 0
+
+    # Writing zeros to other chunks doesn't use any memory
+    block.write(((10, 10), (100, 100)), numpy.zeros((90, 90), dtype=numpy.uint8))
+    assert block.storage_size() == single_chunk_size
+
+
+def test_masked(codec):
+    shape = (20, 30)
+    rng = numpy.random.RandomState(0)
+    data = numpy.ma.masked_array(
+        rng.rand(*shape).astype(numpy.float32), mask=rng.rand(*shape) > 0.5, fill_value=numpy.nan, shrink=False
+    )
+    block = compressedBlockStore.create_block(shape, numpy.float32, (7, 30), has_mask=True, codec=codec)
+    block.write(((0, 0), shape), data)
+
+    result = block.read(((3, 4), (15, 22)))
+    assert (result.data == data.data[3:15, 4:22]).all()
+    assert (result.mask == data.mask[3:15, 4:22]).all()
+    assert numpy.isnan(block.fill_value)
+
+
+def test_hdf5_roundtrip(codec, tmp_path):
+    shape = (20, 30)
+    data = numpy.indices(shape).sum(0).astype(numpy.float32)
+    block = compressedBlockStore.create_block(shape, numpy.float32, (7, 30), codec=codec)
+    block.write(((0, 0), shape), data)
+
+    with h5py.File(str(tmp_path / "block.h5"), "w") as f:
+        block.write_hdf5(f, "block")
+        assert (f["block"][()] == data).all()
+
+        restored = compressedBlockStore.create_block(shape, numpy.float32, (7, 30), codec=codec)
+        restored.read_hdf5(f["block"])
+        assert (restored.read_all() == data).all()
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        compressedBlockStore.configure("no-such-codec")
+
+
+def test_reads_see_whole_writes():
+    shape = (100, 100)
+    block = compressedBlockStore.create_block(shape, numpy.uint8, (5, 5), codec="zlib")
+    block.write(((0, 0), shape), numpy.ones(shape, dtype=numpy.uint8))
+
+    def write():
+        for value in range(2, 20):
+            block.write(((0, 0), shape), numpy.full(shape, value, dtype=numpy.uint8))
+
+    num_workers = Request.global_thread_pool.num_workers
+    Request.reset_thread_pool(4)
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        while writer.is_alive():
+            # All chunks of a read come from the same write
+            assert len(numpy.unique(block.read_all())) == 1
+    finally:
+        writer.join()
+        Request.reset_thread_pool(num_workers)
+
+
+def test_configure():
+    default = compressedBlockStore.default_codec()
+    compressedBlockStore.configure()
+    assert compressedBlockStore.default_codec() == default
+
+    blosc = pytest.importorskip("blosc")
+    previous = blosc.set_releasegil(False)
+    try:
+        compressedBlockStore.configure(release_gil=True)
+        assert blosc.set_releasegil(False)
+    finally:
+        blosc.set_releasegil(previous)
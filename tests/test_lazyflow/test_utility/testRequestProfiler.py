@@ -0,0 +1,117 @@
+import json
+import multiprocessing
+
+import greenlet
+import numpy
+import pytest
+
+from lazyflow.graph import Graph
+from lazyflow.operator import Operator
+from lazyflow.operators import OpArrayPiper
+from lazyflow.request import Request
+from lazyflow.utility import requestProfiler
+
+
+@pytest.fixture
+def profiler():
+    assert not requestProfiler.is_running()
+    yield requestProfiler
+    requestProfiler.stop()
+
+
+@pytest.fixture
+def pipeline():
+    graph = Graph()
+    op1 = OpArrayPiper(graph=graph)
+    op2 = OpArrayPiper(graph=graph)
+    op2.Input.connect(op1.Output)
+    op1.Input.setValue(numpy.zeros((100, 100), dtype=numpy.uint8))
+    return op2
+
+
+def test_records(profiler, pipeline):
+    original = Operator.call_execute
+    profiler.start()
+    assert Operator.call_execute is not original
+    pipeline.Output[:50, :].wait()
+    profile = profiler.stop()
+    assert Operator.call_execute is original
+    assert not profiler.is_running()
+
+    assert len(profile.records) == 2
+    for record in profile.records:
+        assert record.operator_type == "OpArrayPiper"
+        assert record.slot_name == "Output"
+        assert record.nbytes == 50 * 100
+        assert record.wall >= 0
+
+    totals = profile.operator_totals()
+    assert totals[("OpArrayPiper", "Output")]["calls"] == 2
+    assert "OpArrayPiper.Output" in profile.operator_table()
+
+    # Nothing is recorded after the profiler was stopped
+    pipeline.Output[:].wait()
+    assert len(profile.records) == 2
+
+
+def test_write(profiler, pipeline, tmp_path):
+    path = str(tmp_path / "trace.json")
+    profiler.start(path)
+    with pytest.raises(RuntimeError):
+        profiler.start()
+    pipeline.Output[:].wait()
+    profiler.stop()
+
+    with open(path) as f:
+        trace = json.load(f)
+    events = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+    assert len(events) == 2
+    assert all(e["args"]["bytes"] == 100 * 100 for e in events)
+    assert (tmp_path / "trace.operators.txt").exists()
+
+
+def test_start_from_env(profiler, monkeypatch, tmp_path):
+    monkeypatch.delenv(requestProfiler.ENV_VAR, raising=False)
+    requestProfiler.start_from_env()
+    assert not requestProfiler.is_running()
+
+    monkeypatch.setenv(requestProfiler.ENV_VAR, str(tmp_path / "trace.json"))
+    requestProfiler.start_from_env()
+    assert requestProfiler.is_running()
+
+
+def test_start_from_env_in_child_process(profiler, monkeypatch, tmp_path):
+    monkeypatch.setenv(requestProfiler.ENV_VAR, str(tmp_path / "trace.json"))
+    monkeypatch.setattr(multiprocessing.current_process(), "name", "SpawnProcess-1")
+    requestProfiler.start_from_env()
+    assert not requestProfiler.is_running()
+
+
+def test_stop_restores_trace(profiler, pipeline):
+    previous_trace = greenlet.gettrace()
+    profiler.start()
+    pipeline.Output[:].wait()  # executed directly in this thread
+    assert greenlet.gettrace() is not previous_trace
+    profiler.stop()
+    assert greenlet.gettrace() is previous_trace
+
+
+def test_worker_idle_time(profiler, pipeline):
+    num_workers = Request.global_thread_pool.num_workers
+    Request.reset_thread_pool(1)
+    try:
+        profiler.start()
+        # The worker waits for the second request after it finished the first one.
+        for _ in range(2):
+            request = Request(pipeline.Output[:].wait)
+            request.submit()
+            request.wait()
+        profile = profiler.stop()
+    finally:
+        Request.reset_thread_pool(num_workers)
+
+    assert len(profile.idle_records) >= 1
+    assert all(name == "Worker #0" and duration >= 0 for name, _, duration in profile.idle_records)
+    assert "waited" in profile.operator_table()
+    idle_events = [e for e in profile.chrome_trace()["traceEvents"] if e["name"] == "idle"]
+    assert len(idle_events) == len(profile.idle_records)
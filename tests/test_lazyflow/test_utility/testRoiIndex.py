@@ -0,0 +1,103 @@
+import itertools
+import threading
+
+import numpy
+
+from lazyflow.roi import containing_rois, getIntersection
+from lazyflow.utility.roiIndex import RoiIndex
+
+
+def _random_rois(n, shape=(200, 200, 50), max_extent=40, seed=0):
+    rng = numpy.random.RandomState(seed)
+    rois = set()
+    while len(rois) < n:
+        start = tuple(int(rng.randint(0, s - 1)) for s in shape)
+        stop = tuple(int(min(s, a + rng.randint(1, max_extent))) for a, s in zip(start, shape))
+        rois.add((start, stop))
+    return sorted(rois)
+
+
+def test_find_containing_matches_linear_scan():
+    rois = _random_rois(300)
+    index = RoiIndex()
+    for roi in rois:
+        index.add(roi)
+    assert len(index) == len(rois)
+
+    for query in _random_rois(300, max_extent=10, seed=1):
+        expected = {(tuple(a), tuple(b)) for a, b in containing_rois(rois, query).tolist()}
+        found = index.find_containing(query)
+        if expected:
+            assert found in expected
+        else:
+            assert found is None
+
+
+def test_intersecting_matches_linear_scan():
+    rois = _random_rois(300)
+    index = RoiIndex()
+    for roi in rois:
+        index.add(roi)
+
+    for query in _random_rois(50, max_extent=100, seed=2):
+        expected = {roi for roi in rois if getIntersection(roi, query, assertIntersect=False) is not None}
+        assert index.intersecting(query) == expected
+
+
+def test_remove_and_oversized():
+    index = RoiIndex(max_cells_per_roi=4)
+    tiles = [((x, y), (x + 10, y + 10)) for x, y in itertools.product(range(0, 100, 10), repeat=2)]
+    for tile in tiles:
+        index.add(tile)
+
+    # Spans far more than 4 cells, so it is stored outside the grid
+    big = ((0, 0), (100, 100))
+    index.add(big)
+    assert index.find_containing(((5, 5), (15, 15))) == big
+    assert big in index.intersecting(((95, 95), (96, 96)))
+
+    index.remove(big)
+    assert big not in index
+    assert index.find_containing(((5, 5), (15, 15))) is None
+    assert index.find_containing(((11, 11), (15, 15))) == ((10, 10), (20, 20))
+
+    for tile in tiles:
+        index.remove(tile)
+    assert len(index) == 0
+    assert index.intersecting(((0, 0), (100, 100))) == set()
+
+
+def test_cell_shape():
+    index = RoiIndex(cell_shape=(10, 10))
+    # A smaller first roi doesn't determine the grid
+    index.add(((0, 0), (2, 2)))
+    assert index.cell_shape == (10, 10)
+
+    index = RoiIndex()
+    index.add(((0, 0), (2, 3)))
+    assert index.cell_shape == (2, 3)
+
+
+def test_lookups_during_modifications():
+    tiles = [((x, y), (x + 10, y + 10)) for x, y in itertools.product(range(0, 200, 10), repeat=2)]
+    index = RoiIndex(cell_shape=(10, 10))
+    for tile in tiles[::2]:
+        index.add(tile)
+
+    def modify():
+        for _ in range(20):
+            for tile in tiles[1::2]:
+                index.add(tile)
+            for tile in tiles[1::2]:
+                index.remove(tile)
+
+    writer = threading.Thread(target=modify)
+    writer.start()
+    try:
+        while writer.is_alive():
+            # The tiles that are never modified are always found
+            for tile in tiles[:40:2]:
+                assert index.find_containing(((tile[0][0] + 1, tile[0][1] + 1), tile[1])) == tile
+            index.intersecting(((0, 0), (200, 200)))
+    finally:
+        writer.join()
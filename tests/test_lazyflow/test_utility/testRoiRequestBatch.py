@@ -29,6 +29,7 @@ import threading
 from lazyflow.graph import Graph
 from lazyflow.roi import getIntersectingBlocks, getBlockBounds, roiToSlice
 from lazyflow.operators import OpArrayPiper
+from lazyflow.request import Request, PriorityClass
 
 from lazyflow.utility import RoiRequestBatch
 
@@ -107,3 +108,23 @@ class TestRoiRequestBatch(object):
         #        This only tests one of them (in the notify_finished() handler)
         with pytest.raises(SpecialException):
             batch.execute()
+
+    def testPriorityClass(self):
+        priority_classes = []
+
+        class OpRecordPriorityClass(OpArrayPiper):
+            def execute(self, slot, subindex, roi, result):
+                priority_classes.append(Request._current_request().priority_class)
+                return super().execute(slot, subindex, roi, result)
+
+        op = OpRecordPriorityClass(graph=Graph())
+        op.Input.setValue(numpy.zeros((100, 100)))
+        rois = [((0, i), (100, i + 10)) for i in range(0, 100, 10)]
+
+        # By default, the requests get the usual class (INTERACTIVE outside of requests)
+        RoiRequestBatch(op.Output, iter(rois), batchSize=3).execute()
+        assert priority_classes == [PriorityClass.INTERACTIVE] * 10
+
+        del priority_classes[:]
+        RoiRequestBatch(op.Output, iter(rois), batchSize=3, priorityClass=PriorityClass.BATCH).execute()
+        assert priority_classes == [PriorityClass.BATCH] * 10
@@ -0,0 +1,75 @@
+import os
+
+import numpy
+import pytest
+
+from lazyflow.utility import spillStore
+from lazyflow.utility.spillStore import SpillStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SpillStore(str(tmp_path / "spill"), max_bytes=3000)
+    yield s
+    s.close()
+
+
+def test_roundtrip(store):
+    data = numpy.arange(100, dtype=numpy.float32).reshape(10, 10)
+    assert store.put(0, ((0, 0), (10, 10)), data, cost=1.5)
+    assert store.used_bytes == data.nbytes
+    assert len(os.listdir(store.directory)) == 1
+
+    restored, cost = store.get(0, ((0, 0), (10, 10)))
+    assert isinstance(restored, numpy.memmap)
+    assert not restored.flags.writeable
+    assert (restored == data).all()
+    assert cost == 1.5
+
+    # Reading a block back removes it from the store
+    assert store.get(0, ((0, 0), (10, 10))) is None
+    assert store.used_bytes == 0
+
+    # The file is deleted once the memory map is released
+    view = restored[2:5]
+    del restored
+    assert len(os.listdir(store.directory)) == 1
+    del view
+    assert os.listdir(store.directory) == []
+
+
+def test_budget(store):
+    block = numpy.zeros(1000, dtype=numpy.uint8)
+    for i in range(5):
+        assert store.put(0, i, block)
+    assert store.used_bytes <= 3000
+    # The oldest blocks were dropped
+    assert sorted(store.keys(0)) == [2, 3, 4]
+
+    # Blocks that exceed the budget on their own, object arrays and masked arrays are never spilled
+    assert not store.put(0, "big", numpy.zeros(4000, dtype=numpy.uint8))
+    assert not store.put(0, "obj", numpy.array([None, None]))
+    assert not store.put(0, "masked", numpy.ma.masked_array(block))
+
+
+def test_namespaces(store):
+    block = numpy.ones(10, dtype=numpy.uint8)
+    store.put(0, "a", block)
+    store.put(1, "a", 2 * block)
+    store.put(1, "b", block)
+
+    store.discard(1, "b")
+    assert store.keys(1) == ["a"]
+
+    store.discard_namespace(0)
+    assert store.get(0, "a") is None
+    assert (store.get(1, "a")[0] == 2).all()
+
+
+def test_configure(tmp_path):
+    try:
+        spillStore.configure(str(tmp_path), max_bytes=1000)
+        assert spillStore.getSpillStore().directory == str(tmp_path)
+    finally:
+        spillStore.configure(max_bytes=0)
+    assert spillStore.getSpillStore() is None
@@ -0,0 +1,122 @@
+import threading
+
+import h5py
+import numpy
+import pytest
+
+from lazyflow.utility.io_util import multiprocessHdf5File
+from lazyflow.utility.io_util.multiprocessHdf5File import MultiProcessHdf5File
+
+
+@pytest.fixture
+def reader_pool():
+    multiprocessHdf5File.configure(2)
+    yield
+    multiprocessHdf5File.configure(0)
+
+
+@pytest.fixture
+def h5_path(tmp_path):
+    path = str(tmp_path / "data.h5")
+    with h5py.File(path, "w") as f:
+        f.create_dataset("group/data", data=numpy.indices((20, 30, 40)).sum(0).astype(numpy.uint32), compression="gzip")
+    return path
+
+
+def test_read(reader_pool, h5_path):
+    expected = numpy.indices((20, 30, 40)).sum(0).astype(numpy.uint32)
+    with MultiProcessHdf5File(h5_path, "r") as f:
+        assert f.keys() == ["group"]
+        assert "data" in f["group"]
+
+        dataset = f["group/data"]
+        assert dataset.shape == expected.shape
+        assert dataset.dtype == expected.dtype
+        assert (dataset[...] == expected).all()
+        assert (dataset[2:5, :, 3] == expected[2:5, :, 3]).all()
+        assert dataset[3:3].shape == (0, 30, 40)
+
+        out = numpy.zeros((30, 40), dtype=numpy.uint32)
+        dataset.read_direct(out, numpy.s_[4])
+        assert (out == expected[4]).all()
+
+
+def test_parallel_reads(reader_pool, h5_path):
+    expected = numpy.indices((20, 30, 40)).sum(0).astype(numpy.uint32)
+    failures = []
+
+    with MultiProcessHdf5File(h5_path, "r") as f:
+        dataset = f["group/data"]
+
+        def read_slices(i):
+            for z in range(i, 20, 8):
+                if not (dataset[z, 5:25] == expected[z, 5:25]).all():
+                    failures.append(z)
+
+        threads = [threading.Thread(target=read_slices, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert not failures
+
+
+def test_read_error(reader_pool, h5_path):
+    with MultiProcessHdf5File(h5_path, "r") as f:
+        dataset = f["group/data"]
+        with pytest.raises(Exception):
+            dataset[15:25]
+
+        # The reader processes survive errors
+        assert (dataset[0:2] == numpy.indices((2, 30, 40)).sum(0)).all()
+
+
+def test_close(reader_pool, h5_path):
+    with MultiProcessHdf5File(h5_path, "r") as f:
+        f["group/data"][0:2]
+
+    # The reader processes released the file, so it can be written and replaced.
+    with h5py.File(h5_path, "a") as f:
+        f["group/data"][0] = 0
+    with h5py.File(h5_path, "w") as f:
+        f.create_dataset("group/data", data=numpy.ones((20, 30, 40), dtype=numpy.uint32), compression="gzip")
+
+    with MultiProcessHdf5File(h5_path, "r") as f:
+        assert (f["group/data"][0:2] == 1).all()
+
+
+def test_interrupted_read(reader_pool, h5_path):
+    class Interrupted(Exception):
+        pass
+
+    class InterruptedConnection(object):
+        def __init__(self, connection):
+            self._connection = connection
+
+        def send(self, request):
+            self._connection.send(request)
+
+        def recv(self):
+            raise Interrupted()
+
+        def close(self):
+            self._connection.close()
+
+    # The next read is interrupted before it receives its reply.
+    pool = multiprocessHdf5File.get_reader_pool()
+    readers = [pool._idle.get() for _ in range(2)]
+    process, connection = readers[0]
+    readers[0] = (process, InterruptedConnection(connection))
+    for reader in readers:
+        pool._idle.put(reader)
+
+    expected = numpy.indices((20, 30, 40)).sum(0).astype(numpy.uint32)
+    with MultiProcessHdf5File(h5_path, "r") as f:
+        dataset = f["group/data"]
+        with pytest.raises(Interrupted):
+            dataset[0]
+
+        # The unread reply must not be returned to later reads.
+        for z in range(20):
+            assert (dataset[z] == expected[z]).all()